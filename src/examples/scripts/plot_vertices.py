@@ -52,10 +52,10 @@ def get_subcorticals(mmvt, vertices_data):
             continue
         subcortical_faces_verts_fname = op.join(
             mu.get_user_fol(), 'subcortical', '{}_faces_verts.npy'.format(subcortical))
-        if not op.isfile(subcortical_faces_verts_fname):
+        if not mu.faces_verts_exist(subcortical_faces_verts_fname):
             print('plot_vertices: Can\'t find {}!'.format(subcortical_faces_verts_fname))
             continue
-        subcortical_faces_verts = np.load(subcortical_faces_verts_fname)
+        subcortical_faces_verts = mu.load_faces_verts_lookup(subcortical_faces_verts_fname)
         subcorticals.append((subcortical, subcortical_faces_verts, obj))
     return subcorticals
 
@@ -5,6 +5,7 @@ import numpy as np
 from itertools import cycle
 
 from src.utils import utils
+from src.mmvt_addon import streaming_utils as stu
 
 LINKS_DIR = utils.get_links_dir()
 MMVT_DIR = op.join(LINKS_DIR, 'mmvt')
@@ -47,42 +48,32 @@ def bind_to_multicast():
     return sock
 
 
-def broadcast_data(sock, multicast_group='239.255.43.21', port=45454, interval=0.0006):
-    import time
-    ind = 0
-    times = []
-    now = time.time()
-    while True:
-        ind += 1
-        if ind % 1000 == 0:
-            print(np.mean(times))
-            times = []
-        data_to_send = next(data)
-        # data_to_send = str(data_to_send).encode('utf-8')
-        data_to_send = ','.join([str(d) for d in data_to_send]).encode('utf-8')
-        sent = sock.sendto(data_to_send, (multicast_group, port))
-        # print('{}: sending data {}'.format(utils.get_time(), data_to_send))
-        times.append(time.time() - now)
-        now = time.time()
-
-        time.sleep(interval)
+def broadcast_data(sock, data, multicast_group='239.255.43.21', port=45454, interval=0.0006, samples_per_packet=1,
+                   dtype=np.float32):
+    send_data(sock, (multicast_group, port), data, interval, samples_per_packet, dtype)
 
 
-def send_data(sock, server_address, data, interval=0.0006):
+def send_data(sock, server_address, data, interval=0.0006, samples_per_packet=1, dtype=np.float32):
+    # Sends the data in the MMVT binary packets format (see src/mmvt_addon/streaming_utils.py),
+    # samples_per_packet samples of all the channels in each packet
     import time
-    ind = 0
+    packet_buffer = bytearray(stu.MAX_PACKET_SIZE)
+    packet_data = None
+    seq = 0
     times = []
     now = time.time()
     while True:
-        ind += 1
-        if ind % 1000 == 0:
+        for sample_ind in range(samples_per_packet):
+            sample = next(data)
+            if packet_data is None:
+                packet_data = np.zeros((len(sample), samples_per_packet), dtype=dtype)
+            packet_data[:, sample_ind] = sample
+        packet_size = stu.pack_packet_into(packet_buffer, packet_data, seq, dtype)
+        sock.sendto(memoryview(packet_buffer)[:packet_size], server_address)
+        seq += 1
+        if seq % 1000 == 0:
             print(np.mean(times))
             times = []
-        data_to_send = next(data)
-        # data_to_send = str(data_to_send).encode('utf-8')
-        data_to_send = ','.join([str(d) for d in data_to_send]).encode('utf-8')
-        sock.sendto(data_to_send, server_address)
-        # print('{}: sending data {}'.format(utils.get_time(), data_to_send))
         times.append(time.time() - now)
         now = time.time()
 
@@ -97,5 +88,5 @@ if __name__ == '__main__':
     port = 45454
     multicast_group = '239.255.43.21'
     sock = bind_to_multicast()
-    # broadcast_data(sock, multicast_group, port)
-    send_data(sock, port, data)
\ No newline at end of file
+    # broadcast_data(sock, data, multicast_group, port)
+    send_data(sock, (multicast_group, port), data)
\ No newline at end of file
@@ -0,0 +1,106 @@
+import time
+import argparse
+import numpy as np
+from src.utils import utils
+from src.utils import args_utils as au
+from src.utils import connectivity_utils as cu
+
+
+# The per pair loops implementations (before connectivity_utils), as the reference
+
+def loop_pli(data):
+    from scipy.signal import hilbert
+    data_hil = hilbert(data)
+    channels_num = data.shape[0]
+    m = np.zeros((channels_num, channels_num))
+    for i in range(channels_num):
+        for j in range(channels_num):
+            if i < j:
+                m[i, j] = abs(np.mean(np.sign(np.imag(data_hil[i] / data_hil[j]))))
+    return m + m.T
+
+
+def loop_wpli(data):
+    from scipy.signal import hilbert
+    data_hil = hilbert(data)
+    channels_num = data.shape[0]
+    m = np.zeros((channels_num, channels_num))
+    for i in range(channels_num):
+        for j in range(channels_num):
+            if i < j:
+                imag_csd = np.imag(data_hil[i] * np.conj(data_hil[j]))
+                m[i, j] = abs(np.mean(imag_csd)) / np.mean(np.abs(imag_csd))
+    return m + m.T
+
+
+def loop_corr(data):
+    conn = np.corrcoef(data)
+    np.fill_diagonal(conn, 0)
+    return conn
+
+
+def loop_mi(conn_w):
+    nch = conn_w.shape[0]
+    conn = np.zeros((nch, nch))
+    for i in range(nch):
+        for j in range(nch):
+            if i < j:
+                conn[i, j] = -0.5 * np.log(1 - conn_w[i, j] ** 2)
+    return conn + conn.T
+
+
+def batched_corr(windows_data):
+    conn = cu.corr_windows(windows_data)
+    conn[:, np.arange(conn.shape[1]), np.arange(conn.shape[1])] = 0
+    return conn
+
+
+def batched_mi(windows_data):
+    return cu.mi_from_corr(batched_corr(windows_data))
+
+
+MEASURES = dict(
+    pli=(loop_pli, cu.pli_windows),
+    wpli=(loop_wpli, cu.wpli_windows),
+    corr=(loop_corr, batched_corr),
+    mi=(lambda data: loop_mi(loop_corr(data)), batched_mi))
+
+
+def compare_loops_and_batched(channels_nums=(64, 128, 256, 512), windows_nums=(1, 10, 50), window_length=500,
+                              measures=('pli', 'wpli', 'corr', 'mi'), loop_windows_num=2,
+                              block_mb=cu.DEFAULT_BLOCK_MB):
+    # The loops are timed on the first loop_windows_num windows, and extrapolated to all the windows
+    print('{:<6} {:>8} {:>8} {:>14} {:>12} {:>9} {:>10}'.format(
+        'method', 'channels', 'windows', 'loop (s, est)', 'batched (s)', 'speedup', 'max diff'))
+    for channels_num in channels_nums:
+        for windows_num in windows_nums:
+            data = np.random.randn(channels_num, window_length * (windows_num + 1) // 2)
+            windows_data = cu.sliding_windows(data, window_length, window_length // 2, windows_num)
+            for measure in measures:
+                loop_func, batched_func = MEASURES[measure]
+                loop_windows = windows_data[:min(loop_windows_num, windows_num)]
+                now = time.time()
+                loop_conn = np.array([loop_func(window) for window in loop_windows])
+                loop_time = (time.time() - now) * windows_num / len(loop_windows)
+                now = time.time()
+                if measure in ('pli', 'wpli'):
+                    conn = batched_func(windows_data, block_mb)
+                else:
+                    conn = batched_func(windows_data)
+                batched_time = time.time() - now
+                max_diff = np.nanmax(np.abs(conn[:len(loop_windows)] - loop_conn))
+                print('{:<6} {:>8} {:>8} {:>14.3f} {:>12.3f} {:>9.1f} {:>10.2e}'.format(
+                    measure, channels_num, windows_num, loop_time, batched_time, loop_time / batched_time, max_diff))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MMVT connectivity kernels benchmark')
+    parser.add_argument('--channels_nums', required=False, default='64,128,256,512', type=au.int_arr_type)
+    parser.add_argument('--windows_nums', required=False, default='1,10,50', type=au.int_arr_type)
+    parser.add_argument('--window_length', required=False, default=500, type=int)
+    parser.add_argument('--measures', required=False, default='pli,wpli,corr,mi', type=au.str_arr_type)
+    parser.add_argument('--loop_windows_num', required=False, default=2, type=int)
+    parser.add_argument('--block_mb', required=False, default=cu.DEFAULT_BLOCK_MB, type=float)
+    args = utils.Bag(au.parse_parser(parser))
+    compare_loops_and_batched(args.channels_nums, args.windows_nums, args.window_length, args.measures,
+                              args.loop_windows_num, args.block_mb)
@@ -0,0 +1,89 @@
+import os.path as op
+import time
+import tempfile
+import shutil
+import argparse
+import resource
+import multiprocessing
+import numpy as np
+from src.utils import utils
+from src.utils import args_utils as au
+
+
+class BenchLabel(object):
+    def __init__(self, name, vertices):
+        self.name, self.vertices = name, vertices
+
+
+def create_random_surface_image(fname, vertices_num, times_num, labels_num):
+    # A (V x 1 x 1 x T) float32 image, and random labels that cover all the vertices
+    import nibabel as nib
+    x = np.lib.format.open_memmap(fname + '.tmp.npy', mode='w+', dtype=np.float32, shape=(vertices_num, 1, 1, times_num))
+    block_len = max(1, (64 * 1024 ** 2) // (vertices_num * 4))
+    for t_from in range(0, times_num, block_len):
+        t_to = min(t_from + block_len, times_num)
+        x[:, 0, 0, t_from:t_to] = np.random.randn(vertices_num, t_to - t_from) + 100
+    nib.save(nib.Nifti1Image(x, np.eye(4)), fname)
+    del x
+    labels_ids = np.random.randint(0, labels_num, vertices_num)
+    return [BenchLabel('label{}'.format(ind), np.where(labels_ids == ind)[0]) for ind in range(labels_num)]
+
+
+def _run_mode(fname, labels, measures, memory_mb, queue):
+    import nibabel as nib
+    from src.utils import labels_utils as lu
+    from src.utils import fmri_streaming_utils as fsu
+    now = time.time()
+    x = fsu.ImageTimeSeries(fname, memory_mb) if memory_mb > 0 else nib.load(fname).get_data()
+    data = lu.calc_time_series_per_labels(
+        x, labels, measures, chunk_mb=memory_mb if memory_mb > 0 else fsu.DEFAULT_MEMORY_MB)
+    # ru_maxrss is in KB on linux
+    queue.put((time.time() - now, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+               {m: d[0] for m, d in data.items()}))
+
+
+def run_mode(fname, labels, measures, memory_mb):
+    # Runs in a new process, to measure its own peak RSS
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_mode, args=(fname, labels, measures, memory_mb, queue))
+    proc.start()
+    res = queue.get()
+    proc.join()
+    return res
+
+
+def compare_in_memory_and_streaming(fmri_fname='', vertices_num=160000, times_num=1200, labels_num=70,
+                                    measures=('mean', 'cv'), memory_mbs=(64, 256)):
+    temp_fol = tempfile.mkdtemp()
+    try:
+        if fmri_fname == '':
+            fmri_fname = op.join(temp_fol, 'fmri.nii')
+            labels = create_random_surface_image(fmri_fname, vertices_num, times_num, labels_num)
+        else:
+            import nibabel as nib
+            labels_ids = np.random.randint(0, labels_num, nib.load(fmri_fname).shape[0])
+            labels = [BenchLabel('label{}'.format(ind), np.where(labels_ids == ind)[0]) for ind in range(labels_num)]
+        print('{:<16} {:>10} {:>14} {:>10}'.format('mode', 'time (s)', 'peak RSS (MB)', 'max diff'))
+        in_memory_time, in_memory_rss, in_memory_data = run_mode(fmri_fname, labels, measures, 0)
+        print('{:<16} {:>10.2f} {:>14.1f} {:>10}'.format('in memory', in_memory_time, in_memory_rss, '-'))
+        for memory_mb in memory_mbs:
+            streaming_time, streaming_rss, streaming_data = run_mode(fmri_fname, labels, measures, memory_mb)
+            max_diff = max([np.nanmax(np.abs(streaming_data[m] - in_memory_data[m])) for m in measures])
+            print('{:<16} {:>10.2f} {:>14.1f} {:>10.2e}'.format(
+                'streaming {}MB'.format(memory_mb), streaming_time, streaming_rss, max_diff))
+    finally:
+        shutil.rmtree(temp_fol)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MMVT 4D fMRI streaming memory benchmark')
+    parser.add_argument('--fmri_fname', required=False, default='')
+    parser.add_argument('--vertices_num', required=False, default=160000, type=int)
+    parser.add_argument('--times_num', required=False, default=1200, type=int)
+    parser.add_argument('--labels_num', required=False, default=70, type=int)
+    parser.add_argument('--measures', required=False, default='mean,cv', type=au.str_arr_type)
+    parser.add_argument('--memory_mbs', required=False, default='64,256', type=au.int_arr_type)
+    args = utils.Bag(au.parse_parser(parser))
+    compare_in_memory_and_streaming(args.fmri_fname, args.vertices_num, args.times_num, args.labels_num,
+                                    args.measures, args.memory_mbs)
@@ -29,11 +29,13 @@ from mne.source_estimate import _make_stc, VolSourceEstimate
 # from surfer import viz
 
 import utils
+from src.utils import morph_utils as mu
 
 COMP_ROOT = utils.get_exisiting_dir(('/homes/5/npeled/space3', '/home/noam'))
 LOCAL_SUBJECTS_DIR = op.join(COMP_ROOT, 'subjects')
 REMOTE_ROOT_DIR = '/autofs/space/lilli_001/users/DARPA-MEG/ecr'
 LOCAL_ROOT_DIR = op.join(COMP_ROOT, 'MEG/ECR/group')
+MORPH_OPERATORS_DIR = op.join(LOCAL_ROOT_DIR, 'morph_operators')
 BLENDER_DIR = op.join(COMP_ROOT, 'visualization_blender')
 SUBJECTS_DIR = '/autofs/space/lilli_001/users/DARPA-MEG/freesurfs'
 os.environ['SUBJECTS_DIR'] = LOCAL_SUBJECTS_DIR
@@ -217,29 +219,30 @@ def morph_stcs_to_fsaverage(events_id, stc_per_epoch=False, inverse_method='dSPM
                     local_stc_file_name = op.join(LOCAL_ROOT_DIR, 'stc', '{}_{}_{}'.format(subject, cond_name, inverse_method))
                     if op.isfile('{}-stc.h5'.format(local_stc_file_name)):
                         stc = mne.read_source_estimate(local_stc_file_name)
-                        stc_morphed = mne.morph_data(subject, 'fsaverage', stc, grade=5, smooth=20,
-                            subjects_dir=subjects_dir)
+                        stc_morphed = mu.morph_stc(stc, subject, 'fsaverage', grade=5, smooth=20,
+                            subjects_dir=subjects_dir, cache_fol=MORPH_OPERATORS_DIR)
                         stc_morphed.save(morphed_stc_file_name, ftype='h5')
                     else:
                         print("can't find stc file for {}, {}".format(subject, cond_name))
             else:
                 stcs = glob.glob(op.join(LOCAL_ROOT_DIR, 'stc_epochs', '{}_{}_*_{}-stc.h5'.format(subject, cond_name, inverse_method)))
-                params = [(subject, cond_name, stc_file_name, inverse_method, subjects_dir) for stc_file_name in stcs]
-                utils.parallel_run(pool, _morphed_epochs_files, params, n_jobs)
-
-
-def _morphed_epochs_files(params):
-    subject, cond_name, stc_file_name, inverse_method, subjects_dir = params
-    print('morphing {}'.format(stc_file_name))
-    epoch_id = utils.namebase(stc_file_name).split('_')[2]
-    morphed_stc_file_name = op.join(LOCAL_ROOT_DIR, 'stc_epochs_morphed',  '{}_{}_{}_{}'.format(subject, cond_name, epoch_id, inverse_method))
-    if not op.isfile('{}-stc.h5'.format(morphed_stc_file_name)):
-        stc = mne.read_source_estimate(stc_file_name)
-        stc_morphed = mne.morph_data(subject, 'fsaverage', stc, grade=5, smooth=20,
-            subjects_dir=subjects_dir)
-        stc_morphed.save(morphed_stc_file_name, ftype='h5')
-    else:
-        print('{} {} {} already morphed'.format(subject, cond_name, epoch_id))
+                _morphed_epochs_files(subject, cond_name, stcs, inverse_method, subjects_dir)
+
+
+def _morphed_epochs_files(subject, cond_name, stcs_file_names, inverse_method, subjects_dir):
+    # All the epochs are morphed with the same (cached) operator, in batches of one sparse matmul
+    stcs_to_morph, morphed_stcs_file_names = [], []
+    for stc_file_name in stcs_file_names:
+        epoch_id = utils.namebase(stc_file_name).split('_')[2]
+        morphed_stc_file_name = op.join(LOCAL_ROOT_DIR, 'stc_epochs_morphed',  '{}_{}_{}_{}'.format(subject, cond_name, epoch_id, inverse_method))
+        if not op.isfile('{}-stc.h5'.format(morphed_stc_file_name)):
+            stcs_to_morph.append(stc_file_name)
+            morphed_stcs_file_names.append(morphed_stc_file_name)
+        else:
+            print('{} {} {} already morphed'.format(subject, cond_name, epoch_id))
+    print('morphing {} epochs of {} {}'.format(len(stcs_to_morph), subject, cond_name))
+    mu.morph_stcs_files(stcs_to_morph, morphed_stcs_file_names, subject, 'fsaverage', grade=5, smooth=20,
+                        subjects_dir=subjects_dir, cache_fol=MORPH_OPERATORS_DIR, ftype='h5')
 
 
 def calc_average_hc_epochs_stc(events_id, inverse_method='dSPM'):
@@ -0,0 +1,69 @@
+import os.path as op
+import glob
+import time
+import tempfile
+import shutil
+import argparse
+from collections import defaultdict
+from src.utils import utils
+from src.utils import args_utils as au
+from src.utils import preproc_utils as pu
+
+SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
+
+SURFACES_TYPES = dict(
+    pial=op.join('surf', '?h.pial.ply'),
+    inflated=op.join('surf', '?h.inflated.ply'),
+    dural=op.join('surf', '?h.dural.ply'),
+    subcortical=op.join('subcortical', '*.ply'),
+    labels=op.join('labels', '*.pial.?h', '*.ply'),
+    skull=op.join('skull', '*.ply'),
+    eeg=op.join('eeg', '*.ply'))
+
+
+def time_read(ply_fname, iterations):
+    now = time.time()
+    for _ in range(iterations):
+        verts, faces = utils.mu.read_ply_file(ply_fname, migrate=False)
+    return (time.time() - now) / iterations, verts, faces
+
+
+def compare_ascii_and_binary_loading(subject, surfaces_types=(), iterations=3, max_files_per_type=20):
+    # Writes an ascii and a binary copy of the subject's surfaces and compares their loading times
+    if len(surfaces_types) == 0:
+        surfaces_types = list(SURFACES_TYPES.keys())
+    temp_fol = tempfile.mkdtemp()
+    times = defaultdict(lambda: [0, 0, 0])
+    try:
+        for surf_type in surfaces_types:
+            ply_fnames = sorted(glob.glob(op.join(MMVT_DIR, subject, SURFACES_TYPES[surf_type])))
+            for ply_fname in ply_fnames[:max_files_per_type]:
+                verts, faces = utils.mu.read_ply_file(ply_fname, migrate=False)
+                ascii_fname = op.join(temp_fol, 'ascii.ply')
+                binary_fname = op.join(temp_fol, 'binary.ply')
+                utils.write_ply_file(verts, faces, ascii_fname, binary=False)
+                utils.write_ply_file(verts, faces, binary_fname, binary=True)
+                ascii_time, _, _ = time_read(ascii_fname, iterations)
+                binary_time, binary_verts, binary_faces = time_read(binary_fname, iterations)
+                if not (binary_faces == faces).all() or abs(binary_verts - verts).max() > 1e-3:
+                    print('{}: The binary surface is different from the original one!'.format(ply_fname))
+                times[surf_type][0] += 1
+                times[surf_type][1] += ascii_time
+                times[surf_type][2] += binary_time
+    finally:
+        shutil.rmtree(temp_fol)
+    print('{:<12} {:>6} {:>10} {:>10} {:>8}'.format('surface', 'files', 'ascii (s)', 'binary (s)', 'speedup'))
+    for surf_type, (files_num, ascii_time, binary_time) in times.items():
+        print('{:<12} {:>6} {:>10.3f} {:>10.3f} {:>7.1f}x'.format(
+            surf_type, files_num, ascii_time, binary_time, ascii_time / binary_time if binary_time > 0 else 0))
+    return times
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MMVT ply loading benchmark')
+    parser.add_argument('-s', '--subject', help='subject name', required=True)
+    parser.add_argument('--surfaces_types', required=False, default='', type=au.str_arr_type)
+    parser.add_argument('--iterations', required=False, default=3, type=int)
+    parser.add_argument('--max_files_per_type', required=False, default=20, type=int)
+    args = utils.Bag(au.parse_parser(parser))
+    compare_ascii_and_binary_loading(args.subject, args.surfaces_types, args.iterations, args.max_files_per_type)
@@ -0,0 +1,223 @@
+import os
+import os.path as op
+import json
+import glob
+import threading
+import traceback
+import numpy as np
+
+# The activity store: one memory-mapped array per activity map folder (hemisphere / condition), instead of a
+# t{t}.npy file per time point. For the activity map folder 'activity_map_rh' the store is:
+#   activity_map_rh.dat         the data, time-major (T x V), raw little-endian float32 or int16
+#   activity_map_rh.verts.dat   optional vertex-major copy (V x T), for fast time course reads
+#   activity_map_rh.json        the header: shape, dtype, scale and layouts
+# When the dtype is int16 the values are quantized, value = stored * scale.
+
+STORE_VERSION = 1
+DATA_EXT, VERTS_EXT, HEADER_EXT = '.dat', '.verts.dat', '.json'
+STORE_DTYPES = {'float32': np.dtype('<f4'), 'int16': np.dtype('<i2')}
+INT16_MAX = 32767
+WRITE_CHUNK_MB = 64
+
+_stores, _stores_lock = {}, threading.Lock()
+
+
+def get_store_base(fol):
+    return fol.rstrip('/').rstrip(os.sep)
+
+
+def get_store_fnames(fol):
+    base = get_store_base(fol)
+    return base + DATA_EXT, base + VERTS_EXT, base + HEADER_EXT
+
+
+def store_exists(fol):
+    data_fname, _, header_fname = get_store_fnames(fol)
+    return op.isfile(data_fname) and op.isfile(header_fname)
+
+
+def load_header(fol):
+    _, _, header_fname = get_store_fnames(fol)
+    with open(header_fname, 'r') as f:
+        return json.load(f)
+
+
+def _chunk_len(V, itemsize):
+    return max(1, int(WRITE_CHUNK_MB * 1024 ** 2) // max(V * itemsize, 1))
+
+
+def save_activity_store(data, fol, dtype='float32', vertex_major=False, scale=None):
+    # data: (V, T), the same orientation as the stc / surface data (data[:, t] is the frame t).
+    # data can be a memmap, it is copied in time chunks.
+    if dtype not in STORE_DTYPES:
+        raise Exception('save_activity_store: dtype should be one of {}'.format(list(STORE_DTYPES.keys())))
+    data = data.reshape((-1, 1)) if data.ndim == 1 else data
+    V, T = data.shape
+    store_dtype = STORE_DTYPES[dtype]
+    if dtype == 'int16':
+        if scale is None:
+            max_abs = float(np.nanmax(np.abs(data)))
+            scale = max_abs / INT16_MAX if max_abs > 0 else 1.0
+    else:
+        scale = 1.0
+    data_fname, verts_fname, header_fname = get_store_fnames(fol)
+    delete_store(fol)
+    chunk_len = _chunk_len(V, 4)
+    out = np.memmap(data_fname, dtype=store_dtype, mode='w+', shape=(T, V))
+    for t_from in range(0, T, chunk_len):
+        t_to = min(t_from + chunk_len, T)
+        out[t_from:t_to] = _quantize(np.asarray(data[:, t_from:t_to]).T, store_dtype, scale)
+    out.flush()
+    layouts = ['time']
+    if vertex_major:
+        # The transposed copy is written from the time-major store, in vertices chunks
+        verts_out = np.memmap(verts_fname, dtype=store_dtype, mode='w+', shape=(V, T))
+        verts_chunk_len = _chunk_len(T, 4)
+        for v_from in range(0, V, verts_chunk_len):
+            v_to = min(v_from + verts_chunk_len, V)
+            verts_out[v_from:v_to] = out[:, v_from:v_to].T
+        verts_out.flush()
+        del verts_out
+        layouts.append('vertex')
+    del out
+    header = dict(version=STORE_VERSION, shape=[T, V], dtype=dtype, scale=scale, layouts=layouts)
+    with open(header_fname, 'w') as f:
+        json.dump(header, f)
+    return header
+
+
+def _quantize(x, store_dtype, scale):
+    if store_dtype.kind == 'f':
+        return x
+    return np.clip(np.rint(x / scale), -INT16_MAX, INT16_MAX)
+
+
+def delete_store(fol):
+    with _stores_lock:
+        _stores.pop(get_store_base(fol), None)
+    for fname in get_store_fnames(fol):
+        if op.isfile(fname):
+            os.remove(fname)
+
+
+class ActivityStore(object):
+    def __init__(self, fol):
+        self.fol = fol
+        self.data_fname, self.verts_fname, self.header_fname = get_store_fnames(fol)
+        self.header = load_header(fol)
+        self.T, self.V = self.header['shape']
+        self.dtype = STORE_DTYPES[self.header['dtype']]
+        self.scale = np.float32(self.header['scale'])
+        self.quantized = self.dtype.kind != 'f'
+        self.mtime = op.getmtime(self.header_fname)
+        self.data = np.memmap(self.data_fname, dtype=self.dtype, mode='r', shape=(self.T, self.V))
+        self.verts_data = None
+        if 'vertex' in self.header['layouts'] and op.isfile(self.verts_fname):
+            self.verts_data = np.memmap(self.verts_fname, dtype=self.dtype, mode='r', shape=(self.V, self.T))
+
+    @property
+    def shape(self):
+        # The shape of the original data, (V, T)
+        return self.V, self.T
+
+    def _values(self, x):
+        return x.astype(np.float32) * self.scale if self.quantized else x
+
+    def read_frame(self, t):
+        # The values of all the vertices in time t, (V, ). For float32 stores it's a view of the memmap
+        return self._values(self.data[t])
+
+    def read_frames(self, t_from=0, t_to=None):
+        # (V, t_to - t_from), like data[:, t_from:t_to] in the original orientation
+        return self._values(np.array(self.data[t_from:t_to]).T)
+
+    def read_vertex(self, vert):
+        # The time course of vert, (T, )
+        if self.verts_data is not None:
+            return self._values(np.array(self.verts_data[vert]))
+        return self._values(np.array(self.data[:, vert]))
+
+    def read_vertices(self, verts):
+        # The time courses of verts, (len(verts), T)
+        verts = np.asarray(verts)
+        if self.verts_data is not None:
+            return self._values(self.verts_data[verts])
+        out = np.empty((len(verts), self.T), dtype=self.data.dtype)
+        chunk_len = _chunk_len(self.V, self.dtype.itemsize)
+        for t_from in range(0, self.T, chunk_len):
+            t_to = min(t_from + chunk_len, self.T)
+            out[:, t_from:t_to] = self.data[t_from:t_to][:, verts].T
+        return self._values(out)
+
+
+def get_activity_store(fol):
+    # Returns the (cached) store of the activity map folder, or None if there isn't one
+    base = get_store_base(fol)
+    if not store_exists(fol):
+        with _stores_lock:
+            _stores.pop(base, None)
+        return None
+    with _stores_lock:
+        store = _stores.get(base)
+        if store is None or store.mtime != op.getmtime(store.header_fname):
+            try:
+                store = _stores[base] = ActivityStore(fol)
+            except:
+                print(traceback.format_exc())
+                print('get_activity_store: Error in reading the store of {}'.format(fol))
+                _stores.pop(base, None)
+                return None
+        return store
+
+
+def clear_activity_stores():
+    with _stores_lock:
+        _stores.clear()
+
+
+def get_frames_files(fol):
+    # The legacy t{t}.npy files of the folder, sorted by t
+    frames_files = glob.glob(op.join(fol, 't*.npy'))
+    frames_files = [f for f in frames_files if op.basename(f)[1:-len('.npy')].isdigit()]
+    return sorted(frames_files, key=lambda f: int(op.basename(f)[1:-len('.npy')]))
+
+
+def activity_map_exists(fol):
+    return store_exists(fol) or op.isfile(op.join(fol, 't0.npy'))
+
+
+def get_activity_map_times_num(fol):
+    if store_exists(fol):
+        return load_header(fol)['shape'][0]
+    return len(get_frames_files(fol))
+
+
+def convert_activity_map_folder(fol, dtype='float32', vertex_major=False, delete_frames=False, overwrite=False):
+    # Converts a folder of t{t}.npy files (one per time point) into a single activity store
+    if store_exists(fol) and not overwrite:
+        print('convert_activity_map_folder: The store of {} already exists'.format(fol))
+        return True
+    frames_files = get_frames_files(fol)
+    T = len(frames_files)
+    if T == 0:
+        print('convert_activity_map_folder: No frames files in {}'.format(fol))
+        return False
+    if int(op.basename(frames_files[-1])[1:-len('.npy')]) != T - 1:
+        print('convert_activity_map_folder: Some frames are missing in {}!'.format(fol))
+        return False
+    frame = np.load(frames_files[0])
+    frame = frame[:, 0] if frame.ndim > 1 else frame
+    V = len(frame)
+    data = np.lib.format.open_memmap(
+        get_store_base(fol) + '.tmp.npy', mode='w+', dtype=np.float32, shape=(V, T))
+    for t, frame_fname in enumerate(frames_files):
+        frame = np.load(frame_fname)
+        data[:, t] = frame[:, 0] if frame.ndim > 1 else frame
+    save_activity_store(data, fol, dtype, vertex_major)
+    del data
+    os.remove(get_store_base(fol) + '.tmp.npy')
+    if delete_frames:
+        for frame_fname in frames_files:
+            os.remove(frame_fname)
+    print('{}: {} frames were converted to {}'.format(fol, T, get_store_fnames(fol)[0]))
+    return True
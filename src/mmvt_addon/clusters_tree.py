@@ -0,0 +1,161 @@
+import os.path as op
+import traceback
+import numpy as np
+
+# The clusters (connected components of the vertices above a threshold) of a surface statistic map, for all the
+# thresholds at once. The edges are sorted by their level (the smaller abs value of their two vertices) and merged
+# with union-find, where every merge is a new node in a tree (a dendrogram):
+#   nodes 0..V-1 are the vertices, with their abs value as the level
+#   node n >= V is the merge of two components, in the level of the edge that connected them
+# The levels only decrease going up the tree, so the clusters in threshold t are the nodes with level > t and a
+# parent level <= t (like mne's _find_clusters with tail=0: x > t and x < -t, positive and negative vertices are
+# never connected). The vertices (leaves) are ordered such that each node's vertices are contiguous:
+#   vertices of node n = leaves[start[n]:start[n] + size[n]]
+
+CLUSTERS_TREE_VERSION = 1
+
+
+class ClustersTree(object):
+    def __init__(self, level, parent, size, peak, start, leaves, values):
+        self.level = np.asarray(level)
+        self.parent = np.asarray(parent)
+        self.size = np.asarray(size)
+        self.peak = np.asarray(peak)
+        self.start = np.asarray(start)
+        self.leaves = np.asarray(leaves)
+        self.values = np.asarray(values)
+        self.parent_level = np.where(self.parent >= 0, self.level[np.maximum(self.parent, 0)], -np.inf)
+
+    @property
+    def vertices_num(self):
+        return len(self.values)
+
+    def clusters_nodes(self, threshold, min_size=0):
+        # The nodes of the clusters in threshold, positive clusters first, each sorted by their first vertex
+        # (the order of mne's _find_clusters)
+        nodes = np.where((self.level > threshold) & (self.parent_level <= threshold))[0]
+        if min_size > 0:
+            nodes = nodes[self.size[nodes] >= min_size]
+        if len(nodes) == 0:
+            return nodes
+        first_vertices = np.array([self.members(node).min() for node in nodes])
+        return nodes[np.lexsort((first_vertices, self.values[self.peak[nodes]] < 0))]
+
+    def members(self, node):
+        return self.leaves[self.start[node]:self.start[node] + self.size[node]]
+
+    def clusters(self, threshold, min_size=0):
+        # The clusters' vertices (sorted), like the clusters returned from mne's _find_clusters
+        return [np.sort(self.members(node)) for node in self.clusters_nodes(threshold, min_size)]
+
+    def clusters_info(self, threshold, min_size=0):
+        # Without the clusters' vertices: the nodes, sizes, peaks vertices and peaks values
+        nodes = self.clusters_nodes(threshold, min_size)
+        peaks = self.peak[nodes]
+        return dict(nodes=nodes, sizes=self.size[nodes], peaks=peaks, max=self.values[peaks])
+
+    def clusters_sizes(self, threshold):
+        return self.size[(self.level > threshold) & (self.parent_level <= threshold)]
+
+    def clusters_hist(self, thresholds):
+        # The clusters number and the max cluster size for each threshold
+        thresholds = np.asarray(thresholds)
+        clusters_num, max_sizes = np.zeros(len(thresholds), dtype=np.int64), np.zeros(len(thresholds), dtype=np.int64)
+        for ind, threshold in enumerate(thresholds):
+            sizes = self.clusters_sizes(threshold)
+            clusters_num[ind] = len(sizes)
+            max_sizes[ind] = sizes.max() if len(sizes) > 0 else 0
+        return clusters_num, max_sizes
+
+    def save(self, fname):
+        np.savez(fname, level=self.level, parent=self.parent, size=self.size, peak=self.peak, start=self.start,
+                 leaves=self.leaves, values=self.values, version=CLUSTERS_TREE_VERSION)
+
+    @staticmethod
+    def load(fname):
+        d = np.load(fname)
+        if int(d['version']) != CLUSTERS_TREE_VERSION:
+            return None
+        return ClustersTree(d['level'], d['parent'], d['size'], d['peak'], d['start'], d['leaves'], d['values'])
+
+
+def build_clusters_tree(x, adjacency):
+    # x: The vertices values, adjacency: The surface's SurfAdjacency (surf_adjacency.py)
+    x = np.asarray(x, dtype=np.float64).ravel()
+    V = len(x)
+    abs_x, sign = np.abs(x), np.sign(x)
+    rows, cols = adjacency.rows, adjacency.indices
+    edges = (rows < cols) & (sign[rows] == sign[cols]) & (sign[rows] != 0)
+    rows, cols = rows[edges], cols[edges]
+    edges_levels = np.minimum(abs_x[rows], abs_x[cols])
+    order = np.argsort(-edges_levels, kind='stable')
+    rows, cols, edges_levels = rows[order].tolist(), cols[order].tolist(), edges_levels[order].tolist()
+
+    abs_values = abs_x.tolist()
+    uf, uf_size = list(range(V)), [1] * V
+    comp_node = list(range(V))
+    level, parent, size = list(abs_values), [-1] * V, [1] * V
+    peak, head, tail, next_leaf = list(range(V)), list(range(V)), list(range(V)), [-1] * V
+    for u, w, edge_level in zip(rows, cols, edges_levels):
+        while uf[u] != u:
+            uf[u] = uf[uf[u]]
+            u = uf[u]
+        while uf[w] != w:
+            uf[w] = uf[uf[w]]
+            w = uf[w]
+        if u == w:
+            continue
+        if uf_size[u] < uf_size[w]:
+            u, w = w, u
+        uf[w] = u
+        uf_size[u] += uf_size[w]
+        node1, node2, node = comp_node[u], comp_node[w], len(level)
+        level.append(edge_level)
+        parent.append(-1)
+        parent[node1] = parent[node2] = node
+        size.append(size[node1] + size[node2])
+        peak.append(peak[node1] if abs_values[peak[node1]] >= abs_values[peak[node2]] else peak[node2])
+        next_leaf[tail[node1]] = head[node2]
+        head.append(head[node1])
+        tail.append(tail[node2])
+        comp_node[u] = node
+
+    # The leaves order: the roots' linked lists one after the other
+    leaves, pos = np.empty(V, dtype=np.int32), np.empty(V, dtype=np.int32)
+    ind = 0
+    for root in [node for node, node_parent in enumerate(parent) if node_parent == -1]:
+        leaf = head[root]
+        while leaf != -1:
+            leaves[ind] = leaf
+            pos[leaf] = ind
+            ind += 1
+            leaf = next_leaf[leaf]
+    start = pos[np.array(head, dtype=np.int64)]
+    return ClustersTree(np.array(level), np.array(parent, dtype=np.int32), np.array(size, dtype=np.int32),
+                        np.array(peak, dtype=np.int32), start, leaves, x)
+
+
+def get_clusters_tree_fname(contrast_fname):
+    # fmri/fmri_{contrast}_{hemi}.npy -> fmri/clusters_tree_{contrast}_{hemi}.npz
+    fol, name = op.split(contrast_fname)
+    name = op.splitext(name)[0]
+    name = name[len('fmri_'):] if name.startswith('fmri_') else name
+    return op.join(fol, 'clusters_tree_{}.npz'.format(name))
+
+
+def load_clusters_tree(contrast_fname, adjacency, x=None, overwrite=False):
+    # Loads the contrast's clusters tree, or builds (and saves) it if it doesn't exist or older than the contrast
+    fname = get_clusters_tree_fname(contrast_fname)
+    if op.isfile(fname) and not overwrite and op.getmtime(fname) >= op.getmtime(contrast_fname):
+        try:
+            tree = ClustersTree.load(fname)
+            if tree is not None:
+                return tree
+        except:
+            print(traceback.format_exc())
+            print('load_clusters_tree: Error in reading {}'.format(fname))
+    if x is None:
+        x = np.load(contrast_fname)
+    tree = build_clusters_tree(x, adjacency)
+    tree.save(fname)
+    return tree
@@ -1,5 +1,7 @@
 import mmvt_utils as mu
 import colors_utils as cu
+import frames_colors_cache as fcc
+import activity_store as acts
 import numpy as np
 import os.path as op
 import os
@@ -26,6 +28,8 @@ except:
     MNE_EXIST = False
 
 HEMIS = mu.HEMIS
+# Above this number of changed loops the incremental coloring writes the whole layer with foreach_set
+INCREMENTAL_COLORING_MAX_LOOPS_ITEMS = 2000
 # Should be moved to mmvt_addon
 (WIC_MEG, WIC_MEG_LABELS, WIC_FMRI, WIC_FMRI_DYNAMICS, WIC_FMRI_LABELS, WIC_FMRI_CLUSTERS, WIC_EEG, WIC_MEG_SENSORS,
 WIC_ELECTRODES, WIC_ELECTRODES_DISTS, WIC_ELECTRODES_SOURCES, WIC_ELECTRODES_STIM, WIC_MANUALLY, WIC_GROUPS, WIC_VOLUMES,
@@ -240,6 +244,20 @@ def get_use_abs_threshold():
     return bpy.context.scene.coloring_use_abs
 
 
+def objects_coloring(objs, colors):
+    # Batch version of object_coloring, for coloring many objects at once (the colors are calculated by the caller)
+    use_nodes = not _addon().is_solid()
+    for obj, rgb in zip(objs, colors):
+        if not obj or mu.check_obj_type(obj.name) == mu.OBJ_TYPE_SUBCORTEX or obj.active_material is None:
+            continue
+        cur_mat = obj.active_material
+        new_color = (rgb[0], rgb[1], rgb[2], 1)
+        cur_mat.diffuse_color = new_color[:3]
+        if cur_mat.node_tree is not None and 'RGB' in cur_mat.node_tree.nodes:
+            cur_mat.node_tree.nodes["RGB"].outputs[0].default_value = new_color
+        cur_mat.use_nodes = use_nodes
+
+
 def can_color_obj(obj):
     cur_mat = obj.active_material
     return 'RGB' in cur_mat.node_tree.nodes
@@ -414,27 +432,20 @@ def init_activity_map_coloring(map_type, subcorticals=True):
 
 
 def load_faces_verts():
-    faces_verts = {}
-    current_root_path = mu.get_user_fol()
-    if op.isfile(op.join(current_root_path, 'faces_verts_lh.npy') and \
-                         op.join(current_root_path, 'faces_verts_rh.npy')):
-        faces_verts['lh'] = np.load(op.join(current_root_path, 'faces_verts_lh.npy'))
-        faces_verts['rh'] = np.load(op.join(current_root_path, 'faces_verts_rh.npy'))
-    return faces_verts
+    faces_verts = {hemi: mu.get_obj_lookup(hemi, mu.get_user_fol()) for hemi in mu.HEMIS}
+    return faces_verts if all([faces_verts[hemi] is not None for hemi in mu.HEMIS]) else {}
 
 
 def load_subs_faces_verts():
     faces_verts = {}
     verts = {}
-    current_root_path = mu.get_user_fol()
-    subcoticals = glob.glob(op.join(current_root_path, 'subcortical', '*_faces_verts.npy'))
-    for subcortical_file in subcoticals:
-        subcortical = mu.namebase(subcortical_file)[:-len('_faces_verts')]
-        lookup_file = op.join(current_root_path, 'subcortical', '{}_faces_verts.npy'.format(subcortical))
-        verts_file = op.join(current_root_path, 'subcortical', '{}.npz'.format(subcortical))
-        if op.isfile(lookup_file) and op.isfile(verts_file):
-            faces_verts[subcortical] = np.load(lookup_file)
-            verts[subcortical] = np.load(verts_file)['verts']
+    subcortical_fol = op.join(mu.get_user_fol(), 'subcortical')
+    for subcortical in mu.get_lookups_registry().get_lookups_names(subcortical_fol):
+        lookup = mu.get_obj_lookup(subcortical, subcortical_fol)
+        verts_data = mu.get_obj_npz(subcortical, subcortical_fol)
+        if lookup is not None and verts_data is not None:
+            faces_verts[subcortical] = lookup
+            verts[subcortical] = verts_data['verts']
     return faces_verts, verts
 
 
@@ -786,41 +797,95 @@ def color_hemi_data(hemi, data, data_min=None, colors_ratio=None, threshold=0, o
                               check_valid_verts=check_valid_verts)
 
 
+def get_activity_map_fol(map_type, hemi):
+    if map_type == 'MEG':
+        activity_type = bpy.context.scene.meg_files
+        activity_type = '' if activity_type == 'conditions diff' else '{}_'.format(activity_type)
+        return op.join(mu.get_user_fol(), 'activity_map_{}{}'.format(activity_type, hemi))
+    elif map_type == 'FMRI_DYNAMICS':
+        return op.join(mu.get_user_fol(), 'fmri', 'activity_map_{}'.format(hemi))
+
+
+def load_activity_frame(frame_key, mmap_mode=None):
+    # frame_key: (activity map folder, t). Reads from the folder's t{t}.npy file if it's newer than the folder's
+    # activity store (a single frame that was saved after the store), otherwise from the store
+    fol, t = frame_key
+    store = acts.get_activity_store(fol)
+    fname = op.join(fol, 't{}.npy'.format(t))
+    if op.isfile(fname) and (store is None or op.getmtime(fname) > store.mtime):
+        return np.load(fname, mmap_mode=mmap_mode)
+    if store is not None:
+        return store.read_frame(t) if 0 <= t < store.T else None
+    return None
+
+
+def get_frames_colors_cache():
+    if ColoringMakerPanel.frames_colors_cache is None:
+        ColoringMakerPanel.frames_colors_cache = fcc.FramesColorsCache(bpy.context.scene.coloring_frames_cache_mb)
+    return ColoringMakerPanel.frames_colors_cache
+
+
+def clear_frames_colors_cache():
+    if ColoringMakerPanel.frames_colors_cache is not None:
+        ColoringMakerPanel.frames_colors_cache.clear()
+
+
+def color_hemi_frame(map_type, hemi, t, data, data_min, colors_ratio, threshold=0, override_current_mat=True):
+    # Colors the hemi using the frames colors cache, and calculates the next frames colors in the background
+    use_abs = bpy.context.scene.coloring_use_abs
+    cm = _addon().get_cm()
+    inflated_hemi = 'inflated_{}'.format(hemi)
+    if cm is None or data_min is None or colors_ratio is None or data.ndim > 1:
+        return color_hemi_data(hemi, data, data_min, colors_ratio, threshold, override_current_mat)
+    if bpy.data.objects[inflated_hemi].hide:
+        return
+    lut = cu.get_colors_lut(cm, data_min, colors_ratio=colors_ratio)
+    cache = get_frames_colors_cache()
+    params = (lut.key, float(threshold), use_abs)
+    cache.check_params(params)
+    fol = get_activity_map_fol(map_type, hemi)
+    frame_colors = cache.get((fol, t), params)
+    if frame_colors is None:
+        frame_colors = fcc.calc_frame_colors(data, lut, threshold, use_abs)
+        cache.put((fol, t), params, frame_colors)
+    colors_inds, valid_verts = frame_colors
+    activity_map_obj_coloring(
+        bpy.data.objects[inflated_hemi], data, ColoringMakerPanel.faces_verts[hemi], threshold, override_current_mat,
+        data_min, colors_ratio, use_abs, verts_colors=lut.colors[colors_inds], valid_verts=valid_verts)
+    play_to = max(bpy.context.scene.play_to, t)
+    next_frames = range(t + 1, min(t + bpy.context.scene.coloring_frames_cache_window, play_to) + 1)
+    cache.prefetch([(fol, frame) for frame in next_frames], params, load_activity_frame, lut, threshold, use_abs)
+
+
 @mu.timeit
 def plot_activity(map_type, faces_verts, threshold, meg_sub_activity=None,
         plot_subcorticals=True, override_current_mat=True, clusters=False):
 
-    current_root_path = mu.get_user_fol()# bpy.path.abspath(bpy.context.scene.conf_path)
     not_hiden_hemis = [hemi for hemi in HEMIS if not mu.get_hemi_obj(hemi).hide]
     t = bpy.context.scene.frame_current
-    frame_str = str(t)
     data_min, data_max = 0, 0
     f = None
     for hemi in not_hiden_hemis:
         colors_ratio, data_min = None, None
         if map_type in ['MEG', 'FMRI_DYNAMICS']:
+            fol = get_activity_map_fol(map_type, hemi)
             if map_type == 'MEG':
-                activity_type = bpy.context.scene.meg_files
-                activity_type = '' if activity_type == 'conditions diff' else '{}_'.format(activity_type)
-                fname = op.join(current_root_path, 'activity_map_{}{}'.format(
-                    activity_type, hemi), 't' + frame_str + '.npy')
                 colors_ratio = ColoringMakerPanel.meg_activity_colors_ratio
                 data_min, data_max = ColoringMakerPanel.meg_activity_data_minmax
                 cb_title = 'MEG'
             elif map_type == 'FMRI_DYNAMICS':
-                fname =  op.join(current_root_path, 'fmri', 'activity_map_' + hemi, 't' + frame_str + '.npy')
                 colors_ratio = ColoringMakerPanel.fmri_activity_colors_ratio
                 data_min, data_max = ColoringMakerPanel.fmri_activity_data_minmax
                 cb_title = 'fMRI'
-            if op.isfile(fname):
-                f = np.load(fname)
+            f = load_activity_frame((fol, t), mmap_mode='r' if bpy.context.scene.coloring_frames_cache else None)
+            if f is not None:
                 if _addon().colorbar_values_are_locked():
                     data_max, data_min = _addon().get_colorbar_max_min()
                     colors_ratio = 256 / (data_max - data_min)
                 else:
                     _addon().set_colorbar_max_min(data_max, data_min)
             else:
-                print("Can't load {}".format(fname))
+                print("Can't load frame {} from {}".format(t, fol))
                 return False
         elif map_type == 'FMRI':
             if not ColoringMakerPanel.fmri_activity_data_minmax is None:
@@ -856,7 +921,10 @@ def plot_activity(map_type, faces_verts, threshold, meg_sub_activity=None,
         #     else:
         #         _addon().set_colormap('BuPu-YlOrRd')
 
-        color_hemi_data(hemi, f, data_min, colors_ratio, threshold, override_current_mat)
+        if map_type in ['MEG', 'FMRI_DYNAMICS'] and bpy.context.scene.coloring_frames_cache:
+            color_hemi_frame(map_type, hemi, t, f, data_min, colors_ratio, threshold, override_current_mat)
+        else:
+            color_hemi_data(hemi, f, data_min, colors_ratio, threshold, override_current_mat)
         # if bpy.context.scene.coloring_both_pial_and_inflated:
         #     for cur_obj in [bpy.data.objects[hemi], mu.get_hemi_obj(hemi)]:
         #         activity_map_obj_coloring(cur_obj, f, faces_verts[hemi], threshold, override_current_mat, data_min,
@@ -904,10 +972,9 @@ def fmri_subcortex_activity_color(threshold, override_current_mat=True, use_abs=
         if cur_obj is None:
             print("Can't find the object {}!".format(subcortical))
         else:
-            lookup_file = op.join(current_root_path, 'subcortical', '{}_faces_verts.npy'.format(subcortical))
+            lookup = mu.get_obj_lookup(subcortical, op.join(current_root_path, 'subcortical'))
             verts_file = op.join(current_root_path, 'subcortical_fmri_activity', '{}.npy'.format(subcortical))
-            if op.isfile(lookup_file) and op.isfile(verts_file):
-                lookup = np.load(lookup_file)
+            if lookup is not None and op.isfile(verts_file):
                 verts_values = np.load(verts_file)
                 activity_map_obj_coloring(cur_obj, verts_values, lookup, threshold, override_current_mat,
                                           use_abs=use_abs)
@@ -926,11 +993,10 @@ def create_inflated_curv_coloring():
             cur_obj.select = True
             bpy.ops.mesh.vertex_color_remove()
             vcol_layer = mesh.vertex_colors.new('curve')
-            for vert in range(curv.shape[0]):
-                x = lookup[vert]
-                for loop_ind in x[x>-1]:
-                    d = vcol_layer.data[loop_ind]
-                    d.color = verts_colors[vert]
+            loops_colors = get_vcol_layer_colors(vcol_layer)
+            loops_inds, loops_verts = calc_verts_loops(np.arange(curv.shape[0]), lookup)
+            loops_colors[loops_inds, :3] = verts_colors[loops_verts]
+            set_vcol_layer_colors(vcol_layer, loops_colors)
 
     try:
         # todo: check not to overwrite
@@ -938,12 +1004,11 @@ def create_inflated_curv_coloring():
         for hemi in mu.HEMIS:
             cur_obj = mu.get_hemi_obj(hemi)
             curv_fname = op.join(mu.get_user_fol(), 'surf', '{}.curv.npy'.format(hemi))
-            faces_verts_fname = op.join(mu.get_user_fol(), 'faces_verts_{}.npy'.format(hemi))
-            if not op.isfile(curv_fname) or not op.isfile(faces_verts_fname):
+            lookup = mu.get_obj_lookup(hemi, mu.get_user_fol())
+            if not op.isfile(curv_fname) or lookup is None:
                 print("Can't plot the {} curves!".format(hemi))
                 continue
             curv = np.load(curv_fname)
-            lookup = np.load(op.join(mu.get_user_fol(), 'faces_verts_{}.npy'.format(hemi)))
             color_obj_curvs(cur_obj, curv, lookup)
         for hemi in mu.HEMIS:
             curvs_fol = op.join(mu.get_user_fol(), 'surf', '{}_{}_curves'.format(bpy.context.scene.atlas, hemi))
@@ -958,11 +1023,9 @@ def create_inflated_curv_coloring():
                     else:
                         print('Can\'t find the file {}'.format(curv_file))
 
-                    faces_verts_file = op.join(lookup_fol, '{}_faces_verts.npy'.format(label))
-                    if op.isfile(faces_verts_file):
-                        lookup = np.load(faces_verts_file)
-                    else:
-                        print('Can\'t find the file {}'.format(faces_verts_file))
+                    lookup = mu.get_obj_lookup(label, lookup_fol)
+                    if lookup is None:
+                        print('Can\'t find the file {}'.format(op.join(lookup_fol, '{}_faces_verts.npy'.format(label))))
                     color_obj_curvs(inflated_cur_obj, curv, lookup)
                 except:
                     print("Can't create {}'s curves!".format(cur_obj.name))
@@ -986,14 +1049,22 @@ def get_obj_color_data(obj, color, val=1):
 
 
 def calc_colors(vert_values, min_data=None, colors_ratio=None, cm=None):
+    lut = get_colors_lut(min_data, colors_ratio, cm)
+    if lut is None:
+        return np.zeros((len(vert_values), 3))
+    return lut(vert_values)
+
+
+def get_colors_lut(min_data=None, colors_ratio=None, cm=None):
+    # The LUT of calc_colors, for coloring many values with the same colormap and range. None if there is no cm
     if cm is None:
         cm = _addon().get_cm()
     if cm is None:
-        return np.zeros((len(vert_values), 3))
+        return None
     if min_data or colors_ratio is None:
         max_data, min_data = _addon().colorbar.get_colorbar_max_min()
         colors_ratio = 256 / (max_data - min_data)
-    return mu.calc_colors_from_cm(vert_values, min_data, colors_ratio, cm)
+    return cu.get_colors_lut(cm, min_data, colors_ratio=colors_ratio)
 
 
 def find_valid_verts(values, threshold, use_abs, bigger_or_equall):
@@ -1029,16 +1100,15 @@ def set_activity_values(cur_obj, values):
 # @mu.timeit
 def activity_map_obj_coloring(cur_obj, vert_values, lookup=None, threshold=0, override_current_mat=True, data_min=None,
                               colors_ratio=None, use_abs=None, bigger_or_equall=False, save_prev_colors=False,
-                              coloring_layer='Col', check_valid_verts=True):
+                              coloring_layer='Col', check_valid_verts=True, bulk_coloring=True, verts_colors=None,
+                              valid_verts=None, incremental=None):
     if isinstance(cur_obj, str):
         cur_obj = bpy.data.objects[cur_obj]
     if lookup is None:
-        lookup_fnames = glob.glob(
-            op.join(mu.get_user_fol(), '**', '{}_faces_verts.npy'.format(cur_obj.name)), recursive=True)
-        if len(lookup_fnames) == 0:
+        lookup = mu.get_obj_lookup(cur_obj.name)
+        if lookup is None:
             print("activity_map_obj_coloring: Can't find the lookup file for {}".format(cur_obj))
             return False
-        lookup = np.load(lookup_fnames[0])
 
     mesh = cur_obj.data
     scn = bpy.context.scene
@@ -1049,23 +1119,34 @@ def activity_map_obj_coloring(cur_obj, vert_values, lookup=None, threshold=0, ov
     values = vert_values[:, 0] if vert_values.ndim > 1 else vert_values
     if coloring_layer == 'Col':
         set_activity_values(cur_obj, values)
-    valid_verts = find_valid_verts(values, threshold, use_abs, bigger_or_equall)
+    if valid_verts is None:
+        valid_verts = find_valid_verts(values, threshold, use_abs, bigger_or_equall)
     # print('activity_map_obj_coloring: Num of valid_verts above {}: {}'.format(threshold, len(valid_verts)))
     if len(valid_verts) == 0 and check_valid_verts:
         print('No vertices values are above the threhold {} ({} to {})'.format(threshold, np.min(values), np.max(values)))
         return
-    colors_picked_from_cm = False
+    # verts_colors can be precalculated (see color_hemi_frame)
+    colors_picked_from_cm = verts_colors is not None
     # cm = _addon().get_cm()
     if vert_values.ndim > 1 and vert_values.squeeze().ndim == 1:
         vert_values = vert_values.squeeze()
-    if vert_values.ndim == 1 and data_min is not None:
+    if vert_values.ndim == 1 and data_min is not None and not colors_picked_from_cm:
         verts_colors = calc_colors(vert_values, data_min, colors_ratio)
         colors_picked_from_cm = True
     #check if our mesh already has Vertex Colors, and if not add some... (first we need to make sure it's the active object)
     scn.objects.active = cur_obj
     cur_obj.select = True
-    if override_current_mat:
+    if incremental is None:
+        incremental = bpy.context.scene.coloring_incremental
+    # The incremental coloring reuses the existing layer, and writes only the vertices that were changed
+    incremental = incremental and bulk_coloring and override_current_mat and coloring_layer == 'Col' and \
+                  not save_prev_colors
+    if override_current_mat and (not incremental or get_incremental_coloring_state(mesh) is None):
         recreate_coloring_layers(mesh, coloring_layer)
+    elif override_current_mat:
+        # Like in recreate_coloring_layers the contours are cleared, but in place, so the Col layer and its
+        # incremental coloring state are kept
+        clear_vcol_layer(mesh.vertex_colors.get('contours'))
         # vcol_layer = mesh.vertex_colors["Col"]
 
     if len(mesh.vertex_colors) > 1 and 'inflated' in cur_obj.name:
@@ -1078,15 +1159,22 @@ def activity_map_obj_coloring(cur_obj, vert_values, lookup=None, threshold=0, ov
     vcol_layer = mesh.vertex_colors[coloring_layer]
     if save_prev_colors:
         ColoringMakerPanel.prev_colors[cur_obj.name] = {'lookup':lookup, 'vcol_layer':vcol_layer, 'colors':{}}
-    if colors_picked_from_cm:
-        verts_lookup_loop_coloring(
-            valid_verts, lookup, vcol_layer, lambda vert:verts_colors[vert], cur_obj.name, save_prev_colors)
+    if not colors_picked_from_cm:
+        verts_colors = vert_values[:, 1:] if vert_values.ndim > 1 else calc_colors(vert_values)
+    if incremental:
+        verts_lookup_incremental_coloring(valid_verts, lookup, vcol_layer, verts_colors, mesh.name)
+        return
+    # The layer is going to be changed outside of the incremental coloring
+    ColoringMakerPanel.incremental_coloring.pop(mesh.name, None)
+    if bulk_coloring:
+        verts_lookup_bulk_coloring(valid_verts, lookup, vcol_layer, verts_colors, cur_obj.name, save_prev_colors)
     else:
         verts_lookup_loop_coloring(
-            valid_verts, lookup, vcol_layer, lambda vert:vert_values[vert, 1:], cur_obj.name, save_prev_colors)
+            valid_verts, lookup, vcol_layer, lambda vert:verts_colors[vert], cur_obj.name, save_prev_colors)
 
 
 def verts_lookup_loop_coloring(valid_verts, lookup, vcol_layer, colors_func, cur_obj_name, save_prev_colors=False):
+    # The old per loop coloring, kept for comparison (see scripts/time_activity_coloring.py)
     if save_prev_colors:
         ColoringMakerPanel.prev_colors[cur_obj_name]['colors'] = defaultdict(dict)
     for vert in valid_verts:
@@ -1098,7 +1186,125 @@ def verts_lookup_loop_coloring(valid_verts, lookup, vcol_layer, colors_func, cur
             d.color = colors_func(vert)
 
 
+def calc_verts_loops(verts, lookup):
+    # Returns the loops indices of the given vertices, and for each loop its vertex
+    if isinstance(lookup, mu.VertsLoopsLookup):
+        return lookup.verts_loops(verts)
+    # Legacy lookup, padded with -1
+    verts = np.asarray(verts, dtype=np.int64).ravel()
+    verts_lookup = lookup[verts]
+    if verts_lookup.ndim == 1:
+        verts_lookup = verts_lookup.reshape((-1, 1))
+    valid = verts_lookup > -1
+    loops_inds = verts_lookup[valid].astype(np.int64)
+    loops_verts = np.broadcast_to(verts.reshape((-1, 1)), verts_lookup.shape)[valid]
+    return loops_inds, loops_verts
+
+
+def get_vcol_layer_colors(vcol_layer):
+    loops_num = len(vcol_layer.data)
+    color_size = len(vcol_layer.data[0].color) if loops_num > 0 else 3
+    loops_colors = np.empty(loops_num * color_size, dtype=np.float32)
+    vcol_layer.data.foreach_get('color', loops_colors)
+    return loops_colors.reshape((loops_num, color_size))
+
+
+def set_vcol_layer_colors(vcol_layer, loops_colors):
+    vcol_layer.data.foreach_set('color', np.ascontiguousarray(loops_colors, dtype=np.float32).ravel())
+
+
+def clear_vcol_layer(vcol_layer):
+    # Whites the layer, like a newly created one
+    if vcol_layer is None or len(vcol_layer.data) == 0:
+        return
+    color_size = len(vcol_layer.data[0].color)
+    vcol_layer.data.foreach_set('color', np.ones(len(vcol_layer.data) * color_size, dtype=np.float32))
+
+
+def verts_lookup_bulk_coloring(valid_verts, lookup, vcol_layer, verts_colors, cur_obj_name, save_prev_colors=False):
+    # Builds one flat per loop colors array and writes it to the layer with a single foreach_set call
+    loops_colors = get_vcol_layer_colors(vcol_layer)
+    if len(loops_colors) == 0:
+        return
+    loops_inds, loops_verts = calc_verts_loops(valid_verts, lookup)
+    if save_prev_colors:
+        saved_loops = np.zeros(len(loops_colors), dtype=bool)
+        saved_loops[loops_inds] = True
+        ColoringMakerPanel.prev_colors[cur_obj_name]['colors'] = loops_colors.copy()
+        ColoringMakerPanel.prev_colors[cur_obj_name]['saved_loops'] = saved_loops
+    if len(loops_inds) == 0:
+        return
+    verts_colors = np.asarray(verts_colors)
+    if verts_colors.ndim == 1:
+        verts_colors = verts_colors.reshape((-1, 1))
+    color_size = min(loops_colors.shape[1], verts_colors.shape[1])
+    loops_colors[loops_inds, :color_size] = verts_colors[loops_verts, :color_size]
+    set_vcol_layer_colors(vcol_layer, loops_colors)
+
+
+def get_incremental_coloring_state(mesh):
+    state = ColoringMakerPanel.incremental_coloring.get(mesh.name)
+    vcol_layer = mesh.vertex_colors.get('Col')
+    if state is not None and (vcol_layer is None or state['layer'] != vcol_layer.as_pointer() or
+                              len(state['loops_colors']) != len(vcol_layer.data)):
+        ColoringMakerPanel.incremental_coloring.pop(mesh.name, None)
+        state = None
+    return state
+
+
+def verts_lookup_incremental_coloring(valid_verts, lookup, vcol_layer, verts_colors, mesh_name):
+    # Colors the layer like recreate_coloring_layers + verts_lookup_bulk_coloring, but writes only the vertices
+    # which color was changed since the previous call (including the ones that crossed the threshold)
+    now = time.time()
+    verts_colors = np.asarray(verts_colors)
+    if verts_colors.ndim == 1:
+        verts_colors = verts_colors.reshape((-1, 1))
+    state = ColoringMakerPanel.incremental_coloring.get(mesh_name)
+    if state is None:
+        # The layer was just recreated, all its loops are white
+        loops_colors = get_vcol_layer_colors(vcol_layer)
+        state = dict(layer=vcol_layer.as_pointer(), loops_colors=loops_colors,
+                     verts_colors=np.ones((len(verts_colors), loops_colors.shape[1]), dtype=np.float32))
+        ColoringMakerPanel.incremental_coloring[mesh_name] = state
+    loops_colors, prev_verts_colors = state['loops_colors'], state['verts_colors']
+    if len(loops_colors) == 0:
+        return
+    color_size = min(loops_colors.shape[1], verts_colors.shape[1])
+    new_verts_colors = np.ones_like(prev_verts_colors)
+    new_verts_colors[valid_verts, :color_size] = verts_colors[valid_verts, :color_size]
+    changed_verts = np.where(np.any(new_verts_colors != prev_verts_colors, axis=1))[0]
+    loops_inds, loops_verts = calc_verts_loops(changed_verts, lookup)
+    if len(loops_inds) > 0:
+        loops_colors[loops_inds] = new_verts_colors[loops_verts]
+        if len(loops_inds) <= INCREMENTAL_COLORING_MAX_LOOPS_ITEMS:
+            # Cheaper than writing the whole layer
+            for loop_ind in loops_inds:
+                vcol_layer.data[loop_ind].color = loops_colors[loop_ind]
+        else:
+            set_vcol_layer_colors(vcol_layer, loops_colors)
+    state['verts_colors'] = new_verts_colors
+    update_incremental_coloring_stats(mesh_name, len(changed_verts), len(loops_inds), (time.time() - now) * 1000)
+
+
+def update_incremental_coloring_stats(mesh_name, changed_verts, changed_loops, ms):
+    stats = ColoringMakerPanel.incremental_coloring_stats.get(
+        mesh_name, dict(frames=0, total_changed_verts=0, total_ms=0))
+    stats.update(dict(changed_verts=changed_verts, changed_loops=changed_loops, ms=ms, frames=stats['frames'] + 1,
+                      total_changed_verts=stats['total_changed_verts'] + changed_verts,
+                      total_ms=stats['total_ms'] + ms))
+    ColoringMakerPanel.incremental_coloring_stats[mesh_name] = stats
+
+
+def get_incremental_coloring_stats():
+    return ColoringMakerPanel.incremental_coloring_stats
+
+
+def clear_incremental_coloring_stats():
+    ColoringMakerPanel.incremental_coloring_stats = {}
+
+
 def recreate_coloring_layers(mesh, coloring_layer='Col'):
+    ColoringMakerPanel.incremental_coloring.pop(mesh.name, None)
     coloring_layers = ['Col', 'contours'] if coloring_layer == 'Col' else ['contours']
     for cl in coloring_layers:
         if mesh.vertex_colors.get(cl) is not None:
@@ -1142,20 +1348,36 @@ def color_prev_colors(verts, obj_name, coloring_layer='Col'):
         mesh.vertex_colors.active_index = mesh.vertex_colors.keys().index(coloring_layer)
         mesh.vertex_colors[coloring_layer].active_render = True
     vcol_layer = mesh.vertex_colors[coloring_layer]
-    for vert in verts:
-        x = lookup[vert]
-        for loop_ind in x[x > -1]:
-            d = vcol_layer.data[loop_ind]
-            if vert in ColoringMakerPanel.prev_colors[obj_name]['colors']:
-                prev_color = ColoringMakerPanel.prev_colors[obj_name]['colors'][vert][loop_ind]
-                if d.color != prev_color:
-                    d.color = prev_color
-            else:
-                if ColoringMakerPanel.curvs is not None:
-                    default_color = [1, 1, 1] if ColoringMakerPanel.curvs[hemi][vert] == 0 else [0.55, 0.55, 0.55]
+    ColoringMakerPanel.incremental_coloring.pop(mesh.name, None)
+    prev_colors = ColoringMakerPanel.prev_colors[obj_name]['colors']
+    if isinstance(prev_colors, dict):
+        # Was saved by verts_lookup_loop_coloring
+        for vert in verts:
+            x = lookup[vert]
+            for loop_ind in x[x > -1]:
+                d = vcol_layer.data[loop_ind]
+                if vert in prev_colors:
+                    prev_color = prev_colors[vert][loop_ind]
+                    if d.color != prev_color:
+                        d.color = prev_color
                 else:
-                    default_color = [1, 1, 1]
-                d.color = default_color
+                    if ColoringMakerPanel.curvs is not None:
+                        default_color = [1, 1, 1] if ColoringMakerPanel.curvs[hemi][vert] == 0 else [0.55, 0.55, 0.55]
+                    else:
+                        default_color = [1, 1, 1]
+                    d.color = default_color
+        return True
+    loops_colors = get_vcol_layer_colors(vcol_layer)
+    loops_inds, loops_verts = calc_verts_loops(verts, lookup)
+    if len(loops_inds) == 0:
+        return True
+    saved_loops = ColoringMakerPanel.prev_colors[obj_name]['saved_loops'][loops_inds]
+    loops_colors[loops_inds[saved_loops]] = prev_colors[loops_inds[saved_loops]]
+    default_loops, default_verts = loops_inds[~saved_loops], loops_verts[~saved_loops]
+    loops_colors[default_loops, :3] = 1
+    if ColoringMakerPanel.curvs is not None and ColoringMakerPanel.curvs[hemi] is not None:
+        loops_colors[default_loops[ColoringMakerPanel.curvs[hemi][default_verts] != 0], :3] = 0.55
+    set_vcol_layer_colors(vcol_layer, loops_colors)
     return True
 
 
@@ -1386,17 +1608,18 @@ def color_subcortical_region(region_name, color, use_abs=None):
         use_abs = bpy.context.scene.coloring_use_abs
     #todo: read the ColoringPanel.subs_verts_faces like in fmri labels coloring
     cur_obj = bpy.data.objects.get(region_name + '_fmri_activity', None)
-    obj_ana_fname = op.join(mu.get_user_fol(), 'subcortical', '{}.npz'.format(region_name))
-    obj_lookup_fname = op.join(mu.get_user_fol(), 'subcortical', '{}_faces_verts.npy'.format(region_name))
-    if not cur_obj is None and op.isfile(obj_lookup_fname):
+    subcortical_fol = op.join(mu.get_user_fol(), 'subcortical')
+    obj_ana_fname = op.join(subcortical_fol, '{}.npz'.format(region_name))
+    lookup = mu.get_obj_lookup(region_name, subcortical_fol)
+    if not cur_obj is None and lookup is not None:
         # todo: read only the verts number
-        if not op.isfile(obj_ana_fname):
-            verts, faces = mu.read_ply_file(op.join(mu.get_user_fol(), 'subcortical', '{}.ply'.format(region_name)))
+        d = mu.get_obj_npz(region_name, subcortical_fol)
+        if d is None:
+            verts, faces = mu.read_ply_file(op.join(subcortical_fol, '{}.ply'.format(region_name)))
             np.savez(obj_ana_fname, verts=verts, faces=faces)
+            mu.get_lookups_registry().add_file(obj_ana_fname)
         else:
-            d = np.load(obj_ana_fname)
             verts =  d['verts']
-        lookup = np.load(obj_lookup_fname)
         region_colors_data = np.hstack((np.array([1.]), color))
         region_colors_data = np.tile(region_colors_data, (len(verts), 1))
         activity_map_obj_coloring(cur_obj, region_colors_data, lookup, 0, True, use_abs=use_abs)
@@ -1424,6 +1647,7 @@ def default_coloring(loop_indices):
         cur_obj = bpy.data.objects[hemi]
         mesh = cur_obj.data
         vcol_layer = mesh.vertex_colors.active
+        ColoringMakerPanel.incremental_coloring.pop(mesh.name, None)
         for loop_ind in indices:
             vcol_layer.data[loop_ind].color = [1, 1, 1]
 
@@ -1489,6 +1713,15 @@ def get_stc_full_fname():
     return full_stc_fname
 
 
+def coloring_frames_cache_update(self, context):
+    if ColoringMakerPanel.frames_colors_cache is None:
+        return
+    if bpy.context.scene.coloring_frames_cache:
+        ColoringMakerPanel.frames_colors_cache.set_memory_budget(bpy.context.scene.coloring_frames_cache_mb)
+    else:
+        ColoringMakerPanel.frames_colors_cache.clear()
+
+
 def meg_minmax_prec_update(selc, context):
     if not ColoringMakerPanel.run_meg_minmax_prec_update:
         return
@@ -1717,7 +1950,7 @@ def color_eeg_helmet(use_abs=None):
         data = np.diff(data, axis=2).squeeze()
         if not _addon().colorbar_values_are_locked():
             _addon().set_colorbar_title('EEG sensors conditions difference')
-    lookup = np.load(op.join(fol, 'eeg', 'eeg_faces_verts.npy'))
+    lookup = mu.get_obj_lookup('eeg', op.join(fol, 'eeg'))
     threshold = 0
     if _addon().colorbar_values_are_locked():
         data_max, data_min = _addon().get_colorbar_max_min()
@@ -2345,7 +2578,8 @@ def draw(self, context):
     layout = self.layout
     user_fol = mu.get_user_fol()
     atlas = bpy.context.scene.atlas
-    faces_verts_exist = mu.hemi_files_exists(op.join(user_fol, 'faces_verts_{hemi}.npy'))
+    faces_verts_exist = all([mu.faces_verts_exist(op.join(user_fol, 'faces_verts_{}.npy'.format(hemi)))
+                             for hemi in mu.HEMIS])
     fmri_files = glob.glob(op.join(user_fol, 'fmri', 'fmri_*lh*.npy'))  # mu.hemi_files_exists(op.join(user_fol, 'fmri_{hemi}.npy'))
     # fmri_clusters_files_exist = mu.hemi_files_exists(op.join(user_fol, 'fmri', 'fmri_clusters_{hemi}.npy'))
     # meg_ext_meth = bpy.context.scene.meg_labels_extract_method
@@ -2369,8 +2603,8 @@ def draw(self, context):
     layout.prop(context.scene, 'color_rois_homogeneously', text="Color ROIs homogeneously")
 
     if faces_verts_exist:
-        meg_current_activity_data_exist = mu.hemi_files_exists(
-            op.join(user_fol, 'activity_map_{hemi}', 't{}.npy'.format(bpy.context.scene.frame_current)))
+        meg_current_activity_data_exist = all([acts.activity_map_exists(
+            op.join(user_fol, 'activity_map_{}'.format(hemi))) for hemi in mu.HEMIS])
         if ColoringMakerPanel.meg_activity_data_exist and meg_current_activity_data_exist or \
                 ColoringMakerPanel.stc_file_exist:
             col = layout.box().column()
@@ -2487,6 +2721,14 @@ bpy.types.Scene.coloring_fmri = bpy.props.BoolProperty(default=True, description
 bpy.types.Scene.coloring_electrodes = bpy.props.BoolProperty(default=False, description="Plot Deep electrodes")
 bpy.types.Scene.coloring_lower_threshold = bpy.props.FloatProperty(default=0.5, min=0, description="")
 bpy.types.Scene.coloring_use_abs = bpy.props.BoolProperty(default=True)
+bpy.types.Scene.coloring_incremental = bpy.props.BoolProperty(
+    default=True, description="Recolor only the vertices which color was changed")
+bpy.types.Scene.coloring_frames_cache = bpy.props.BoolProperty(
+    default=True, description="Cache the frames colors while playing", update=coloring_frames_cache_update)
+bpy.types.Scene.coloring_frames_cache_mb = bpy.props.IntProperty(
+    default=512, min=16, description="Frames colors cache memory budget (MB)", update=coloring_frames_cache_update)
+bpy.types.Scene.coloring_frames_cache_window = bpy.props.IntProperty(
+    default=20, min=0, description="Number of frames to calculate ahead of the current frame")
 bpy.types.Scene.fmri_files = bpy.props.EnumProperty(items=[('', '', '', 0)], description="fMRI files")
 bpy.types.Scene.stc_files = bpy.props.EnumProperty(items=[('', '', '', 0)], description="STC files")
 bpy.types.Scene.meg_sensors_conditions= bpy.props.EnumProperty(items=[])
@@ -2541,6 +2783,8 @@ class ColoringMakerPanel(bpy.types.Panel):
     connectivity_labels = []
     activity_values = {hemi:[] for hemi in mu.HEMIS}
     prev_colors = {}
+    frames_colors_cache = None
+    incremental_coloring, incremental_coloring_stats = {}, {}
     stc = None
     stc_file_chosen = False
     activity_map_chosen = False
@@ -2611,6 +2855,7 @@ def init(addon, do_register=True):
     init_connectivity_labels_avg()
     init_static_conn()
 
+    mu.init_lookups_registry(mu.get_user_fol())
     ColoringMakerPanel.faces_verts = load_faces_verts()
     bpy.context.scene.coloring_meg_subcorticals = False
     bpy.context.scene.meg_peak_mode = 'abs'
@@ -2650,8 +2895,8 @@ def init_meg_activity_map():
     for activity_type in activity_types:
         if activity_type != '':
             activity_type = activity_type[:-1]
-        meg_files_exist = len(glob.glob(op.join(user_fol, 'activity_map_{}rh'.format(activity_type), 't*.npy'))) > 0 and \
-                          len(glob.glob(op.join(user_fol, 'activity_map_{}lh'.format(activity_type), 't*.npy'))) > 0
+        meg_files_exist = all([acts.activity_map_exists(op.join(user_fol, 'activity_map_{}{}'.format(
+            activity_type, hemi))) for hemi in mu.HEMIS])
         meg_data_maxmin_fname = op.join(mu.get_user_fol(), 'meg_activity_map_{}minmax.pkl'.format(activity_type))
         if meg_files_exist and op.isfile(meg_data_maxmin_fname):
             data_min, data_max = mu.load(meg_data_maxmin_fname)
@@ -2700,7 +2945,8 @@ def create_stc_files_list(list_items=[]):
 
 def init_fmri_activity_map():
     user_fol = mu.get_user_fol()
-    fmri_files_exist = mu.hemi_files_exists(op.join(user_fol, 'fmri', 'activity_map_{hemi}', 't0.npy'))
+    fmri_files_exist = all([acts.activity_map_exists(op.join(user_fol, 'fmri', 'activity_map_{}'.format(hemi)))
+                            for hemi in mu.HEMIS])
     fmri_data_maxmin_fname = op.join(user_fol, 'fmri', 'activity_map_minmax.npy')
     if fmri_files_exist and op.isfile(fmri_data_maxmin_fname):
         ColoringMakerPanel.fmri_activity_map_exist = True
@@ -2,6 +2,7 @@ import re
 from collections import OrderedDict
 import numpy as np
 from itertools import cycle
+import threading
 # Light version of webcolors
 
 # http://stackoverflow.com/a/4382138/1060738
@@ -277,3 +278,123 @@ def normalize_hex(hex_value):
     if len(hex_digits) == 3:
         hex_digits = u''.join(2 * s for s in hex_digits)
     return u'#{}'.format(hex_digits.lower())
+
+
+# Colormaps lookup tables (LUT) engine
+# A LUT holds the colormap sampled in float32 for a given (colormap, min, max, resolution). Mapping an array to colors
+# is a single quantization to indices followed by one fancy-indexing pass.
+# rounding='rint' is the addon's convention (mu.calc_colors_from_cm), rounding='floor' is matplotlib's (to_rgba)
+LUTS_CACHE_SIZE = 64
+_luts_cache = OrderedDict()
+_luts_cache_lock = threading.Lock()
+
+
+class ColorsLUT(object):
+    def __init__(self, colors, data_min, scale, rounding='rint', key=None):
+        self.colors = colors
+        self.data_min = data_min
+        self.scale = scale
+        self.rounding = rounding
+        self.key = key
+
+    @property
+    def resolution(self):
+        return len(self.colors)
+
+    def indices(self, x):
+        x = np.asarray(x, dtype=np.float64)
+        inds = (x - self.data_min) * self.scale
+        inds = np.rint(inds) if self.rounding == 'rint' else np.floor(inds)
+        inds = np.clip(np.where(np.isnan(inds), 0, inds), 0, self.resolution - 1)
+        return inds.astype(np.uint8 if self.resolution <= 256 else np.uint16)
+
+    def __call__(self, x):
+        return self.colors[self.indices(x)]
+
+
+def get_colors_lut(cm, data_min, data_max=None, colors_ratio=None, resolution=None, rounding='rint'):
+    # cm can be a (N, 3/4) colors array (the addon's colormaps), a matplotlib colormap or its name.
+    # The colors indices are (x - data_min) * colors_ratio, where colors_ratio = resolution / (data_max - data_min)
+    if colors_ratio is None:
+        if data_max is None:
+            raise Exception('get_colors_lut: data_max or colors_ratio should be set!')
+        lut_len = _colormap_len(cm) if resolution is None else resolution
+        colors_ratio = lut_len / (data_max - data_min) if data_max != data_min else 0
+    key = (_colormap_key(cm), float(data_min), float(colors_ratio), resolution, rounding)
+    with _luts_cache_lock:
+        lut = _luts_cache.get(key)
+        if lut is not None:
+            _luts_cache.move_to_end(key)
+            return lut
+    lut = ColorsLUT(_sample_colormap(cm, resolution), float(data_min), float(colors_ratio), rounding, key)
+    with _luts_cache_lock:
+        _luts_cache[key] = lut
+        while len(_luts_cache) > LUTS_CACHE_SIZE:
+            _luts_cache.popitem(last=False)
+    return lut
+
+
+def calc_colors_from_lut(x, cm, data_min, data_max=None, colors_ratio=None, resolution=None, rounding='rint'):
+    return get_colors_lut(cm, data_min, data_max, colors_ratio, resolution, rounding)(x)
+
+
+def calc_two_colormaps_colors(x, x_min, x_max, cm_big='YlOrRd', cm_small='PuBu', threshold=0, default_val=0,
+                              flip_cm_big=False, flip_cm_small=False):
+    # Diverging scheme: x >= threshold are colored by cm_big in [threshold, x_max],
+    # x <= -threshold are colored by cm_small in [x_min, -threshold]
+    x = np.asarray(x)
+    colors = np.ones((len(x), 3)) * default_val
+    big, small = x >= threshold, x <= -threshold
+    if np.any(big):
+        if not flip_cm_big:
+            colors[big] = calc_colors_from_lut(x[big], cm_big, threshold, x_max, rounding='floor')[:, :3]
+        else:
+            colors[big] = calc_colors_from_lut(-x[big], cm_big, -x_max, -threshold, rounding='floor')[:, :3]
+    if np.any(small):
+        if not flip_cm_small:
+            colors[small] = calc_colors_from_lut(x[small], cm_small, x_min, -threshold, rounding='floor')[:, :3]
+        else:
+            colors[small] = calc_colors_from_lut(-x[small], cm_small, threshold, -x_min, rounding='floor')[:, :3]
+    return colors
+
+
+def clear_luts_cache():
+    with _luts_cache_lock:
+        _luts_cache.clear()
+
+
+def _colormap_key(cm):
+    if isinstance(cm, str):
+        return cm
+    elif isinstance(cm, np.ndarray):
+        return hash(cm.tobytes()), cm.shape
+    else:
+        # matplotlib colormap
+        return cm.name, cm.N
+
+
+def _colormap_len(cm):
+    if isinstance(cm, np.ndarray):
+        return len(cm)
+    return _get_mpl_colormap(cm).N
+
+
+def _get_mpl_colormap(cm):
+    if isinstance(cm, str):
+        import matplotlib.pyplot as plt
+        return plt.get_cmap(cm)
+    return cm
+
+
+def _sample_colormap(cm, resolution=None):
+    if isinstance(cm, np.ndarray):
+        colors = cm.astype(np.float32)
+        if resolution is not None and resolution != len(cm):
+            org_x, new_x = np.linspace(0, 1, len(cm)), np.linspace(0, 1, resolution)
+            colors = np.column_stack([np.interp(new_x, org_x, colors[:, k]) for k in range(colors.shape[1])])
+        return np.ascontiguousarray(colors, dtype=np.float32)
+    mpl_cm = _get_mpl_colormap(cm)
+    if resolution is None:
+        resolution = mpl_cm.N
+    # Sample the colormap in its bins centers, like to_rgba does
+    return mpl_cm((np.arange(resolution) + 0.5) / resolution).astype(np.float32)
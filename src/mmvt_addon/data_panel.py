@@ -395,6 +395,7 @@ def recalc_eeg_mesh_faces_verts():
     ply_file_name = op.join(mu.get_user_fol(), 'eeg', 'eeg_helmet.ply')
     utils.calc_ply_faces_verts(verts, faces, out_file, overwrite=True)
     utils.write_ply_file(verts, faces, ply_file_name, write_also_npz=True)
+    mu.get_lookups_registry().add_file(out_file)
 
 
 class ImportRois(bpy.types.Operator):
@@ -639,6 +640,7 @@ class CreateEEGMesh(bpy.types.Operator):
 def add_data_to_brain(source_files):
     print('Adding data to Brain')
     conditions = []
+    now, keyframes_num = time.time(), 0
     for f in source_files:
         T = len(f['data'][0])
         for obj_name, data in zip(f['names'], f['data']):
@@ -656,23 +658,15 @@ def add_data_to_brain(source_files):
                 print('keyframing {}'.format(obj_name))
                 for cond_ind, cond_str in enumerate(f['conditions']):
                     cond_str = cond_str.astype(str)
-                    # Set the values to zeros in the first and last frame for current object(current label)
-                    mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, 1)
-                    mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, len(f['data'][0]) + 2)
-    
-                    # For every time point insert keyframe to current object
-                    for ind, t in enumerate(data[:, cond_ind]):
-                        mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, t, ind + 2)
-    
+                    # Zeros in the first and last frame, and a keyframe for every time point
+                    keyframes_num += mu.insert_keyframes_to_custom_prop(
+                        cur_obj, obj_name + '_' + cond_str, data[:, cond_ind], len(f['data'][0]) + 2)
                     # remove the orange keyframe sign in the fcurves window
                     fcurves = bpy.data.objects[obj_name].animation_data.action.fcurves[cond_ind]
                     mod = fcurves.modifiers.new(type='LIMITS')
             elif bpy.context.scene.add_meg_labels_data_overwrite:
                 for fcurve_ind, fcurve in enumerate(cur_obj.animation_data.action.fcurves):
-                    fcurve.keyframe_points[0].co[1] = 0
-                    fcurve.keyframe_points[-1].co[1] = 0
-                    for t in range(T):
-                        fcurve.keyframe_points[t + 1].co[1] = data[t, fcurve_ind]
+                    keyframes_num += mu.set_fcurve_values(fcurve, data[:T, fcurve_ind])
 
         conditions.extend(f['conditions'])
     try:
@@ -686,7 +680,7 @@ def add_data_to_brain(source_files):
     if bpy.data.objects.get(' '):
         bpy.context.scene.objects.active = bpy.data.objects[' ']
     selection_panel.set_conditions_enum(conditions)
-    print('Finished keyframing!!')
+    mu.print_keyframing_throughput(keyframes_num, now)
 
 
 # def add_data_to_parent_brain_obj(brain_sources, subcorticals_sources, stat=STAT_DIFF):
@@ -794,35 +788,24 @@ def add_data_to_parent_obj(parent_obj, source_files, stat):
     N = len(sources_names)
     T = len(sources[sources_names[0]]) + 2
     fcurves_num = mu.count_fcurves(parent_obj)
+    now, keyframes_num = time.time(), 0
     if fcurves_num < len(sources_names):
         parent_obj.animation_data_clear()
-        now = time.time()
         for obj_counter, source_name in enumerate(sources_names):
             mu.time_to_go(now, obj_counter, N, runs_num_to_print=10)
-            data = sources[source_name]
-            # Set the values to zeros in the first and last frame for Brain object
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, 1)
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, T)
-
-            # For every time point insert keyframe to the main Brain object
-            for ind in range(data.shape[0]):
-                mu.insert_keyframe_to_custom_prop(parent_obj, source_name, data[ind], ind + 2)
-
+            # Zeros in the first and last frame, and a keyframe for every time point
+            keyframes_num += mu.insert_keyframes_to_custom_prop(parent_obj, source_name, sources[source_name], T)
             # remove the orange keyframe sign in the fcurves window
             fcurves = parent_obj.animation_data.action.fcurves[obj_counter]
             mod = fcurves.modifiers.new(type='LIMITS')
     else:
         for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
             fcurve_name = mu.get_fcurve_name(fcurve)
-            fcurve.keyframe_points[0].co[1] = 0
-            fcurve.keyframe_points[-1].co[1] = 0
-            T = min([len(fcurve.keyframe_points) - 1, len(sources[fcurve_name])])
-            for t in range(T):
-                fcurve.keyframe_points[t + 1].co[1] = sources[fcurve_name][t]
+            keyframes_num += mu.set_fcurve_values(fcurve, sources[fcurve_name])
 
     if bpy.data.objects.get(' '):
         bpy.context.scene.objects.active = bpy.data.objects[' ']
-    print('Finished keyframing the brain parent obj!!')
+    mu.print_keyframing_throughput(keyframes_num, now, 'keyframing the brain parent obj')
 
 
 class AddDataToBrain(bpy.types.Operator):
@@ -941,6 +924,7 @@ def add_data_to_electrodes(all_data, meta_data, window_len=None, conditions=None
     if isinstance(conditions, str):
         conditions = [conditions]
     print('keyframing for {}'.format(meta_data['names']))
+    keyframes_num = 0
     for obj_counter, (obj_name, data) in enumerate(zip(meta_data['names'], all_data)):
         mu.time_to_go(now, obj_counter, N, runs_num_to_print=10)
         obj_name = obj_name.astype(str)
@@ -954,28 +938,21 @@ def add_data_to_electrodes(all_data, meta_data, window_len=None, conditions=None
             cur_obj.animation_data_clear()
             for cond_ind, cond_str in enumerate(conditions):
                 cond_str = cond_str.astype(str) if not isinstance(cond_str, str) else cond_str
-                # Set the values to zeros in the first and last frame for current object(current label)
-                mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, 1)
-                # todo: +2? WTF?!?
-                mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + cond_str, 0, T + 2)
-
                 print('keyframing ' + obj_name + ' object in condition ' + cond_str)
-                # For every time point insert keyframe to current object
+                # Zeros in the first and last frame, and a keyframe for every time point
+                # todo: +2? WTF?!?
                 data_cond_ind = conditions.index(cond_str) #np.where(conditions == cond_str)[0][0]
-                for ind, t in enumerate(data[:T, data_cond_ind]):
-                    mu.insert_keyframe_to_custom_prop(cur_obj, obj_name + '_' + str(cond_str), t, ind + 2)
+                keyframes_num += mu.insert_keyframes_to_custom_prop(
+                    cur_obj, obj_name + '_' + str(cond_str), data[:T, data_cond_ind], T + 2)
                 # remove the orange keyframe sign in the fcurves window
                 fcurves = bpy.data.objects[obj_name].animation_data.action.fcurves[cond_ind]
                 mod = fcurves.modifiers.new(type='LIMITS')
         else:
             for fcurve_ind, fcurve in enumerate(cur_obj.animation_data.action.fcurves):
-                fcurve.keyframe_points[0].co[1] = 0
-                fcurve.keyframe_points[-1].co[1] = 0
-                for t in range(T):
-                    fcurve.keyframe_points[t + 1].co[1] = data[t, fcurve_ind]
+                keyframes_num += mu.set_fcurve_values(fcurve, data[:T, fcurve_ind])
 
     conditions = meta_data['conditions']
-    print('Finished keyframing!!')
+    mu.print_keyframing_throughput(keyframes_num, now)
     return conditions
 
 
@@ -1001,30 +978,22 @@ def add_data_to_electrodes_parent_obj(parent_obj, all_data, meta, stat=STAT_DIFF
     N = len(sources_names)
     # T = _addon().get_max_time_steps() # len(sources[sources_names[0]]) + 2
     fcurves_num = mu.count_fcurves(parent_obj)
+    now, keyframes_num = time.time(), 0
     if fcurves_num < len(sources_names):
-        now = time.time()
         parent_obj.animation_data_clear()
         for obj_counter, source_name in enumerate(sources_names):
             mu.time_to_go(now, obj_counter, N, runs_num_to_print=10)
-            data = sources[source_name]
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, 1)
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, T + 2)
-
-            for ind in range(T):
-                mu.insert_keyframe_to_custom_prop(parent_obj, source_name, data[ind], ind + 2)
-
+            keyframes_num += mu.insert_keyframes_to_custom_prop(
+                parent_obj, source_name, sources[source_name][:T], T + 2)
             fcurves = parent_obj.animation_data.action.fcurves[obj_counter]
             mod = fcurves.modifiers.new(type='LIMITS')
     else:
         for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
             fcurve_name = mu.get_fcurve_name(fcurve)
-            fcurve.keyframe_points[0].co[1] = 0
-            fcurve.keyframe_points[-1].co[1] = 0
-            for t in range(T):
-                fcurve.keyframe_points[t + 1].co[1] = sources[fcurve_name][t]
+            keyframes_num += mu.set_fcurve_values(fcurve, sources[fcurve_name][:T])
 
     mu.view_all_in_graph_editor()
-    print('Finished keyframing {}!!'.format(parent_obj.name))
+    mu.print_keyframing_throughput(keyframes_num, now, 'keyframing {}'.format(parent_obj.name))
 
 
 def load_meg_labels_data():
@@ -1,4 +1,5 @@
 from src.mmvt_addon.dell import find_electrodes_in_ct as fect
+from src.mmvt_addon import surf_adjacency as sa
 import numpy as np
 import os.path as op
 import nibabel as nib
@@ -6,6 +7,7 @@ from itertools import product
 from scipy.spatial.distance import cdist
 
 from src.utils import utils
+from src.utils import geometry_utils as gu
 
 MMVT_DIR = utils.get_link_dir(utils.get_links_dir(), 'mmvt')
 
@@ -107,12 +109,10 @@ def calc_dist_on_cylinder(elc1, elc2, threshold, output_fol, error_radius):
 def check_if_outside_pial(threshold, user_fol, output_fol, subject_fol, ct_header, brain, aseg, sigma=2):
     (electrodes, names, hemis, threshold) = utils.load(op.join(output_fol, '{}_electrodes.pkl'.format(int(threshold))))
     all_voxels = fect.t1_ras_tkr_to_ct_voxels(electrodes, ct_header, brain.header)
-    voxels = fect.t1_ras_tkr_to_ct_voxels(electrodes, ct_header, brain.header)
-    voxels_in, voxels_in_indices = fect.mask_voxels_outside_brain(
-        voxels, ct_header, brain, user_fol, subject_fol, aseg, None, sigma)
-    indices_outside_brain = list(set(range(len(voxels))) - set(voxels_in_indices))
+    inside = gu.points_inside_dural(subject_fol, electrodes, sigma)
+    indices_outside_brain = np.where(~(inside['rh'] | inside['lh']))[0]
     outside_voxels = all_voxels[indices_outside_brain]
-    outside_voxels_norm = [np.linalg.norm(v) for v in outside_voxels]
+    outside_voxels_norm = np.linalg.norm(outside_voxels, axis=1)
     plt.hist(outside_voxels_norm, bins=40)
     plt.show()
     print('asdf')
@@ -222,14 +222,11 @@ def load_find_electrode_lead_log(output_fol, logs_fol, log_name, threshold, elc1
 
 
 def check_voxel_dist_to_dural(voxel, subject_fol, ct_header, brain_header, sigma):
-    verts, faces, normals = fect.get_dural_surface(subject_fol, do_calc_normals=True)
+    dural_surfaces = gu.get_dural_surfaces(subject_fol)
     electrodes_t1_tkreg = fect.ct_voxels_to_t1_ras_tkr(voxel, ct_header, brain_header)
     for hemi in ['rh', 'lh']:
-        dists = cdist([electrodes_t1_tkreg], verts[hemi])
-        close_verts_indices = np.argmin(dists, axis=1)[0]
-        inside, v = fect.point_in_mesh(electrodes_t1_tkreg, verts[hemi][close_verts_indices],
-                                       normals[hemi][close_verts_indices], sigma=sigma, return_v=True)
-        print(hemi, inside, v)
+        v = dural_surfaces[hemi].calc_dists_along_normals(electrodes_t1_tkreg)[0] + sigma
+        print(hemi, not(v < 0.0), v)
 
 
 def check_voxels_around_electrodes_in_group(ct_data, output_fol, threshold, ct_header, brain_header):
@@ -330,8 +327,7 @@ if __name__ == '__main__':
     user_fol = op.join(mmvt_dir, subject)
     subject_fol = op.join(subjects_dir, subject)
 
-    verts_dural_neighbors_fname = op.join(mmvt_dir, subject, 'verts_neighbors_dural_{hemi}.pkl')
-    verts_dural_nei = {hemi:utils.load(verts_dural_neighbors_fname.format(hemi=hemi)) for hemi in utils.HEMIS}
+    verts_dural_nei = {hemi:sa.load_surf_adjacency(user_fol, hemi, 'dural') for hemi in utils.HEMIS}
     verts_dural = fect.read_surf_verts(user_fol, 'dural')
 
     # find_local_maxima_from_voxels([97, 88, 125], ct_data, threshold, find_nei_maxima=False)
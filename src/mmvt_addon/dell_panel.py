@@ -12,6 +12,8 @@ import time
 import csv
 from itertools import cycle
 import mmvt_utils as mu
+import surf_adjacency as sa
+import dural_surface as ds
 from scripts import scripts_utils as su
 
 try:
@@ -623,14 +625,17 @@ def open_interactive_ct_viewer():
         mu.run_command_in_new_thread(cmd, False)
 
 
+def points_inside_dural(points, sigma=0):
+    # Like point_in_mesh, for all the points at once, using the dural surfaces from init_dural
+    return {hemi: DellPanel.dural_surfaces[hemi].points_inside(points, sigma) for hemi in mu.HEMIS}
+
+
 def check_if_outside_pial():
-    # aseg = None if not bpy.context.scene.dell_brain_mask_use_aseg else DellPanel.aseg
-    # subject_fol = op.join(mu.get_subjects_dir(), mu.get_user())
-    voxels = fect.t1_ras_tkr_to_ct_voxels(DellPanel.pos, DellPanel.ct.header, DellPanel.brain.header)
-    voxels_in, voxels_in_indices = fect.mask_voxels_outside_brain(
-        voxels, DellPanel.ct.header, DellPanel.brain, mu.get_user_fol(),
-        bpy.context.scene.dell_brain_mask_sigma)
-    indices_outside_brain = set(range(len(voxels))) - set(voxels_in_indices)
+    if len(DellPanel.dural_surfaces) == 0 and not init_dural():
+        print('check_if_outside_pial: No dural surface!')
+        return
+    inside = points_inside_dural(DellPanel.pos, bpy.context.scene.dell_brain_mask_sigma)
+    indices_outside_brain = np.where(~(inside['rh'] | inside['lh']))[0]
     for ind in indices_outside_brain:
         _addon().object_coloring(bpy.data.objects[DellPanel.names[ind]], (0, 1, 0))
 
@@ -1295,6 +1300,7 @@ class DellPanel(bpy.types.Panel):
     play_time_step = 0.7
     max_finding_group_tries = 10
     log, current_log = [], []
+    dural_surfaces = {}
     debug_fol = ''
     update_position = True
 
@@ -1404,14 +1410,14 @@ def init_ct(ct_name='ct_reg_to_mr.mgz', brain_mask_name='brain.mgz', aseg_name='
 def init_dural():
     try:
         user_fol = mu.get_user_fol()
-        verts_dural_neighbors_fname = op.join(user_fol, 'verts_neighbors_dural_{hemi}.pkl')
-        DellPanel.verts_dural_nei = {hemi:mu.load(verts_dural_neighbors_fname.format(hemi=hemi)) \
-            if op.isfile(verts_dural_neighbors_fname.format(hemi=hemi)) else None for hemi in mu.HEMIS}
+        DellPanel.verts_dural_nei = {hemi:sa.load_surf_adjacency(user_fol, hemi, 'dural') for hemi in mu.HEMIS}
         DellPanel.verts_dural, DellPanel.faces_dural = fect.read_surf_verts(user_fol, 'dural', True)
         if DellPanel.verts_dural['rh'] is None or DellPanel.faces_dural['rh'] is None:
             return False
         DellPanel.normals_dural = {hemi:fect.calc_normals(DellPanel.verts_dural[hemi], DellPanel.faces_dural[hemi])
                                    for hemi in mu.HEMIS}
+        DellPanel.dural_surfaces = {hemi:ds.DuralSurface(DellPanel.verts_dural[hemi], DellPanel.normals_dural[hemi])
+                                    for hemi in mu.HEMIS}
         return True
     except:
         print(traceback.format_exc())
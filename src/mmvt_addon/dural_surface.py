@@ -0,0 +1,26 @@
+import numpy as np
+
+# A hemi's dural surface with a KD-tree of its vertices, to test if points are inside the dura, like
+# geometry_utils.point_in_mesh, for all the points (and sigmas) at once. A point is inside if its distance from
+# its closest vertex, along the vertex normal, plus sigma, isn't negative.
+# Used by both the preproc (geometry_utils) and the addon (dell_panel).
+
+
+class DuralSurface(object):
+    def __init__(self, verts, normals):
+        from scipy.spatial import cKDTree
+        self.verts, self.normals = np.asarray(verts, dtype=np.float64), normals
+        self.tree = cKDTree(self.verts)
+
+    def calc_dists_along_normals(self, points):
+        # The distance of the points from their closest vertices, along the vertices normals
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 3))
+        _, close_verts_indices = self.tree.query(points, k=1)
+        return np.einsum('ij,ij->i', points - self.verts[close_verts_indices], self.normals[close_verts_indices])
+
+    def points_inside(self, points, sigmas=0):
+        # (points_num) bools for a scalar sigma, (sigmas_num x points_num) for a list of sigmas
+        v = self.calc_dists_along_normals(points)
+        if np.isscalar(sigmas):
+            return ~(v + sigmas < 0)
+        return ~(v[np.newaxis, :] + np.asarray(sigmas, dtype=np.float64)[:, np.newaxis] < 0)
@@ -1,6 +1,7 @@
 import os.path as op
 import numpy as np
 import glob
+import traceback
 from queue import Empty
 try:
     from scipy.spatial.distance import cdist
@@ -11,9 +12,13 @@ try:
     import bpy
     import bpy_extras
     import mmvt_utils as mu
+    import clusters_tree
+    import surf_adjacency as sa
     BLENDER_EMBEDDED = True
 except:
     from src.mmvt_addon import mmvt_utils as mu
+    from src.mmvt_addon import clusters_tree
+    from src.mmvt_addon import surf_adjacency as sa
     bpy = mu.dummy_bpy()
     BLENDER_EMBEDDED = False
 
@@ -132,6 +137,41 @@ def plot_blob(cluster_labels, faces_verts, is_inflated=None, use_abs=None):
         fMRIPanel.colors_in_hemis[other_hemi] = False
 
 
+def get_clusters_trees(fmri_file_name):
+    # The clusters trees of the fMRI contrast, to query the clusters in any threshold
+    if fmri_file_name in fMRIPanel.clusters_trees:
+        return fMRIPanel.clusters_trees[fmri_file_name]
+    user_fol = mu.get_user_fol()
+    fname_template = op.join(user_fol, 'fmri', 'fmri_*{}*{}.npy'.format('{hemi}', fmri_file_name))
+    if not mu.both_hemi_files_exist(fname_template):
+        fname_template = op.join(user_fol, 'fmri', 'fmri_*{}*{}.npy'.format(fmri_file_name, '{hemi}'))
+    if not mu.both_hemi_files_exist(fname_template):
+        return None
+    trees = {}
+    for hemi in mu.HEMIS:
+        adjacency = sa.load_surf_adjacency(user_fol, hemi)
+        if adjacency is None:
+            return None
+        contrast_fname = glob.glob(fname_template.format(hemi=hemi))[0]
+        trees[hemi] = clusters_tree.load_clusters_tree(contrast_fname, adjacency)
+    fMRIPanel.clusters_trees[fmri_file_name] = trees
+    return trees
+
+
+def fmri_clustering_threshold_update(self, context):
+    try:
+        trees = get_clusters_trees(_addon().coloring.get_select_fMRI_contrast())
+        if trees is None:
+            fMRIPanel.clusters_preview = None
+            return
+        threshold = bpy.context.scene.fmri_clustering_threshold
+        sizes = np.concatenate([trees[hemi].clusters_sizes(threshold) for hemi in mu.HEMIS])
+        fMRIPanel.clusters_preview = (len(sizes), sizes.max() if len(sizes) > 0 else 0)
+    except:
+        print(traceback.format_exc())
+        fMRIPanel.clusters_preview = None
+
+
 def calc_clusters():
     import importlib
     mu.add_mmvt_code_root_to_path()
@@ -642,6 +682,8 @@ def fMRI_draw(self, context):
     if not fMRIPanel.fMRI_clusters_files_exist and _addon().coloring.fMRI_constrasts_exist() > 0:
         row = layout.row(align=True)
         row.prop(context.scene, 'fmri_clustering_threshold', text='Threshold')
+        if fMRIPanel.clusters_preview is not None:
+            layout.label(text='{} clusters, max size {}'.format(*fMRIPanel.clusters_preview))
         layout.operator(CalcClusters.bl_idname, text="Find clusters", icon='GROUP_VERTEX')
         return
     layout.prop(context.scene, 'fmri_clusters_labels_files', text='')
@@ -851,7 +893,7 @@ try:
     bpy.types.Scene.fmri_cluster_size_threshold = bpy.props.FloatProperty(default=50,
         description='clusters size threshold', min=1, max=2000, update=fmri_clusters_update)
     bpy.types.Scene.fmri_clustering_threshold = bpy.props.FloatProperty(default=2,
-        description='clustering threshold', min=0, max=20)
+        description='clustering threshold', min=0, max=20, update=fmri_clustering_threshold_update)
     bpy.types.Scene.fmri_clusters_labels_files = bpy.props.EnumProperty(
         items=[], description="fMRI files", update=fmri_clusters_labels_files_update)
     bpy.types.Scene.fmri_clusters_labels_parcs = bpy.props.EnumProperty(
@@ -898,6 +940,8 @@ class fMRIPanel(bpy.types.Panel):
     constrast = {'rh':None, 'lh':None}
     clusters_labels_file_names = []
     clusters_labels_files = []
+    clusters_trees = {}
+    clusters_preview = None
 
     @classmethod
     def poll(cls, context):
@@ -917,6 +961,7 @@ def init(addon):
     fMRIPanel.addon = addon
     fMRIPanel.lookup, fMRIPanel.clusters_labels = {}, {}
     fMRIPanel.cluster_labels = {}
+    fMRIPanel.clusters_trees, fMRIPanel.clusters_preview = {}, None
     files_names, clusters_labels_files, clusters_labels_items = get_clusters_files(user_fol)
     fMRIPanel.fMRI_clusters_files_exist = len(files_names) > 0 # and len(fmri_blobs) > 0
     if not fMRIPanel.fMRI_clusters_files_exist:
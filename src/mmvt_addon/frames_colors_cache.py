@@ -0,0 +1,115 @@
+import threading
+import traceback
+import numpy as np
+from collections import OrderedDict
+from queue import Queue, Empty
+
+
+# A frames colors cache for the activity playback. For each frame it keeps the quantized per-vertex colors
+# indices (uint8, see colors_utils.ColorsLUT) and the vertices above the threshold.
+# The cached frames are valid for one set of parameters (threshold, use_abs and the colors LUT). When the
+# parameters change (new threshold, colormap or colorbar limits) the whole cache is invalidated.
+
+
+def calc_frame_colors(values, lut, threshold, use_abs, bigger_or_equall=False):
+    values = values[:, 0] if values.ndim > 1 else values
+    abs_values = np.abs(values) if use_abs else values
+    valid_verts = np.where(abs_values >= threshold if bigger_or_equall else abs_values > threshold)[0]
+    return lut.indices(values), valid_verts.astype(np.int32)
+
+
+class FramesColorsCache(object):
+    def __init__(self, memory_budget_mb=512):
+        self.frames = OrderedDict()
+        self.memory_budget = memory_budget_mb * 1024 ** 2
+        self.memory_used = 0
+        self.params = None
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        self.thread = None
+
+    def set_memory_budget(self, memory_budget_mb):
+        with self.lock:
+            self.memory_budget = memory_budget_mb * 1024 ** 2
+            self._evict()
+
+    def check_params(self, params):
+        # Invalidates the cache if the parameters were changed
+        with self.lock:
+            if params != self.params:
+                self._clear()
+                self.params = params
+
+    def get(self, key, params):
+        with self.lock:
+            if params != self.params or key not in self.frames:
+                self.misses += 1
+                return None
+            self.frames.move_to_end(key)
+            self.hits += 1
+            return self.frames[key]
+
+    def put(self, key, params, frame_colors):
+        frame_size = sum([x.nbytes for x in frame_colors])
+        with self.lock:
+            if params != self.params or frame_size > self.memory_budget:
+                return
+            if key in self.frames:
+                self.memory_used -= sum([x.nbytes for x in self.frames.pop(key)])
+            self.frames[key] = frame_colors
+            self.memory_used += frame_size
+            self._evict()
+
+    def contains(self, key, params):
+        with self.lock:
+            return params == self.params and key in self.frames
+
+    def prefetch(self, keys, params, load_func, lut, threshold, use_abs):
+        # Calculates the frames colors of keys in a background thread. load_func(key) returns the frame's values
+        for key in keys:
+            if not self.contains(key, params):
+                self.queue.put((key, params, load_func, lut, threshold, use_abs))
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._prefetch_worker, daemon=True)
+            self.thread.start()
+
+    def clear(self):
+        with self.lock:
+            self._clear()
+
+    def stats(self):
+        with self.lock:
+            return dict(frames=len(self.frames), memory_mb=self.memory_used / 1024 ** 2, hits=self.hits,
+                        misses=self.misses)
+
+    def _prefetch_worker(self):
+        while True:
+            try:
+                key, params, load_func, lut, threshold, use_abs = self.queue.get(timeout=1)
+            except Empty:
+                return
+            try:
+                if self.contains(key, params) or params != self.params:
+                    continue
+                values = load_func(key)
+                if values is not None:
+                    self.put(key, params, calc_frame_colors(values, lut, threshold, use_abs))
+            except:
+                print('FramesColorsCache: Error in prefetching {}'.format(key))
+                print(traceback.format_exc())
+
+    def _clear(self):
+        self.frames.clear()
+        self.memory_used = 0
+        # Drop the pending prefetching requests
+        while not self.queue.empty():
+            try:
+                self.queue.get_nowait()
+            except Empty:
+                break
+
+    def _evict(self):
+        while self.memory_used > self.memory_budget and len(self.frames) > 0:
+            _, frame_colors = self.frames.popitem(last=False)
+            self.memory_used -= sum([x.nbytes for x in frame_colors])
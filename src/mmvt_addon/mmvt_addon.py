@@ -183,6 +183,7 @@ clear_subcortical_fmri_activity = coloring_panel.clear_subcortical_fmri_activity
 clear_cortex = coloring_panel.clear_cortex
 clear_object_vertex_colors = coloring_panel.clear_object_vertex_colors
 color_objects_homogeneously = coloring_panel.color_objects_homogeneously
+objects_coloring = coloring_panel.objects_coloring
 init_activity_map_coloring = coloring_panel.init_activity_map_coloring
 load_faces_verts = coloring_panel.load_faces_verts
 load_meg_subcortical_activity = coloring_panel.load_meg_subcortical_activity
@@ -209,6 +210,7 @@ get_lower_threshold = coloring_panel.get_lower_threshold
 create_inflated_curv_coloring = coloring_panel.create_inflated_curv_coloring
 color_eeg_helmet = coloring_panel.color_eeg_helmet
 calc_colors = coloring_panel.calc_colors
+get_colors_lut = coloring_panel.get_colors_lut
 init_meg_labels_coloring_type = coloring_panel.init_meg_labels_coloring_type
 color_connections = coloring_panel.color_connections
 plot_meg = coloring_panel.plot_meg
@@ -232,6 +234,11 @@ get_meg_sensors_data = coloring_panel.get_meg_sensors_data
 get_eeg_sensors_data = coloring_panel.get_eeg_sensors_data
 color_labels_data = coloring_panel.color_labels_data
 color_hemi_data = coloring_panel.color_hemi_data
+color_hemi_frame = coloring_panel.color_hemi_frame
+get_frames_colors_cache = coloring_panel.get_frames_colors_cache
+clear_frames_colors_cache = coloring_panel.clear_frames_colors_cache
+get_incremental_coloring_stats = coloring_panel.get_incremental_coloring_stats
+clear_incremental_coloring_stats = coloring_panel.clear_incremental_coloring_stats
 coloring_panel_initialized = coloring_panel.panel_initialized
 get_no_plotting = coloring_panel.get_no_plotting
 set_no_plotting = coloring_panel.set_no_plotting
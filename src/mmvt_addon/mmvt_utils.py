@@ -14,6 +14,14 @@ try:
 except:
     pass
 
+try:
+    import colors_utils as cu
+except:
+    try:
+        from src.mmvt_addon import colors_utils as cu
+    except:
+        pass
+
 
 try:
     import scipy
@@ -256,6 +264,65 @@ def insert_keyframe_to_custom_prop(obj, prop_name, value, keyframe):
     obj.keyframe_insert(data_path='[' + '"' + prop_name + '"' + ']', frame=keyframe)
 
 
+def insert_keyframes_to_custom_prop(obj, prop_name, values, last_frame=None):
+    # Bulk version of insert_keyframe_to_custom_prop. Sets the prop's F-curve keyframes at once:
+    # 0 at frame 1, the values at frames 2..len(values)+1, and 0 at last_frame (default len(values) + 2).
+    # If the F-curve already exists its keyframes are replaced in place. Returns the number of keyframes.
+    values = np.asarray(values, dtype=np.float32).ravel()
+    last_frame = len(values) + 2 if last_frame is None else last_frame
+    co = np.zeros((len(values) + 2, 2), dtype=np.float32)
+    co[:-1, 0] = np.arange(1, len(values) + 2)
+    co[-1, 0] = last_frame
+    co[1:-1, 1] = values
+    if prop_name not in obj.keys():
+        obj[prop_name] = 0.0
+    if obj.animation_data is None:
+        obj.animation_data_create()
+    if obj.animation_data.action is None:
+        obj.animation_data.action = bpy.data.actions.new('{}Action'.format(obj.name))
+    data_path = '["{}"]'.format(prop_name)
+    fcurves = obj.animation_data.action.fcurves
+    fcurve = fcurves.find(data_path)
+    if fcurve is None:
+        fcurve = fcurves.new(data_path)
+    set_fcurve_keyframes(fcurve, co)
+    return len(co)
+
+
+def set_fcurve_keyframes(fcurve, co):
+    # co: (N, 2) array of (frame, value)
+    keyframe_points = fcurve.keyframe_points
+    if len(keyframe_points) < len(co):
+        keyframe_points.add(len(co) - len(keyframe_points))
+    while len(keyframe_points) > len(co):
+        keyframe_points.remove(keyframe_points[-1], fast=True)
+    keyframe_points.foreach_set('co', np.ascontiguousarray(co, dtype=np.float32).ravel())
+    # Sorts the keyframes and recalculates the handles
+    fcurve.update()
+
+
+def set_fcurve_values(fcurve, values):
+    # Replaces the values of the keyframes between the first and last (zeros) ones, without changing their frames.
+    # Returns the number of values set
+    keyframe_points = fcurve.keyframe_points
+    if len(keyframe_points) == 0:
+        return 0
+    co = np.empty(len(keyframe_points) * 2, dtype=np.float32)
+    keyframe_points.foreach_get('co', co)
+    co = co.reshape((-1, 2))
+    N = max(min(len(values), len(co) - 2), 0)
+    co[1:N + 1, 1] = np.asarray(values[:N], dtype=np.float32).ravel()
+    co[0, 1] = co[-1, 1] = 0
+    set_fcurve_keyframes(fcurve, co)
+    return N
+
+
+def print_keyframing_throughput(keyframes_num, start_time, title='keyframing'):
+    took = time.time() - start_time
+    print('Finished {}: {} keyframes in {:.2f}s ({:.0f} keyframes/s)'.format(
+        title, keyframes_num, took, keyframes_num / took if took > 0 else 0))
+
+
 def create_and_set_material(obj):
     # curMat = bpy.data.materials['OrigPatchesMat'].copy()
     if obj.active_material is None or obj.active_material.name != obj.name + '_Mat':
@@ -1187,18 +1254,293 @@ def create_empty_in_vertex(vertex_location, obj_name, layer, parent_name=''):
         bpy.context.object.parent = bpy.data.objects[parent_name]
 
 
-def read_ply_file(ply_file):
-    with open(ply_file, 'r') as f:
-        lines = f.readlines()
-        verts_num = int(lines[2].split(' ')[-1])
-        faces_num = int(lines[6].split(' ')[-1])
-        verts_lines = lines[9:9 + verts_num]
-        faces_lines = lines[9 + verts_num:]
-        verts = np.array([list(map(float, l.strip().split(' '))) for l in verts_lines])
-        faces = np.array([list(map(int, l.strip().split(' '))) for l in faces_lines])[:,1:]
+PLY_BINARY_HEADER = 'ply\nformat binary_little_endian 1.0\nelement vertex {}\nproperty float x\nproperty float y\n' + \
+                    'property float z\nelement face {}\nproperty list uchar int vertex_index\nend_header\n'
+PLY_TYPES = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1', 'short': 'i2', 'int16': 'i2',
+             'ushort': 'u2', 'uint16': 'u2', 'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+
+def read_ply_header(ply_file):
+    header = Bag(dict(format='', verts_num=0, faces_num=0, verts_props=[], faces_props=('u1', 'i4'), header_len=0))
+    element = ''
+    with open(ply_file, 'rb') as f:
+        for line in f:
+            header.header_len += len(line)
+            words = line.decode('ascii').strip().split()
+            if len(words) == 0:
+                continue
+            if words[0] == 'format':
+                header.format = words[1]
+            elif words[0] == 'element':
+                element = words[1]
+                if element == 'vertex':
+                    header.verts_num = int(words[2])
+                elif element == 'face':
+                    header.faces_num = int(words[2])
+            elif words[0] == 'property' and element == 'vertex':
+                header.verts_props.append((words[-1], PLY_TYPES[words[1]]))
+            elif words[0] == 'property' and element == 'face' and words[1] == 'list':
+                header.faces_props = (PLY_TYPES[words[2]], PLY_TYPES[words[3]])
+            elif words[0] == 'end_header':
+                break
+    return header
+
+
+def read_ply_file(ply_file, migrate=False):
+    header = read_ply_header(ply_file)
+    if header.format == 'ascii':
+        with open(ply_file, 'r') as f:
+            lines = f.readlines()
+            verts_num = int(lines[2].split(' ')[-1])
+            faces_num = int(lines[6].split(' ')[-1])
+            verts_lines = lines[9:9 + verts_num]
+            faces_lines = lines[9 + verts_num:]
+            verts = np.array([list(map(float, l.strip().split(' '))) for l in verts_lines])
+            faces = np.array([list(map(int, l.strip().split(' '))) for l in faces_lines])[:,1:]
+        if migrate:
+            # One time migration to the binary format
+            try:
+                migrate_ply_file(ply_file, verts, faces)
+            except OSError:
+                print(traceback.format_exc())
+                print("read_ply_file: Can't migrate {} to the binary format".format(ply_file))
+    elif header.format == 'binary_little_endian':
+        verts, faces = read_binary_ply_file(ply_file, header)
+    else:
+        raise Exception('read_ply_file: Unsupported ply format {} ({})'.format(header.format, ply_file))
     return verts, faces
 
 
+def read_binary_ply_file(ply_file, header=None):
+    if header is None:
+        header = read_ply_header(ply_file)
+    verts_dtype = np.dtype([(name, '<' + dtype) for name, dtype in header.verts_props])
+    verts_mm = np.memmap(ply_file, dtype=verts_dtype, mode='r', offset=header.header_len, shape=(header.verts_num,))
+    verts = np.column_stack([verts_mm[k] for k in ['x', 'y', 'z']]).astype(np.float64)
+    faces_offset = header.header_len + verts_dtype.itemsize * header.verts_num
+    count_dtype, index_dtype = header.faces_props
+    if header.faces_num == 0:
+        return verts, np.zeros((0, 3), dtype=int)
+    # Assuming all the faces have the same number of vertices (triangles)
+    face_verts_num = int(np.memmap(ply_file, dtype=count_dtype, mode='r', offset=faces_offset, shape=(1,))[0])
+    faces_dtype = np.dtype([('n', '<' + count_dtype), ('vertex_index', '<' + index_dtype, (face_verts_num,))])
+    faces_mm = np.memmap(ply_file, dtype=faces_dtype, mode='r', offset=faces_offset, shape=(header.faces_num,))
+    if np.any(faces_mm['n'] != face_verts_num):
+        raise Exception('read_binary_ply_file: Not all the faces have {} vertices ({})'.format(
+            face_verts_num, ply_file))
+    faces = np.array(faces_mm['vertex_index'], dtype=int)
+    del verts_mm, faces_mm
+    return verts, faces
+
+
+class VertsLoopsLookup(object):
+    """ Compressed (CSR) vertex -> loops lookup: the loops of vertex v are indices[indptr[v]:indptr[v + 1]]
+        The file is one int32 array: [verts_num, indptr (verts_num + 1), indices]
+    """
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    @property
+    def shape(self):
+        return (len(self.indptr) - 1,)
+
+    def __len__(self):
+        return len(self.indptr) - 1
+
+    def __getitem__(self, vert):
+        return self.indices[self.indptr[vert]:self.indptr[vert + 1]]
+
+    def verts_loops(self, verts):
+        verts = np.asarray(verts, dtype=np.int64).ravel()
+        starts = np.asarray(self.indptr[verts], dtype=np.int64)
+        counts = np.asarray(self.indptr[verts + 1], dtype=np.int64) - starts
+        loops_verts = np.repeat(verts, counts)
+        offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        loops_inds = np.asarray(self.indices[np.repeat(starts, counts) + offsets], dtype=np.int64)
+        return loops_inds, loops_verts
+
+
+def faces_verts_csr_fname(faces_verts_fname):
+    return '{}_csr.npy'.format(op.splitext(faces_verts_fname)[0])
+
+
+def faces_verts_exist(faces_verts_fname):
+    return op.isfile(faces_verts_csr_fname(faces_verts_fname)) or op.isfile(faces_verts_fname)
+
+
+def load_faces_verts_lookup(faces_verts_fname, mmap_mode='r'):
+    # Loads the CSR lookup if exist, otherwise the legacy padded (verts_num, max_valence) lookup
+    csr_fname = faces_verts_csr_fname(faces_verts_fname)
+    if op.isfile(csr_fname):
+        csr = np.load(csr_fname, mmap_mode=mmap_mode)
+        verts_num = int(csr[0])
+        return VertsLoopsLookup(csr[1:verts_num + 2], csr[verts_num + 2:])
+    elif op.isfile(faces_verts_fname):
+        return np.load(faces_verts_fname)
+    else:
+        return None
+
+
+# A process wide index of the lookups (*_faces_verts*.npy, faces_verts_*.npy) and the surfaces npz files under
+# the subject's folder. The folder is walked once, and the loaded files are kept in memory (LRU), and reloaded
+# if they were changed on the disk since.
+LOOKUPS_REGISTRY_SIZE = 256
+_lookups_registry = None
+
+
+class LookupsRegistry(object):
+    def __init__(self, root, max_items=LOOKUPS_REGISTRY_SIZE):
+        self.root = root
+        self.max_items = max_items
+        self.lookups_fnames, self.npz_fnames = {}, {}
+        self.loaded = OrderedDict()
+        self.lock = threading.Lock()
+        self.index()
+
+    def index(self):
+        lookups_fnames, npz_fnames, lookups_fols = {}, {}, set()
+        for fol, _, files in os.walk(self.root):
+            for fname in files:
+                if fname.endswith('.npy') and 'faces_verts' in fname:
+                    name = lookup_name(fname)
+                    if name is not None:
+                        lookups_fnames.setdefault(name, []).append(op.join(fol, lookup_legacy_fname(fname)))
+                        lookups_fols.add(fol)
+                elif fname.endswith('.npz'):
+                    npz_fnames.setdefault(fname[:-len('.npz')], []).append(op.join(fol, fname))
+        # Only the npz files next to the lookups are surfaces files
+        npz_fnames = {name: [f for f in fnames if op.dirname(f) in lookups_fols or
+                             op.basename(op.dirname(f)) == 'surf'] for name, fnames in npz_fnames.items()}
+        with self.lock:
+            self.lookups_fnames = {name: self._sort_by_depth(fnames) for name, fnames in lookups_fnames.items()}
+            self.npz_fnames = {name: self._sort_by_depth(fnames) for name, fnames in npz_fnames.items() if fnames}
+            self.loaded.clear()
+
+    def add_file(self, fname):
+        # Adds a lookup or a surface npz file that was created after the indexing
+        fname = op.abspath(fname)
+        name = lookup_name(op.basename(fname))
+        if name is not None:
+            fnames_dict, fname = self.lookups_fnames, op.join(op.dirname(fname), lookup_legacy_fname(op.basename(fname)))
+        elif fname.endswith('.npz'):
+            fnames_dict, name = self.npz_fnames, namebase(fname)
+        else:
+            return
+        with self.lock:
+            fnames = fnames_dict.get(name, [])
+            if fname not in fnames:
+                fnames_dict[name] = self._sort_by_depth(fnames + [fname])
+
+    def get_lookup_fname(self, name, fol=None):
+        return self._get_fname(self.lookups_fnames, name, fol)
+
+    def get_npz_fname(self, name, fol=None):
+        return self._get_fname(self.npz_fnames, name, fol)
+
+    def get_lookups_names(self, fol):
+        with self.lock:
+            return sorted([name for name, fnames in self.lookups_fnames.items() if
+                           any(op.dirname(f) == op.abspath(fol) for f in fnames)])
+
+    def get_lookup(self, name, fol=None):
+        fname = self.get_lookup_fname(name, fol)
+        if fname is None:
+            return None
+        csr_fname = faces_verts_csr_fname(fname)
+        return self._load(fname, csr_fname if op.isfile(csr_fname) else fname, load_faces_verts_lookup)
+
+    def get_npz(self, name, fol=None):
+        fname = self.get_npz_fname(name, fol)
+        if fname is None:
+            return None
+        return self._load(fname, fname, load_npz_to_dict)
+
+    def clear(self):
+        with self.lock:
+            self.loaded.clear()
+
+    def _get_fname(self, fnames_dict, name, fol):
+        with self.lock:
+            fnames = fnames_dict.get(name, [])
+        if fol is not None:
+            fnames = [f for f in fnames if op.dirname(f) == op.abspath(fol)]
+        return fnames[0] if len(fnames) > 0 else None
+
+    def _load(self, fname, mtime_fname, load_func):
+        try:
+            mtime = op.getmtime(mtime_fname)
+        except OSError:
+            with self.lock:
+                self.loaded.pop(fname, None)
+            return None
+        with self.lock:
+            if fname in self.loaded and self.loaded[fname][0] == mtime:
+                self.loaded.move_to_end(fname)
+                return self.loaded[fname][1]
+        data = load_func(fname)
+        with self.lock:
+            self.loaded[fname] = (mtime, data)
+            while len(self.loaded) > self.max_items:
+                self.loaded.popitem(last=False)
+        return data
+
+    def _sort_by_depth(self, fnames):
+        return sorted(fnames, key=lambda f: (f.count(os.sep), f))
+
+
+def load_npz_to_dict(fname):
+    with np.load(fname) as d:
+        return {k: d[k] for k in d.files}
+
+
+def lookup_name(fname):
+    # '{name}_faces_verts[_csr].npy' or 'faces_verts_{name}[_csr].npy'
+    fname = namebase(fname)
+    if fname.endswith('_csr'):
+        fname = fname[:-len('_csr')]
+    if fname.endswith('_faces_verts'):
+        return fname[:-len('_faces_verts')]
+    elif fname.startswith('faces_verts_'):
+        return fname[len('faces_verts_'):]
+    else:
+        return None
+
+
+def lookup_legacy_fname(fname):
+    # The lookups are loaded by their legacy name (see load_faces_verts_lookup)
+    return fname[:-len('_csr.npy')] + '.npy' if fname.endswith('_csr.npy') else fname
+
+
+def get_lookups_registry(root=None):
+    global _lookups_registry
+    root = op.abspath(get_user_fol() if root is None else root)
+    if _lookups_registry is None or _lookups_registry.root != root:
+        _lookups_registry = LookupsRegistry(root)
+    return _lookups_registry
+
+
+def init_lookups_registry(root=None):
+    registry = get_lookups_registry(root)
+    registry.index()
+    return registry
+
+
+def get_obj_lookup(obj_name, fol=None):
+    # The inflated objects use their pial objects' lookups
+    registry = get_lookups_registry()
+    lookup = registry.get_lookup(obj_name, fol)
+    if lookup is None and obj_name.startswith('inflated_'):
+        lookup = registry.get_lookup(obj_name[len('inflated_'):], fol)
+    return lookup
+
+
+def get_obj_npz(obj_name, fol=None):
+    return get_lookups_registry().get_npz(obj_name, fol)
+
+
 def change_selected_fcurves_colors(selected_objects_types, color_also_objects=True, exclude=()):
     import colorsys
     # print('change_selected_fcurves_colors')
@@ -2506,12 +2848,8 @@ def get_distinct_colors(colors_num=1):
 
 
 def calc_colors_from_cm(vert_values, data_min, colors_ratio, cm):
-    colors_indices = np.rint(((np.array(vert_values) - data_min) * colors_ratio)).astype(int)
-    # take care about values that are higher or smaller than the min and max values that were calculated (maybe using precentiles)
-    colors_indices[colors_indices < 0] = 0
-    colors_indices[colors_indices > 255] = 255
-    verts_colors = cm[colors_indices]
-    return verts_colors
+    # Values that are higher or smaller than the min and max values (maybe calculated using precentiles) are clipped
+    return cu.calc_colors_from_lut(vert_values, cm, data_min, colors_ratio=colors_ratio)
 
 
 def in_shape(xyz, shape):
@@ -2639,11 +2977,21 @@ def matlab_cell_str_to_list(cell_arr):
     return ret_list
 
 
-def write_ply_file(verts, faces, ply_file_name):
-    ply_header = 'ply\nformat ascii 1.0\nelement vertex {}\nproperty float x\nproperty float y\n' + \
-                 'property float z\nelement face {}\nproperty list uchar int vertex_index\nend_header\n'
+def write_ply_file(verts, faces, ply_file_name, binary=True):
     verts_num = verts.shape[0]
     faces_num = faces.shape[0]
+    if binary:
+        face_verts_num = faces.shape[1] if faces.ndim == 2 else 3
+        faces_for_ply = np.empty(faces_num, dtype=[('n', '<u1'), ('vertex_index', '<i4', (face_verts_num,))])
+        faces_for_ply['n'] = face_verts_num
+        faces_for_ply['vertex_index'] = faces
+        with open(ply_file_name, 'wb') as f:
+            f.write(PLY_BINARY_HEADER.format(verts_num, faces_num).encode('ascii'))
+            f.write(np.ascontiguousarray(verts, dtype='<f4').tobytes())
+            f.write(faces_for_ply.tobytes())
+        return
+    ply_header = 'ply\nformat ascii 1.0\nelement vertex {}\nproperty float x\nproperty float y\n' + \
+                 'property float z\nelement face {}\nproperty list uchar int vertex_index\nend_header\n'
     faces = faces.astype(np.int)
     faces_for_ply = np.hstack((np.ones((faces_num, 1)) * faces.shape[1], faces))
     with open(ply_file_name, 'w') as f:
@@ -2653,6 +3001,36 @@ def write_ply_file(verts, faces, ply_file_name):
         np.savetxt(f, faces_for_ply, fmt='%d', delimiter=' ')
 
 
+def migrate_ply_file(ply_file, verts, faces):
+    # Rewrites ply_file in the binary format. The file is written to a temp file next to it, and then replaces it,
+    # so ply_file is never left half written
+    temp_fname = '{}.{}.tmp'.format(ply_file, uuid.uuid4().hex)
+    try:
+        write_ply_file(verts, faces, temp_fname)
+        shutil.copymode(ply_file, temp_fname)
+        os.replace(temp_fname, ply_file)
+    finally:
+        if op.isfile(temp_fname):
+            os.remove(temp_fname)
+
+
+def migrate_ascii_ply_files(fol, recursive=True):
+    # Converts all the ascii ply files in fol to the binary format, returns the converted files
+    ply_files = glob.glob(op.join(fol, '**', '*.ply'), recursive=True) if recursive else \
+        glob.glob(op.join(fol, '*.ply'))
+    migrated = []
+    for ply_file in ply_files:
+        try:
+            if read_ply_header(ply_file).format == 'ascii':
+                verts, faces = read_ply_file(ply_file)
+                migrate_ply_file(ply_file, verts, faces)
+                migrated.append(ply_file)
+        except:
+            print('migrate_ascii_ply_files: Error in migrating {}!'.format(ply_file))
+            print(traceback.format_exc())
+    return migrated
+
+
 def select_time_range(t_start=None, t_end=None):
     if t_start is not None:
         bpy.data.scenes['Scene'].frame_preview_start = t_start
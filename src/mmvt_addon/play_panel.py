@@ -570,6 +570,15 @@ def play_panel_draw(context, layout):
     row.operator(NextKeyFrame.bl_idname, text="", icon='NEXT_KEYFRAME')
     layout.prop(context.scene, 'render_movie', text="Render to a movie")
     layout.prop(context.scene, 'save_images', text="Save images")
+    layout.prop(context.scene, 'coloring_frames_cache', text='Cache the frames colors')
+    if bpy.context.scene.coloring_frames_cache:
+        row = layout.row(align=True)
+        row.prop(context.scene, 'coloring_frames_cache_mb', text='MB')
+        row.prop(context.scene, 'coloring_frames_cache_window', text='Ahead')
+    layout.prop(context.scene, 'coloring_incremental', text='Recolor only the changed vertices')
+    if bpy.context.scene.coloring_incremental:
+        for mesh_name, stats in sorted(_addon().get_incremental_coloring_stats().items()):
+            layout.label(text='{}: {} vertices changed, {:.1f}ms'.format(mesh_name, stats['changed_verts'], stats['ms']))
     layout.prop(context.scene, 'rotate_brain_while_playing', text='Rotate the brain while playing')
     if bpy.context.scene.rotate_brain_while_playing:
         row = layout.row(align=True)
@@ -0,0 +1,63 @@
+import sys
+import os
+import os.path as op
+import time
+
+
+try:
+    from src.mmvt_addon.scripts import scripts_utils as su
+except:
+    # Add current folder the imports path
+    sys.path.append(os.path.split(__file__)[0])
+    import scripts_utils as su
+
+
+def wrap_blender_call():
+    args = read_args()
+    su.call_script(__file__, args)
+
+
+def read_args(argv=None):
+    parser = su.add_default_args()
+    parser.add_argument('--iterations', help='number of coloring iterations', required=False, default=3, type=int)
+    parser.add_argument('--threshold', help='coloring threshold', required=False, default=0.5, type=float)
+    parser.add_argument('--save_prev_colors', required=False, default=0, type=su.is_true)
+    parser.add_argument('--changed_ratio', help='ratio of vertices changed between iterations', required=False,
+                        default=0.05, type=float)
+    return su.parse_args(parser, argv)
+
+
+def time_activity_coloring(subject_fname):
+    import numpy as np
+    args = read_args(su.get_python_argv())
+    if args.debug:
+        su.debug()
+    mmvt = su.init_mmvt_addon()
+    faces_verts = mmvt.get_faces_verts()
+    for hemi in su.HEMIS:
+        cur_obj = su.get_hemi_obj(hemi)
+        vert_values = np.random.rand(len(cur_obj.data.vertices))
+        loops_num = len(cur_obj.data.loops)
+        for coloring_type, bulk_coloring, incremental in [
+                ('loop', False, False), ('bulk', True, False), ('incremental', True, True)]:
+            now = time.time()
+            for iter_ind in range(args.iterations):
+                # Like adjacent time points, only some of the vertices are changed between the iterations
+                changed = np.random.rand(len(vert_values)) < args.changed_ratio
+                vert_values[changed] = np.random.rand(np.sum(changed))
+                mmvt.activity_map_obj_coloring(
+                    cur_obj, vert_values, faces_verts[hemi], args.threshold, True, 0, 256,
+                    save_prev_colors=args.save_prev_colors, bulk_coloring=bulk_coloring, incremental=incremental)
+            took = (time.time() - now) / args.iterations
+            su.stdout_print('{} ({} vertices, {} loops), {} coloring: {:.3f}s per frame'.format(
+                hemi, len(vert_values), loops_num, coloring_type, took))
+        su.stdout_print(mmvt.get_incremental_coloring_stats().get(cur_obj.data.name))
+    su.exit_blender()
+
+
+if __name__ == '__main__':
+    import sys
+    if op.isfile(sys.argv[0]) and sys.argv[0][-2:] == 'py':
+        wrap_blender_call()
+    else:
+        time_activity_coloring(sys.argv[1])
@@ -1,12 +1,13 @@
 import bpy
 import mmvt_utils as mu
+import colors_utils as cu
+import streaming_utils as stu
 import sys
 import os.path as op
 import time
 import numpy as np
 import glob
-# import traceback
-from itertools import cycle
+import traceback
 from datetime import datetime
 from queue import Queue
 import copy
@@ -35,7 +36,7 @@ def load_offline_data(sub_folder):
             continue
         offline_data = data if offline_data == [] else np.hstack((offline_data, data))
     StreamingPanel.offline_data = offline_data
-    StreamingPanel.cycle_data = []
+    StreamingPanel.cycle_data, StreamingPanel.cycle_len = None, 0
     StreamingPanel.minmax_vals = []
 
 
@@ -44,25 +45,74 @@ def electrodes_sep_update(self, context):
     # data_amp = np.max(data) - np.min(data)
     T = data.shape[1] - 1
     parent_obj = bpy.data.objects['Deep_electrodes']
-    C = len(parent_obj.animation_data.action.fcurves)
-    for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
-        elc_ind = fcurve_ind
-        for t in range(T):
-            fcurve.keyframe_points[t].co[1] = data[elc_ind, t] + \
-                                             (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
+    fcurves = parent_obj.animation_data.action.fcurves
+    C = len(fcurves)
+    for fcurve_ind, fcurve in enumerate(fcurves):
+        co = get_fcurve_co(fcurve)
+        co[:T, 1] = data[fcurve_ind, :T] + (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
+        set_fcurve_co(fcurve, co)
+    # The cached keyframes (StreamingPanel.fcurves_co) have the previous separation
+    reset_streaming_fcurves()
     mu.view_all_in_graph_editor()
 
 
+def get_fcurve_co(fcurve):
+    co = np.empty(len(fcurve.keyframe_points) * 2, dtype=np.float32)
+    fcurve.keyframe_points.foreach_get('co', co)
+    return co.reshape((-1, 2))
+
+
+def set_fcurve_co(fcurve, co):
+    fcurve.keyframe_points.foreach_set('co', co.ravel())
+
+
+def calc_stim_channel(stim_data, T, stim_length):
+    # 1 for stim_length samples after every onset (0->1), without a mask per onset
+    stim_indices = np.where(np.diff(stim_data[:T]) == 1)[0] + 1
+    stim_edges = np.zeros(T + 1)
+    np.add.at(stim_edges, stim_indices, 1)
+    np.add.at(stim_edges, np.minimum(stim_indices + stim_length, T), -1)
+    return (np.cumsum(stim_edges[:T]) > 0).astype(stim_data.dtype)
+
+
+def get_streaming_fcurves(parent_obj, channels_names, stim_channels, channels_num):
+    # The (fcurve, fcurve_ind, channel_ind) of the streamed fcurves, calculated once for the streaming session.
+    # The fcurves keyframes are cached in StreamingPanel.fcurves_co, and written back in bulk
+    fcurves = parent_obj.animation_data.action.fcurves
+    key = (tuple(channels_names), tuple(stim_channels), channels_num, len(fcurves),
+           bpy.context.scene.stream_show_only_good_electrodes)
+    if StreamingPanel.streaming_fcurves_key == key:
+        return StreamingPanel.streaming_fcurves
+    streaming_fcurves = []
+    for fcurve_ind, fcurve in enumerate(fcurves):
+        fcurve_name = mu.get_fcurve_name(fcurve)
+        if len(channels_names) > 0 and fcurve_name not in channels_names and fcurve_name not in stim_channels:
+            bpy.data.objects[fcurve_name].hide = bpy.context.scene.stream_show_only_good_electrodes
+            fcurve.hide = True
+            continue
+        streaming_fcurves.append((fcurve, fcurve_ind, len(streaming_fcurves) % channels_num))
+    StreamingPanel.streaming_fcurves, StreamingPanel.streaming_fcurves_key = streaming_fcurves, key
+    StreamingPanel.fcurves_co = [get_fcurve_co(fcurve) for fcurve, _, _ in streaming_fcurves]
+    StreamingPanel.electrodes_objs = [bpy.data.objects.get(mu.get_fcurve_name(fcurve))
+                                      for fcurve, _, _ in streaming_fcurves]
+    StreamingPanel.electrodes_colors_inds = None
+    return streaming_fcurves
+
+
+def reset_streaming_fcurves():
+    StreamingPanel.streaming_fcurves, StreamingPanel.streaming_fcurves_key = [], None
+    StreamingPanel.fcurves_co, StreamingPanel.electrodes_objs = [], []
+    StreamingPanel.electrodes_colors_inds = None
+
+
 # @mu.profileit()
 def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=50):
+    now = time.time()
     MAX_STEPS = StreamingPanel.max_steps
     T = min(mat.shape[1], MAX_STEPS)
     parent_obj = bpy.data.objects['Deep_electrodes']
     C = len(parent_obj.animation_data.action.fcurves)
-    good_electrodes = range(mat.shape[0])
-    elecs_cycle = cycle(good_electrodes)
-    no_zeros_data = mat[good_electrodes]
-    no_zeros_data = no_zeros_data[np.where(no_zeros_data)]
+    no_zeros_data = mat[np.where(mat)]
     if len(no_zeros_data) == 0:
         data_min, data_max = 0, 0
         colors_ratio = 256
@@ -80,7 +130,6 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
     if not _addon().colorbar_values_are_locked():
         _addon().set_colorbar_max_min(data_max, data_min)
     curr_t = bpy.context.scene.frame_current
-    first_curve = True
 
     # stim
     stim_ch_indices = [channels_names.index(s) for s in stim_channels if s in channels_names]
@@ -88,54 +137,68 @@ def change_graph_all_vals(mat, channels_names=(), stim_channels=(), stim_length=
         if len(np.unique(mat[stim_ch_indice])) == 1:
             mat[stim_ch_indice] = 0
         else:
-            stim_indices = np.where(np.diff(mat[stim_ch_indice]) == 1)[0] + 1
-            stim_ch = np.zeros(T)
-            for stim_indice in stim_indices:
-                # mat[stim_ch_indice][(np.arange(T) < stim_indice) | (np.arange(T) > stim_indice + stim_length)] = 0
-                stim_ch[(np.arange(T) >= stim_indice) & (np.arange(T) < stim_indice + stim_length)] = 1
-            mat[stim_ch_indice] = stim_ch
-
-    for fcurve_ind, fcurve in enumerate(parent_obj.animation_data.action.fcurves):
-        fcurve_name = mu.get_fcurve_name(fcurve)
-        if len(channels_names) > 0 and fcurve_name not in channels_names and fcurve_name not in stim_channels:
-            bpy.data.objects[fcurve_name].hide = bpy.context.scene.stream_show_only_good_electrodes
-            fcurve.hide = True
-            continue
-        if first_curve:
-            max_steps = min([len(fcurve.keyframe_points), MAX_STEPS]) - 2
-            first_curve = False
-        elc_ind = next(elecs_cycle) #fcurve_ind
-        if elc_ind >= mat.shape[0]:
-            continue
-        for ind in range(T):
-            t = curr_t + ind
-            if t > max_steps:
-                t = ind
-            fcurve.keyframe_points[t].co[1] = mat[elc_ind, ind] + (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
-            # if fcurve.keyframe_points[t].co[1] != 0:
-            #     print(elc_ind, ind, fcurve.keyframe_points[t].co[1])
-        _addon().color_objects_homogeneously([mat[elc_ind, ind]], [fcurve_name], None, data_min, colors_ratio)
-        # fcurve.keyframe_points[max_steps + 1].co[1] = 0
-        # fcurve.keyframe_points[0].co[1] = 0
-
-    try:
-        StreamingPanel.cycle_data = mat if StreamingPanel.cycle_data == [] else np.hstack((StreamingPanel.cycle_data, mat))
-    except:
-        StreamingPanel.cycle_data = mat
-        # print('asfd')
+            mat[stim_ch_indice, :T] = calc_stim_channel(mat[stim_ch_indice], T, stim_length)
+            mat[stim_ch_indice, T:] = 0
+
+    streaming_fcurves = get_streaming_fcurves(parent_obj, channels_names, stim_channels, mat.shape[0])
+    if len(streaming_fcurves) > 0:
+        max_steps = min([len(StreamingPanel.fcurves_co[0]), MAX_STEPS]) - 2
+        # The window's keyframes indices, wrapping around at max_steps
+        t_inds = curr_t + np.arange(T)
+        t_inds[t_inds > max_steps] = np.arange(T)[t_inds > max_steps]
+        for (fcurve, fcurve_ind, elc_ind), co in zip(streaming_fcurves, StreamingPanel.fcurves_co):
+            co[t_inds, 1] = mat[elc_ind, :T] + (C / 2 - fcurve_ind) * bpy.context.scene.electrodes_sep
+            set_fcurve_co(fcurve, co)
+        color_electrodes(mat[[elc_ind for _, _, elc_ind in streaming_fcurves], T - 1], data_min, colors_ratio)
+
+    append_cycle_data(mat)
     bpy.context.scene.frame_current += mat.shape[1]
+    update_time = time.time() - now
+    StreamingPanel.update_times.append(update_time)
+    # The acquisition rate is 1kHz (see max_steps_secs)
+    if update_time > mat.shape[1] / 1000:
+        StreamingPanel.late_updates += 1
     if bpy.context.scene.frame_current > MAX_STEPS - 1:
         bpy.context.scene.frame_current = bpy.context.scene.frame_current - MAX_STEPS
         time_diff = (datetime.now() - StreamingPanel.time)
         time_diff_sec = time_diff.seconds + time_diff.microseconds * 1e-6
         print('cycle! ', str(time_diff), time_diff_sec)
+        print_update_times()
         save_cycle()
         max_steps_secs = MAX_STEPS / 1000
         if time_diff_sec < max_steps_secs:
             print('sleep for {}'.format(max_steps_secs - time_diff_sec))
             time.sleep(max_steps_secs - time_diff_sec)
         StreamingPanel.time = datetime.now()
-        StreamingPanel.cycle_data = []
+        StreamingPanel.cycle_len = 0
+
+
+def color_electrodes(values, data_min, colors_ratio):
+    # Colors all the electrodes at once, only the ones which color index was changed are updated. The colors are
+    # calculated like in the coloring panel (color_objects_homogeneously)
+    lut = _addon().get_colors_lut(data_min, colors_ratio)
+    if lut is None:
+        return
+    colors_inds = lut.indices(values)
+    prev_colors_inds = StreamingPanel.electrodes_colors_inds
+    # The same indices are the same colors only if the colormap wasn't changed (lut.key[0])
+    if prev_colors_inds is None or prev_colors_inds.shape != colors_inds.shape or \
+            StreamingPanel.electrodes_colors_cm_key != lut.key[0]:
+        changed = np.arange(len(colors_inds))
+    else:
+        changed = np.where(colors_inds != prev_colors_inds)[0]
+    StreamingPanel.electrodes_colors_inds, StreamingPanel.electrodes_colors_cm_key = colors_inds, lut.key[0]
+    if len(changed) > 0:
+        objs = StreamingPanel.electrodes_objs
+        _addon().objects_coloring([objs[ind] for ind in changed], lut.colors[colors_inds[changed]])
+
+
+def print_update_times():
+    update_times = np.array(StreamingPanel.update_times) * 1000
+    if len(update_times) > 0:
+        print('Frames update: mean {:.2f}ms, max {:.2f}ms, {}/{} slower than the acquisition'.format(
+            np.mean(update_times), np.max(update_times), StreamingPanel.late_updates, len(update_times)))
+    StreamingPanel.update_times, StreamingPanel.late_updates = [], 0
 
 
 def show_electrodes_fcurves():
@@ -145,19 +208,16 @@ def show_electrodes_fcurves():
 
 
 def change_color(obj, val, data_min, colors_ratio):
-    colors_ind = calc_color_ind(val, data_min, colors_ratio)
-    colors = StreamingPanel.cm[colors_ind]
+    colors = get_colors_lut(data_min, colors_ratio)(val)
     _addon().object_coloring(obj, colors)
 
 
 def calc_color_ind(val, data_min, colors_ratio):
-    colors_ind = int(((val - data_min) * colors_ratio))
-    N = len(StreamingPanel.cm)
-    if colors_ind < 0:
-        colors_ind = 0
-    if colors_ind > N - 1:
-        colors_ind = N - 1
-    return colors_ind
+    return int(get_colors_lut(data_min, colors_ratio).indices(val))
+
+
+def get_colors_lut(data_min, colors_ratio):
+    return cu.get_colors_lut(StreamingPanel.cm, data_min, colors_ratio=colors_ratio, rounding='floor')
 
 
 def reading_from_udp_while_termination_func():
@@ -219,11 +279,13 @@ def udp_reader(udp_queue, while_termination_func, **kargs):
     multicast_group = kargs.get('multicast_group', '1.1.1.1')
     multicast = kargs.get('multicast', True)
     timeout = kargs.get('timeout', 0.1)
+    ring_buffer_len = kargs.get('ring_buffer_len', 10000)
     print('udp_reader:', server, port, multicast_group, buffer_size, multicast, timeout)
     if multicast:
         sock = bind_to_multicast(port, multicast_group)
     else:
         sock = bind_to_server(server, port)
+    sock.settimeout(timeout)
 
     #todo:
     # 1) calc good channels on the fly?
@@ -237,89 +299,94 @@ def udp_reader(udp_queue, while_termination_func, **kargs):
     no_channels = kargs.get('no_channels', '')
     no_channels = list(map(mu.to_int, no_channels.split(','))) if bad_channels != '' else []
 
-    buffer = []
-    prev_val = None
-    mat_len = 0
-    first_message = True
-    now = time.time()
-    prev_value = None
+    # Everything is allocated once, the packets are received into recv_buffer and copied into the ring buffer
+    recv_buffer = bytearray(stu.MAX_PACKET_SIZE)
+    channels_inds, channels_block, legacy_prev_val = None, None, None
+    prev_seq = None
+    stats = StreamingPanel.udp_stats = dict(packets=0, samples=0, dropped=0, out_of_order=0, duplicates=0)
+    stats_time = time.time()
 
     while while_termination_func():
         try:
-            sock.settimeout(timeout)
-            if multicast:
-                next_val, address = sock.recvfrom(2048)
-            else:
-                next_val = sock.recv(2048 * 16)
-        except socket.timeout as e:
-            if e.args[0] == 'timed out':
-                # print('!!! timed out !!!')
-                if prev_val is None and mat_len > 0:
-                    prev_val = np.zeros((mat_len, 1))
-                else:
-                    continue
-                next_val = prev_val
-            else:
-                print('!!! {} !!!'.format(e))
-                raise Exception(e)
-        else:
-            # https://docs.scipy.org/doc/numpy/user/basics.byteswapping.html
-            # data = pnet(socket,'read',packetSize,dtype,'intel');
-            # big-endian:
-            # x = np.ndarray(shape=(len(next_val) / 2,), dtype='>f8', buffer=next_val)
-            # dt = np.dtype(np.float64).newbyteorder('>')
-            # x = np.frombuffer(next_val, dtype=dt)
-            next_val = np.frombuffer(next_val, dtype=np.dtype(np.float64)).copy() #.reshape(14, 100)[10:, :]
-            next_val[bad_channels] = 0
-            if len(no_channels) > 0:
-                next_val = np.delete(next_val, no_channels, axis=0)
-            if good_channels:
-                next_val = next_val[good_channels]
-
-            if np.allclose(next_val, 0):
-                continue
-            if prev_val is not None and np.allclose(next_val.ravel(), prev_val.ravel()):
-                continue
-            prev_val = next_val.copy()
-            print('New packet! ({:.5f}s): {}'.format(next_val, time.time() - now, next_val))
-            now = time.time()
-
-            # print(next_val[0])
-            # next_val = next_val.decode(sys.getfilesystemencoding(), 'ignore')
-            # next_val = np.array([mu.to_float(f, 0.0) for f in next_val.split(',')])
-            if first_message:
-                mat_len = len(next_val)
-                first_message = False
-            else:
-                if len(next_val) != mat_len:
-                    pass
-                    # print('Wrong message len! {}'.format(len(next_val)))
-            # next_val = next_val[:mat_len]
-            next_val = next_val[..., np.newaxis]
-
+            nbytes = sock.recv_into(recv_buffer)
+        except socket.timeout:
+            continue
         try:
-            buffer = next_val if buffer == [] else np.hstack((buffer, next_val))
+            seq, next_val = stu.unpack_packet(recv_buffer, nbytes)
         except:
-            # todo: transpose first if needed
-            buffer = next_val if buffer == [] else np.hstack((buffer, next_val.T))
-        # buffer.append(next_val)
-        if buffer.shape[1] >= buffer_size:
-        # if len(buffer) >= buffer_size:
-            # print('{} took {:.5f}s {}'.format('udp_reader', time.time() - now, buffer.shape[1]))
-            # print('udp_reader: ', datetime.now())
-            # zeros_indices = np.where(np.all(buffer == 0, 1))[0]
-            # buffer = buffer[zeros_indices]
-            udp_queue.put(buffer)
-            buffer = []
+            print(traceback.format_exc())
+            continue
+        if seq is None:
+            # Legacy packets, one sample without a sequence number
+            if not next_val.any() or (legacy_prev_val is not None and np.array_equal(next_val, legacy_prev_val)):
+                continue
+            legacy_prev_val = next_val.copy()
+        else:
+            if prev_seq is not None:
+                seq_diff = stu.seq_diff(seq, prev_seq)
+                if seq_diff == 0:
+                    stats['duplicates'] += 1
+                    continue
+                elif seq_diff < 0:
+                    # The samples are already in the past
+                    stats['out_of_order'] += 1
+                    continue
+                stats['dropped'] += seq_diff - 1
+            prev_seq = seq
+        if channels_inds is None or len(next_val) != channels_num:
+            channels_num = len(next_val)
+            channels_inds = np.delete(np.arange(channels_num), [c for c in no_channels if c < channels_num])
+            if good_channels:
+                channels_inds = channels_inds[good_channels]
+            bad_channels_mask = np.array([c in bad_channels for c in channels_inds], dtype=bool)
+            all_channels = len(channels_inds) == channels_num and np.all(channels_inds == np.arange(channels_num))
+            StreamingPanel.ring_buffer = ring_buffer = stu.RingBuffer(len(channels_inds), ring_buffer_len)
+        samples_num = next_val.shape[1]
+        if not all_channels or bad_channels_mask.any():
+            if channels_block is None or channels_block.shape != (len(channels_inds), samples_num) or \
+                    channels_block.dtype != next_val.dtype:
+                channels_block = np.empty((len(channels_inds), samples_num), dtype=next_val.dtype)
+            np.take(next_val, channels_inds, axis=0, out=channels_block, mode='clip')
+            channels_block[bad_channels_mask] = 0
+            next_val = channels_block
+        ring_buffer.write(next_val)
+        stats['packets'] += 1
+        stats['samples'] += samples_num
+        if time.time() - stats_time > 5:
+            print('udp_reader: {} ({} overflowed samples)'.format(stats, ring_buffer.overflows))
+            stats_time = time.time()
+
+
+def get_streaming_block(buffer_size):
+    # Reads the next buffer_size samples from the udp reader's ring buffer (offline data is still read from the queue)
+    if bpy.context.scene.stream_type == 'offline':
+        return mu.queue_get(StreamingPanel.udp_queue)
+    ring_buffer = StreamingPanel.ring_buffer
+    if ring_buffer is None:
+        return None
+    block = StreamingPanel.stream_block
+    if block is None or block.shape != (ring_buffer.channels_num, buffer_size):
+        block = StreamingPanel.stream_block = np.empty((ring_buffer.channels_num, buffer_size))
+    return ring_buffer.read(buffer_size, block)
+
+
+def append_cycle_data(mat):
+    cycle_data, cycle_len = StreamingPanel.cycle_data, StreamingPanel.cycle_len
+    if cycle_data is None or len(cycle_data) == 0 or cycle_data.shape[0] != mat.shape[0]:
+        cycle_data, cycle_len = np.zeros((mat.shape[0], max(StreamingPanel.max_steps, mat.shape[1]))), 0
+    elif cycle_len + mat.shape[1] > cycle_data.shape[1]:
+        cycle_data = np.hstack((cycle_data, np.zeros((mat.shape[0], max(cycle_data.shape[1], mat.shape[1])))))
+    cycle_data[:, cycle_len:cycle_len + mat.shape[1]] = mat
+    StreamingPanel.cycle_data, StreamingPanel.cycle_len = cycle_data, cycle_len + mat.shape[1]
 
 
 def save_cycle():
-    if bpy.context.scene.save_streaming:
+    if bpy.context.scene.save_streaming and StreamingPanel.cycle_data is not None:
         streaming_fol = datetime.strftime(datetime.now(), '%Y-%m-%d')
         output_fol = op.join(mu.get_user_fol(), 'electrodes', 'streaming', streaming_fol)
         output_fname = 'streaming_data_{}.npy'.format(datetime.strftime(datetime.now(), '%H-%M-%S'))
         mu.make_dir(output_fol)
-        np.save(op.join(output_fol, output_fname), StreamingPanel.cycle_data)
+        np.save(op.join(output_fol, output_fname), StreamingPanel.cycle_data[:, :StreamingPanel.cycle_len])
 
 
 def get_electrodes_data():
@@ -329,8 +396,7 @@ def get_electrodes_data():
         if fcurve_ind == 0:
             max_steps = min([len(fcurve.keyframe_points), StreamingPanel.max_steps]) - 2
             data = np.zeros((len(fcurves), max_steps))
-        for t in range(max_steps):
-            data[fcurve_ind, t] = fcurve.keyframe_points[t].co[1]
+        data[fcurve_ind] = get_fcurve_co(fcurve)[:max_steps, 1]
     return data
 
 
@@ -392,7 +458,8 @@ class StreamButton(bpy.types.Operator):
                         port=bpy.context.scene.streaming_server_port,
                         timeout=bpy.context.scene.timeout,
                         multicast=bpy.context.scene.multicast,
-                        mat_len=len(bpy.data.objects['Deep_electrodes'].children))
+                        mat_len=len(bpy.data.objects['Deep_electrodes'].children),
+                        ring_buffer_len=max(10 * bpy.context.scene.streaming_buffer_size, StreamingPanel.max_steps))
             if bpy.context.scene.stream_type == 'offline':
                 config = mu.read_config_ini(op.join(
                     mu.get_user_fol(), 'electrodes', 'streaming', bpy.context.scene.logs_folders))
@@ -410,6 +477,7 @@ class StreamButton(bpy.types.Operator):
                 StreamingPanel.udp_queue = mu.run_thread(
                     offline_logs_reader, reading_from_udp_while_termination_func, **args)
             else:
+                StreamingPanel.ring_buffer = None
                 StreamingPanel.udp_queue = mu.run_thread(
                     udp_reader, reading_from_udp_while_termination_func, **args)
 
@@ -427,7 +495,7 @@ class StreamButton(bpy.types.Operator):
             if StreamingPanel.is_streaming and time.time() - self._time > bpy.context.scene.streaming_buffer_size / 1000.0:
                 print(time.time() - self._time)
                 self._time = time.time()
-                data = mu.queue_get(StreamingPanel.udp_queue)
+                data = get_streaming_block(bpy.context.scene.streaming_buffer_size)
                 if not data is None:
                     # if len(np.where(data)[0]) > 0:
                     #     print('spike!!!!!')
@@ -484,6 +552,8 @@ def streaming_draw(self, context):
     layout.prop(context.scene, 'streaming_window_length', text='Window length')
     layout.prop(context.scene, 'stim_length', text='Stim length')
     layout.prop(context.scene, 'electrodes_sep', text='electrodes sep')
+    if StreamingPanel.is_streaming and len(StreamingPanel.update_times) > 0:
+        layout.label(text='Frame update: {:.1f}ms'.format(StreamingPanel.update_times[-1] * 1000))
 
 
 bpy.types.Scene.streaming_buffer_size = bpy.props.IntProperty(default=100, min=1)
@@ -522,7 +592,13 @@ class StreamingPanel(bpy.types.Panel):
     electrodes_file = None
     electrodes_data = None
     time = datetime.now()
-    electrodes_names, electrodes_conditions, offline_data, cycle_data = [], [], [], []
+    electrodes_names, electrodes_conditions, offline_data = [], [], []
+    cycle_data, cycle_len = None, 0
+    ring_buffer, stream_block, udp_stats = None, None, {}
+    streaming_fcurves, streaming_fcurves_key, fcurves_co, electrodes_objs = [], None, [], []
+    electrodes_colors_inds = None
+    electrodes_colors_cm_key = None
+    update_times, late_updates = [], 0
     data_max, data_min, electrodes_colors_ratio = 0, 0, 1
 
     def draw(self, context):
@@ -591,8 +667,10 @@ def init_electrodes_fcurves(window_length=2500):
             if fcurve_ind == 0:
                 # max_steps = min([len(fcurve.keyframe_points), StreamingPanel.max_steps]) - 1
                 max_steps = len(fcurve.keyframe_points) - 1
-            for t in range(max_steps):
-                fcurve.keyframe_points[t].co[1] = 0
+            co = get_fcurve_co(fcurve)
+            co[:max_steps, 1] = 0
+            set_fcurve_co(fcurve, co)
+    reset_streaming_fcurves()
 
 
 def init_electrodes_animation(window_length=2500):
@@ -603,10 +681,7 @@ def init_electrodes_animation(window_length=2500):
     for obj_counter, source_obj in enumerate(parent_obj.children):
         mu.time_to_go(now, obj_counter, N, runs_num_to_print=10)
         source_name = source_obj.name
-        mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, 1)
-        mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0, window_length + 2)
-        for ind in range(window_length):
-            mu.insert_keyframe_to_custom_prop(parent_obj, source_name, 0.1, ind + 2)
+        mu.insert_keyframes_to_custom_prop(parent_obj, source_name, np.ones(window_length) * 0.1)
         fcurves = parent_obj.animation_data.action.fcurves[obj_counter]
         mod = fcurves.modifiers.new(type='LIMITS')
 
@@ -0,0 +1,128 @@
+import struct
+import threading
+import numpy as np
+
+# The MMVT streaming packet. A 16 bytes little-endian header followed by the samples:
+#   offset  type      field
+#   0       4 bytes   magic, b'MMVT'
+#   4       uint8     version (PACKET_VERSION)
+#   5       uint8     samples dtype code (see PACKET_DTYPES)
+#   6       uint16    channels number (C)
+#   8       uint16    samples number (T)
+#   10      uint16    reserved (0)
+#   12      uint32    sequence number, incremented by one for every packet (wraps around at 2**32)
+#   16      C*T items the samples, little-endian, a (C, T) array in C order (all the samples of channel 0 first)
+# Packets without the magic are read as the legacy format: one sample of all the channels, as float64.
+PACKET_MAGIC = b'MMVT'
+PACKET_VERSION = 1
+PACKET_HEADER = struct.Struct('<4sBBHHHI')
+PACKET_DTYPES = {0: np.dtype('<f4'), 1: np.dtype('<f8'), 2: np.dtype('<i2'), 3: np.dtype('<i4')}
+PACKET_DTYPES_CODES = {dtype: code for code, dtype in PACKET_DTYPES.items()}
+MAX_PACKET_SIZE = 65507
+SEQ_MOD = 2 ** 32
+
+
+def packet_size(channels_num, samples_num, dtype=np.float32):
+    return PACKET_HEADER.size + channels_num * samples_num * np.dtype(dtype).itemsize
+
+
+def pack_packet_into(buffer, data, seq, dtype=np.float32):
+    # Writes the packet of data (C, T) into a preallocated buffer (bytearray), and returns the packet's size
+    dtype = np.dtype(dtype).newbyteorder('<')
+    if dtype not in PACKET_DTYPES_CODES:
+        raise Exception('pack_packet_into: dtype {} is not supported!'.format(dtype))
+    data = data.reshape((-1, 1)) if data.ndim == 1 else data
+    channels_num, samples_num = data.shape
+    size = packet_size(channels_num, samples_num, dtype)
+    if size > len(buffer):
+        raise Exception('pack_packet_into: The packet size ({}) is bigger than the buffer ({})'.format(
+            size, len(buffer)))
+    PACKET_HEADER.pack_into(buffer, 0, PACKET_MAGIC, PACKET_VERSION, PACKET_DTYPES_CODES[dtype], channels_num,
+                            samples_num, 0, seq % SEQ_MOD)
+    np.frombuffer(buffer, dtype, channels_num * samples_num, PACKET_HEADER.size).reshape(data.shape)[...] = data
+    return size
+
+
+def pack_packet(data, seq, dtype=np.float32):
+    data = data.reshape((-1, 1)) if data.ndim == 1 else data
+    buffer = bytearray(packet_size(data.shape[0], data.shape[1], dtype))
+    pack_packet_into(buffer, data, seq, dtype)
+    return bytes(buffer)
+
+
+def unpack_packet(buffer, nbytes=None):
+    # Returns (seq, data), where data is a (C, T) view of the buffer (no copy). seq is None for legacy packets
+    nbytes = len(buffer) if nbytes is None else nbytes
+    if nbytes >= PACKET_HEADER.size and bytes(buffer[:4]) == PACKET_MAGIC:
+        _, version, dtype_code, channels_num, samples_num, _, seq = PACKET_HEADER.unpack_from(buffer, 0)
+        if version != PACKET_VERSION or dtype_code not in PACKET_DTYPES:
+            raise Exception('unpack_packet: Unknown packet version ({}) or dtype ({})'.format(version, dtype_code))
+        dtype = PACKET_DTYPES[dtype_code]
+        if packet_size(channels_num, samples_num, dtype) > nbytes:
+            raise Exception('unpack_packet: Truncated packet ({} bytes)'.format(nbytes))
+        data = np.frombuffer(buffer, dtype, channels_num * samples_num, PACKET_HEADER.size)
+        return seq, data.reshape((channels_num, samples_num))
+    else:
+        data = np.frombuffer(buffer, np.float64, nbytes // 8)
+        return None, data.reshape((-1, 1))
+
+
+def seq_diff(seq, prev_seq):
+    # The number of packets from prev_seq to seq, in [-2**31, 2**31)
+    return (seq - prev_seq + SEQ_MOD // 2) % SEQ_MOD - SEQ_MOD // 2
+
+
+class RingBuffer(object):
+    # A preallocated (channels x samples) ring buffer. One thread writes (the reader), another one reads.
+    # When the buffer is full the oldest samples are overwritten (and counted in overflows).
+    def __init__(self, channels_num, samples_num, dtype=np.float64):
+        self.data = np.zeros((channels_num, samples_num), dtype=dtype)
+        self.write_ind = 0
+        self.available = 0
+        self.overflows = 0
+        self.lock = threading.Lock()
+
+    @property
+    def channels_num(self):
+        return self.data.shape[0]
+
+    @property
+    def capacity(self):
+        return self.data.shape[1]
+
+    def __len__(self):
+        return self.available
+
+    def write(self, block):
+        # block: (channels, T)
+        block = block[:, -self.capacity:]
+        T = block.shape[1]
+        with self.lock:
+            first = min(T, self.capacity - self.write_ind)
+            self.data[:, self.write_ind:self.write_ind + first] = block[:, :first]
+            if first < T:
+                self.data[:, :T - first] = block[:, first:]
+            self.write_ind = (self.write_ind + T) % self.capacity
+            overflow = max(self.available + T - self.capacity, 0)
+            self.overflows += overflow
+            self.available = min(self.available + T, self.capacity)
+
+    def read(self, samples_num=None, out=None):
+        # Reads (and removes) the oldest samples_num samples. Returns None if there are not enough samples
+        with self.lock:
+            samples_num = self.available if samples_num is None else samples_num
+            if samples_num > self.available or samples_num == 0:
+                return None
+            if out is None:
+                out = np.empty((self.channels_num, samples_num), dtype=self.data.dtype)
+            read_ind = (self.write_ind - self.available) % self.capacity
+            first = min(samples_num, self.capacity - read_ind)
+            out[:, :first] = self.data[:, read_ind:read_ind + first]
+            if first < samples_num:
+                out[:, first:samples_num] = self.data[:, :samples_num - first]
+            self.available -= samples_num
+        return out
+
+    def clear(self):
+        with self.lock:
+            self.write_ind = self.available = self.overflows = 0
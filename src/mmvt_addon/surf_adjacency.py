@@ -0,0 +1,140 @@
+import os.path as op
+import threading
+import traceback
+import numpy as np
+
+# The surfaces' vertices adjacency (neighbors), one CSR cache per hemisphere and surface type, next to the
+# surface's npz file: surf/{hemi}.{surf}.npz -> surf/{hemi}.{surf}_adjacency.npz
+#   indptr   int32, (V + 1, )
+#   indices  int32, the neighbors of vertex v are indices[indptr[v]:indptr[v + 1]], sorted
+# The adjacency is built from the surface's faces, without the diagonal, like mne.spatial_tris_connectivity.
+
+ADJACENCY_VERSION = 1
+
+_adjacencies, _adjacencies_lock = {}, threading.Lock()
+
+
+def get_surf_fname(subject_fol, hemi, surf='pial'):
+    return op.join(subject_fol, 'surf', '{}.{}.npz'.format(hemi, surf))
+
+
+def get_adjacency_fname(subject_fol, hemi, surf='pial'):
+    return op.join(subject_fol, 'surf', '{}.{}_adjacency.npz'.format(hemi, surf))
+
+
+def calc_adjacency_csr(faces, vertices_num=None):
+    faces = np.asarray(faces, dtype=np.int64)
+    V = int(faces.max()) + 1 if vertices_num is None else vertices_num
+    rows = np.concatenate((faces[:, 0], faces[:, 1], faces[:, 2], faces[:, 1], faces[:, 2], faces[:, 0]))
+    cols = np.concatenate((faces[:, 1], faces[:, 2], faces[:, 0], faces[:, 0], faces[:, 1], faces[:, 2]))
+    # Each edge as one int64 key, np.unique removes the duplicates and sorts by (row, col)
+    edges = np.unique(rows * V + cols)
+    rows, cols = edges // V, edges % V
+    indptr = np.zeros(V + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum(np.bincount(rows, minlength=V))
+    return indptr, cols.astype(np.int32)
+
+
+class SurfAdjacency(object):
+    def __init__(self, indptr, indices):
+        self.indptr = np.asarray(indptr, dtype=np.int32)
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self._rows = None
+        self.mtime = 0
+
+    @property
+    def vertices_num(self):
+        return len(self.indptr) - 1
+
+    def __len__(self):
+        return self.vertices_num
+
+    def __getitem__(self, vert):
+        # The neighbors of vert, a view of indices (can replace the old verts_neighbors dicts)
+        return self.indices[self.indptr[vert]:self.indptr[vert + 1]]
+
+    def neighbors(self, vert):
+        return self[vert]
+
+    @property
+    def degrees(self):
+        return np.diff(self.indptr)
+
+    @property
+    def rows(self):
+        # The source vertex of each edge (the COO rows)
+        if self._rows is None:
+            self._rows = np.repeat(np.arange(self.vertices_num, dtype=np.int32), self.degrees)
+        return self._rows
+
+    def any_edge(self, edges_mask):
+        # True for the vertices that have at least one edge in edges_mask (bool, len(indices))
+        return np.bincount(self.rows[edges_mask], minlength=self.vertices_num) > 0
+
+    def any_neighbor(self, vertices_mask):
+        # True for the vertices that have at least one neighbor in vertices_mask (bool, V)
+        return self.any_edge(np.asarray(vertices_mask, dtype=bool)[self.indices])
+
+    def any_neighbor_differs(self, values, ignore_value=-1):
+        # True for the vertices that have a neighbor with a different value (like a label id), where
+        # vertices with ignore_value are ignored (both as a vertex and as a neighbor)
+        values = np.asarray(values)
+        rows_values, cols_values = values[self.rows], values[self.indices]
+        return self.any_edge((rows_values != cols_values) & (rows_values != ignore_value) &
+                             (cols_values != ignore_value))
+
+    def as_matrix(self, fmt='csr'):
+        # The adjacency as a scipy sparse matrix (ones, without the diagonal). mne's clustering needs 'coo'
+        import scipy.sparse
+        data = np.ones(len(self.indices), dtype=np.int8)
+        mat = scipy.sparse.csr_matrix((data, self.indices, self.indptr), shape=(self.vertices_num, ) * 2)
+        return mat.asformat(fmt)
+
+
+def save_surf_adjacency(faces, fname, vertices_num=None):
+    indptr, indices = calc_adjacency_csr(faces, vertices_num)
+    np.savez(fname, indptr=indptr, indices=indices, version=ADJACENCY_VERSION)
+    return SurfAdjacency(indptr, indices)
+
+
+def create_surf_adjacency(subject_fol, hemi, surf='pial', overwrite=False):
+    fname = get_adjacency_fname(subject_fol, hemi, surf)
+    if op.isfile(fname) and not overwrite:
+        return True
+    surf_fname = get_surf_fname(subject_fol, hemi, surf)
+    if not op.isfile(surf_fname):
+        print("create_surf_adjacency: The surface file doesn't exist! {}".format(surf_fname))
+        return False
+    d = np.load(surf_fname)
+    vertices_num = len(d['verts']) if 'verts' in d.files else None
+    save_surf_adjacency(d['faces'], fname, vertices_num)
+    return op.isfile(fname)
+
+
+def surf_adjacency_exists(subject_fol, surf='pial'):
+    return all([op.isfile(get_adjacency_fname(subject_fol, hemi, surf)) for hemi in ['rh', 'lh']])
+
+
+def load_surf_adjacency(subject_fol, hemi, surf='pial', as_matrix=False, fmt='csr', create=True):
+    # Returns the (cached) SurfAdjacency, or its scipy sparse matrix if as_matrix. None if it can't be loaded
+    fname = get_adjacency_fname(subject_fol, hemi, surf)
+    if not op.isfile(fname) and (not create or not create_surf_adjacency(subject_fol, hemi, surf)):
+        return None
+    with _adjacencies_lock:
+        adjacency = _adjacencies.get(fname)
+        if adjacency is None or adjacency.mtime != op.getmtime(fname):
+            try:
+                d = np.load(fname)
+                adjacency = _adjacencies[fname] = SurfAdjacency(d['indptr'], d['indices'])
+                adjacency.mtime = op.getmtime(fname)
+            except:
+                print(traceback.format_exc())
+                print('load_surf_adjacency: Error in reading {}'.format(fname))
+                _adjacencies.pop(fname, None)
+                return None
+    return adjacency.as_matrix(fmt) if as_matrix else adjacency
+
+
+def clear_surf_adjacencies():
+    with _adjacencies_lock:
+        _adjacencies.clear()
@@ -1,5 +1,6 @@
 import bpy
 import mmvt_utils as mu
+import activity_store as acts
 import mathutils
 import numpy as np
 import os.path as op
@@ -192,12 +193,19 @@ class CreateVertexData(bpy.types.Operator):
 
     def keyframe_empty_test(self, empty_name, closest_mesh_name, vertex_ind, data_path):
         obj = bpy.data.objects[empty_name]
-        lookup = np.load(op.join(data_path, 'activity_map_' + closest_mesh_name + '_verts_lookup.npy'))
-        file_num_str = str(int(lookup[vertex_ind, 0]))
-        line_num = int(lookup[vertex_ind, 1])
-        data_file = np.load(
-            op.join(data_path, 'activity_map_' + closest_mesh_name + '_verts', file_num_str + '.npy'))
-        data = data_file[line_num, :].squeeze()
+        # The vertex-major store (save_vertex_activity_map), or the activity map's store
+        store = acts.get_activity_store(op.join(data_path, 'activity_map_' + closest_mesh_name + '_verts'))
+        if store is None:
+            store = acts.get_activity_store(op.join(data_path, 'activity_map_' + closest_mesh_name))
+        if store is not None:
+            data = store.read_vertex(vertex_ind)
+        else:
+            lookup = np.load(op.join(data_path, 'activity_map_' + closest_mesh_name + '_verts_lookup.npy'))
+            file_num_str = str(int(lookup[vertex_ind, 0]))
+            line_num = int(lookup[vertex_ind, 1])
+            data_file = np.load(
+                op.join(data_path, 'activity_map_' + closest_mesh_name + '_verts', file_num_str + '.npy'))
+            data = data_file[line_num, :].squeeze()
 
         number_of_time_points = len(data)
         mu.insert_keyframe_to_custom_prop(obj, 'data', 0, 0)
@@ -242,13 +250,13 @@ class DataInVertMakerPanel(bpy.types.Panel):
 
 def init(addon):
     DataInVertMakerPanel.addon = addon
-    lookup_files = glob.glob(op.join(mu.get_user_fol(), 'activity_map_*_verts_lookup.npy'))
+    lookup_files = glob.glob(op.join(mu.get_user_fol(), 'activity_map_*_verts_lookup.npy')) + \
+                   glob.glob(op.join(mu.get_user_fol(), 'activity_map_*' + acts.HEADER_EXT))
     if len(lookup_files) == 0:
         print('No lookup files for vertex_data_panel')
         DataInVertMakerPanel.init = False
-    DataInVertMakerPanel.activity_maps_exist = \
-        op.isdir(op.join(mu.get_user_fol(), 'activity_map_rh')) and \
-        op.isdir(op.join(mu.get_user_fol(), 'activity_map_lh'))
+    DataInVertMakerPanel.activity_maps_exist = all([acts.activity_map_exists(
+        op.join(mu.get_user_fol(), 'activity_map_{}'.format(hemi))) for hemi in mu.HEMIS])
     DataInVertMakerPanel.init = True
     register()
 
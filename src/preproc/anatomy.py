@@ -18,6 +18,7 @@ from src.utils import utils
 from src.utils import freesurfer_utils as fu
 from src.utils import args_utils as au
 from src.utils import preproc_utils as pu
+from src.mmvt_addon import surf_adjacency as sa
 
 
 SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
@@ -319,7 +320,7 @@ def calc_faces_verts_dic(subject, atlas, overwrite=False):
             out_files.extend(faces_verts_dic_fnames)
 
     for ply_file, out_file in zip(ply_files, out_files):
-        if not overwrite and op.isfile(out_file):
+        if not overwrite and op.isfile(utils.faces_verts_csr_fname(out_file)):
             # print('{} already exist.'.format(out_file))
             continue
         # ply_file = op.join(SUBJECTS_DIR, subject,'surf', '{}.pial.ply'.format(hemi))
@@ -332,6 +333,13 @@ def calc_faces_verts_dic(subject, atlas, overwrite=False):
     return len(errors) == 0
 
 
+def migrate_ply_files(subject):
+    # One time migration of the subject's ascii ply files to the binary format
+    migrated = utils.migrate_ascii_ply_files(op.join(MMVT_DIR, subject))
+    print('{} ply files were migrated to the binary format'.format(len(migrated)))
+    return True
+
+
 @utils.tryit()
 def load_bem_surfaces(subject, include_seghead=True, overwrite=False):
     watershed_files = ['brain_surface', 'inner_skull_surface', 'outer_skin_surface', 'outer_skull_surface']
@@ -357,9 +365,9 @@ def load_bem_surfaces(subject, include_seghead=True, overwrite=False):
         if not op.isfile(ply_fname) or overwrite:
             utils.write_ply_file(verts, faces, ply_fname)
         faces_verts_fname = op.join(MMVT_DIR, subject, 'surf', '{}_faces_verts.npy'.format(watershed_name))
-        if not op.isfile(faces_verts_fname):
+        if not op.isfile(utils.faces_verts_csr_fname(faces_verts_fname)):
             utils.calc_ply_faces_verts(verts, faces, faces_verts_fname, overwrite, watershed_name)
-        ret = ret and op.isfile(ply_fname) and op.isfile(faces_verts_fname)
+        ret = ret and op.isfile(ply_fname) and utils.faces_verts_exist(faces_verts_fname)
     return ret
 
 
@@ -504,8 +512,7 @@ def parcelate_cortex(subject, atlas, overwrite=False, overwrite_annotation=False
     utils.make_dir(op.join(MMVT_DIR, subject, 'labels'))
     labels_to_annot(subject, atlas, overwrite_annotation, surf_type, overwrite_vertices_labels_lookup,
                     n_jobs=n_jobs)
-    vertices_labels_ids_lookup = lu.create_vertices_labels_lookup(
-        subject, atlas, True, overwrite_vertices_labels_lookup)
+    vertices_labels_index = lu.create_vertices_labels_index(subject, atlas, overwrite_vertices_labels_lookup)
     params = []
     for surface_type in ['pial', 'inflated']:
         files_exist = True
@@ -515,7 +522,7 @@ def parcelate_cortex(subject, atlas, overwrite=False, overwrite_annotation=False
             files_exist = files_exist and op.isdir(blender_labels_fol) and \
                 len(glob.glob(op.join(blender_labels_fol, '*.ply'))) >= len(labels)
             if overwrite or not files_exist:
-                params.append((subject, atlas, hemi, surface_type, vertices_labels_ids_lookup[hemi],
+                params.append((subject, atlas, hemi, surface_type, vertices_labels_index[hemi],
                                overwrite_vertices_labels_lookup))
 
     if len(params) > 0:
@@ -530,9 +537,9 @@ def parcelate_cortex(subject, atlas, overwrite=False, overwrite_annotation=False
 
 def _parcelate_cortex_parallel(p):
     from src.preproc import parcelate_cortex
-    subject, atlas, hemi, surface_type, vertices_labels_ids_lookup, overwrite_vertices_labels_lookup = p
+    subject, atlas, hemi, surface_type, vertices_labels_index, overwrite_vertices_labels_lookup = p
     print('Parcelate the {} {} cortex'.format(hemi, surface_type))
-    return parcelate_cortex.parcelate(subject, atlas, hemi, surface_type, vertices_labels_ids_lookup,
+    return parcelate_cortex.parcelate(subject, atlas, hemi, surface_type, vertices_labels_index,
                                       overwrite_vertices_labels_lookup)
 
 
@@ -565,43 +572,35 @@ def save_labels_vertices(subject, atlas):
 
 
 @utils.tryit()
-def create_spatial_connectivity(subject):
+def create_spatial_connectivity(subject, overwrite=False):
+    # The CSR adjacency cache of each surface type and hemisphere (see src/mmvt_addon/surf_adjacency.py)
     ret = True
+    subject_fol = op.join(MMVT_DIR, subject)
     for surf in ['pial', 'dural']:
-        verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors{}_{}.pkl'.format(
-            '' if surf == 'pial' else '_{}'.format(surf), '{hemi}'))
-        connectivity_fname = op.join(MMVT_DIR, subject, 'spatial_connectivity{}.pkl'.format(
-            '' if surf == 'pial' else '_{}'.format(surf)))
-        if utils.both_hemi_files_exist(verts_neighbors_fname) and op.isfile(connectivity_fname):
-            continue
-        connectivity_per_hemi = {}
         for hemi in utils.HEMIS:
-            neighbors = defaultdict(list)
-            conn_fname = op.join(MMVT_DIR, subject, 'surf', '{}.{}.npz'.format(hemi, surf))
-            if not op.isfile(conn_fname):
-                print("Connectivity file doesn't exist! {}".format(conn_fname))
+            surf_fname = sa.get_surf_fname(subject_fol, hemi, surf)
+            if not op.isfile(surf_fname):
+                print("Connectivity file doesn't exist! {}".format(surf_fname))
+                if surf == 'pial':
+                    ret = False
                 continue
-            d = np.load(conn_fname)
-            connectivity_per_hemi[hemi] = mne.spatial_tris_connectivity(d['faces'])
-            rows, cols = connectivity_per_hemi[hemi].nonzero()
-            for ind in range(len(rows)):
-                neighbors[rows[ind]].append(cols[ind])
-            utils.save(neighbors, verts_neighbors_fname.format(hemi=hemi))
-        utils.save(connectivity_per_hemi, connectivity_fname)
-        ret = ret and op.isfile(connectivity_fname)
+            ret = ret and sa.create_surf_adjacency(subject_fol, hemi, surf, overwrite)
     return ret
 
 
+def load_surf_adjacency(subject, hemi, surf='pial', as_matrix=False, fmt='csr'):
+    subject_fol = op.join(MMVT_DIR, subject)
+    if not op.isfile(sa.get_adjacency_fname(subject_fol, hemi, surf)):
+        print('load_surf_adjacency: You should first run create_spatial_connectivity')
+        create_spatial_connectivity(subject)
+    return sa.load_surf_adjacency(subject_fol, hemi, surf, as_matrix, fmt)
+
+
 def calc_three_rois_intersection(subject, rois, output_fol='', model_name='', atlas='aparc.DKTatlas40', debug=False,
                                  overwrite=False):
 
-    def get_vertices_between_labels(label1_contours_verts_inds, label2_contours_verts_inds, vertices_neighbros):
-        vertices = []
-        for vert_ind in label1_contours_verts_inds:
-            for neighbor_vert in vertices_neighbros[vert_ind]:
-                if neighbor_vert in label2_contours_verts_inds:
-                    vertices.append(vert_ind)
-        return set(vertices)
+    def get_vertices_between_labels(label1_contours_verts_mask, label2_contours_verts_mask, adjacency):
+        return set(np.where(label1_contours_verts_mask & adjacency.any_neighbor(label2_contours_verts_mask))[0])
 
     if output_fol != '':
         output_fol = utils.make_dir(output_fol)
@@ -611,11 +610,6 @@ def calc_three_rois_intersection(subject, rois, output_fol='', model_name='', at
         if op.isfile(output_fname) and not overwrite:
             return utils.load(output_fname)
 
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
-    if not utils.both_hemi_files_exist(verts_neighbors_fname):
-        print('calc_labeles_contours: You should first run create_spatial_connectivity')
-        create_spatial_connectivity(subject)
-
     contours = op.join(MMVT_DIR, subject, 'labels', '{}_contours_{}.npz'.format(atlas, '{hemi}'))
     if not utils.both_hemi_files_exist(contours):
         calc_labeles_contours(subject, atlas)
@@ -625,11 +619,10 @@ def calc_three_rois_intersection(subject, rois, output_fol='', model_name='', at
         d = np.load(contours.format(hemi=hemi))
         hemi_contours = d['contours']
         surf, _ = utils.read_pial(subject, MMVT_DIR, hemi)
-        vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
+        vertices_neighbors = load_surf_adjacency(subject, hemi)
         labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
         labels_names = [label.name for label in labels]
-        labels_contoures_inds = [set(np.where(hemi_contours == labels_names.index('{}-{}'.format(roi, hemi)) + 1)[0]) \
-                                 for roi in rois]
+        labels_contoures_inds = [hemi_contours == labels_names.index('{}-{}'.format(roi, hemi)) + 1 for roi in rois]
         vertices_in_between = \
             (get_vertices_between_labels(labels_contoures_inds[0], labels_contoures_inds[1], vertices_neighbors) & \
             get_vertices_between_labels(labels_contoures_inds[0], labels_contoures_inds[2], vertices_neighbors)) | \
@@ -666,11 +659,6 @@ def calc_flat_patch_cut_vertices(subject, atlas='aparc.DKTatlas40', overwrite=Tr
                                 ('caudalanteriorcingulate', 'posteriorcingulate'),
                                 ('superiorfrontal', 'posteriorcingulate'), ('paracentral', 'superiorfrontal')]
 
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
-    if not utils.both_hemi_files_exist(verts_neighbors_fname):
-        print('calc_labeles_contours: You should first run create_spatial_connectivity')
-        create_spatial_connectivity(subject)
-        # return calc_labeles_contours(subject, atlas, overwrite, verbose)
     # vertices_labels_lookup = lu.create_vertices_labels_lookup(subject, atlas, False, overwrite)
     bad_vertices = {}
 
@@ -680,7 +668,7 @@ def calc_flat_patch_cut_vertices(subject, atlas='aparc.DKTatlas40', overwrite=Tr
         calc_labeles_contours(subject, atlas)
     for hemi in utils.HEMIS:
         d = np.load(contours_tempalte.format(hemi=hemi))
-        vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
+        vertices_neighbors = load_surf_adjacency(subject, hemi)
         labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
         bad_vertices_hemi = []
         for regions_pair in neighbors_regions_for_cut:
@@ -719,18 +707,11 @@ def calc_flat_patch_cut_vertices(subject, atlas='aparc.DKTatlas40', overwrite=Tr
 
 
 def get_vertices_between_labels(hemi, label1, label2, labels, vertices_neighbros, contours):
-    vertices_between_labels = []
+    # vertices_neighbros: The hemi's SurfAdjacency
     label1_code = [label.name for label in labels].index('{}-{}'.format(label1, hemi))+1
     label2_code = [label.name for label in labels].index('{}-{}'.format(label2, hemi))+1
-
-    label1_contours_verts_inds = np.where(contours == label1_code)
-    label2_contours_verts_inds = np.where(contours == label2_code)
-
-    for vert_ind in label1_contours_verts_inds[0]:
-        for neighbor_vert in vertices_neighbros[vert_ind]:
-            if neighbor_vert in label2_contours_verts_inds[0]:
-                vertices_between_labels.append(vert_ind)
-                break
+    vertices_between_labels = np.where(
+        (contours == label1_code) & vertices_neighbros.any_neighbor(contours == label2_code))[0].tolist()
     if len(vertices_between_labels)==0:
         print('empty vertices_between_labels for pair {} and {}'.format(label1, label2))
     return vertices_between_labels
@@ -805,37 +786,33 @@ def write_flat_brain_patch(subject, hemi, flat_patch_fname):
     return utils.write_ply_file(flat_verts, flat_faces, ply_fname, True)
 
 
+def calc_labels_borders_vertices(vertices_labels_index, adjacency):
+    # True for the labeled vertices that have a neighbor from another label (ignoring vertices without a label)
+    return adjacency.any_neighbor_differs(vertices_labels_index.vertices_labels_ids(np.arange(len(adjacency))))
+
+
 @utils.tryit(False, False)
 def calc_labeles_contours(subject, atlas, overwrite=True, verbose=False):
     utils.make_dir(op.join(MMVT_DIR, subject, 'labels'))
     output_fname = op.join(MMVT_DIR, subject, 'labels', '{}_contours_{}.npz'.format(atlas, '{hemi}'))
     if utils.both_hemi_files_exist(output_fname) and not overwrite:
         return True
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
-    if not utils.both_hemi_files_exist(verts_neighbors_fname):
-        print('calc_labeles_contours: You should first run create_spatial_connectivity')
-        create_spatial_connectivity(subject)
-        return calc_labeles_contours(subject, atlas, overwrite, verbose)
-    vertices_labels_lookup = lu.create_vertices_labels_lookup(subject, atlas, False, overwrite)
+    vertices_labels_index = lu.create_vertices_labels_index(subject, atlas, overwrite)
     for hemi in utils.HEMIS:
         verts, _ = utils.read_pial(subject, MMVT_DIR, hemi)
         contours = np.zeros((len(verts)))
-        vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
+        adjacency = load_surf_adjacency(subject, hemi)
+        # The vertices with a neighbor from another label
+        borders = calc_labels_borders_vertices(vertices_labels_index[hemi], adjacency)
         # labels = lu.read_hemi_labels(subject, SUBJECTS_DIR, atlas, hemi)
         labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
         labels = [l for l in labels if 'unknown' not in l.name]
         for label_ind, label in enumerate(labels):
+            label_vertices = np.asarray(label.vertices)
+            label_vertices = label_vertices[label_vertices < len(verts)]
+            contours[label_vertices] = np.where(borders[label_vertices], label_ind + 1, 0)
             if verbose:
-                label_nei = np.zeros((len(label.vertices)))
-            for vert_ind, vert in enumerate(label.vertices):
-                if vert >= len(verts):
-                    continue
-                nei = set([vertices_labels_lookup[hemi].get(v, '') for v in vertices_neighbors[vert]]) - set([''])
-                contours[vert] = label_ind + 1 if len(nei) > 1 else 0
-                if verbose:
-                    label_nei[vert_ind] = contours[vert]
-            if verbose:
-                print(label.name, len(np.where(label_nei)[0]) / len(verts))
+                print(label.name, np.sum(borders[label_vertices]) / len(verts))
         if utils.both_hemi_files_exist(op.join(SUBJECTS_DIR, subject, 'surf', '{hemi}.sphere')):
             centers = [l.center_of_mass(restrict_vertices=True) for l in labels]
         else:
@@ -865,28 +842,21 @@ def create_verts_faces_lookup(subject, surface_type='pial'):
 
 @utils.timeit
 def calc_faces_contours(subject, atlas):
-    create_verts_faces_lookup(subject)
-    vertices_labels_lookup = lu.create_vertices_labels_lookup(subject, atlas)
-    verts_neighbors_fname = op.join(MMVT_DIR, subject, 'verts_neighbors_{hemi}.pkl')
+    vertices_labels_index = lu.create_vertices_labels_index(subject, atlas)
     contours_fname = op.join(MMVT_DIR, subject, 'labels', '{}_contours_{}.npz'.format(atlas, '{hemi}'))
-    # verts_faces_lookup_fname = op.join(MMVT_DIR, subject, 'faces_verts_{}.npy'.format('{hemi}'))
-    verts_faces_lookup_fname = op.join(MMVT_DIR, subject, 'faces_verts_lookup_{}.pkl'.format('{hemi}'))
     output_fname = op.join(MMVT_DIR, subject, 'contours_faces_{}.pkl'.format(atlas))
     contours_faces = dict(rh=set(), lh=set())
     for hemi in utils.HEMIS:
         contours_dict = np.load(contours_fname.format(hemi=hemi))
-        vertices_neighbors = np.load(verts_neighbors_fname.format(hemi=hemi))
-        verts_faces_lookup = utils.load(verts_faces_lookup_fname.format(hemi=hemi))
-        contours_vertices = np.where(contours_dict['contours'])[0]
-        for vert in tqdm(contours_vertices):
-            vert_label = vertices_labels_lookup[hemi].get(vert, '')
-            vert_faces = verts_faces_lookup[vert]
-            for vert_nei in vertices_neighbors[vert]:
-                nei_label = vertices_labels_lookup[hemi].get(vert_nei, '')
-                if vert_label != nei_label:
-                    nei_faces = verts_faces_lookup[vert_nei]
-                    common_faces = set(vert_faces) & set(nei_faces)
-                    contours_faces[hemi] |= common_faces
+        _, faces = utils.read_pial(subject, MMVT_DIR, hemi)
+        is_contour = contours_dict['contours'] != 0
+        faces_labels = vertices_labels_index[hemi].vertices_labels_ids(faces)
+        # A face is on the contours if one of its edges connects a contour vertex to a vertex from another label
+        on_contours = np.zeros(len(faces), dtype=bool)
+        for v1, v2 in [(0, 1), (1, 2), (2, 0)]:
+            on_contours |= (is_contour[faces[:, v1]] | is_contour[faces[:, v2]]) & \
+                           (faces_labels[:, v1] != faces_labels[:, v2])
+        contours_faces[hemi] = set(np.where(on_contours)[0].tolist())
     utils.save(contours_faces, output_fname)
     sio.savemat(op.join(MMVT_DIR, subject, 'contours_faces_{}.mat'.format(atlas)),
                 mdict={hemi:np.array(list(contours_faces[hemi])) + 1 for hemi in utils.HEMIS})
@@ -1396,7 +1366,7 @@ def create_skull_surfaces(subject, surfaces_fol_name='bem', verts_in_ras=True):
             print('{}: {}'.format(k, message))
 
     return all([op.isfile(op.join(skull_fol, '{}.ply'.format(skull_surf))) and \
-                op.isfile(op.join(skull_fol, 'faces_verts_{}.npy'.format(skull_surf))) \
+                utils.faces_verts_exist(op.join(skull_fol, 'faces_verts_{}.npy'.format(skull_surf))) \
                 for skull_surf in ['inner_skull', 'outer_skull']])
 
 
@@ -1528,6 +1498,9 @@ def main(subject, remote_subject_dir, args, flags):
     if 'check_labels' in args.function:
         flags['check_labels'] = check_labels(subject, args.atlas)
 
+    if 'migrate_ply_files' in args.function:
+        flags['migrate_ply_files'] = migrate_ply_files(subject)
+
     if 'load_bem_surfaces' in args.function:
         flags['load_bem_surfaces'] = load_bem_surfaces(subject, True, args.overwrite)
 
@@ -1,3 +1,4 @@
+import os
 import os.path as op
 import numpy as np
 import scipy.io as sio
@@ -14,6 +15,7 @@ from tqdm import tqdm
 from src.utils import utils
 from src.utils import preproc_utils as pu
 from src.utils import labels_utils as lu
+from src.utils import connectivity_utils as cu
 from src.preproc import fMRI as fmri
 
 SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
@@ -263,34 +265,51 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
         windows_num = min(args.max_windows_num, windows_num)
     output_fname = get_output_fname(args.connectivity_method[0], labels_extract_mode, identifier)
     output_mat_fname = get_output_mat_fname(args.connectivity_method[0], labels_extract_mode, identifier)
-    static_conn = None
-    if op.isfile(output_mat_fname) and not args.recalc_connectivity:
-        conn = np.load(output_mat_fname)
-        if conn.shape[0] != data.shape[0]:
+    static_conn, conn_pairs = None, None
+    # With --incremental_windows the output is the (pairs x windows) memmap instead of the matrix
+    pairs_fname = get_pairs_fname(output_mat_fname)
+    pairs_exist = args.incremental_windows and op.isfile(pairs_fname)
+    if (op.isfile(output_mat_fname) or pairs_exist) and not args.recalc_connectivity:
+        if pairs_exist:
+            conn_pairs = np.load(pairs_fname, mmap_mode='r')
+            channels_num = cu.pairs_channels_num(conn_pairs.shape[0])
+        else:
+            conn = np.load(output_mat_fname)
+            channels_num = conn.shape[0]
+        if channels_num != data.shape[0]:
             args.recalc_connectivity = True
         if 'corr' in args.connectivity_method:
             connectivity_method = 'Pearson corr'
         elif 'pli' in args.connectivity_method:
             connectivity_method = 'PLI'
+        elif 'wpli' in args.connectivity_method:
+            connectivity_method = 'wPLI'
         elif 'mi' in args.connectivity_method:
             connectivity_method = 'MI'
         elif 'coherence' in args.connectivity_method:
             connectivity_method = 'COH'
-    if not op.isfile(output_mat_fname) or args.recalc_connectivity:
+    if not (op.isfile(output_mat_fname) or pairs_exist) or args.recalc_connectivity:
+        conn_pairs = None
+        incremental = args.incremental_windows and data.ndim == 2
         if 'corr' in args.connectivity_method:
-            conn = np.zeros((data.shape[0], data.shape[0], windows_num))
+            incremental = incremental and not labels_extract_mode.startswith('pca_')
+            conn = np.zeros((data.shape[0], data.shape[0], windows_num)) if not incremental else None
             if labels_extract_mode.startswith('pca_'):
                 comps_num = int(labels_extract_mode.split('_')[1])
                 dims = (data.shape[0], data.shape[0], windows_num, comps_num * 2, comps_num * 2)
                 conn = np.zeros(dims)
-            if data.ndim == 3 and not labels_extract_mode.startswith('pca_') or data.ndim == 4:
+            if data.ndim == 3 and not labels_extract_mode.startswith('pca_'):
+                conn = np.transpose(cu.corr_windows(np.transpose(data[:, :, :windows_num], (2, 0, 1))), (1, 2, 0))
+            elif data.ndim == 4:
                 for w in range(windows_num):
                     conn[:, :, w] = np.corrcoef(data[:, :, w])
             else:
-                if not labels_extract_mode.startswith('pca_'):
-                    for w in range(windows_num):
-                        conn[:, :, w] = np.corrcoef(data[:, windows[w, 0]:windows[w, 1]])
-                        np.fill_diagonal(conn[:, :, w], 0)
+                if incremental:
+                    conn_pairs = calc_sliding_windows_connectivity(data, 'corr', windows_num, output_mat_fname, args)
+                elif not labels_extract_mode.startswith('pca_'):
+                    conn = np.transpose(cu.corr_windows(cu.sliding_windows(
+                        data, args.windows_length, args.windows_shift, windows_num)), (1, 2, 0))
+                    conn[np.arange(data.shape[0]), np.arange(data.shape[0])] = 0
                 else:
                     params = []
                     for w in range(windows_num):
@@ -303,32 +322,34 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                     for chunk in results:
                         for w, con in chunk.items():
                             conn[:, :, w] = con
-            if conn.shape[2] == 1:
-                conn = conn.squeeze()
-            backup(output_mat_fname)
-            print('Saving {}, {}'.format(output_mat_fname, conn.shape))
-            np.save(output_mat_fname, conn)
+            if conn_pairs is None:
+                if conn.shape[2] == 1:
+                    conn = conn.squeeze()
+                backup(output_mat_fname)
+                print('Saving {}, {}'.format(output_mat_fname, conn.shape))
+                np.save(output_mat_fname, conn)
             connectivity_method = 'Pearson corr'
 
-        elif 'pli' in args.connectivity_method:
-            conn = np.zeros((data.shape[0], data.shape[0], windows_num))
-            if data.ndim == 3:
-                conn_data = np.transpose(data, [2, 1, 0])
-            elif data.ndim == 2:
-                conn_data = np.zeros((windows_num, data.shape[0], args.windows_length))
-                for w in range(windows_num):
-                    conn_data[w] = data[:, windows[w, 0]:windows[w, 1]]
-            indices = np.array_split(np.arange(windows_num), args.n_jobs)
-            # chunks = utils.chunks(list(enumerate(conn_data)), windows_num / args.n_jobs)
-            chunks = [(conn_data[chunk_indices], chunk_indices, len(labels_names), args.windows_length)
-                  for chunk_indices in indices]
-            results = utils.run_parallel(_pli_parallel, chunks, args.n_jobs)
-            for chunk in results:
-                for w, con in chunk.items():
-                    conn[:, :, w] = con
-            backup(output_mat_fname)
-            np.save(output_mat_fname, conn)
-            connectivity_method = 'PLI'
+        elif 'pli' in args.connectivity_method or 'wpli' in args.connectivity_method:
+            pli_method = 'pli' if 'pli' in args.connectivity_method else 'wpli'
+            if incremental:
+                conn_pairs = calc_sliding_windows_connectivity(data, pli_method, windows_num, output_mat_fname, args)
+            else:
+                conn = np.zeros((data.shape[0], data.shape[0], windows_num))
+                if data.ndim == 3:
+                    conn_data = np.transpose(data, [2, 1, 0])[:windows_num]
+                elif data.ndim == 2:
+                    conn_data = cu.sliding_windows(data, args.windows_length, args.windows_shift, windows_num)
+                indices = np.array_split(np.arange(windows_num), args.n_jobs)
+                chunks = [(conn_data[chunk_indices], chunk_indices, len(labels_names), args.windows_length,
+                           pli_method) for chunk_indices in indices if len(chunk_indices) > 0]
+                results = utils.run_parallel(_pli_parallel, chunks, args.n_jobs)
+                for chunk in results:
+                    for w, con in chunk.items():
+                        conn[:, :, w] = con
+                backup(output_mat_fname)
+                np.save(output_mat_fname, conn)
+            connectivity_method = 'PLI' if pli_method == 'pli' else 'wPLI'
 
         elif 'coherence' in args.connectivity_method:
             if args.bands == '':
@@ -348,25 +369,20 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
         elif 'mi' in args.connectivity_method or 'mi_vec' in args.connectivity_method:
             conn = np.zeros((data.shape[0], data.shape[0], windows_num))
             corr_fname = get_output_mat_fname('corr', labels_extract_mode)
-            if op.isfile(corr_fname):
-                corr = np.load(get_output_mat_fname('corr', labels_extract_mode))
-            if not op.isfile(corr_fname) or corr.shape[0] != data.shape[0]:
+            corr = load_connectivity_matrix(corr_fname)
+            if corr is None or corr.shape[0] != data.shape[0]:
                 new_args = utils.Bag(args.copy())
                 new_args.connectivity_method = ['corr']
                 calc_lables_connectivity(subject, labels_extract_mode, new_args)
-                corr = np.load(get_output_mat_fname('corr', labels_extract_mode))
+                corr = load_connectivity_matrix(corr_fname)
             if 'mi' in args.connectivity_method or 'mi_vec' in args.connectivity_method and corr.ndim == 3:
                 conn_fname = get_output_mat_fname('mi', labels_extract_mode)
                 if op.isfile(conn_fname):
                     conn = np.load(conn_fname)
                 if not op.isfile(conn_fname) or conn.shape[0] != data.shape[0]:
                     conn = np.zeros(corr.shape)
-                    params = [(corr[:, :, w]) for w in range(windows_num)]
-                    chunks = utils.chunks(list(enumerate(params)), windows_num / args.n_jobs)
-                    results = utils.run_parallel(_mi_parallel, chunks, args.n_jobs)
-                    for chunk in results:
-                        for w, con in chunk.items():
-                            conn[:, :, w] = con
+                    conn[:, :, :windows_num] = np.transpose(
+                        cu.mi_from_corr(np.transpose(corr[:, :, :windows_num], (2, 0, 1))), (1, 2, 0))
                     backup(conn_fname)
                     np.save(conn_fname, conn)
             if 'mi_vec' in args.connectivity_method and corr.ndim == 5:
@@ -377,20 +393,21 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
                     # comps_num = int(labels_extract_mode.split('_')[1])
                     dims = (data.shape[0], data.shape[0], windows_num)
                     conn = np.zeros(dims)
-                    params = [(corr[:, :, w]) for w in range(windows_num)]
-                    chunks = utils.chunks(list(enumerate(params)), windows_num / args.n_jobs)
-                    results = utils.run_parallel(_mi_vec_parallel, chunks, args.n_jobs)
-                    for chunk in results:
-                        for w, con in chunk.items():
-                            conn[:, :, w] = con
+                    for w in range(windows_num):
+                        conn[:, :, w] = mi_vec(corr[:, :, w])
                     backup(conn_fname)
                     np.save(conn_fname, conn)
             connectivity_method = 'MI'
 
+    # The reductions of the pairs memmap, in pairs blocks
+    pairs_stats = cu.calc_pairs_stats(conn_pairs) if conn_pairs is not None else None
     if 'corr' in args.connectivity_method or 'pli' in args.connectivity_method and \
             not utils.both_hemi_files_exist(labels_avg_output_fname):
-        avg_per_label = np.mean(conn, 0)
-        abs_minmax = utils.calc_abs_minmax(conn)
+        if conn_pairs is None:
+            avg_per_label = np.mean(conn, 0)
+            abs_minmax = utils.calc_abs_minmax(conn)
+        else:
+            avg_per_label, abs_minmax = pairs_stats['channels_mean'], pairs_stats['abs_max']
         for hemi in utils.HEMIS:
             inds = labels_hemi_indices[hemi]
             backup(labels_avg_output_fname.format(hemi=hemi))
@@ -405,8 +422,12 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
         no_wins_connectivity_method = '{} CV'.format(args.connectivity_method)
         # todo: check why if it's not always True, the else fails
         if True:#not op.isfile(static_output_mat_fname):
-            conn_std = np.nanstd(conn, 2)
-            static_conn = conn_std / np.mean(np.abs(conn), 2)
+            if conn_pairs is None:
+                conn_std = np.nanstd(conn, 2)
+                static_conn = conn_std / np.mean(np.abs(conn), 2)
+            else:
+                conn_std = cu.pairs_to_matrix(pairs_stats['std'], data.shape[0])
+                static_conn = cu.pairs_to_matrix(pairs_stats['cv'], data.shape[0])
             if np.ndim(static_conn) == 2:
                 np.fill_diagonal(static_conn, 0)
             elif np.ndim(static_conn) == 4:
@@ -433,21 +454,21 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
         if not op.isfile(static_mean_output_mat_fname):
             dFC = np.nanmean(static_conn, 1)
             std_mean = np.nanmean(conn_std, 1)
-            stat_conn = np.nanmean(np.abs(conn), 1)
+            stat_conn = np.nanmean(np.abs(conn), 1) if conn_pairs is None else pairs_stats['channels_abs_nanmean']
             backup(static_mean_output_mat_fname)
             print('Saving {}, {}'.format(static_mean_output_mat_fname, std_mean.shape))
             np.savez(static_mean_output_mat_fname, dFC=dFC, std_mean=std_mean, stat_conn=stat_conn)
             lu.create_labels_coloring(subject, labels_names, dFC, '{}_{}_cv_mean'.format(
                 args.connectivity_modality, args.connectivity_method[0]), norm_percs=(1, 99), norm_by_percentile=True,
                 colors_map='YlOrRd')
-    if windows_num > 1 and conn.ndim == 3 and not op.isfile(conn_mean_mat_fname):
-        mean_conn = np.mean(conn, 2)
+    if windows_num > 1 and (conn_pairs is not None or conn.ndim == 3) and not op.isfile(conn_mean_mat_fname):
+        mean_conn = np.mean(conn, 2) if conn_pairs is None else cu.pairs_to_matrix(pairs_stats['mean'], data.shape[0])
         np.save(conn_mean_mat_fname, mean_conn)
     if not args.save_mmvt_connectivity:
         return True
-    conn = conn[:, :, :, np.newaxis]
+    conn = conn[:, :, :, np.newaxis] if conn_pairs is None else None
     d = save_connectivity(subject, conn, args.connectivity_method, ROIS_TYPE, labels_names, conditions, output_fname, args,
-                          con_vertices_fname)
+                          con_vertices_fname, conn_pairs=conn_pairs)
     ret = op.isfile(output_fname)
     if not static_conn is None:
         static_conn = static_conn[:, :, np.newaxis]
@@ -458,20 +479,40 @@ def calc_lables_connectivity(subject, labels_extract_mode, args):
     return ret
 
 
-def pli(data, channels_num, window_length):
+def calc_sliding_windows_connectivity(data, method, windows_num, output_mat_fname, args):
+    # The incremental sliding windows connectivity (connectivity_utils.SlidingWindowsConnectivity), streamed to a
+    # (pairs x windows) memmap next to output_mat_fname, which is saved instead of the (channels x channels x windows)
+    # matrix. Returns the memmap
+    return cu.calc_sliding_windows_connectivity(
+        data, args.windows_length, args.windows_shift, method, get_pairs_fname(output_mat_fname), windows_num,
+        n_jobs=args.n_jobs)
+
+
+def get_pairs_fname(output_mat_fname):
+    return '{}_pairs.npy'.format(op.splitext(output_mat_fname)[0])
+
+
+def load_connectivity_matrix(output_mat_fname):
+    # The (channels x channels x windows) matrix, densified on demand if its pairs memmap (--incremental_windows)
+    # is newer. None if neither exists
+    pairs_fname = get_pairs_fname(output_mat_fname)
+    if op.isfile(output_mat_fname) and (not op.isfile(pairs_fname) or
+                                         op.getmtime(output_mat_fname) >= op.getmtime(pairs_fname)):
+        return np.load(output_mat_fname)
+    elif op.isfile(pairs_fname):
+        conn_pairs = np.load(pairs_fname, mmap_mode='r')
+        conn = cu.pairs_to_matrix(conn_pairs, cu.pairs_channels_num(conn_pairs.shape[0]))
+        return conn.squeeze(2) if conn.shape[2] == 1 else conn
+    return None
+
+
+def pli(data, channels_num, window_length, pli_method='pli'):
+    # data: One window (channels x window_length), or (windows x channels x window_length)
     try:
-        from scipy.signal import hilbert
-        # nch = data.shape[0]
-        data_hil = hilbert(data)
-        if data_hil.shape != (channels_num, window_length):
+        if data.shape[-2:] != (channels_num, window_length):
             raise Exception('PLI: Wrong dimentions!')
-        m = np.zeros((channels_num, channels_num))
-        for i in range(channels_num):
-            for j in range(channels_num):
-                if i < j:
-                    m[i, j] = abs(np.mean(np.sign(np.imag(data_hil[i] / data_hil[j]))))
-                    # m[i, j] = abs(np.mean(np.sign(np.imag(data_hil[:, i] / data_hil[:, j]))))
-        return m + m.T
+        m = cu.pli_windows(data) if pli_method == 'pli' else cu.wpli_windows(data)
+        return m[0] if data.ndim == 2 else m
     except:
         print(traceback.format_exc())
         return None
@@ -479,15 +520,14 @@ def pli(data, channels_num, window_length):
 
 def _pli_parallel(p):
     res = {}
-    conn_data, indices, channels_num, window_length = p
-    # for window_ind, window in windows_chunk:
-    for window_ind, window in zip(indices, conn_data):
-        print('PLI: Window ind {}'.format(window_ind))
-        pli_val = pli(window, channels_num, window_length)
-        if not pli_val is None:
-            res[window_ind] = pli_val
-        else:
-            print('Error in PLI! windowsw ind {}'.format(window_ind))
+    conn_data, indices, channels_num, window_length = p[:4]
+    pli_method = p[4] if len(p) > 4 else 'pli'
+    print('PLI: Windows {}-{}'.format(indices[0], indices[-1]))
+    pli_vals = pli(np.asarray(conn_data), channels_num, window_length, pli_method)
+    if pli_vals is not None:
+        res = {window_ind: pli_val for window_ind, pli_val in zip(indices, pli_vals)}
+    else:
+        print('Error in PLI! windows inds {}'.format(indices))
     return res
 
 
@@ -516,17 +556,10 @@ def coherence(data, sfreq, fmin, fmax):
 
 
 def corr_matrix(data, comps_num):
-    corr = np.zeros((data.shape[0], data.shape[0], comps_num * 2, comps_num * 2))
-    # w1, w2 = int(windows[w, 0]), int(windows[w, 1])
-    for i in range(data.shape[0]):
-        for j in range(data.shape[0]):
-            if i < j:
-                corr[i, j] = np.corrcoef(data[i].T, data[j].T)
-    for i in range(data.shape[0]):
-        for j in range(data.shape[0]):
-            if i > j:
-                corr[i, j] = corr[j, i]
-    return corr
+    # data: (channels x T x comps_num), corr[i, j] = np.corrcoef(data[i].T, data[j].T) for i != j
+    if data.shape[2] != comps_num:
+        raise Exception('corr_matrix: Wrong number of components!')
+    return cu.corr_matrix_pairs(data)
 
 
 def _corr_matrix_parallel(windows_chunk):
@@ -539,14 +572,7 @@ def _corr_matrix_parallel(windows_chunk):
 
 
 def mi(conn_w):
-    nch = conn_w.shape[0]
-    conn = np.zeros((nch, nch))
-    for i in range(nch):
-        for j in range(nch):
-            if i < j:
-                conn[i, j] = -0.5 * np.log(1 - conn_w[i, j] ** 2)
-    conn = conn + conn.T
-    return conn
+    return cu.mi_from_corr(conn_w)
 
 
 def _mi_parallel(windows_chunk):
@@ -558,15 +584,7 @@ def _mi_parallel(windows_chunk):
 
 
 def mi_vec(corr_w):
-    nch = corr_w.shape[0]
-    conn = np.zeros((nch, nch))
-    for i in range(nch):
-        for j in range(nch):
-            if i < j:
-                conn[i, j] = -0.5 * np.log(np.linalg.norm(
-                    np.eye(corr_w.shape[3]) - corr_w[i, j] * corr_w[i, j].T))
-    conn = conn + conn.T
-    return conn
+    return cu.mi_vec_from_corr(corr_w)
 
 
 def _mi_vec_parallel(windows_chunk):
@@ -579,7 +597,7 @@ def _mi_vec_parallel(windows_chunk):
 
 @utils.tryit()
 def save_connectivity(subject, conn, connectivity_method, obj_type, labels_names, conditions, output_fname, args,
-                      con_vertices_fname='', labels=None, locations=None, hemis=None):
+                      con_vertices_fname='', labels=None, locations=None, hemis=None, conn_pairs=None):
     d = dict()
     d['conditions'] = conditions
     # args.labels_exclude = []
@@ -602,7 +620,7 @@ def save_connectivity(subject, conn, connectivity_method, obj_type, labels_names
     else:
         d['labels'], d['locations'], d['hemis'] = labels, locations, hemis
     (_, d['con_indices'], d['con_names'], d['con_values'], d['con_types'],
-     d['data_max'], d['data_min']) = calc_connectivity(conn, d['labels'], d['hemis'], args)
+     d['data_max'], d['data_min']) = calc_connectivity(conn, d['labels'], d['hemis'], args, conn_pairs)
     d['connectivity_method'] = connectivity_method
     print('Saving results to {}'.format(output_fname))
     np.savez(output_fname, **d)
@@ -644,20 +662,25 @@ def calc_lables_info(subject, args, sorted_according_to_annot_file=True, sorted_
     return labels_names, locations, hemis
 
 
-def calc_connectivity(data, labels, hemis, args):
+def calc_connectivity(data, labels, hemis, args, conn_pairs=None):
     # stat, conditions, w, threshold=0, threshold_percentile=0, color_map='jet',
     #                         norm_by_percentile=True, norm_percs=(1, 99), symetric_colors=True):
+    # conn_pairs: Instead of data, (pairs x windows) values (one condition), in the lower_rec_indices order
     # import time
-    M = data.shape[0]
-    W = data.shape[2] if 'windows' not in args or args.windows == 0 else args.windows
+    M = data.shape[0] if conn_pairs is None else len(labels)
+    if conn_pairs is not None:
+        W = conn_pairs.shape[1]
+    else:
+        W = data.shape[2] if 'windows' not in args or args.windows == 0 else args.windows
     L = int((M * M + M) / 2 - M)
     con_indices = np.zeros((L, 2))
-    con_values = np.zeros((L, W, len(args.conditions)))
+    # conn_pairs stays a memmap, its reductions are calculated in pairs blocks
+    con_values = np.zeros((L, W, len(args.conditions))) if conn_pairs is None else conn_pairs[:, :, np.newaxis]
     con_names = [None] * L
     con_type = np.zeros((L))
     lower_rec_indices = list(utils.lower_rec_indices(M))
     # LRI = len(lower_rec_indices)
-    for cond in range(len(args.conditions)):
+    for cond in range(len(args.conditions) if conn_pairs is None else 0):
         for w in range(W):
             # now = time.time()
             if W > 1 and data.ndim == 4:
@@ -689,14 +712,22 @@ def calc_connectivity(data, labels, hemis, args):
             print('error in calc_connectivity!')
     con_indices = con_indices.astype(np.int)
     con_names = np.array(con_names)
-    data_max, data_min = utils.get_data_max_min(stat_data, args.norm_by_percentile, args.norm_percs)
+    if conn_pairs is None:
+        data_max, data_min = utils.get_data_max_min(stat_data, args.norm_by_percentile, args.norm_percs)
+    else:
+        data_max, data_min = cu.calc_pairs_max_min(conn_pairs, args.norm_by_percentile, args.norm_percs)
     data_minmax = max(map(abs, [data_max, data_min]))
     if 'threshold_percentile' in args and args.threshold_percentile > 0:
-        args.threshold = np.percentile(np.abs(stat_data), args.threshold_percentile)
+        if conn_pairs is None:
+            args.threshold = np.percentile(np.abs(stat_data), args.threshold_percentile)
+        else:
+            args.threshold = cu.calc_pairs_percentiles(conn_pairs, [args.threshold_percentile], use_abs=True)[0]
     if args.threshold > data_minmax:
         raise Exception('threshold > abs(max(data)) ({})'.format(data_minmax))
     if args.threshold >= 0:
-        if stat_data.ndim >= 2:
+        if conn_pairs is not None:
+            indices = np.where(cu.calc_pairs_abs_max(conn_pairs) > args.threshold)[0]
+        elif stat_data.ndim >= 2:
             indices = np.where(np.max(abs(stat_data), axis=1) > args.threshold)[0]
         else:
             indices = np.where(abs(stat_data) > args.threshold)[0]
@@ -704,9 +735,10 @@ def calc_connectivity(data, labels, hemis, args):
         # con_colors = con_colors[indices]
         con_indices = con_indices[indices]
         con_names = con_names[indices]
-        con_values = con_values[indices]
+        if conn_pairs is None or len(indices) < len(con_values):
+            con_values = con_values[indices]
+            stat_data = stat_data[indices]
         con_type  = con_type[indices]
-        stat_data = stat_data[indices]
 
     con_values = np.squeeze(con_values)
     if 'data_max' not in args and 'data_min' not in args or args.data_max == 0 and args.data_min == 0:
@@ -768,7 +800,11 @@ def calc_electrodes_rest_connectivity(subject, args):
     con_vertices_fname = op.join(
         MMVT_DIR, subject, 'connectivity', '{}_vertices.pkl'.format(args.connectivity_modality))
 
-    if not op.isfile(output_mat_fname):
+    pairs_fname = get_pairs_fname(output_mat_fname)
+    conn, conn_pairs = None, None
+    if args.incremental_windows and op.isfile(pairs_fname):
+        conn_pairs = np.load(pairs_fname, mmap_mode='r')
+    elif not op.isfile(output_mat_fname) or args.incremental_windows:
         conn_data = get_electrode_conn_data()
         windows_num, E, windows_length = conn_data.shape
 
@@ -778,49 +814,64 @@ def calc_electrodes_rest_connectivity(subject, args):
             conn_data = filter.filter_data(conn_data, args.sfreq, args.fmin, args.fmax)
             # plt.figure()
             # plt.psd(conn_data, Fs=args.sfreq)
-            conn_data = conn_data[np.newaxis, :, :]
 
             import math
             T = windows_length
             windows_num = math.floor((T - args.windows_length) / args.windows_shift + 1)
-            data_winodws = np.zeros((windows_num, E, args.windows_length))
-            for w in range(windows_num):
-                data_winodws[w] = conn_data[0, :, w * args.windows_shift:w * args.windows_shift + args.windows_length]
-            conn_data = data_winodws
+            if args.max_windows_num != 0:
+                windows_num = min(args.max_windows_num, windows_num)
+            if args.incremental_windows:
+                # The (pairs x windows) PLI, streamed to a memmap, with the whole recording's analytic signal
+                analytic_signal_fname = op.join(MMVT_DIR, subject, 'connectivity', 'electrodes_analytic_signal.npy')
+                conn_pairs = cu.calc_sliding_windows_connectivity(
+                    conn_data, args.windows_length, args.windows_shift, 'pli', pairs_fname, windows_num,
+                    analytic_signal_fname=analytic_signal_fname, n_jobs=args.n_jobs)
+                os.remove(analytic_signal_fname)
+            else:
+                conn_data = cu.sliding_windows(conn_data, args.windows_length, args.windows_shift, windows_num)
+        elif args.incremental_windows:
+            print('The electrodes data is already in windows, calculating each window')
         if args.max_windows_num != 0:
             windows_num = min(args.max_windows_num, windows_num)
 
-        # pli_wins = 1
-        conn = np.zeros((E, E, windows_num))
-        conn_data = conn_data[:windows_num]
-        chunks = utils.chunks(list(enumerate(conn_data)), windows_num / args.n_jobs)
-        results = utils.run_parallel(_pli_parallel, chunks, args.n_jobs)
-        for chunk in results:
-            for w, con in chunk.items():
-                conn[:, :, w] = con
-
-        # five_cycle_freq = 5. * args.sfreq / float(conn_data.shape[2])
-        # for w in range(windows_num - pli_wins):
-        #     window_conn_data = conn_data[w:w+pli_wins, :, :]
-        #     con, _, _, _, _ = mne.connectivity.spectral_connectivity(
-        #         window_conn_data, 'pli2_unbiased', sfreq=args.sfreq, fmin=args.fmin, fmax=args.fmax,
-        #         n_jobs=args.n_jobs)
-        #     con = np.mean(con, 2) # Over freqs
-        #     conn[:, :, w] = con + con.T
-
-        np.save(output_mat_fname, conn)
+        if conn_pairs is None:
+            # pli_wins = 1
+            conn = np.zeros((E, E, windows_num))
+            conn_data = conn_data[:windows_num]
+            indices = np.array_split(np.arange(windows_num), args.n_jobs)
+            chunks = [(conn_data[chunk_indices], chunk_indices, E, conn_data.shape[2])
+                      for chunk_indices in indices if len(chunk_indices) > 0]
+            results = utils.run_parallel(_pli_parallel, chunks, args.n_jobs)
+            for chunk in results:
+                for w, con in chunk.items():
+                    conn[:, :, w] = con
+
+            # five_cycle_freq = 5. * args.sfreq / float(conn_data.shape[2])
+            # for w in range(windows_num - pli_wins):
+            #     window_conn_data = conn_data[w:w+pli_wins, :, :]
+            #     con, _, _, _, _ = mne.connectivity.spectral_connectivity(
+            #         window_conn_data, 'pli2_unbiased', sfreq=args.sfreq, fmin=args.fmin, fmax=args.fmax,
+            #         n_jobs=args.n_jobs)
+            #     con = np.mean(con, 2) # Over freqs
+            #     conn[:, :, w] = con + con.T
+
+            np.save(output_mat_fname, conn)
     else:
         conn = np.load(output_mat_fname)
 
     connectivity_method = 'PLI'
     no_wins_connectivity_method = '{} CV'.format(connectivity_method)
-    static_conn = np.nanstd(conn, 2) / np.mean(np.abs(conn), 2)
-    np.fill_diagonal(static_conn, 0)
-    conn = conn[:, :, :, np.newaxis]
-    conditions = ['rest']
     electrodes_names = get_electrodes_names()
+    if conn_pairs is not None:
+        # The CV and the output from the (pairs x windows) memmap, without the (E x E x windows) matrix
+        static_conn = cu.pairs_to_matrix(cu.calc_pairs_cv(conn_pairs), len(electrodes_names))
+    else:
+        static_conn = np.nanstd(conn, 2) / np.mean(np.abs(conn), 2)
+        np.fill_diagonal(static_conn, 0)
+        conn = conn[:, :, :, np.newaxis]
+    conditions = ['rest']
     d = save_connectivity(subject, conn, connectivity_method, ELECTRODES_TYPE, electrodes_names, conditions, output_fname, args,
-                          con_vertices_fname)
+                          con_vertices_fname, conn_pairs=conn_pairs)
     ret = op.isfile(output_fname)
     if not static_conn is None:
         static_conn = static_conn[:, :, np.newaxis]
@@ -979,6 +1030,7 @@ def read_cmd_args(argv=None):
     parser.add_argument('--windows_length', help='', required=False, default=0, type=int)
     parser.add_argument('--windows_shift', help='', required=False, default=500, type=int)
     parser.add_argument('--max_windows_num', help='', required=False, default=None, type=au.int_or_none)
+    parser.add_argument('--incremental_windows', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--tmin', help='', required=False, default=None, type=au.int_or_none)
     parser.add_argument('--tmax', help='', required=False, default=None, type=au.int_or_none)
 
@@ -18,6 +18,7 @@ from src.mmvt_addon import colors_utils as cu
 from src.utils import matlab_utils as mu
 from src.utils import preproc_utils as pu
 from src.utils import geometry_utils as gu
+from src.utils import ela_utils as ela
 
 SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
 ELECTRODES_DIR = utils.get_link_dir(utils.get_links_dir(), 'electrodes')
@@ -582,64 +583,63 @@ def find_electrodes_hemis(subject, bipolar, sigma=0, manual=False):
 
 
 def check_if_electrodes_inside_the_dura(subject, electrodes_t1_tkreg, sigma):
-
+    # sigma can be a list, then in_dural[hemi] is (sigmas_num x electrodes_num), calculated in one pass
     if not utils.both_hemi_files_exist(op.join(SUBJECTS_DIR, subject, 'surf', '{hemi}.dural')):
         print('check_if_electrodes_inside_the_dura: No dura surface!')
         return None
 
-    from scipy.spatial.distance import cdist
-    in_dural = {}
-    dural_verts, _, dural_normals = gu.get_dural_surface(op.join(SUBJECTS_DIR, subject), do_calc_normals=True)
-    if dural_verts is None:
+    in_dural = gu.points_inside_dural(op.join(SUBJECTS_DIR, subject), electrodes_t1_tkreg, sigma)
+    if in_dural is None:
         from src.misc.dural import create_dural
         create_dural.create_dural_surface(subject, SUBJECTS_DIR)
-        dural_verts, _, dural_normals = gu.get_dural_surface(op.join(SUBJECTS_DIR, subject), do_calc_normals=True)
-    if dural_verts is None:
+        in_dural = gu.points_inside_dural(op.join(SUBJECTS_DIR, subject), electrodes_t1_tkreg, sigma)
+    if in_dural is None:
         print('No Dural surface!!!')
         return False
-    for hemi in ['rh', 'lh']:
-        dists = cdist(electrodes_t1_tkreg, dural_verts[hemi])
-        close_verts_indices = np.argmin(dists, axis=1)
-        in_dural[hemi] = [gu.point_in_mesh(u, dural_verts[hemi][vert_ind], dural_normals[hemi][vert_ind], sigma)
-                          for u, vert_ind in zip(electrodes_t1_tkreg, close_verts_indices)]
     return in_dural
 
 
 @utils.tryit()
 def check_how_many_electrodes_inside_the_dura(subject, sigma=0, bipolar=False):
+    # For a list of sigmas, all the sigmas are tested in one pass, and the results are saved per sigma
     if bipolar:
         print('This function is only for monopolar electrodes')
         return False
-    output_fname = op.join(MMVT_DIR, subject, 'electrodes', 'how_many_inside_dura.csv')
-    if op.isfile(output_fname):
-        os.remove(output_fname)
+    sigmas = [sigma] if np.isscalar(sigma) else sigma
+    output_fnames = [op.join(MMVT_DIR, subject, 'electrodes', 'how_many_inside_dura.csv') if np.isscalar(sigma)
+                     else op.join(MMVT_DIR, subject, 'electrodes', 'how_many_inside_dura_sigma_{}.csv'.format(s))
+                     for s in sigmas]
+    for output_fname in output_fnames:
+        if op.isfile(output_fname):
+            os.remove(output_fname)
     electrodes, electrodes_t1_tkreg = read_electrodes_file(subject, bipolar)
-    in_dural_hemis = check_if_electrodes_inside_the_dura(subject, electrodes_t1_tkreg, sigma)
+    in_dural_hemis = check_if_electrodes_inside_the_dura(subject, electrodes_t1_tkreg, sigmas)
     if in_dural_hemis is None:
         return False
-    num_inside_dura = defaultdict(int)
-    electrodes_num = defaultdict(int)
-    groups_inside = defaultdict(dict)
-    for elc_ind, elc_name in enumerate(electrodes):
-        elc_group, elc_num = utils.elec_group_number(elc_name, bipolar)
-        in_dural = in_dural_hemis['rh'][elc_ind] or in_dural_hemis['lh'][elc_ind]
-        groups_inside[elc_group][elc_num] = in_dural
-        electrodes_num[elc_group] += 1
-    for elc_ind, elc_name in enumerate(electrodes):
-        elc_group, elc_num = utils.elec_group_number(elc_name, bipolar)
-        in_dural = groups_inside[elc_group][elc_num]
-        if in_dural:
-            num_inside_dura[elc_group] += 1
-        else: # Check if the elc is inside the brain
-            if any([groups_inside[elc_group][k] for k in range(elc_num + 1,  electrodes_num[elc_group])]):
+    for sigma_ind, output_fname in enumerate(output_fnames):
+        num_inside_dura = defaultdict(int)
+        electrodes_num = defaultdict(int)
+        groups_inside = defaultdict(dict)
+        for elc_ind, elc_name in enumerate(electrodes):
+            elc_group, elc_num = utils.elec_group_number(elc_name, bipolar)
+            in_dural = in_dural_hemis['rh'][sigma_ind][elc_ind] or in_dural_hemis['lh'][sigma_ind][elc_ind]
+            groups_inside[elc_group][elc_num] = in_dural
+            electrodes_num[elc_group] += 1
+        for elc_ind, elc_name in enumerate(electrodes):
+            elc_group, elc_num = utils.elec_group_number(elc_name, bipolar)
+            in_dural = groups_inside[elc_group][elc_num]
+            if in_dural:
                 num_inside_dura[elc_group] += 1
-    print('Saving results to {}'.format(output_fname))
-    with open(output_fname, 'w') as output_file:
-        for group, in_dura_num in num_inside_dura.items():
-            output_str = '{}, {}, {}'.format(group, in_dura_num, electrodes_num[group])
-            output_file.write('{}\n'.format(output_str))
-            print(output_str)
-    return op.isfile(output_fname)
+            else: # Check if the elc is inside the brain
+                if any([groups_inside[elc_group][k] for k in range(elc_num + 1,  electrodes_num[elc_group])]):
+                    num_inside_dura[elc_group] += 1
+        print('Saving results to {}'.format(output_fname))
+        with open(output_fname, 'w') as output_file:
+            for group, in_dura_num in num_inside_dura.items():
+                output_str = '{}, {}, {}'.format(group, in_dura_num, electrodes_num[group])
+                output_file.write('{}\n'.format(output_str))
+                print(output_str)
+    return all([op.isfile(output_fname) for output_fname in output_fnames])
 
 
 # @pu.tryit_ret_bool
@@ -988,17 +988,27 @@ def create_electrodes_groups_coloring(subject, bipolar, coloring_fname=''):
     return op.isfile(coloring_fname)
 
 
+def get_ela_output_name(subject, atlas, bipolar, error_radius, elec_length):
+    # '{:g}': 3.0 -> 3, like the names of the electrodes_rois output
+    return '{}_{}_electrodes_cigar_r_{:g}_l_{:g}{}.pkl'.format(
+        subject, atlas, float(error_radius), float(elec_length), '_bipolar' if bipolar else '')
+
+
 def get_electrodes_labeling(subject, blender_root, atlas, bipolar=False, error_radius=3, elec_length=4, other_fname='',
-                            overwrite_ela=False):
+                            overwrite_ela=False, ela_in_tree=True, n_jobs=4):
     if other_fname == '':
         # We remove the 'all_rois' and 'stretch' for the name!
-        electrode_labeling_fname = op.join(blender_root, subject, 'electrodes',
-            '{}_{}_electrodes_cigar_r_{}_l_{}{}.pkl'.format(subject, atlas, error_radius, elec_length,
-            '_bipolar' if bipolar else ''))
+        electrode_labeling_fname = op.join(blender_root, subject, 'electrodes', get_ela_output_name(
+            subject, atlas, bipolar, error_radius, elec_length))
     else:
         electrode_labeling_fname = other_fname
-    if not op.isfile(electrode_labeling_fname):
-        run_ela(subject, atlas, bipolar, overwrite_ela, error_radius, elec_length)
+    # The in tree and the electrodes_rois labeling have the same name, and they are told apart by the in tree's
+    # model. The in tree ELA labels again only the contacts whose coordinates changed
+    model_changed = other_fname == '' and op.isfile(electrode_labeling_fname) and \
+        ela.is_in_tree_labeling(utils.load(electrode_labeling_fname)) != ela_in_tree
+    if not op.isfile(electrode_labeling_fname) or model_changed or \
+            (overwrite_ela and ela_in_tree and other_fname == ''):
+        run_ela(subject, atlas, bipolar, overwrite_ela, error_radius, elec_length, ela_in_tree, n_jobs)
     if op.isfile(electrode_labeling_fname):
         labeling = utils.load(electrode_labeling_fname)
         return labeling, electrode_labeling_fname
@@ -1009,10 +1019,12 @@ def get_electrodes_labeling(subject, blender_root, atlas, bipolar=False, error_r
 
 @pu.tryit_ret_bool
 def create_electrodes_labeling_coloring(subject, bipolar, atlas, good_channels=None, error_radius=3, elec_length=4,
-                                        overwrite_ela=False, p_threshold=0.05, legend_name='', coloring_fname=''):
+                                        overwrite_ela=False, p_threshold=0.05, legend_name='', coloring_fname='',
+                                        ela_in_tree=True, n_jobs=4):
     # elecs_names, elecs_coords = read_electrodes_file(subject, bipolar)
     elecs_probs, electrode_labeling_fname = get_electrodes_labeling(
-        subject, MMVT_DIR, atlas, bipolar, error_radius, elec_length, overwrite_ela=overwrite_ela)
+        subject, MMVT_DIR, atlas, bipolar, error_radius, elec_length, overwrite_ela=overwrite_ela,
+        ela_in_tree=ela_in_tree, n_jobs=n_jobs)
     if elecs_probs is None:
         print('No electrodes labeling file!')
         return
@@ -1229,17 +1241,21 @@ def get_ras_file(subject, args):
     return op.isfile(local_fname)
 
 
-def run_ela(subject, atlas, bipolar, overwrite=False, elc_r=3, elc_len=4):
+def run_ela(subject, atlas, bipolar, overwrite=False, elc_r=3, elc_len=4, in_tree=True, n_jobs=4):
+    if in_tree:
+        return run_ela_in_tree(subject, atlas, bipolar, elc_r, elc_len, n_jobs)
     mmvt_code_fol = utils.get_mmvt_code_root()
     ela_code_fol = op.join(utils.get_parent_fol(mmvt_code_fol), 'electrodes_rois')
     if not op.isdir(ela_code_fol) or not op.isfile(op.join(ela_code_fol, 'find_rois', 'find_rois.py')):
         print("Can't find ELA folder!")
         return
 
-    output_name = '{}_{}_electrodes_cigar_r_{}_l_{}{}.pkl'.format(
-        subject, atlas, elc_r, elc_len, '_bipolar' if bipolar else '')
+    output_name = get_ela_output_name(subject, atlas, bipolar, elc_r, elc_len)
     output_fname = op.join(ela_code_fol, 'electrodes', output_name)
     mmvt_ela_fname = op.join(MMVT_DIR, subject, 'electrodes', output_name)
+    if op.isfile(mmvt_ela_fname) and ela.is_in_tree_labeling(utils.load(mmvt_ela_fname)):
+        # The in tree labeling (it can be calculated again from its cache) is replaced by the electrodes_rois one
+        os.remove(mmvt_ela_fname)
     if op.isfile(output_fname) or (not op.isfile(mmvt_ela_fname) and overwrite):
         if not op.isfile(mmvt_ela_fname) and op.isfile(output_fname):
             shutil.copyfile(output_fname, mmvt_ela_fname)
@@ -1260,6 +1276,18 @@ def run_ela(subject, atlas, bipolar, overwrite=False, elc_r=3, elc_len=4):
         return True
 
 
+def run_ela_in_tree(subject, atlas, bipolar, elc_r=3, elc_len=4, n_jobs=4):
+    names, pos = read_electrodes_file(subject, bipolar)
+    if len(names) == 0:
+        return False
+    output_name = get_ela_output_name(subject, atlas, bipolar, elc_r, elc_len)
+    mmvt_ela_fname = op.join(MMVT_DIR, subject, 'electrodes', output_name)
+    cache_fname = op.join(MMVT_DIR, subject, 'electrodes', 'ela_cache_{}'.format(output_name))
+    labeling = ela.calc_electrodes_labeling(
+        subject, atlas, names, pos, bipolar, elc_r, elc_len, mmvt_ela_fname, cache_fname, SUBJECTS_DIR, n_jobs)
+    return labeling is not None and op.isfile(mmvt_ela_fname)
+
+
 def main(subject, remote_subject_dir, args, flags):
     utils.make_dir(op.join(ELECTRODES_DIR, subject))
     utils.make_dir(op.join(MMVT_DIR, subject))
@@ -1293,7 +1321,8 @@ def main(subject, remote_subject_dir, args, flags):
 
     if utils.should_run(args, 'create_electrodes_labeling_coloring'):
         flags['create_electrodes_labeling_coloring'] = create_electrodes_labeling_coloring(
-            subject, args.bipolar, args.atlas, overwrite_ela=args.overwrite_ela)
+            subject, args.bipolar, args.atlas, error_radius=args.error_radius, elec_length=args.elc_length,
+            overwrite_ela=args.overwrite_ela, ela_in_tree=args.ela_in_tree, n_jobs=args.n_jobs)
 
     if utils.should_run(args, 'create_electrodes_groups_coloring'):
         flags['create_electrodes_groups_coloring'] = create_electrodes_groups_coloring(
@@ -1314,11 +1343,12 @@ def main(subject, remote_subject_dir, args, flags):
 
     if 'electrodes_inside_the_dura' in args.function:
         flags['electrodes_inside_the_dura'] = check_how_many_electrodes_inside_the_dura(
-            subject, args.sigma, args.bipolar)
+            subject, args.sigma if args.get('sigmas', '') == '' else args.sigmas, args.bipolar)
 
     if 'run_ela' in args.function:
         flags['run_ela'] = run_ela(
-            subject, args.atlas, args.bipolar, args.overwrite_ela, args.error_radius, args.elc_length)
+            subject, args.atlas, args.bipolar, args.overwrite_ela, args.error_radius, args.elc_length,
+            args.ela_in_tree, args.n_jobs)
 
     return flags
     # check_montage_and_electrodes_names('/homes/5/npeled/space3/MMVT/mg79/mg79.sfp', '/homes/5/npeled/space3/inaivu/data/mg79_ieeg/angelique/electrode_names.txt')
@@ -1350,6 +1380,8 @@ def read_cmd_args(argv=None):
     parser.add_argument('--normalize_data', help='normalize_data', required=False, default=1, type=au.is_true)
     parser.add_argument('--preload', help='preload', required=False, default=1, type=au.is_true)
     parser.add_argument('--sigma', help='surf sigma', required=False, default=0, type=float)
+    parser.add_argument('--sigmas', help='surf sigmas (tested in one pass)', required=False, default='',
+                        type=au.float_arr_type)
     parser.add_argument('--find_hemis_manual', required=False, default=0, type=au.is_true)
 
     parser.add_argument('--start_time', help='', required=False, default='0:00:00')
@@ -1379,8 +1411,10 @@ def read_cmd_args(argv=None):
     parser.add_argument('--trans_from_subject', help='transform electrodes coords from this subject', required=False,
                         default='colin27')
     parser.add_argument('--overwrite_ela', required=False, default=0, type=au.is_true)
-    parser.add_argument('--error_radius', help='error radius', required=False, default=3)
-    parser.add_argument('--elc_length', help='elc length', required=False, default=4)
+    parser.add_argument('--error_radius', help='error radius', required=False, default=3, type=float)
+    parser.add_argument('--elc_length', help='elc length', required=False, default=4, type=float)
+    parser.add_argument('--ela_in_tree', help='use ela_utils and not the electrodes_rois code', required=False,
+                        default=1, type=au.is_true)
 
     pu.add_common_args(parser)
     args = utils.Bag(au.parse_parser(parser, argv))
@@ -9,14 +9,8 @@ import glob
 import traceback
 from collections import defaultdict
 
-try:
-    from sklearn.neighbors import BallTree
-except:
-    print('No sklearn!')
-
 try:
     import mne.label
-    import mne.stats.cluster_level as mne_clusters
     MNE_EXIST = True
 except:
     MNE_EXIST = False
@@ -43,6 +37,10 @@ from src.utils import freesurfer_utils as fu
 from src.preproc import meg as meg
 from src.utils import preproc_utils as pu
 from src.utils import labels_utils as lu
+from src.utils import projection_utils as prju
+from src.utils import fmri_streaming_utils as fsu
+from src.mmvt_addon import activity_store as acts
+from src.mmvt_addon import clusters_tree
 
 
 SUBJECTS_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
@@ -216,22 +214,19 @@ def init_clusters(subject, input_fname):
             np.savez(pial_npz_fname[:-4], verts=verts, faces=faces)
         d = np.load(pial_npz_fname)
         verts_per_hemi[hemi] = d['verts']
-    connectivity_fname = op.join(MMVT_DIR, subject, 'spatial_connectivity.pkl')
-    if not op.isfile(connectivity_fname):
-        from src.preproc import anatomy
-        anatomy.create_spatial_connectivity(subject)
-    connectivity_per_hemi = utils.load(connectivity_fname)
+    from src.preproc import anatomy
+    connectivity_per_hemi = {hemi: anatomy.load_surf_adjacency(subject, hemi) for hemi in utils.HEMIS}
     return contrast_per_hemi, connectivity_per_hemi, verts_per_hemi
 
 
-def find_clusters(subject, surf_template_fname, t_val, atlas, min_cluster_max=0, min_cluster_size=0, clusters_label='',
-                  task='', n_jobs=1):
-    # contrast_name = contrast_name if volume_name == '' else volume_name
-    # volume_name = volume_name if volume_name != '' else contrast_name
-    # if input_fol == '':
-    #     input_fol = op.join(MMVT_DIR, subject, 'fmri')
-    # input_fname = op.join(input_fol, 'fmri_{}_{}_{}.npy'.format(task, contrast_name, '{hemi}'))
+def load_clusters_trees(surf_full_input_fname, contrast, connectivity, overwrite=False):
+    # The clusters of all the thresholds, built once per contrast (see src/mmvt_addon/clusters_tree.py)
+    return {hemi: clusters_tree.load_clusters_tree(
+        surf_full_input_fname.format(hemi=hemi), connectivity[hemi], contrast[hemi], overwrite)
+        for hemi in utils.HEMIS}
+
 
+def get_surf_full_input_fname(subject, surf_template_fname):
     surf_template_fname = utils.namebase_with_ext(surf_template_fname)
     if lu.get_hemi_from_name(surf_template_fname) == '':
         surf_template_fname = 'fmri_{}_{}.npy'.format(utils.namebase(surf_template_fname), '{hemi}')
@@ -242,12 +237,26 @@ def find_clusters(subject, surf_template_fname, t_val, atlas, min_cluster_max=0,
         surf_full_input_fnames = find_hemi_files_from_template(surf_full_input_fname)
         if len(surf_full_input_fnames) == 0:
             print('No hemi files were found from the template {}'.format(surf_full_input_fname))
-            return False
-    surf_full_input_fname = utils.select_one_file(surf_full_input_fnames, surf_full_input_fname, 'fMRI surf')
+            return ''
+    return utils.select_one_file(surf_full_input_fnames, surf_full_input_fname, 'fMRI surf')
+
+
+def find_clusters(subject, surf_template_fname, t_val, atlas, min_cluster_max=0, min_cluster_size=0, clusters_label='',
+                  task='', n_jobs=1):
+    # contrast_name = contrast_name if volume_name == '' else volume_name
+    # volume_name = volume_name if volume_name != '' else contrast_name
+    # if input_fol == '':
+    #     input_fol = op.join(MMVT_DIR, subject, 'fmri')
+    # input_fname = op.join(input_fol, 'fmri_{}_{}_{}.npy'.format(task, contrast_name, '{hemi}'))
+
+    surf_full_input_fname = get_surf_full_input_fname(subject, surf_template_fname)
+    if surf_full_input_fname == '':
+        return False
     contrast, connectivity, verts = init_clusters(subject, surf_full_input_fname)
+    clusters_trees = load_clusters_trees(surf_full_input_fname, contrast, connectivity)
     clusters_labels = dict(threshold=t_val, values=[], atlas=atlas)
     for hemi in utils.HEMIS:
-        clusters, _ = mne_clusters._find_clusters(contrast[hemi], t_val, connectivity=connectivity[hemi])
+        clusters = clusters_trees[hemi].clusters(t_val)
         # blobs_output_fname = op.join(input_fol, 'blobs_{}_{}.npy'.format(contrast_name, hemi))
         # print('Saving blobs: {}'.format(blobs_output_fname))
         # save_clusters_for_blender(clusters, contrast[hemi], blobs_output_fname)
@@ -295,33 +304,37 @@ def find_clusters(subject, surf_template_fname, t_val, atlas, min_cluster_max=0,
     return op.isfile(clusters_labels_output_fname)
 
 
-# def find_clusters_tval_hist(subject, contrast_name, output_fol, input_fol='', n_jobs=1):
-#     contrast, connectivity, _ = init_clusters(subject, contrast_name, input_fol)
-#     clusters = {}
-#     tval_values = np.arange(2, 20, 0.1)
-#     now = time.time()
-#     for ind, tval in enumerate(tval_values):
-#         try:
-#             # utils.time_to_go(now, ind, len(tval_values), 5)
-#             clusters[tval] = {}
-#             for hemi in utils.HEMIS:
-#                 clusters[tval][hemi], _ = mne_clusters._find_clusters(
-#                     contrast[hemi], tval, connectivity=connectivity[hemi])
-#             print('tval: {:.2f}, len rh: {}, lh: {}'.format(tval, max(map(len, clusters[tval]['rh'])),
-#                                                         max(map(len, clusters[tval]['rh']))))
-#         except:
-#             print('error with tval {}'.format(tval))
-#     utils.save(clusters, op.join(output_fol, 'clusters_tval_hist.pkl'))
+def find_clusters_tval_hist(subject, surf_template_fname, output_fol='', tval_values=None):
+    surf_full_input_fname = get_surf_full_input_fname(subject, surf_template_fname)
+    if surf_full_input_fname == '':
+        return False
+    if output_fol == '':
+        output_fol = op.join(MMVT_DIR, subject, 'fmri')
+    if tval_values is None:
+        tval_values = np.arange(2, 20, 0.1)
+    contrast, connectivity, _ = init_clusters(subject, surf_full_input_fname)
+    clusters_trees = load_clusters_trees(surf_full_input_fname, contrast, connectivity)
+    # The clusters' sizes per threshold
+    clusters = {tval: {hemi: clusters_trees[hemi].clusters_sizes(tval) for hemi in utils.HEMIS}
+                for tval in tval_values}
+    for tval in tval_values:
+        print('tval: {:.2f}, max size rh: {}, lh: {}'.format(tval, *[
+            max(clusters[tval][hemi], default=0) for hemi in ['rh', 'lh']]))
+    output_fname = op.join(output_fol, 'clusters_tval_hist.pkl')
+    utils.save(clusters, output_fname)
+    return op.isfile(output_fname)
 
 
 def load_clusters_tval_hist(input_fol):
     from itertools import chain
     clusters = utils.load(op.join(input_fol, 'clusters_tval_hist.pkl'))
     res = []
+    # The clusters' sizes, or the clusters themselves in old files
+    clusters_sizes = lambda clusters: [c if np.isscalar(c) else len(c) for c in clusters]
     for t_val, clusters_tval in clusters.items():
         tval = float('{:.2f}'.format(t_val))
-        max_size = max([max([len(c) for c in clusters_tval[hemi]]) for hemi in utils.HEMIS])
-        avg_size = np.mean(list(chain.from_iterable(([[len(c) for c in clusters_tval[hemi]] for hemi in utils.HEMIS]))))
+        max_size = max([max(clusters_sizes(clusters_tval[hemi]), default=0) for hemi in utils.HEMIS])
+        avg_size = np.mean(list(chain.from_iterable(([clusters_sizes(clusters_tval[hemi]) for hemi in utils.HEMIS]))))
         clusters_num = sum(map(len, [clusters_tval[hemi] for hemi in utils.HEMIS]))
         res.append((tval, max_size, avg_size, clusters_num))
     res = sorted(res)
@@ -429,7 +442,7 @@ def convert_fmri_file(input_fname_template, from_format='nii.gz', to_format='mgz
 
 
 def calc_subs_surface_activity(subject, fmri_file_template, template_brains, threshold=2, subcortical_codes_fname='',
-        aseg_stats_file_name='', method='max', k_points=100, format='mgz', do_plot=False):
+        aseg_stats_file_name='', method='max', k_points=100, format='mgz', do_plot=False, n_jobs=1):
     # todo: Should fix:
     # 1) morph the data to subject's space / read vertices from the template brain
     # 2) Solve issues if the data has time dim
@@ -449,6 +462,7 @@ def calc_subs_surface_activity(subject, fmri_file_template, template_brains, thr
     out_folder = op.join(MMVT_DIR, subject, 'fmri', 'subcortical_fmri_activity')
     if not op.isdir(out_folder):
         os.mkdir(out_folder)
+    projections_fol = utils.make_dir(op.join(MMVT_DIR, subject, 'fmri', 'projections'))
     sub_cortical_generator = utils.sub_cortical_voxels_generator(aseg, seg_labels, spacing=5, use_grid=False)
     for pts, seg_name, seg_id in sub_cortical_generator:
         print(seg_name)
@@ -458,7 +472,8 @@ def calc_subs_surface_activity(subject, fmri_file_template, template_brains, thr
         print(seg_name, seg_id, np.mean(vals), is_sig)
         pts = utils.transform_voxels_to_RAS(aseg.header, pts)
         # plot_points(verts,pts)
-        verts_vals = calc_vert_vals(verts, pts, vals, method=method, k_points=k_points)
+        verts_vals = calc_vert_vals(verts, pts, vals, method=method, k_points=k_points, cache_fol=projections_fol,
+                                    n_jobs=n_jobs)
         print('verts vals: {}+-{}'.format(verts_vals.mean(), verts_vals.std()))
         if sum(abs(verts_vals) > threshold) > 0:
             sig_subs.append(seg_name)
@@ -552,22 +567,11 @@ def calc_subs_activity(subject, fmri_file_template, measures=['mean'], subcortic
     return all([op.isfile(o) for o in out_fnames])
 
 
-def calc_vert_vals(verts, pts, vals, method='max', k_points=100):
-    ball_tree = BallTree(pts)
-    dists, pts_inds = ball_tree.query(verts, k=k_points, return_distance=True)
-    near_vals = vals[pts_inds]
-    # sig_dists = dists[np.where(abs(near_vals)>2)]
-    cover = len(np.unique(pts_inds.ravel()))/float(len(pts))
-    print('{}% of the points are covered'.format(cover*100))
-    if method=='dist':
-        n_dists = 1/(dists**2)
-        norm = 1/np.sum(n_dists, 1)
-        norm = np.reshape(norm, (len(norm), 1))
-        n_dists = norm * n_dists
-        verts_vals = np.sum(near_vals * n_dists, 1)
-    elif method=='max':
-        verts_vals = near_vals[range(near_vals.shape[0]), np.argmax(abs(near_vals), 1)]
-    return verts_vals
+def calc_vert_vals(verts, pts, vals, method='max', k_points=100, cache_fol='', n_jobs=1):
+    # The nearest points of the vertices are calculated once per (pts, verts), and cached in cache_fol
+    projection = prju.get_surface_projection(verts, pts, k_points, cache_fol, n_jobs)
+    print('{}% of the points are covered'.format(projection.coverage * 100))
+    return projection.project(vals, method)
 
 
 def plot_points(subject, verts, pts=None, colors=None, fig_name='', ax=None):
@@ -834,7 +838,9 @@ def copy_volumes(subject, contrast_file_template, contrast, volume_fol, volume_n
 
 def analyze_4d_data(subject, atlas, input_fname_template, measures=['mean'], template_brain='', norm_percs=(1,99),
                           overwrite=False, remote_fmri_dir='', do_plot=False, do_plot_all_vertices=False,
-                          excludes=('corpuscallosum', 'unknown'), input_format='nii.gz'):
+                          excludes=('corpuscallosum', 'unknown'), input_format='nii.gz', n_jobs=1, memory_mb=0):
+    # memory_mb: If > 0, the 4D data is read in blocks (through nibabel's array proxy) up to memory_mb, instead of
+    # loading all of it to memory
     files_exist = all([utils.both_hemi_files_exist(op.join(
         MMVT_DIR, subject, 'fmri', 'labels_data_{}_{}_{}.npz'.format(atlas, em, '{hemi}'))) for em in measures])
     minmax_fname_template = op.join(MMVT_DIR, subject, 'fmri', 'labels_data_{}_{}_minmax.pkl'.format(atlas, '{em}'))
@@ -851,10 +857,13 @@ def analyze_4d_data(subject, atlas, input_fname_template, measures=['mean'], tem
         fmri_fname = input_fname_template_file.format(hemi=hemi)
         fmri_fname = convert_fmri_file(fmri_fname, from_format=input_format)
         print('loading {} ({})'.format(fmri_fname, utils.file_modification_time(fmri_fname)))
-        x = nib.load(fmri_fname).get_data()
+        if memory_mb > 0:
+            x = fsu.ImageTimeSeries(fmri_fname, memory_mb)
+        else:
+            x = nib.load(fmri_fname).get_data()
         morph_from_subject = check_vertices_num(subject, hemi, x, morph_from_subject)
         # print(max([max(label.vertices) for label in labels]))
-        labels = []
+        measures_to_calc = []
         for em in measures:
             output_fname = op.join(MMVT_DIR, subject, 'fmri', 'labels_data_{}_{}_{}.npz'.format(atlas, em, hemi))
             if op.isfile(output_fname) and not overwrite:
@@ -863,14 +872,22 @@ def analyze_4d_data(subject, atlas, input_fname_template, measures=['mean'], tem
                     labels_data = np.load(output_fname)['data']
                     labels_minmax[em].append(utils.calc_min_max(labels_data, norm_percs=norm_percs))
                 continue
-            if len(labels) == 0:
-                # labels = lu.read_hemi_labels(morph_from_subject, SUBJECTS_DIR, atlas, hemi)
-                labels = lu.read_labels(morph_from_subject, SUBJECTS_DIR, atlas, hemi=hemi)
-                if len(labels) == 0:
-                    print('No {} {} labels were found!'.format(morph_from_subject, atlas))
-                    return False
-            labels_data, labels_names = lu.calc_time_series_per_label(
-                x, labels, em, excludes, figures_dir, do_plot, do_plot_all_vertices)
+            measures_to_calc.append(em)
+        if len(measures_to_calc) == 0:
+            continue
+        # labels = lu.read_hemi_labels(morph_from_subject, SUBJECTS_DIR, atlas, hemi)
+        labels = lu.read_labels(morph_from_subject, SUBJECTS_DIR, atlas, hemi=hemi)
+        if len(labels) == 0:
+            print('No {} {} labels were found!'.format(morph_from_subject, atlas))
+            return False
+        # All the measures are calculated in one pass over the data
+        membership = lu.get_labels_membership(morph_from_subject, atlas, hemi, labels, x.shape[0])
+        measures_data = lu.calc_time_series_per_labels(
+            x, labels, measures_to_calc, excludes, figures_dir, do_plot, do_plot_all_vertices, membership, n_jobs,
+            chunk_mb=memory_mb if memory_mb > 0 else fsu.DEFAULT_MEMORY_MB)
+        for em in measures_to_calc:
+            output_fname = op.join(MMVT_DIR, subject, 'fmri', 'labels_data_{}_{}_{}.npz'.format(atlas, em, hemi))
+            labels_data, labels_names = measures_data[em]
             np.savez(output_fname, data=labels_data, names=labels_names)
             labels_minmax[em].append(utils.calc_min_max(labels_data, norm_percs=norm_percs))
             print('{} was saved'.format(output_fname))
@@ -1130,7 +1147,7 @@ def find_fmri_fname_template(subject, fmri_file_template, template_brains, only_
 
 
 def save_dynamic_activity_map(subject, fmri_file_template='', template_brains='fsaverage', format='mgz',
-                              norm_percs=(1, 99), overwrite=False):
+                              norm_percs=(1, 99), overwrite=False, store_dtype='float32', store_vertex_major=True):
     minmax_fname = op.join(MMVT_DIR, subject, 'fmri', 'activity_map_minmax.npy')
     fmri_fname_template = find_fmri_fname_template(subject, fmri_file_template, template_brains, False, format)
     hemi_minmax = []
@@ -1140,7 +1157,7 @@ def save_dynamic_activity_map(subject, fmri_file_template='', template_brains='f
         # Check if there is a morphed file
         data = nib.load(fmri_fname).get_data().squeeze()
         T = data.shape[1]
-        if not overwrite and len(glob.glob(op.join(fol, '*.npy'))) == T:
+        if not overwrite and acts.get_activity_map_times_num(fol) == T:
             hemi_minmax.append(utils.calc_min_max(data, norm_percs=norm_percs))
             continue
         verts, faces = utils.read_pial(subject, MMVT_DIR, hemi)
@@ -1165,17 +1182,15 @@ def save_dynamic_activity_map(subject, fmri_file_template='', template_brains='f
         assert (data.shape[0] == subject_verts_num)
         hemi_minmax.append(utils.calc_min_max(data, norm_percs=norm_percs))
         utils.delete_folder_files(fol)
-        now = time.time()
         T = data.shape[1]
-        for t in range(T):
-            utils.time_to_go(now, t, T, runs_num_to_print=10)
-            np.save(op.join(fol, 't{}'.format(t)), data[:, t])
+        acts.save_activity_store(data, fol, store_dtype, store_vertex_major)
+        print('{} frames were saved in {}'.format(T, acts.get_store_fnames(fol)[0]))
 
     data_min, data_max = utils.calc_minmax_from_arr(hemi_minmax)
     print('save_dynamic_activity_map minmax: {},{}'.format(data_min, data_max))
     np.save(minmax_fname, (data_min, data_max))
-    return np.all([len(glob.glob(op.join(MMVT_DIR, subject, 'fmri', 'activity_map_{}'.format(hemi), '*.npy'))) == T
-                   for hemi in utils.HEMIS])
+    return np.all([acts.get_activity_map_times_num(
+        op.join(MMVT_DIR, subject, 'fmri', 'activity_map_{}'.format(hemi))) == T for hemi in utils.HEMIS])
 
 
 def find_template_files(template_fname, file_types=('mgz', 'nii.gz', 'nii', 'npy')):
@@ -1851,6 +1866,9 @@ def main(subject, remote_subject_dir, args, flags):
             subject, args.fmri_file_template, args.threshold, args.atlas, args.min_cluster_max,
             args.min_cluster_size, args.clusters_label, args.task, args.n_jobs)
 
+    if 'find_clusters_tval_hist' in args.function:
+        flags['find_clusters_tval_hist'] = find_clusters_tval_hist(subject, args.fmri_file_template)
+
     if 'fmri_pipeline_all' in args.function:
         flags['fmri_pipeline_all'] = fmri_pipeline_all(subject, args.atlas, filter_dic=None)
 
@@ -1863,12 +1881,14 @@ def main(subject, remote_subject_dir, args, flags):
         flags['analyze_4d_data'] = analyze_4d_data(
             subject, args.atlas, args.fmri_file_template, args.labels_extract_mode, args.template_brain,
             args.norm_percs, args.overwrite_labels_data, remote_fmri_dir, args.resting_state_plot,
-            args.resting_state_plot_all_vertices, args.excluded_labels, args.input_format)
+            args.resting_state_plot_all_vertices, args.excluded_labels, args.input_format, args.n_jobs,
+            args.fmri_memory_mb)
 
     if 'save_dynamic_activity_map' in args.function:
         flags['save_dynamic_activity_map'] = save_dynamic_activity_map(
             subject, args.fmri_file_template, template_brains=args.template_brain,
-            norm_percs=args.norm_percs, overwrite=args.overwrite_activity_data)
+            norm_percs=args.norm_percs, overwrite=args.overwrite_activity_data,
+            store_dtype=args.activity_store_dtype)
 
     if 'calc_labels_minmax' in args.function:
         flags['calc_labels_minmax'] = calc_labels_minmax(subject, args.atlas, args.labels_extract_mode)
@@ -1877,7 +1897,7 @@ def main(subject, remote_subject_dir, args, flags):
         flags['calc_subs_surface_activity'] = calc_subs_surface_activity(
             subject, args.fmri_file_template, args.template_brain, args.subs_threshold, args.subcortical_codes_file,
             args.aseg_stats_fname, method=args.calc_subs_surface_method, k_points=args.calc_subs_surface_points,
-            format='mgz', do_plot=False)
+            format='mgz', do_plot=False, n_jobs=args.n_jobs)
 
     if 'calc_meg_activity' in args.function:
         meg_subject = args.meg_subject
@@ -1958,6 +1978,7 @@ def read_cmd_args(argv=None):
 
     parser.add_argument('--norm_by_percentile', help='', required=False, default=1, type=au.is_true)
     parser.add_argument('--norm_percs', help='', required=False, default='1,99', type=au.int_arr_type)
+    parser.add_argument('--activity_store_dtype', help='float32 or int16', required=False, default='float32')
     parser.add_argument('--symetric_colors', help='', required=False, default=1, type=au.is_true)
 
     # Clusters:
@@ -1978,6 +1999,8 @@ def read_cmd_args(argv=None):
     parser.add_argument('--excluded_labels', help='', required=False, default='corpuscallosum,unknown', type=au.str_arr_type)
     parser.add_argument('--st_template', help='', required=False, default='*{subject}_{atlas}*.txt')
     parser.add_argument('--overwrite_labels_data', help='', required=False, default=0, type=au.is_true)
+    parser.add_argument('--fmri_memory_mb', help='Read the 4D data in blocks up to this size (MB), 0 to load all of it',
+                        required=False, default=0, type=float)
     parser.add_argument('--overwrite_activity_data', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--overwrite_mri_segstat', help='', required=False, default=0, type=au.is_true)
     # parser.add_argument('--raw_fwhm', help='Raw Full Width at Half Maximum for Spatial Smoothing', required=False, default=5, type=float)
@@ -28,9 +28,13 @@ from mne.preprocessing import create_ecg_epochs, create_eog_epochs
 from src.utils import utils
 from src.utils import preproc_utils as pu
 from src.utils import labels_utils as lu
+from src.utils import labels_extraction_utils as leu
 from src.utils import args_utils as au
 from src.utils import freesurfer_utils as fu
+from src.utils import morph_utils as mu
+from src.utils import pipeline_utils as pipu
 from src.preproc import anatomy as anat
+from src.mmvt_addon import activity_store as acts
 
 SUBJECTS_MRI_DIR, MMVT_DIR, FREESURFER_HOME = pu.get_links()
 
@@ -1483,7 +1487,7 @@ def find_dipole_cortical_locations(atlas, cond, dipole_title, grow_label=True, l
     if inv_fname == '':
         inv_fname = INV
     dipole_fname = op.join(SUBJECT_MEG_FOLDER, 'dipole_{}_{}.pkl'.format(cond, dipole_title))
-    vertices_labels_lookup = lu.create_vertices_labels_lookup(MRI_SUBJECT, atlas)
+    vertices_labels_index = lu.create_vertices_labels_index(MRI_SUBJECT, atlas)
     dipole, _ = utils.load(dipole_fname)
     trans = _get_trans(COR, fro='head', to='mri')[0]
     scatter_points = apply_trans(trans['trans'], dipole.pos) * 1e3
@@ -1503,7 +1507,7 @@ def find_dipole_cortical_locations(atlas, cond, dipole_title, grow_label=True, l
         hemi = ['lh', 'rh'][hemi_ind]
         dist = vertices_dist[hemi_ind][ind]
         vert = vertices[hemi_ind][ind]
-        label = vertices_labels_lookup[hemi][vert]
+        label = vertices_labels_index[hemi].vertices_labels([vert])[0]
         gof = dipole.gof[ind]
         if label.startswith('precentral'):
             print(ind, hemi, dist, label, gof)
@@ -1910,8 +1914,12 @@ def calc_stc_for_all_vertices(stc, subject='', morph_to_subject='', n_jobs=6):
     subject = MRI_SUBJECT if subject == '' else MRI_SUBJECT
     morph_to_subject = subject if morph_to_subject == '' else morph_to_subject
     grade = None if morph_to_subject != 'fsaverage' else 5
-    vertices_to = mne.grade_to_vertices(morph_to_subject, grade)
-    return mne.morph_data(subject, morph_to_subject, stc, n_jobs=n_jobs, grade=vertices_to)
+    return mu.morph_stc(stc, subject, morph_to_subject, grade, cache_fol=get_morph_operators_fol(subject),
+                        n_jobs=n_jobs)
+
+
+def get_morph_operators_fol(subject):
+    return op.join(MMVT_DIR, subject, 'meg', 'morph_operators')
 
 
 # def create_stc_t(stc, t, subject=''):
@@ -1977,7 +1985,8 @@ def _morph_stc(from_subject, to_subject, stc_fname, output_fname, grade=5, smoot
         stc_fname = '{}-rh.stc'.format(stc_fname)
     if op.isfile(stc_fname):
         stc = mne.read_source_estimate(stc_fname)
-        stc_morphed = mne.morph_data(from_subject, to_subject, stc, grade=grade, smooth=smooth, n_jobs=n_jobs)
+        stc_morphed = mu.morph_stc(stc, from_subject, to_subject, grade, smooth,
+                                   cache_fol=get_morph_operators_fol(from_subject), n_jobs=n_jobs)
         stc_morphed.save(output_fname)
         print('Morphed stc file was saves in {}'.format(output_fname))
     else:
@@ -2027,7 +2036,8 @@ def check_stc_with_ply(stc, cond_name='', subject=''):
 
 
 def save_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM', smoothed_stc=True, morph_to_subject='',
-                      stc_t=-1, norm_by_percentile=False, norm_percs=(1,99), plot_cb=False):
+                      stc_t=-1, norm_by_percentile=False, norm_percs=(1,99), plot_cb=False, store_dtype='float32',
+                      store_vertex_major=True):
     try:
         if stat not in [STAT_DIFF, STAT_AVG]:
             raise Exception('stat not in [STAT_DIFF, STAT_AVG]!')
@@ -2048,13 +2058,12 @@ def save_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM', smoo
             if morph_to_subject != '':
                 fol = fol.replace(MRI_SUBJECT, morph_to_subject)
             if stc_t == -1:
+                # One activity store (activity_map_{hemi}.dat) instead of a file per time point
                 utils.delete_folder_files(fol)
-                now = time.time()
-                T = data.shape[1]
-                for t in range(T):
-                    utils.time_to_go(now, t, T, runs_num_to_print=10)
-                    np.save(op.join(fol, 't{}'.format(t)), data[:, t])
+                acts.save_activity_store(data, fol, store_dtype, store_vertex_major)
+                print('{} frames were saved in {}'.format(data.shape[1], acts.get_store_fnames(fol)[0]))
             else:
+                # Read instead of the store's frame, as long as it's newer than the store
                 utils.make_dir(fol)
                 np.save(op.join(fol, 't{}'.format(stc_t)), data)
         flag = True
@@ -2159,35 +2168,27 @@ def get_subject_tris():
     return tris
 
 
-def save_vertex_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM', number_of_files=100):
+def save_vertex_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM', store_dtype='float32',
+                             smoothed_stc=True, morph_to_subject=''):
+    # A vertex-major activity store in {ACT}_verts (activity_map_{hemi}_verts.verts.dat), for fast time course reads
     try:
         if stat not in [STAT_DIFF, STAT_AVG]:
             raise Exception('stat not in [STAT_DIFF, STAT_AVG]!')
-        stcs = get_stat_stc_over_conditions(events, stat, stcs_conds, inverse_method, smoothed=True)
+        stcs = get_stat_stc_over_conditions(
+            events, stat, stcs_conds, inverse_method, smoothed_stc, morph_to_subject)
+        subject = MRI_SUBJECT if morph_to_subject == '' else morph_to_subject
         for hemi in HEMIS:
-            verts, faces = utils.read_pial(MRI_SUBJECT, MMVT_DIR, hemi)
+            verts, faces = utils.read_pial(subject, MMVT_DIR, hemi)
             data = stcs[hemi]
             if verts.shape[0]!=data.shape[0]:
                 raise Exception('save_vertex_activity_map: wrong number of vertices!')
             else:
                 print('Both {}.pial.ply and the stc file have {} vertices'.format(hemi, data.shape[0]))
-
-            data_hash = defaultdict(list)
             fol = '{}_verts'.format(ACT.format(hemi))
-            utils.delete_folder_files(fol)
-            look_up = np.zeros((data.shape[0], 2), dtype=np.int)
-            for vert_ind in range(data.shape[0]):
-                file_num = vert_ind % number_of_files
-                data_hash[file_num].append(data[vert_ind, :])
-                look_up[vert_ind] = [file_num, len(data_hash[file_num])-1]
-                if vert_ind % 10000 == 0:
-                    print('{}: {} out of {}'.format(hemi, vert_ind, data.shape[0]))
-
-            np.save('{}_verts_lookup'.format(ACT.format(hemi)), look_up)
-            for file_num in range(number_of_files):
-                file_name = op.join(fol, str(file_num))
-                x = np.array(data_hash[file_num])
-                np.save(file_name, x)
+            if morph_to_subject != '':
+                fol = fol.replace(MRI_SUBJECT, morph_to_subject)
+            acts.save_activity_store(data, fol, store_dtype, vertex_major=True)
+            print('The vertices time courses were saved in {}'.format(acts.get_store_fnames(fol)[1]))
         flag = True
     except:
         print(traceback.format_exc())
@@ -2196,6 +2197,18 @@ def save_vertex_activity_map(events, stat, stcs_conds=None, inverse_method='dSPM
     return flag
 
 
+def convert_activity_maps(subject, store_dtype='float32', store_vertex_major=True, delete_frames=False,
+                          overwrite=False):
+    # Converts the existing activity_map_* folders (a t{t}.npy file per time point) into activity stores
+    folders = [fol for fol in glob.glob(op.join(MMVT_DIR, subject, 'activity_map_*')) +
+               glob.glob(op.join(MMVT_DIR, subject, 'fmri', 'activity_map_*')) if op.isdir(fol)]
+    if len(folders) == 0:
+        print('convert_activity_maps: No activity map folders in {}'.format(op.join(MMVT_DIR, subject)))
+        return False
+    return all([acts.convert_activity_map_folder(fol, store_dtype, store_vertex_major, delete_frames, overwrite)
+                for fol in folders])
+
+
 def get_stat_stc_over_conditions(events, stat, stcs_conds=None, inverse_method='dSPM', smoothed=False,
                                  morph_to_subject='', stc_t=-1):
     stcs = {}
@@ -2278,7 +2291,7 @@ def labels_to_annot(parc_name, labels_fol='', overwrite=True):
         return None
 
 
-def calc_single_trial_labels_per_condition(atlas, events, stcs, extract_modes=('mean_flip'), src=None):
+def calc_single_trial_labels_per_condition(atlas, events, stcs, extract_modes=('mean_flip',), src=None):
     global_inverse_operator = False
     if '{cond}' not in INV:
         global_inverse_operator = True
@@ -2286,16 +2299,27 @@ def calc_single_trial_labels_per_condition(atlas, events, stcs, extract_modes=('
             inverse_operator = read_inverse_operator(INV)
             src = inverse_operator['src']
 
+    labels = lu.read_labels(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas)
+    labels_extractor = None
     for extract_mode in extract_modes:
         for (cond_name, cond_id), stc in zip(events.items(), stcs.values()):
             if not global_inverse_operator:
                 if src is None:
                     inverse_operator = read_inverse_operator(INV.format(cond=cond_name))
                     src = inverse_operator['src']
-            labels = lu.read_labels(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas)
-            labels_ts = mne.extract_label_time_course(stcs[cond_name], labels, src, mode=extract_mode,
-                                                      return_generator=False, allow_empty=True)
-            np.save(op.join(SUBJECT_MEG_FOLDER, 'labels_ts_{}_{}'.format(cond_name, extract_mode)), np.array(labels_ts))
+            if labels_extractor is None:
+                labels_extractor = get_labels_extractor(labels, src)
+            if hasattr(stcs[cond_name], 'data'):
+                labels_ts = labels_extractor.extract(stcs[cond_name], extract_mode)
+            else:
+                # All the epochs stcs are reduced together
+                labels_ts = labels_extractor.extract_stcs(stcs[cond_name], extract_mode)
+            np.save(op.join(SUBJECT_MEG_FOLDER, 'labels_ts_{}_{}'.format(cond_name, extract_mode)), labels_ts)
+
+
+def get_labels_extractor(labels, src, overwrite=False):
+    # The labels' sources and flips are cached in the subject's MEG folder, hashed on the src and the labels
+    return leu.LabelsExtractor(labels, src, op.join(SUBJECT_MEG_FOLDER, 'labels_extraction'), overwrite)
 
 
 def get_stc_conds(events, inverse_method, stc_hemi_template):
@@ -2383,6 +2407,7 @@ def calc_labels_avg_per_condition(
         conds_incdices = {cond_id:ind for ind, cond_id in zip(range(len(stcs)), events.values())}
         conditions = []
         labels_data = {}
+        labels_extractor = None
         labels = lu.read_labels(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas, hemi=hemi, surf_name=surf_name,
                                 labels_fol=labels_fol, read_only_from_annot=read_only_from_annot, n_jobs=n_jobs)
         for (cond_name, cond_id), stc_cond in zip(events.items(), stcs.values()):
@@ -2399,6 +2424,8 @@ def calc_labels_avg_per_condition(
             if len(labels) == 0:
                 print('No labels were found for {} atlas!'.format(atlas))
                 return False
+            if labels_extractor is None:
+                labels_extractor = get_labels_extractor(labels, src)
 
             if isinstance(stc_cond, types.GeneratorType):
                 stc_cond_num = stcs_num[cond_name]
@@ -2407,16 +2434,13 @@ def calc_labels_avg_per_condition(
                 stc_cond_num = 1
             for stc_ind, stc in enumerate(stc_cond):
                 for em in extract_modes:
-                    for ind, label in enumerate(labels):
-                        label_data = stc.extract_label_time_course(label, src, mode=em, allow_empty=True)
-                        label_data = np.squeeze(label_data)
-                        # Set flip to be always positive
-                        # mean_flip *= np.sign(mean_flip[np.argmax(np.abs(mean_flip))])
-                        if em not in labels_data:
-                            T = len(stc.times)
-                            labels_data[em] = np.zeros((len(labels), T, len(stcs), stc_cond_num))
-                        labels_data[em][ind, :, conds_incdices[cond_id], stc_ind] = label_data
-                        if do_plot:
+                    # All the labels time courses at once
+                    if em not in labels_data:
+                        T = len(stc.times)
+                        labels_data[em] = np.zeros((len(labels), T, len(stcs), stc_cond_num))
+                    labels_data[em][:, :, conds_incdices[cond_id], stc_ind] = labels_extractor.extract(stc, em)
+                    if do_plot:
+                        for ind, label in enumerate(labels):
                             plt.plot(labels_data[em][ind, :, conds_incdices[cond_id]], label=label.name)
 
             if do_plot:
@@ -2851,7 +2875,7 @@ def calc_labels_avg_for_rest(
         if raw is None:
             raw_fname = get_raw_fname(raw_fname)
             if op.isfile(raw_fname):
-                mne.io.read_raw_fif(raw_fname)
+                raw = mne.io.read_raw_fif(raw_fname)
             else:
                 raise Exception("Can't find the raw file! ({})".format(raw_fname))
         if not isinstance(inverse_method, str) and isinstance(inverse_method, Iterable):
@@ -2862,10 +2886,12 @@ def calc_labels_avg_for_rest(
         labels_data = {}
         for hemi in utils.HEMIS:
             labels = lu.read_labels(MRI_SUBJECT, SUBJECTS_MRI_DIR, atlas, hemi=hemi)
+            # Calculated (or loaded from the cache) once, and shared by all the jobs
+            labels_extractor = get_labels_extractor(labels, src)
             indices = np.array_split(np.arange(len(labels)), n_jobs)
-            chunks = [([labels[ind] for ind in indices_chunk], raw, src, inverse_operator, lambda2, inverse_method,
-                       extract_modes, pick_ori, save_data_files, labels_output_fol_template, overwrite_stc,
-                       do_plot_time_series) for indices_chunk in indices]
+            chunks = [([labels[ind] for ind in indices_chunk], indices_chunk, labels_extractor, raw, inverse_operator,
+                       lambda2, inverse_method, extract_modes, pick_ori, save_data_files, labels_output_fol_template,
+                       overwrite_stc, do_plot_time_series) for indices_chunk in indices]
             results = utils.run_parallel(calc_stc_labels_parallel, chunks, n_jobs)
             labels_data[hemi] = collect_parallel_results(indices, results, len(labels))
 
@@ -2901,21 +2927,17 @@ def calc_labels_avg_for_rest(
 
 
 def calc_stc_labels_parallel(p):
-    (labels, raw, src, inverse_operator, lambda2, inverse_method, extract_modes, pick_ori,
+    (labels, labels_inds, labels_extractor, raw, inverse_operator, lambda2, inverse_method, extract_modes, pick_ori,
      save_data_files, labels_output_fol_template, overwrite, do_plot_time_series) = p
     labels_data = {}
-    for ind, label in enumerate(labels):
+    for ind, (label, label_ind) in enumerate(zip(labels, labels_inds)):
         stc = mne.minimum_norm.apply_inverse_raw(
             raw, inverse_operator, lambda2, inverse_method, label=label, pick_ori=pick_ori)
         for em in extract_modes:
-            # label_data = stc.extract_label_time_course(label, src, mode=em, allow_empty=True)
-            if em != 'mean_flip':
-                print("{} isn't implemented yet for rest data!".format(em))
-                continue
             labels_output_fol = labels_output_fol_template.format(extract_mode=em)
             utils.make_dir(labels_output_fol)
-            label_data = extract_label_data(label, src, stc)
-            label_data = np.squeeze(label_data)
+            # The stc has only the label's sources
+            label_data = labels_extractor.extract(stc, em, labels_inds=[label_ind])[0]
             if do_plot_time_series:
                 plot_label_data(label_data, label.name, em, labels_output_fol)
             if save_data_files:
@@ -2958,16 +2980,10 @@ def plot_label_data(label_data, label, em, labels_output_fol):
     plt.close()
 
 
-def extract_label_data(label, src, stc):
-    label_flip = mne.label_sign_flip(label, src)[:, None].squeeze()
-    label_flip = np.tile(label_flip, (stc.data.shape[1], 1)).T
-    label_tc = np.mean(label_flip * stc.data, axis=0)
-    return label_tc
-
-
 def calc_labels_avg_per_condition_wrapper(
         subject, conditions, atlas, inverse_method, stcs_conds, args, flags={}, stcs_num={}, raw=None, epochs=None,
-        modality='meg'):
+        modality='meg', hemis=None):
+    hemis = HEMIS if hemis is None else hemis
     if utils.should_run(args, 'calc_labels_avg_per_condition'):
         labels_data_exist = all([utils.both_hemi_files_exist(args.labels_data_template.format(
             args.atlas, me, '{hemi}')) for me in args.extract_mode])
@@ -2991,7 +3007,7 @@ def calc_labels_avg_per_condition_wrapper(
             if stcs_conds is None:
                 return False
         factor = 6 if modality == 'eeg' else 12  # micro V for EEG, fT (Magnetometers) and fT/cm (Gradiometers) for MEG
-        for hemi_ind, hemi in enumerate(HEMIS):
+        for hemi_ind, hemi in enumerate(hemis):
             flags['calc_labels_avg_per_condition_{}'.format(hemi)] = calc_labels_avg_per_condition(
                 args.atlas, hemi, conditions, extract_modes=args.extract_mode,
                 positive=args.evoked_flip_positive, inverse_method=args.inverse_method,
@@ -3346,11 +3362,9 @@ def get_stc_data_and_vertices(stc, hemi):
 
 
 def load_connectivity(subject):
-    connectivity_fname = op.join(MMVT_DIR, subject, 'spatial_connectivity.pkl')
-    if not op.isfile(connectivity_fname):
-        from src.preproc import anatomy
-        anatomy.create_spatial_connectivity(subject)
-    connectivity_per_hemi = utils.load(connectivity_fname)
+    from src.preproc import anatomy
+    connectivity_per_hemi = {hemi: anatomy.load_surf_adjacency(subject, hemi, as_matrix=True, fmt='coo')
+                             for hemi in utils.HEMIS}
     return connectivity_per_hemi
 
 
@@ -3719,6 +3733,167 @@ def init(subject, args, mri_subject='', remote_subject_dir=''):
     return fname_format, fname_format_cond, conditions
 
 
+def get_pipeline_step_args(args, function, overwrite_args=()):
+    # A copy of args that runs only the step's function, and overwrites its outputs (the step runs only if its
+    # inputs or params were changed)
+    step_args = utils.Bag(dict(args))
+    step_args.function, step_args.exclude = [function], []
+    for overwrite_arg in overwrite_args:
+        step_args[overwrite_arg] = True
+    return step_args
+
+
+def get_pipeline_params(args, args_names, **kwargs):
+    params = {arg_name: args.get(arg_name, None) for arg_name in args_names}
+    params.update(kwargs)
+    return params
+
+
+def build_meg_pipeline(subject, mri_subject, conditions, inverse_method, args):
+    # The main MEG steps (epochs -> evokes -> fwd -> inv -> stc per condition -> labels per hemi -> minmax) as a
+    # pipeline, where a step runs only if the content of its inputs or its params were changed since its last run.
+    # The STCs of the conditions, and the labels data of the hemis, are calculated in parallel.
+    # main runs once per inverse method, so the steps from the stc on are per inverse method (in their names,
+    # outputs and params), while the epochs, evokes, fwd and inv steps are shared by all the methods
+    if isinstance(inverse_method, Iterable) and not isinstance(inverse_method, str):
+        inverse_method = inverse_method[0]
+    conditions_keys = list(conditions.keys()) if conditions is not None else ['all']
+    epo_fname = get_epo_fname(args.epo_fname)
+    evo_fname = get_evo_fname(args.evo_fname)
+    fwd_fname = get_fwd_fname(args.fwd_fname, args.fwd_usingMEG, args.fwd_usingEEG)
+    inv_fname = get_inv_fname(args.inv_fname, args.fwd_usingMEG, args.fwd_usingEEG)
+    cor_fname = get_cor_fname(args.cor_fname)
+    stc_hemi_template = STC_HEMI if args.stc_template == '' else get_stc_hemi_template(args.stc_template)
+    labels_data_template = LBL if args.labels_data_template == '' else args.labels_data_template
+    pipeline = pipu.Pipeline(op.join(SUBJECT_MEG_FOLDER, 'pipeline'), args.pipeline_n_jobs)
+    steps = set()
+
+    def add_step(name, func, inputs, outputs, params, deps=()):
+        steps.add(pipeline.add_step(name, func, inputs, outputs, params, [d for d in deps if d in steps]))
+
+    def method_step_name(name):
+        return '{}_{}'.format(name, inverse_method)
+
+    def calc_epochs_step():
+        step_args = get_pipeline_step_args(args, 'calc_epochs', ['overwrite_epochs'])
+        return calc_evokes_wrapper(subject, conditions, step_args, {}, mri_subject=mri_subject)[0]['calc_epochs']
+
+    def calc_evokes_step():
+        step_args = get_pipeline_step_args(args, 'calc_evokes', ['overwrite_evoked'])
+        return calc_evokes_wrapper(subject, conditions, step_args, {}, mri_subject=mri_subject)[0]['calc_evokes']
+
+    def make_forward_solution_step():
+        step_args = get_pipeline_step_args(args, 'make_forward_solution', ['overwrite_fwd', 'overwrite_inv'])
+        flags = calc_fwd_inv_wrapper(subject, step_args, conditions, {}, mri_subject)
+        return flags.get('make_forward_solution', False)
+
+    def calc_inverse_operator_step():
+        step_args = get_pipeline_step_args(args, 'calc_inverse_operator', ['overwrite_inv', 'overwrite_noise_cov'])
+        flags = calc_fwd_inv_wrapper(subject, step_args, conditions, {}, mri_subject)
+        return flags.get('calc_inverse_operator', False)
+
+    def calc_stc_step(step_conds):
+        step_args = get_pipeline_step_args(args, 'calc_stc', ['overwrite_stc'])
+        step_args.calc_stc_diff = False
+        step_conditions = {cond: conditions[cond] for cond in step_conds} if conditions is not None else None
+        flags = calc_stc_per_condition_wrapper(subject, step_conditions, inverse_method, step_args)[0]
+        return flags.get('calc_stc', False)
+
+    def calc_stc_diff_step():
+        return calc_stc_diff_both_hemis(conditions, stc_hemi_template, inverse_method, overwrite_stc=True)
+
+    def calc_labels_avg_per_condition_step(hemi):
+        step_args = get_pipeline_step_args(args, 'calc_labels_avg_per_condition', ['overwrite_labels_data'])
+        flags = calc_labels_avg_per_condition_wrapper(
+            subject, conditions, args.atlas, inverse_method, None, step_args, {}, hemis=[hemi])
+        return flags.get('calc_labels_avg_per_condition_{}'.format(hemi), False) if flags else False
+
+    def calc_labels_min_max_step():
+        return calc_labels_minmax(
+            args.atlas, [inverse_method], args.extract_mode, args.task, args.labels_data_template, True)
+
+    if utils.should_run(args, 'calc_epochs'):
+        epochs_inputs = calc_epochs_necessary_files(args) if args.calc_epochs_from_raw else []
+        add_step('calc_epochs', calc_epochs_step, epochs_inputs, [epo_fname], get_pipeline_params(args, [
+            't_min', 't_max', 'baseline', 'read_events_from_file', 'stim_channels', 'pick_meg', 'pick_eeg',
+            'pick_eog', 'reject', 'reject_grad', 'reject_mag', 'reject_eog', 'remove_power_line_noise',
+            'power_line_freq', 'bad_channels', 'l_freq', 'h_freq', 'task', 'windows_length', 'windows_shift',
+            'windows_num', 'using_auto_reject', 'ar_compute_thresholds_method', 'ar_consensus_percs',
+            'ar_n_interpolates', 'bad_ar_threshold'], conditions=conditions))
+    if utils.should_run(args, 'calc_evokes'):
+        add_step('calc_evokes', calc_evokes_step, [epo_fname], [evo_fname], get_pipeline_params(args, [
+            'normalize_data', 'norm_by_percentile', 'norm_percs', 'modality', 'calc_max_min_diff',
+            'calc_evoked_for_all_epoches', 'task', 'set_eeg_reference', 'average_per_event'],
+            conditions=conditions), deps=['calc_epochs'])
+    if utils.should_run(args, 'make_forward_solution'):
+        add_step('make_forward_solution', make_forward_solution_step, [evo_fname, cor_fname], [fwd_fname],
+                 get_pipeline_params(args, [
+                     'fwd_usingMEG', 'fwd_usingEEG', 'fwd_calc_corticals', 'fwd_calc_subcorticals',
+                     'fwd_recreate_source_space', 'recreate_src_spacing', 'recreate_src_surface']),
+                 deps=['calc_evokes'])
+    if utils.should_run(args, 'calc_inverse_operator'):
+        add_step('calc_inverse_operator', calc_inverse_operator_step, [fwd_fname, epo_fname, evo_fname],
+                 [inv_fname], get_pipeline_params(args, [
+                     'inv_loose', 'inv_depth', 'noise_t_min', 'noise_t_max', 'use_empty_room_for_noise_cov',
+                     'use_raw_for_noise_cov', 'inv_calc_cortical', 'inv_calc_subcorticals', 'empty_fname']),
+                 deps=['make_forward_solution', 'calc_epochs', 'calc_evokes'])
+    stc_steps = []
+    if utils.should_run(args, 'calc_stc'):
+        # One step per condition, unless the stc of all the conditions together is needed
+        conds_groups = [conditions_keys] if args.calc_stc_for_all or conditions is None else \
+            [[cond] for cond in conditions_keys]
+        for step_conds in conds_groups:
+            name = method_step_name(
+                'calc_stc_{}'.format('_'.join(step_conds)) if len(conds_groups) > 1 else 'calc_stc')
+            stc_inputs = [inv_fname, epo_fname if args.single_trial_stc or args.apply_on_raw else evo_fname]
+            stc_outputs = [stc_hemi_template.format(cond=cond, method=inverse_method, hemi=hemi)
+                           for cond in step_conds for hemi in utils.HEMIS]
+            add_step(name, partial(calc_stc_step, step_conds), stc_inputs, stc_outputs, get_pipeline_params(args, [
+                'task', 'stc_t_min', 'stc_t_max', 'baseline', 'apply_SSP_projection_vectors', 'add_eeg_ref',
+                'pick_ori', 'single_trial_stc', 'calc_source_band_induced_power', 'snr', 'apply_on_raw',
+                'calc_stc_for_all'], inverse_method=inverse_method, conditions=step_conds),
+                deps=['calc_inverse_operator', 'calc_evokes'])
+            stc_steps.append(name)
+        if args.calc_stc_diff and len(conditions_keys) == 2:
+            diff_cond = '{}-{}'.format(*conditions_keys)
+            add_step(method_step_name('calc_stc_diff'), calc_stc_diff_step, [
+                stc_hemi_template.format(cond=cond, method=inverse_method, hemi=hemi)
+                for cond in conditions_keys for hemi in utils.HEMIS],
+                [stc_hemi_template.format(cond=diff_cond, method=inverse_method, hemi=hemi) for hemi in utils.HEMIS],
+                dict(inverse_method=inverse_method), deps=stc_steps)
+    labels_steps = []
+    if utils.should_run(args, 'calc_labels_avg_per_condition'):
+        for hemi in utils.HEMIS:
+            name = method_step_name('calc_labels_avg_per_condition_{}'.format(hemi))
+            labels_inputs = [inv_fname] + [stc_hemi_template.format(cond=cond, method=inverse_method, hemi=hemi)
+                                           for cond in conditions_keys]
+            labels_outputs = [op.join(MMVT_DIR, MRI_SUBJECT, 'meg', op.basename(get_labels_data_fname(
+                labels_data_template, inverse_method, args.task, args.atlas, em, hemi))) for em in args.extract_mode]
+            add_step(name, partial(calc_labels_avg_per_condition_step, hemi), labels_inputs, labels_outputs,
+                     get_pipeline_params(args, [
+                         'atlas', 'extract_mode', 'evoked_flip_positive', 'evoked_moving_average_win_size',
+                         'read_only_from_annot', 'task'], inverse_method=inverse_method, conditions=conditions_keys),
+                     deps=stc_steps)
+            labels_steps.append(name)
+    if utils.should_run(args, 'calc_labels_min_max'):
+        min_max_output_template = get_labels_minmax_template(labels_data_template)
+        add_step(method_step_name('calc_labels_min_max'), calc_labels_min_max_step, [
+            op.join(MMVT_DIR, MRI_SUBJECT, 'meg', op.basename(get_labels_data_fname(
+                labels_data_template, inverse_method, args.task, args.atlas, em, hemi)))
+            for em, hemi in product(args.extract_mode, utils.HEMIS)], [
+            op.join(MMVT_DIR, MRI_SUBJECT, 'meg', get_minmax_fname(
+                min_max_output_template, inverse_method, args.task, args.atlas, em)) for em in args.extract_mode],
+            get_pipeline_params(args, ['atlas', 'extract_mode', 'task'], inverse_method=inverse_method),
+            deps=labels_steps)
+    return pipeline
+
+
+def run_meg_pipeline(subject, mri_subject, conditions, inverse_method, args, flags):
+    pipeline = build_meg_pipeline(subject, mri_subject, conditions, inverse_method, args)
+    flags.update(pipeline.run(args.pipeline_force))
+    return flags
+
+
 def main(tup, remote_subject_dir, args, flags=None):
     (subject, mri_subject), inverse_method = tup
     evoked, epochs, raw = None, None, None
@@ -3731,15 +3906,20 @@ def main(tup, remote_subject_dir, args, flags=None):
     #     subject, mri_subject, fname_format, fname_format_cond, MEG_DIR, SUBJECTS_MRI_DIR, MMVT_DIR, args)
     stat = STAT_AVG if len(conditions) == 1 else STAT_DIFF
 
-    # flags: calc_evoked
-    flags, evoked, epochs = calc_evokes_wrapper(subject, conditions, args, flags, mri_subject=mri_subject)
-    # flags: make_forward_solution, calc_inverse_operator
-    flags = calc_fwd_inv_wrapper(subject, args, conditions, flags, mri_subject)
-    # flags: calc_stc_per_condition
-    flags, stcs_conds, stcs_num = calc_stc_per_condition_wrapper(subject, conditions, inverse_method, args, flags)
-    # flags: calc_labels_avg_per_condition
-    flags = calc_labels_avg_per_condition_wrapper(
-        subject, conditions, args.atlas, inverse_method, stcs_conds, args, flags, stcs_num, raw, epochs)
+    if args.incremental_pipeline:
+        # flags: calc_epochs, calc_evokes, make_forward_solution, calc_inverse_operator, and per inverse method
+        # calc_stc*_{method}, calc_labels_avg_per_condition_{hemi}_{method}, calc_labels_min_max_{method}
+        flags = run_meg_pipeline(subject, mri_subject, conditions, inverse_method, args, flags)
+    else:
+        # flags: calc_evoked
+        flags, evoked, epochs = calc_evokes_wrapper(subject, conditions, args, flags, mri_subject=mri_subject)
+        # flags: make_forward_solution, calc_inverse_operator
+        flags = calc_fwd_inv_wrapper(subject, args, conditions, flags, mri_subject)
+        # flags: calc_stc_per_condition
+        flags, stcs_conds, stcs_num = calc_stc_per_condition_wrapper(subject, conditions, inverse_method, args, flags)
+        # flags: calc_labels_avg_per_condition
+        flags = calc_labels_avg_per_condition_wrapper(
+            subject, conditions, args.atlas, inverse_method, stcs_conds, args, flags, stcs_num, raw, epochs)
 
     if utils.should_run(args, 'read_sensors_layout'):
         flags['read_sensors_layout'] = read_sensors_layout(mri_subject, args)
@@ -3748,7 +3928,9 @@ def main(tup, remote_subject_dir, args, flags=None):
         stc_fnames = [STC_HEMI_SMOOTH.format(cond='{cond}', method=inverse_method, hemi=hemi)
                       for hemi in utils.HEMIS]
         get_meg_files(subject, stc_fnames, args, conditions)
-        flags['save_vertex_activity_map'] = save_vertex_activity_map(conditions, stat, stcs_conds_smooth, inverse_method)
+        flags['save_vertex_activity_map'] = save_vertex_activity_map(
+            conditions, stat, stcs_conds_smooth, inverse_method, args.activity_store_dtype,
+            args.save_smoothed_activity, args.morph_to_subject)
 
     if 'calc_labels_avg_for_rest' in args.function:
         flags['calc_labels_avg_for_rest'] = calc_labels_avg_for_rest(
@@ -3770,7 +3952,13 @@ def main(tup, remote_subject_dir, args, flags=None):
         get_meg_files(subject, stc_fnames, args, conditions)
         flags['save_activity_map'] = save_activity_map(
             conditions, stat, stcs_conds_smooth, inverse_method, args.save_smoothed_activity, args.morph_to_subject,
-            args.stc_t, args.norm_by_percentile, args.norm_percs)
+            args.stc_t, args.norm_by_percentile, args.norm_percs, store_dtype=args.activity_store_dtype,
+            store_vertex_major=args.activity_store_vertex_major)
+
+    if 'convert_activity_maps' in args.function:
+        flags['convert_activity_maps'] = convert_activity_maps(
+            MRI_SUBJECT, args.activity_store_dtype, args.activity_store_vertex_major,
+            args.activity_store_delete_frames, args.overwrite_activity_store)
 
     if 'find_functional_rois_in_stc' in args.function:
         flags['find_functional_rois_in_stc'] = find_functional_rois_in_stc(
@@ -3784,7 +3972,7 @@ def main(tup, remote_subject_dir, args, flags=None):
         print_files_names()
 
     if 'calc_single_trial_labels_per_condition' in args.function:
-        calc_single_trial_labels_per_condition(args.atlas, conditions, stcs_conds, extract_mode=args.extract_mode)
+        calc_single_trial_labels_per_condition(args.atlas, conditions, stcs_conds, extract_modes=args.extract_mode)
 
     sub_corticals_codes_file = op.join(MMVT_DIR, 'sub_cortical_codes.txt')
     if 'calc_sub_cortical_activity' in args.function:
@@ -3872,6 +4060,10 @@ def read_cmd_args(argv=None):
     parser.add_argument('--overwrite_inv', help='overwrite_inv', required=False, default=0, type=au.is_true)
     parser.add_argument('--overwrite_stc', help='overwrite_stc', required=False, default=0, type=au.is_true)
     parser.add_argument('--overwrite_labels_data', help='overwrite_labels_data', required=False, default=0, type=au.is_true)
+    parser.add_argument('--incremental_pipeline', help='run the main steps only if their inputs/params were changed',
+                        required=False, default=0, type=au.is_true)
+    parser.add_argument('--pipeline_n_jobs', help='parallel independent steps', required=False, default=2, type=int)
+    parser.add_argument('--pipeline_force', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--read_events_from_file', help='read_events_from_file', required=False, default=0, type=au.is_true)
     parser.add_argument('--events_file_name', help='events_file_name', required=False, default='')
     parser.add_argument('--windows_length', help='', required=False, default=1000, type=int)
@@ -3946,6 +4138,10 @@ def read_cmd_args(argv=None):
     parser.add_argument('--normalize_data', help='', required=False, default=1, type=au.is_true)
     parser.add_argument('--norm_by_percentile', help='', required=False, default=1, type=au.is_true)
     parser.add_argument('--norm_percs', help='', required=False, default='1,99', type=au.int_arr_type)
+    parser.add_argument('--activity_store_dtype', help='float32 or int16', required=False, default='float32')
+    parser.add_argument('--activity_store_vertex_major', help='', required=False, default=1, type=au.is_true)
+    parser.add_argument('--activity_store_delete_frames', help='', required=False, default=0, type=au.is_true)
+    parser.add_argument('--overwrite_activity_store', help='', required=False, default=0, type=au.is_true)
     parser.add_argument('--remote_subject_meg_dir', help='remote_subject_dir', required=False, default='')
     parser.add_argument('--meg_root_fol', required=False, default='')
     parser.add_argument('--bands', required=False, default='')
@@ -19,17 +19,21 @@ def mode(arr):
 
 
 # @utils.profileit(root_folder=op.join(MMVT_DIR, 'profileit'))
-def parcelate(subject, atlas, hemi, surface_type, vertices_labels_ids_lookup=None,
+def parcelate(subject, atlas, hemi, surface_type, vertices_labels_index=None,
               overwrite_vertices_labels_lookup=False):
     output_fol = op.join(MMVT_DIR, subject, 'labels', '{}.{}.{}'.format(atlas, surface_type, hemi))
     utils.make_dir(output_fol)
     vtx, fac = utils.read_ply_file(op.join(MMVT_DIR, subject, 'surf', '{}.{}.ply'.format(hemi, surface_type)))
-    if vertices_labels_ids_lookup is None or overwrite_vertices_labels_lookup:
-        vertices_labels_ids_lookup = lu.create_vertices_labels_lookup(
-            subject, atlas, True, overwrite_vertices_labels_lookup)[hemi]
+    if vertices_labels_index is None or overwrite_vertices_labels_lookup:
+        vertices_labels_index = lu.create_vertices_labels_index(
+            subject, atlas, overwrite_vertices_labels_lookup)[hemi]
     labels = lu.read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
     if 'unknown-{}'.format(hemi) not in [l.name for l in labels]:
         labels.append(lu.Label([], name='unknown-{}'.format(hemi), hemi=hemi))
+    # The faces vertices labels ids, the vertices without a label are in the unknown label
+    unknown_id = [l.name for l in labels].index('unknown-{}'.format(hemi))
+    faces_labels = vertices_labels_index.vertices_labels_ids(fac)
+    faces_labels[faces_labels < 0] = unknown_id
 
     nV = vtx.shape[0]
     nF = fac.shape[0]
@@ -44,7 +48,7 @@ def parcelate(subject, atlas, hemi, surface_type, vertices_labels_ids_lookup=Non
         utils.time_to_go(now, f, nF, runs_num_to_print=50000)
         # Current face & labels
         Cfac = fac[f]
-        Cidx = [vertices_labels_ids_lookup[vert_ind] for vert_ind in Cfac]
+        Cidx = faces_labels[f]
         # Depending on how many vertices of the current face
         # are in different labels, behave differently
         # nuCidx = len(np.unique(Cidx))
@@ -0,0 +1,56 @@
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+
+from src.mmvt_addon import surf_adjacency as sa
+from src.mmvt_addon import clusters_tree as ct
+from src.tests.test_surf_adjacency import grid_faces
+
+
+def find_clusters(x, mat, threshold):
+    # The clusters of x > threshold and x < -threshold by scipy's connected components, positive clusters first,
+    # each sorted by their first vertex
+    clusters = []
+    for verts in [np.where(x > threshold)[0], np.where(x < -threshold)[0]]:
+        if len(verts) == 0:
+            continue
+        _, comps = connected_components(mat[verts][:, verts], directed=False)
+        sign_clusters = [verts[comps == comp] for comp in np.unique(comps)]
+        clusters.extend(sorted(sign_clusters, key=lambda cluster: cluster.min()))
+    return clusters
+
+
+def test_clusters_tree_vs_connected_components():
+    adjacency = sa.SurfAdjacency(*sa.calc_adjacency_csr(grid_faces(20, 25)))
+    mat = scipy.sparse.csr_matrix(adjacency.as_matrix())
+    x = np.random.RandomState(0).randn(adjacency.vertices_num)
+    x[::17] = 0
+    tree = ct.build_clusters_tree(x, adjacency)
+    thresholds = [0, 0.3, 1, 1.5, 2.5, 10]
+    for threshold in thresholds:
+        clusters = tree.clusters(threshold)
+        expected = find_clusters(x, mat, threshold)
+        assert len(clusters) == len(expected)
+        for cluster, expected_cluster in zip(clusters, expected):
+            np.testing.assert_array_equal(cluster, expected_cluster)
+        info = tree.clusters_info(threshold)
+        for peak, peak_max, cluster in zip(info['peaks'], info['max'], expected):
+            assert np.abs(peak_max) == np.abs(x[cluster]).max() and peak in cluster
+        min_size_clusters = tree.clusters(threshold, min_size=3)
+        assert [len(c) for c in min_size_clusters] == [len(c) for c in expected if len(c) >= 3]
+    clusters_num, max_sizes = tree.clusters_hist(thresholds)
+    for threshold, clusters_num_t, max_size in zip(thresholds, clusters_num, max_sizes):
+        expected = find_clusters(x, mat, threshold)
+        assert clusters_num_t == len(expected)
+        assert max_size == max([len(c) for c in expected], default=0)
+
+
+def test_clusters_tree_save_load(tmp_path):
+    adjacency = sa.SurfAdjacency(*sa.calc_adjacency_csr(grid_faces(5, 6)))
+    tree = ct.build_clusters_tree(np.random.RandomState(1).randn(adjacency.vertices_num), adjacency)
+    fname = str(tmp_path / 'clusters_tree.npz')
+    tree.save(fname)
+    loaded_tree = ct.ClustersTree.load(fname)
+    for threshold in [0, 0.5, 1]:
+        for cluster, loaded_cluster in zip(tree.clusters(threshold), loaded_tree.clusters(threshold)):
+            np.testing.assert_array_equal(cluster, loaded_cluster)
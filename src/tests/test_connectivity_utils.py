@@ -0,0 +1,134 @@
+import numpy as np
+
+from src.utils import connectivity_utils as cu
+
+
+def test_pairs_stats_vs_matrix():
+    C, W = 9, 13
+    rows, cols = cu.pairs_indices(C)
+    conn_pairs = np.random.RandomState(0).randn(len(rows), W)
+    conn_pairs[3, 5] = np.nan
+    conn = cu.pairs_to_matrix(conn_pairs, C)
+    assert cu.pairs_channels_num(len(rows)) == C
+    # Small memory_mb for a few pairs blocks
+    stats = cu.calc_pairs_stats(conn_pairs, memory_mb=W * 8 * 5 / 1024 ** 2)
+    np.testing.assert_allclose(stats['channels_mean'], np.mean(conn, 0))
+    np.testing.assert_allclose(stats['channels_abs_nanmean'], np.nanmean(np.abs(conn), 1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        static_conn = np.nanstd(conn, 2) / np.mean(np.abs(conn), 2)
+    np.fill_diagonal(static_conn, 0)
+    np.testing.assert_allclose(cu.pairs_to_matrix(stats['cv'], C), static_conn)
+    np.testing.assert_allclose(cu.pairs_to_matrix(stats['std'], C), np.nanstd(conn, 2))
+    np.testing.assert_allclose(cu.pairs_to_matrix(stats['mean'], C)[rows, cols], np.mean(conn, 2)[rows, cols])
+    assert stats['abs_max'] == max(map(abs, [np.nanmin(conn), np.nanmax(conn)]))
+    np.testing.assert_allclose(cu.calc_pairs_cv(conn_pairs)[~np.isnan(stats['cv'])],
+                               stats['cv'][~np.isnan(stats['cv'])])
+
+
+def test_pairs_percentiles_vs_numpy():
+    conn_pairs = np.random.RandomState(1).randn(300, 7)
+    conn_pairs[5, 2] = np.nan
+    x = conn_pairs[~np.isnan(conn_pairs)]
+    for percs in [[1, 99], [0, 100], [50], [33.3]]:
+        for bins_num in [16, 2 ** 16]:
+            np.testing.assert_allclose(cu.calc_pairs_percentiles(
+                conn_pairs, percs, memory_mb=1e-3, bins_num=bins_num), np.percentile(x, percs))
+            np.testing.assert_allclose(cu.calc_pairs_percentiles(
+                conn_pairs, percs, use_abs=True, bins_num=bins_num), np.percentile(np.abs(x), percs))
+    assert cu.calc_pairs_max_min(conn_pairs, True, (1, 99)) == tuple(np.percentile(x, [99, 1]))
+    assert cu.calc_pairs_max_min(conn_pairs) == (np.max(x), np.min(x))
+    np.testing.assert_array_equal(cu.calc_pairs_abs_max(conn_pairs), np.max(np.abs(conn_pairs), 1))
+
+
+# The per pair loops of connectivity.py (before connectivity_utils), as the reference
+
+def loop_pli(data_hil):
+    C = data_hil.shape[0]
+    m = np.zeros((C, C))
+    for i in range(C):
+        for j in range(C):
+            if i < j:
+                m[i, j] = abs(np.mean(np.sign(np.imag(data_hil[i] / data_hil[j]))))
+    return m + m.T
+
+
+def loop_wpli(data_hil):
+    C = data_hil.shape[0]
+    m = np.zeros((C, C))
+    for i in range(C):
+        for j in range(C):
+            if i < j:
+                imag_csd = np.imag(data_hil[i] * np.conj(data_hil[j]))
+                m[i, j] = abs(np.mean(imag_csd)) / np.mean(np.abs(imag_csd))
+    return m + m.T
+
+
+def loop_mi(conn_w):
+    C = conn_w.shape[0]
+    conn = np.zeros((C, C))
+    for i in range(C):
+        for j in range(C):
+            if i < j:
+                conn[i, j] = -0.5 * np.log(1 - conn_w[i, j] ** 2)
+    return conn + conn.T
+
+
+def loop_corr_matrix(data):
+    C, k = data.shape[0], data.shape[2]
+    corr = np.zeros((C, C, k * 2, k * 2))
+    for i in range(C):
+        for j in range(C):
+            if i < j:
+                corr[i, j] = corr[j, i] = np.corrcoef(data[i].T, data[j].T)
+    return corr
+
+
+def loop_mi_vec(corr_w):
+    C = corr_w.shape[0]
+    conn = np.zeros((C, C))
+    for i in range(C):
+        for j in range(C):
+            if i < j:
+                conn[i, j] = -0.5 * np.log(np.linalg.norm(np.eye(corr_w.shape[3]) - corr_w[i, j] * corr_w[i, j].T))
+    return conn + conn.T
+
+
+def test_batched_kernels_vs_loops():
+    from scipy.signal import hilbert
+    data = np.random.RandomState(2).randn(11, 400)
+    # A constant channel, where the correlation is nan
+    data[4] = 1
+    windows_data = cu.sliding_windows(data, 100, 50)
+    # Small blocks, for a few channels blocks and windows chunks
+    pli, wpli = cu.pli_windows(windows_data, block_mb=0.01), cu.wpli_windows(windows_data, block_mb=0.01)
+    corr = cu.corr_windows(windows_data, memory_mb=0.01)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for w, window_data in enumerate(windows_data):
+            window_hil = hilbert(window_data)
+            np.testing.assert_array_equal(pli[w], loop_pli(window_hil))
+            np.testing.assert_allclose(wpli[w], loop_wpli(window_hil), rtol=1e-12)
+            np.testing.assert_allclose(corr[w], np.corrcoef(window_data), atol=1e-12)
+            np.testing.assert_allclose(cu.mi_from_corr(corr[w]), loop_mi(corr[w]))
+    comps_data = np.random.RandomState(3).randn(6, 200, 3)
+    corr_pairs = cu.corr_matrix_pairs(comps_data)
+    np.testing.assert_allclose(corr_pairs, loop_corr_matrix(comps_data), atol=1e-12)
+    np.testing.assert_allclose(cu.mi_vec_from_corr(corr_pairs), loop_mi_vec(corr_pairs), atol=1e-12)
+
+
+def test_sliding_windows_connectivity_vs_batched():
+    from scipy.signal import hilbert
+    data = np.random.RandomState(4).randn(7, 600)
+    windows_length, windows_shift = 100, 20
+    rows, cols = cu.pairs_indices(data.shape[0])
+    windows_data = cu.sliding_windows(data, windows_length, windows_shift)
+    # The incremental engine uses the analytic signal of the whole recording
+    windows_hil = cu.sliding_windows(hilbert(data), windows_length, windows_shift)
+    # A small refresh_every, for a few refreshes of the running sums
+    corr = cu.calc_sliding_windows_connectivity(data, windows_length, windows_shift, 'corr', refresh_every=4)
+    pli = cu.calc_sliding_windows_connectivity(data, windows_length, windows_shift, 'pli', refresh_every=4)
+    wpli = cu.calc_sliding_windows_connectivity(data, windows_length, windows_shift, 'wpli', refresh_every=4)
+    assert corr.shape == (len(rows), len(windows_data))
+    np.testing.assert_allclose(corr, cu.corr_windows(windows_data)[:, rows, cols].T, atol=1e-10)
+    for w, window_hil in enumerate(windows_hil):
+        np.testing.assert_allclose(pli[:, w], loop_pli(window_hil)[rows, cols], atol=1e-12)
+        np.testing.assert_allclose(wpli[:, w], loop_wpli(window_hil)[rows, cols], atol=1e-10)
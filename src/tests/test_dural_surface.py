@@ -0,0 +1,26 @@
+import numpy as np
+
+from src.mmvt_addon import dural_surface as ds
+
+
+def point_in_mesh(point, verts, normals, sigma=0):
+    # The per point test (like geometry_utils.point_in_mesh), by the closest vertex
+    closest_vert = np.argmin(np.linalg.norm(verts - point, axis=1))
+    return not (np.dot(point - verts[closest_vert], normals[closest_vert]) + sigma < 0)
+
+
+def test_points_inside_vs_point_in_mesh():
+    # A sphere, with the normals pointing inward
+    rs = np.random.RandomState(0)
+    verts = rs.randn(500, 3)
+    verts /= np.linalg.norm(verts, axis=1)[:, np.newaxis]
+    verts *= 50
+    normals = -verts / 50
+    points = rs.uniform(-60, 60, (300, 3))
+    dural = ds.DuralSurface(verts, normals)
+    sigmas = [0, 2, 5]
+    inside = dural.points_inside(points, sigmas)
+    assert inside.shape == (len(sigmas), len(points))
+    for sigma, sigma_inside in zip(sigmas, inside):
+        np.testing.assert_array_equal(dural.points_inside(points, sigma), sigma_inside)
+        np.testing.assert_array_equal(sigma_inside, [point_in_mesh(p, verts, normals, sigma) for p in points])
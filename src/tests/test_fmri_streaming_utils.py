@@ -0,0 +1,87 @@
+import numpy as np
+import scipy.sparse
+
+from src.utils import fmri_streaming_utils as fsu
+
+
+def _create_membership(labels_vertices, V):
+    rows = np.concatenate([[ind] * len(vertices) for ind, vertices in enumerate(labels_vertices)])
+    cols = np.concatenate(labels_vertices)
+    return scipy.sparse.csr_matrix((np.ones(len(cols)), (rows, cols)), shape=(len(labels_vertices), V))
+
+
+def test_streamed_labels_stats_vs_numpy():
+    V, T = 100, 7
+    x = np.random.RandomState(0).randn(V, T) * 3 + 10
+    # With 1e-4 MB the vertices blocks are 13 vertices long, and the labels don't span all of them
+    labels_vertices = [np.arange(0, 5), np.arange(20, 30), np.arange(50, 100, 3), np.array([99]),
+                       np.arange(0, 100)]
+    membership = _create_membership(labels_vertices, V)
+    for memory_mb in [1e-4, 0.01, fsu.DEFAULT_MEMORY_MB]:
+        means, variances = fsu.calc_labels_stats(x, membership, memory_mb)
+        cv = np.sqrt(variances) / means
+        for ind, vertices in enumerate(labels_vertices):
+            np.testing.assert_allclose(means[ind], np.mean(x[vertices], axis=0))
+            np.testing.assert_allclose(variances[ind], np.var(x[vertices], axis=0), atol=1e-12)
+            np.testing.assert_allclose(cv[ind], np.std(x[vertices], axis=0) / np.mean(x[vertices], axis=0))
+
+
+def test_empty_label_stats():
+    V, T = 50, 3
+    x = np.random.RandomState(1).randn(V, T)
+    membership = _create_membership([np.arange(10), np.array([], dtype=int)], V)
+    means, variances = fsu.calc_labels_stats(x, membership, 1e-4)
+    assert np.all(np.isnan(means[1]))
+    np.testing.assert_allclose(means[0], np.mean(x[:10], axis=0))
+
+
+def test_merge_welford_stats_zero_counts():
+    x = np.random.RandomState(2).randn(6, 4)
+    stats = (np.array([3, 0]), np.vstack((x[:3].mean(0), np.full(4, np.nan))),
+             np.vstack((((x[:3] - x[:3].mean(0)) ** 2).sum(0), np.zeros(4))))
+    empty = (np.array([0, 3]), np.vstack((np.full(4, np.nan), x[3:].mean(0))),
+             np.vstack((np.zeros(4), ((x[3:] - x[3:].mean(0)) ** 2).sum(0))))
+    counts, means, M2 = fsu.merge_welford_stats(*stats, *empty)
+    assert not np.any(np.isnan(means)) and not np.any(np.isnan(M2))
+    np.testing.assert_allclose(means[0], x[:3].mean(0))
+    np.testing.assert_allclose(means[1], x[3:].mean(0))
+    np.testing.assert_allclose(M2[1] / counts[1], x[3:].var(0))
+
+
+class _Image(object):
+    def __init__(self, data):
+        self.dataobj = _Proxy(data)
+        self.shape = data.shape
+
+    def get_data_dtype(self):
+        return self.dataobj.data.dtype
+
+
+class _Proxy(object):
+    # Records the size of every read, like nibabel's ArrayProxy reads only the sliced part
+    def __init__(self, data):
+        self.data, self.shape, self.reads = data, data.shape, []
+
+    def __getitem__(self, key):
+        block = self.data[key]
+        self.reads.append(block.size)
+        return block
+
+
+def test_image_time_series_blocks():
+    for shape in [(100, 1, 1, 6), (5, 4, 5, 6)]:
+        data = np.random.RandomState(3).randn(*shape)
+        flat = data.reshape((-1, shape[-1]))
+        x = fsu.ImageTimeSeries(_Image(data), memory_mb=1e-4)
+        np.testing.assert_array_equal(x[:, 2:5], flat[:, 2:5])
+        np.testing.assert_array_equal(x[13:37, 1:4], flat[13:37, 1:4])
+        rows = np.array([40, 3, 17, 17, 60])
+        np.testing.assert_array_equal(x[rows], flat[rows])
+        np.testing.assert_array_equal(x.read_rows([]), flat[[]])
+        x.dataobj.reads = []
+        x[13:26, 3:4]
+        # Only the first axis' slices of the vertices are read, not the whole time point
+        assert x.dataobj.reads == [13 if shape[1] == 1 else 40]
+        means, variances = fsu.calc_labels_stats(x, _create_membership([np.arange(10, 90)], 100), 1e-4)
+        np.testing.assert_allclose(means[0], flat[10:90].mean(0))
+        np.testing.assert_allclose(variances[0], flat[10:90].var(0), atol=1e-12)
@@ -0,0 +1,86 @@
+import os
+import os.path as op
+
+from src.utils import pipeline_utils as pipu
+
+
+def write_file(fname, content):
+    with open(fname, 'w') as f:
+        f.write(content)
+
+
+def read_file(fname):
+    with open(fname, 'r') as f:
+        return f.read()
+
+
+def test_pipeline_statuses_and_invalidation(tmp_path):
+    fol = str(tmp_path)
+    in_fname, a_fname, b_fname = op.join(fol, 'in.txt'), op.join(fol, 'a.txt'), op.join(fol, 'b.txt')
+    write_file(in_fname, 'x')
+    runs = []
+    params = dict(scale=2)
+
+    def step_a():
+        runs.append('a')
+        write_file(a_fname, read_file(in_fname) * params['scale'])
+        return True
+
+    def step_b():
+        runs.append('b')
+        write_file(b_fname, read_file(a_fname).upper())
+        return True
+
+    def step_failed():
+        runs.append('failed')
+        return False
+
+    def step_blocked():
+        runs.append('blocked')
+        return True
+
+    def build_pipeline():
+        pipeline = pipu.Pipeline(op.join(fol, 'pipeline'), n_jobs=2)
+        pipeline.add_step('a', step_a, [in_fname], [a_fname], dict(params))
+        pipeline.add_step('b', step_b, [a_fname], [b_fname], deps=['a'])
+        pipeline.add_step('failed', step_failed, [in_fname], [op.join(fol, 'missing.txt')])
+        pipeline.add_step('blocked', step_blocked, deps=['failed'])
+        return pipeline
+
+    def run_pipeline():
+        del runs[:]
+        pipeline = build_pipeline()
+        ret = pipeline.run()
+        return ret, {name: status for name, status, _ in pipeline.report}
+
+    ret, statuses = run_pipeline()
+    assert ret == dict(a=True, b=True, failed=False, blocked=False)
+    assert statuses == dict(a=pipu.STEP_RUN, b=pipu.STEP_RUN, failed=pipu.STEP_FAILED, blocked=pipu.STEP_BLOCKED)
+    assert sorted(runs) == ['a', 'b', 'failed'] and read_file(b_fname) == 'XX'
+    assert op.isfile(op.join(fol, 'pipeline', 'pipeline_report.csv'))
+
+    # Nothing was changed
+    ret, statuses = run_pipeline()
+    assert statuses['a'] == statuses['b'] == pipu.STEP_CACHED and statuses['failed'] == pipu.STEP_FAILED
+    assert runs == ['failed'] and ret['a'] and ret['b']
+
+    # The input's content was changed: a runs, and b runs as a's output was changed
+    write_file(in_fname, 'yy')
+    _, statuses = run_pipeline()
+    assert statuses['a'] == statuses['b'] == pipu.STEP_RUN and read_file(b_fname) == 'YYYY'
+
+    # Only a's params were changed, a's output is the same, so b is cached
+    write_file(in_fname, 'yyyy')
+    params['scale'] = 1
+    _, statuses = run_pipeline()
+    assert statuses['a'] == pipu.STEP_RUN and statuses['b'] == pipu.STEP_CACHED
+
+    # A missing output
+    os.remove(b_fname)
+    _, statuses = run_pipeline()
+    assert statuses['a'] == pipu.STEP_CACHED and statuses['b'] == pipu.STEP_RUN and op.isfile(b_fname)
+
+    # force
+    pipeline = build_pipeline()
+    pipeline.run(force=True)
+    assert all(status == pipu.STEP_RUN for name, status, _ in pipeline.report if name in ('a', 'b'))
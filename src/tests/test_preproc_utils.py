@@ -0,0 +1,41 @@
+import os.path as op
+import time
+import pytest
+
+pytest.importorskip('mne')
+from src.utils import utils
+from src.utils import preproc_utils as pu
+
+
+def square(x):
+    return x * x
+
+
+def parallel_main(tup, remote_subject_dir, args, flags):
+    # Runs its own pool, like meg's labels extraction
+    flags['run_parallel'] = utils.run_parallel(square, [1, 2, 3], 2) == [1, 4, 9]
+    flags['n_jobs'] = args.n_jobs == 2
+    # The run's times, to check that the tups of the same subject don't run at once
+    with open(op.join(pu.MMVT_DIR, '{}_runs.txt'.format(tup[0])), 'a') as f:
+        start = time.time()
+        time.sleep(0.2)
+        f.write('{} {}\n'.format(start, time.time()))
+    return flags
+
+
+def test_subjects_parallel_inner_pool(tmp_path, monkeypatch):
+    monkeypatch.setattr(pu, 'MMVT_DIR', str(tmp_path))
+    monkeypatch.setattr(pu, 'prepare_subject_folder', lambda *args: True)
+    args = utils.Bag(remote_subject_dir='', atlas='aparc', ignore_missing=False, n_jobs=2)
+    subjects_tups = [('s1', ('s1', 'dSPM')), ('s1', ('s1', 'MNE')), ('s2', ('s2', 'dSPM'))]
+    results = pu.run_subjects_parallel(subjects_tups, args, parallel_main, 2)
+    assert [key for key, _ in results] == [pu.get_tup_key(tup) for _, tup in subjects_tups]
+    for key, (flags, steps_times, error, wall_time) in results:
+        assert error == ''
+        assert flags == dict(prepare_subject_folder=True, run_parallel=True, n_jobs=True)
+    with open(op.join(str(tmp_path), 's1_runs.txt'), 'r') as f:
+        runs = sorted([tuple(map(float, line.split())) for line in f.readlines()])
+    assert len(runs) == 2 and runs[0][1] <= runs[1][0]
+    # A log per tup
+    assert op.isfile(pu.get_subject_log_fname('s1', parallel_main, "('s1', 'dSPM')"))
+    assert op.isfile(pu.get_subject_log_fname('s1', parallel_main, "('s1', 'MNE')"))
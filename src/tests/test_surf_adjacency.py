@@ -0,0 +1,41 @@
+import numpy as np
+
+from src.mmvt_addon import surf_adjacency as sa
+
+
+def grid_faces(rows_num, cols_num):
+    # A triangulated rows_num x cols_num grid
+    faces = []
+    for r in range(rows_num - 1):
+        for c in range(cols_num - 1):
+            v = r * cols_num + c
+            faces.extend([(v, v + 1, v + cols_num), (v + 1, v + cols_num + 1, v + cols_num)])
+    return np.array(faces)
+
+
+def test_adjacency_csr_vs_brute_force():
+    faces = grid_faces(7, 9)
+    # An isolated last vertex
+    V = 7 * 9 + 1
+    neighbors = [set() for _ in range(V)]
+    for face in faces:
+        for u in face:
+            for w in face:
+                if u != w:
+                    neighbors[u].add(w)
+    adjacency = sa.SurfAdjacency(*sa.calc_adjacency_csr(faces, V))
+    assert adjacency.vertices_num == V
+    for vert in range(V):
+        assert adjacency[vert].tolist() == sorted(neighbors[vert])
+    np.testing.assert_array_equal(adjacency.degrees, [len(n) for n in neighbors])
+    mat = adjacency.as_matrix('coo').tocsr()
+    assert mat.diagonal().sum() == 0
+    assert (mat != mat.T).nnz == 0
+
+    labels = np.random.RandomState(0).randint(-1, 3, V)
+    brute_contours = [labels[vert] != -1 and any(labels[n] != -1 and labels[n] != labels[vert]
+                                                 for n in neighbors[vert]) for vert in range(V)]
+    np.testing.assert_array_equal(adjacency.any_neighbor_differs(labels), brute_contours)
+    mask = labels == 2
+    np.testing.assert_array_equal(
+        adjacency.any_neighbor(mask), [any(mask[n] for n in neighbors[vert]) for vert in range(V)])
@@ -0,0 +1,484 @@
+import os
+import os.path as op
+import numpy as np
+
+# Batched connectivity kernels, for all the channels pairs of many windows at once. The windows data is
+# (windows x channels x T), and the results are (windows x channels x channels), symmetric with a zero diagonal.
+# The elementwise operations are the same as in the original per pair loops (connectivity.py), so PLI and MI are
+# identical to them, and corr and MI_vec equal up to the rounding of the BLAS sums (~1e-16, np.corrcoef itself
+# isn't bitwise reproducible, it depends on the arrays' memory alignment).
+# The PLI pairs are calculated in channels blocks, such that the (windows x block x block x T) temporaries fit in
+# block_mb. Small blocks, that stay in the CPU cache, are faster than big ones.
+
+DEFAULT_MEMORY_MB = 256
+DEFAULT_BLOCK_MB = 1
+# A few rounding errors of |h_i||h_j|, the bound of the PLI's cross product rounding errors
+SIGN_MARGIN = 16 * np.finfo(np.float64).eps
+
+
+def sliding_windows(data, windows_length, windows_shift, windows_num=None):
+    # A (windows x channels x windows_length) view of data (channels x T), without copying
+    from numpy.lib.stride_tricks import as_strided
+    C, T = data.shape
+    max_windows_num = (T - windows_length) // windows_shift + 1
+    windows_num = max_windows_num if windows_num is None else min(windows_num, max_windows_num)
+    return as_strided(data, shape=(windows_num, C, windows_length),
+                      strides=(data.strides[1] * windows_shift, data.strides[0], data.strides[1]), writeable=False)
+
+
+def calc_channels_block_len(T, memory_mb, itemsize=16):
+    return max(1, int(np.sqrt(int(memory_mb * 1024 ** 2) // (T * itemsize))))
+
+
+def _symmetric_from_upper(conn):
+    # conn[..., i, j] for i < j, mirrored to the lower triangle, with a zero diagonal (m + m.T)
+    C = conn.shape[-1]
+    upper = np.triu(np.ones((C, C), dtype=bool), 1)
+    conn = np.where(upper, conn, 0)
+    return conn + np.swapaxes(conn, -1, -2)
+
+
+def _pairs_blocks_kernel(data_hil, kernel, block_mb):
+    # Runs kernel(x_i (W x bi x 1 x T), x_j (W x 1 x bj x T)) -> (W x bi x bj) over the upper triangle blocks
+    W, C, T = data_hil.shape
+    block_len = min(C, calc_channels_block_len(T, block_mb, data_hil.itemsize))
+    windows_chunk_len = max(1, int(block_mb * 1024 ** 2) // (block_len ** 2 * T * data_hil.itemsize))
+    conn = np.zeros((W, C, C))
+    for w_from in range(0, W, windows_chunk_len):
+        w_to = min(w_from + windows_chunk_len, W)
+        for i_from in range(0, C, block_len):
+            i_to = min(i_from + block_len, C)
+            for j_from in range(i_from, C, block_len):
+                j_to = min(j_from + block_len, C)
+                conn[w_from:w_to, i_from:i_to, j_from:j_to] = kernel(
+                    data_hil[w_from:w_to, i_from:i_to, np.newaxis], data_hil[w_from:w_to, np.newaxis, j_from:j_to])
+    return _symmetric_from_upper(conn)
+
+
+def _pli_signs(x_i, x_j):
+    # sign(imag(h_i / h_j)) = sign(imag(h_i * conj(h_j))), without the (slow) complex division. Where the real
+    # cross product is too close to 0 to be sure about its sign (and where h_j = 0), the division is used
+    cross = np.imag(x_i) * np.real(x_j)
+    cross -= np.real(x_i) * np.imag(x_j)
+    signs = np.sign(cross)
+    # |imag(h_i)real(h_j)| + |real(h_i)imag(h_j)| <= |h_i||h_j|
+    uncertain = np.abs(cross) <= (np.abs(x_i) * SIGN_MARGIN) * np.abs(x_j)
+    if np.any(uncertain):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            signs[uncertain] = np.sign(np.imag(
+                np.broadcast_to(x_i, signs.shape)[uncertain] / np.broadcast_to(x_j, signs.shape)[uncertain]))
+    return signs
+
+
+def _pli_kernel(x_i, x_j):
+    return np.abs(np.mean(_pli_signs(x_i, x_j), -1))
+
+
+def _wpli_kernel(x_i, x_j):
+    imag_csd = np.imag(x_i * np.conj(x_j))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.abs(np.mean(imag_csd, -1)) / np.mean(np.abs(imag_csd), -1)
+
+
+def calc_analytic_signal(windows_data):
+    from scipy.signal import hilbert
+    return hilbert(windows_data, axis=-1)
+
+
+def pli_windows(windows_data, block_mb=DEFAULT_BLOCK_MB):
+    # The phase lag index, |mean(sign(imag(h_i / h_j)))|, h is the analytic signal
+    windows_data = windows_data[np.newaxis] if windows_data.ndim == 2 else windows_data
+    return _pairs_blocks_kernel(calc_analytic_signal(windows_data), _pli_kernel, block_mb)
+
+
+def wpli_windows(windows_data, block_mb=DEFAULT_BLOCK_MB):
+    # The weighted phase lag index, |mean(imag(X))| / mean(|imag(X)|), X = h_i * conj(h_j)
+    windows_data = windows_data[np.newaxis] if windows_data.ndim == 2 else windows_data
+    return _pairs_blocks_kernel(calc_analytic_signal(windows_data), _wpli_kernel, block_mb)
+
+
+def corr_windows(windows_data, memory_mb=DEFAULT_MEMORY_MB):
+    # np.corrcoef of each window (channels x T), in windows chunks
+    windows_data = windows_data[np.newaxis] if windows_data.ndim == 2 else windows_data
+    W, C, T = windows_data.shape
+    windows_chunk_len = max(1, int(memory_mb * 1024 ** 2) // (C * max(T, C) * 8))
+    conn = np.zeros((W, C, C))
+    for w_from in range(0, W, windows_chunk_len):
+        w_to = min(w_from + windows_chunk_len, W)
+        x = np.array(windows_data[w_from:w_to], dtype=np.float64)
+        x -= np.mean(x, -1, keepdims=True)
+        c = np.matmul(x, np.swapaxes(x, -1, -2))
+        c *= np.true_divide(1, T - 1)
+        stddev = np.sqrt(np.diagonal(c, axis1=-2, axis2=-1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            c /= stddev[:, :, np.newaxis]
+            c /= stddev[:, np.newaxis, :]
+        conn[w_from:w_to] = np.clip(c, -1, 1)
+    return conn
+
+
+def corr_matrix_pairs(data):
+    # data: (channels x T x comps). For each pair i < j, np.corrcoef(data[i].T, data[j].T), (2comps x 2comps),
+    # mirrored to j > i (the same matrix). Returns (channels x channels x 2comps x 2comps), zeros for i == j
+    C, T, k = data.shape
+    rows_corr = np.corrcoef(np.transpose(data, (0, 2, 1)).reshape((C * k, T)))
+    pairs_corr = np.transpose(rows_corr.reshape((C, k, C, k)), (0, 2, 1, 3))
+    diag_corr = pairs_corr[np.arange(C), np.arange(C)]
+    corr = np.empty((C, C, 2 * k, 2 * k))
+    corr[:, :, :k, :k] = diag_corr[:, np.newaxis]
+    corr[:, :, k:, k:] = diag_corr[np.newaxis, :]
+    corr[:, :, :k, k:] = pairs_corr
+    corr[:, :, k:, :k] = np.swapaxes(pairs_corr, 0, 1)
+    lower = np.tril(np.ones((C, C), dtype=bool), -1)
+    corr[lower] = np.swapaxes(corr, 0, 1)[lower]
+    corr[np.arange(C), np.arange(C)] = 0
+    return corr
+
+
+def mi_from_corr(corr):
+    # The Gaussian mutual information, -0.5 * log(1 - r ** 2), for (... x channels x channels) correlations
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return _symmetric_from_upper(-0.5 * np.log(1 - corr ** 2))
+
+
+def mi_vec_from_corr(corr):
+    # For (channels x channels x K x K) correlations: -0.5 * log(||I - r * r.T||), r.T the transpose of each K x K
+    K = corr.shape[-1]
+    x = np.eye(K) - corr * np.swapaxes(corr, -1, -2)
+    norms = np.sqrt(np.sum(x.reshape(x.shape[:-2] + (K * K, )) ** 2, -1))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return _symmetric_from_upper(-0.5 * np.log(norms))
+
+
+# Sliding windows connectivity, where the windows overlap (windows_shift < windows_length). Instead of calculating
+# each window from scratch, the running sums of the window are updated with the samples that enter and leave it,
+# so each window costs O(windows_shift) instead of O(windows_length):
+#   corr: the channels' sums and cross products (of the data minus the first window's mean, for stability)
+#   pli: the sums of sign(imag(h_i / h_j)), wpli: the sums of imag(h_i * conj(h_j)) and |imag(h_i * conj(h_j))|
+# where h is the analytic signal of the whole recording (not of each window, so there are no window edge effects).
+# Every refresh_every windows the sums are recalculated from scratch, to bound the floats drift.
+# The results are (pairs x windows), the pairs are in the order of utils.lower_rec_indices (np.tril_indices(C, -1)),
+# like calc_connectivity's con_values, and can be streamed to a memory-mapped npy file.
+
+SLIDING_WINDOWS_METHODS = ('corr', 'pli', 'wpli')
+REFRESH_EVERY = 100
+
+
+def pairs_indices(channels_num):
+    return np.tril_indices(channels_num, -1)
+
+
+def pairs_to_matrix(conn_pairs, channels_num):
+    # (pairs x ...) -> (channels x channels x ...), symmetric with a zero diagonal
+    conn_pairs = np.asarray(conn_pairs)
+    rows, cols = pairs_indices(channels_num)
+    conn = np.zeros((channels_num, channels_num) + conn_pairs.shape[1:], dtype=conn_pairs.dtype)
+    conn[rows, cols] = conn_pairs
+    conn[cols, rows] = conn_pairs
+    return conn
+
+
+def calc_analytic_signal_memmap(data, fname, dtype=np.complex128):
+    # The analytic signal of each channel of the whole recording, channel by channel into a memmap
+    from scipy.signal import hilbert
+    h = np.lib.format.open_memmap(fname, mode='w+', dtype=dtype, shape=data.shape)
+    for ind in range(data.shape[0]):
+        h[ind] = hilbert(np.asarray(data[ind], dtype=np.float64))
+    h.flush()
+    return h
+
+
+def _pairs_blocks_sums(h, sums_kernel, sums_num, block_mb):
+    # h: (channels x n). Returns (sums_num x channels x channels), the sums over n of sums_kernel, for i < j
+    C, n = h.shape
+    block_len = min(C, calc_channels_block_len(n, block_mb, h.itemsize))
+    sums = np.zeros((sums_num, C, C))
+    for i_from in range(0, C, block_len):
+        i_to = min(i_from + block_len, C)
+        for j_from in range(i_from, C, block_len):
+            j_to = min(j_from + block_len, C)
+            sums[:, i_from:i_to, j_from:j_to] = sums_kernel(h[i_from:i_to, np.newaxis], h[np.newaxis, j_from:j_to])
+    return sums
+
+
+def _pli_sums(x_i, x_j):
+    return np.sum(_pli_signs(x_i, x_j), -1)[np.newaxis]
+
+
+def _wpli_sums(x_i, x_j):
+    imag_csd = np.imag(x_i * np.conj(x_j))
+    return np.array([np.sum(imag_csd, -1), np.sum(np.abs(imag_csd), -1)])
+
+
+class SlidingWindowsConnectivity(object):
+    def __init__(self, data, windows_length, windows_shift, method='corr', windows_num=None,
+                 refresh_every=REFRESH_EVERY, block_mb=DEFAULT_BLOCK_MB, analytic_signal=None):
+        # data: (channels x T), an array or a memmap. analytic_signal: For pli and wpli, the (precalculated, see
+        # calc_analytic_signal_memmap) analytic signal of data
+        if method not in SLIDING_WINDOWS_METHODS:
+            raise Exception('SlidingWindowsConnectivity: method should be one of {}'.format(SLIDING_WINDOWS_METHODS))
+        self.data, self.method = data, method
+        self.windows_length, self.windows_shift = windows_length, windows_shift
+        self.channels_num, T = data.shape
+        max_windows_num = max((T - windows_length) // windows_shift + 1, 0)
+        self.windows_num = max_windows_num if windows_num is None else int(min(windows_num, max_windows_num))
+        self.refresh_every, self.block_mb = max(refresh_every, 1), block_mb
+        self.rows, self.cols = pairs_indices(self.channels_num)
+        if method == 'corr':
+            self.offset = np.mean(np.asarray(data[:, :windows_length], dtype=np.float64), 1)
+        elif analytic_signal is None:
+            self.analytic_signal = calc_analytic_signal(np.asarray(data, dtype=np.float64))
+        else:
+            self.analytic_signal = analytic_signal
+
+    def __len__(self):
+        return self.windows_num
+
+    def window_range(self, window_ind):
+        return window_ind * self.windows_shift, window_ind * self.windows_shift + self.windows_length
+
+    def calc_sums(self, t_from, t_to):
+        # The method's sums over the samples [t_from, t_to)
+        if self.method == 'corr':
+            x = np.asarray(self.data[:, t_from:t_to], dtype=np.float64) - self.offset[:, np.newaxis]
+            return np.sum(x, 1), np.dot(x, x.T)
+        h = np.asarray(self.analytic_signal[:, t_from:t_to])
+        if self.method == 'pli':
+            return _pairs_blocks_sums(h, _pli_sums, 1, self.block_mb)
+        return _pairs_blocks_sums(h, _wpli_sums, 2, self.block_mb)
+
+    def update_sums(self, sums, enter_sums, leave_sums):
+        if self.method == 'corr':
+            return [s + e - l for s, e, l in zip(sums, enter_sums, leave_sums)]
+        return sums + enter_sums - leave_sums
+
+    def window_conn(self, sums):
+        # The window's (pairs, ) connectivity from its sums
+        n = self.windows_length
+        if self.method == 'corr':
+            channels_sums, cross_products = sums
+            cov = (cross_products - np.outer(channels_sums, channels_sums) / n) / (n - 1)
+            stddev = np.sqrt(np.diag(cov))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                conn = cov[self.rows, self.cols] / (stddev[self.rows] * stddev[self.cols])
+            return np.clip(conn, -1, 1)
+        # The sums are only in the upper triangle, (i, j) -> (j, i)
+        if self.method == 'pli':
+            return np.abs(sums[0, self.cols, self.rows] / n)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.abs(sums[0, self.cols, self.rows] / n) / (sums[1, self.cols, self.rows] / n)
+
+    def __iter__(self):
+        return self.iter_windows()
+
+    def iter_windows(self, windows_from=0, windows_to=None):
+        # Yields (window ind, (pairs, ) connectivity)
+        windows_to = self.windows_num if windows_to is None else min(windows_to, self.windows_num)
+        sums = None
+        for window_ind in range(windows_from, windows_to):
+            t_from, t_to = self.window_range(window_ind)
+            if sums is None or self.windows_shift >= self.windows_length or \
+                    (window_ind - windows_from) % self.refresh_every == 0:
+                sums = self.calc_sums(t_from, t_to)
+            else:
+                prev_from, prev_to = self.window_range(window_ind - 1)
+                sums = self.update_sums(sums, self.calc_sums(prev_to, t_to), self.calc_sums(prev_from, t_from))
+            yield window_ind, self.window_conn(sums)
+
+
+def _calc_sliding_windows_connectivity(p):
+    # The worker reopens the memmaps by their file names, and reads only its windows' range from them
+    (data_fname, analytic_signal_fname, windows_length, windows_shift, method, windows_num, refresh_every,
+     output_fname, windows_from, windows_to, flush_len) = p
+    data = np.load(data_fname, mmap_mode='r')
+    analytic_signal = np.load(analytic_signal_fname, mmap_mode='r') if analytic_signal_fname != '' else None
+    engine = SlidingWindowsConnectivity(
+        data, windows_length, windows_shift, method, windows_num, refresh_every, analytic_signal=analytic_signal)
+    output = np.load(output_fname, mmap_mode='r+')
+    _write_windows(engine, output, windows_from, windows_to, flush_len)
+    output.flush()
+
+
+def get_npy_memmap_fname(x):
+    # The npy file of x if it's a memmap of a whole npy file (np.load(fname, mmap_mode=...)), otherwise ''
+    fname = getattr(x, 'filename', None)
+    if not isinstance(x, np.memmap) or fname is None or not fname.endswith('.npy') or not x.flags.c_contiguous:
+        return ''
+    npy = np.load(fname, mmap_mode='r')
+    return fname if npy.shape == x.shape and npy.dtype == x.dtype and npy.offset == x.offset else ''
+
+
+def _write_windows(engine, output, windows_from, windows_to, flush_len):
+    # Buffers flush_len windows, such that each pair's row is written in contiguous runs
+    buffer = np.zeros((output.shape[0], flush_len), dtype=output.dtype)
+    buffer_from = windows_from
+    for window_ind, conn in engine.iter_windows(windows_from, windows_to):
+        buffer[:, window_ind - buffer_from] = conn
+        if window_ind - buffer_from == flush_len - 1 or window_ind == windows_to - 1:
+            output[:, buffer_from:window_ind + 1] = buffer[:, :window_ind + 1 - buffer_from]
+            buffer_from = window_ind + 1
+
+
+def calc_sliding_windows_connectivity(data, windows_length, windows_shift, method='corr', output_fname='',
+                                      windows_num=None, dtype=np.float64, refresh_every=REFRESH_EVERY,
+                                      analytic_signal_fname='', n_jobs=1, memory_mb=DEFAULT_MEMORY_MB):
+    # Returns the (pairs x windows) connectivity, a memmap of output_fname if given. With n_jobs > 1 (and an
+    # output_fname), each process calculates a contiguous range of windows, and writes it to the memmap. The
+    # processes get the data and the analytic signal as npy files (temporary ones next to output_fname if needed)
+    parallel = n_jobs > 1 and output_fname != ''
+    temp_fnames = []
+    if method in ('pli', 'wpli') and analytic_signal_fname == '' and parallel:
+        analytic_signal_fname = '{}_analytic_signal.npy'.format(op.splitext(output_fname)[0])
+        temp_fnames.append(analytic_signal_fname)
+    analytic_signal = None
+    if method in ('pli', 'wpli') and analytic_signal_fname != '':
+        analytic_signal = calc_analytic_signal_memmap(data, analytic_signal_fname)
+    engine = SlidingWindowsConnectivity(
+        data, windows_length, windows_shift, method, windows_num, refresh_every, analytic_signal=analytic_signal)
+    pairs_num, windows_num = len(engine.rows), len(engine)
+    if output_fname != '':
+        output = np.lib.format.open_memmap(output_fname, mode='w+', dtype=dtype, shape=(pairs_num, windows_num))
+    else:
+        output = np.zeros((pairs_num, windows_num), dtype=dtype)
+    flush_len = max(1, min(windows_num, int(memory_mb * 1024 ** 2) // max(pairs_num * np.dtype(dtype).itemsize, 1)))
+    if parallel and windows_num > 1:
+        from src.utils import utils
+        output.flush()
+        del output
+        data_fname = get_npy_memmap_fname(data)
+        if data_fname == '':
+            data_fname = '{}_data.npy'.format(op.splitext(output_fname)[0])
+            np.save(data_fname, np.asarray(data))
+            temp_fnames.append(data_fname)
+        ranges = np.array_split(np.arange(windows_num), n_jobs)
+        params = [(data_fname, '' if analytic_signal is None else analytic_signal_fname, windows_length,
+                   windows_shift, method, windows_num, refresh_every, output_fname, r[0], r[-1] + 1, flush_len)
+                  for r in ranges if len(r) > 0]
+        utils.run_parallel(_calc_sliding_windows_connectivity, params, n_jobs)
+        output = np.load(output_fname, mmap_mode='r')
+    else:
+        _write_windows(engine, output, 0, windows_num, flush_len)
+        if output_fname != '':
+            output.flush()
+    del engine, analytic_signal
+    for fname in temp_fnames:
+        os.remove(fname)
+    return output
+
+
+def pairs_channels_num(pairs_num):
+    # The inverse of pairs_num = C * (C - 1) / 2
+    return int(round((1 + np.sqrt(1 + 8 * pairs_num)) / 2))
+
+
+def pairs_blocks(conn_pairs, memory_mb=DEFAULT_MEMORY_MB):
+    # Yields (p_from, p_to, float64 copy of conn_pairs[p_from:p_to]), pairs blocks of the (pairs x windows)
+    # connectivity that fit in memory_mb
+    pairs_num, windows_num = conn_pairs.shape
+    block_len = max(1, int(memory_mb * 1024 ** 2) // max(windows_num * 8, 1))
+    for p_from in range(0, pairs_num, block_len):
+        p_to = min(p_from + block_len, pairs_num)
+        yield p_from, p_to, np.asarray(conn_pairs[p_from:p_to], dtype=np.float64)
+
+
+def calc_pairs_cv(conn_pairs, memory_mb=DEFAULT_MEMORY_MB):
+    # The (pairs, ) std / mean(abs) over the windows, in pairs blocks of the (pairs x windows) connectivity
+    cv = np.zeros(len(conn_pairs))
+    for p_from, p_to, x in pairs_blocks(conn_pairs, memory_mb):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cv[p_from:p_to] = np.nanstd(x, 1) / np.mean(np.abs(x), 1)
+    return cv
+
+
+def calc_pairs_stats(conn_pairs, memory_mb=DEFAULT_MEMORY_MB):
+    # The reductions of the (channels x channels x windows) matrix (symmetric, zero diagonal) of the (pairs x
+    # windows) connectivity, in one pass over its pairs blocks, without creating the matrix:
+    #   channels_mean: np.mean(conn, 0), channels_abs_nanmean: np.nanmean(np.abs(conn), 1), (channels x windows)
+    #   mean: np.mean(conn, 2), std: np.nanstd(conn, 2), cv: std / np.mean(np.abs(conn), 2), (pairs, )
+    #   abs_max: max(abs(min(conn)), abs(max(conn)))
+    import scipy.sparse
+    pairs_num, windows_num = conn_pairs.shape
+    C = pairs_channels_num(pairs_num)
+    rows, cols = pairs_indices(C)
+    # (channels x pairs), the two channels of each pair
+    incidence = scipy.sparse.csc_matrix(
+        (np.ones(2 * pairs_num), (np.concatenate((rows, cols)), np.tile(np.arange(pairs_num), 2))),
+        shape=(C, pairs_num))
+    channels_sums, channels_abs_sums = np.zeros((C, windows_num)), np.zeros((C, windows_num))
+    channels_counts = np.ones((C, windows_num))
+    stats = dict(mean=np.zeros(pairs_num), std=np.zeros(pairs_num), cv=np.zeros(pairs_num), abs_max=0.0)
+    for p_from, p_to, x in pairs_blocks(conn_pairs, memory_mb):
+        block_incidence = incidence[:, p_from:p_to]
+        abs_x = np.abs(x)
+        not_nan = ~np.isnan(x)
+        channels_sums += block_incidence.dot(x)
+        channels_abs_sums += block_incidence.dot(np.where(not_nan, abs_x, 0))
+        channels_counts += block_incidence.dot(not_nan.astype(np.float64))
+        stats['mean'][p_from:p_to] = np.mean(x, 1)
+        stats['std'][p_from:p_to] = np.nanstd(x, 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats['cv'][p_from:p_to] = stats['std'][p_from:p_to] / np.mean(abs_x, 1)
+        if np.any(not_nan):
+            stats['abs_max'] = max(stats['abs_max'], float(np.max(abs_x[not_nan])))
+    stats['channels_mean'] = channels_sums / C
+    stats['channels_abs_nanmean'] = channels_abs_sums / channels_counts
+    return stats
+
+
+def calc_pairs_abs_max(conn_pairs, memory_mb=DEFAULT_MEMORY_MB):
+    # The (pairs, ) max(abs) over the windows, nan if one of the pair's windows is nan (like np.max)
+    abs_max = np.zeros(len(conn_pairs))
+    for p_from, p_to, x in pairs_blocks(conn_pairs, memory_mb):
+        abs_max[p_from:p_to] = np.max(np.abs(x), 1)
+    return abs_max
+
+
+def calc_pairs_percentiles(conn_pairs, percs, use_abs=False, memory_mb=DEFAULT_MEMORY_MB, bins_num=2 ** 16):
+    # np.percentile(x[~np.isnan(x)], percs) of the (pairs x windows) connectivity (of its abs if use_abs), without
+    # reading all of it to memory. Three passes over the pairs blocks: the min and max, a histogram that finds the
+    # bins of the percentiles' ranks, and the values in these bins, which are sorted to get the exact ranks
+    def blocks():
+        for _, _, x in pairs_blocks(conn_pairs, memory_mb):
+            x = x[~np.isnan(x)]
+            yield np.abs(x) if use_abs else x
+
+    x_min, x_max, n = np.inf, -np.inf, 0
+    for x in blocks():
+        if len(x) > 0:
+            x_min, x_max, n = min(x_min, np.min(x)), max(x_max, np.max(x)), n + len(x)
+    if n == 0 or x_min == x_max:
+        return [np.nan if n == 0 else x_min] * len(percs)
+    edges = np.linspace(x_min, x_max, bins_num + 1)
+    hist = np.zeros(bins_num, dtype=np.int64)
+    for x in blocks():
+        hist += np.histogram(x, edges)[0]
+    # The (linear interpolation) ranks of each percentile, and their bins
+    ranks_pos = [(n - 1) * perc / 100.0 for perc in percs]
+    ranks = sorted(set([int(np.floor(pos)) for pos in ranks_pos] + [int(np.ceil(pos)) for pos in ranks_pos]))
+    hist_cumsum = np.cumsum(hist)
+    ranks_bins = {rank: int(np.searchsorted(hist_cumsum, rank, side='right')) for rank in ranks}
+    bins = sorted(set(ranks_bins.values()))
+    bins_values, bins_below = {b: [] for b in bins}, {b: 0 for b in bins}
+    for x in blocks():
+        for b in bins:
+            bin_to = x <= edges[b + 1] if b == bins_num - 1 else x < edges[b + 1]
+            bins_values[b].append(x[(x >= edges[b]) & bin_to])
+            bins_below[b] += int(np.sum(x < edges[b]))
+    bins_values = {b: np.sort(np.concatenate(values)) for b, values in bins_values.items()}
+    ranks_values = {rank: bins_values[b][rank - bins_below[b]] for rank, b in ranks_bins.items()}
+    percentiles = []
+    for pos in ranks_pos:
+        low, high = ranks_values[int(np.floor(pos))], ranks_values[int(np.ceil(pos))]
+        percentiles.append(low + (high - low) * (pos - np.floor(pos)))
+    return percentiles
+
+
+def calc_pairs_max_min(conn_pairs, norm_by_percentile=False, norm_percs=None, memory_mb=DEFAULT_MEMORY_MB):
+    # Like utils.get_data_max_min of the (pairs x windows) connectivity, in its pairs blocks
+    if norm_by_percentile:
+        data_max, data_min = calc_pairs_percentiles(conn_pairs, [norm_percs[1], norm_percs[0]], memory_mb=memory_mb)
+        return data_max, data_min
+    data_max, data_min = -np.inf, np.inf
+    for _, _, x in pairs_blocks(conn_pairs, memory_mb):
+        data_max, data_min = max(data_max, np.nanmax(x)), min(data_min, np.nanmin(x))
+    return data_max, data_min
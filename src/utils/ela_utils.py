@@ -0,0 +1,183 @@
+import os.path as op
+import hashlib
+import traceback
+from collections import defaultdict, Counter
+import numpy as np
+from scipy.spatial import cKDTree
+
+from src.utils import utils
+from src.utils import labels_utils as lu
+
+# Electrodes labeling (ELA): the probabilities of every contact to be in each ROI, by the ROIs of the pial vertices
+# (cortical, by the atlas' vertices labels index, see labels_utils.create_vertices_labels_index) and the aseg voxels (subcortical) inside a cigar around the contact: a
+# cylinder of radius error_radius and length elec_length along the lead, with hemispherical caps. If the cigar is
+# empty, its radius is enlarged (by error_radius, up to MAX_APPROX times), and 'approx' is the number of times.
+# The contacts are labeled in parallel, in a process pool where every process reads the anatomy once, and the
+# results are cached per contact by its cigar (center and direction) and the anatomy files' mtimes, so only the
+# contacts whose coordinates changed are labeled again.
+# Every contact's labeling has a 'model' (ELA_MODEL), to tell it apart from the external electrodes_rois output.
+
+ELA_MODEL = 'mmvt_ela_utils_1'
+SUBCORTICAL_EXCLUDE = ('Unknown', 'Left-Cerebral-Cortex', 'Right-Cerebral-Cortex')
+MAX_APPROX = 3
+
+_anatomies = {}
+
+
+def get_anatomy_fnames(subject, atlas, subjects_dir):
+    fnames = dict(aseg=op.join(subjects_dir, subject, 'mri', 'aseg.mgz'))
+    ids_fname, names_fname = lu.get_vertices_labels_index_fnames(subject, atlas)
+    for hemi in utils.HEMIS:
+        fnames['{}_pial'.format(hemi)] = op.join(subjects_dir, subject, 'surf', '{}.pial'.format(hemi))
+        fnames['{}_labels_ids'.format(hemi)] = ids_fname.format(hemi=hemi)
+        fnames['{}_labels_names'.format(hemi)] = names_fname.format(hemi=hemi)
+    return fnames
+
+
+def calc_anatomy_key(anatomy_fnames):
+    return tuple([(fname, op.getmtime(fname)) for _, fname in sorted(anatomy_fnames.items())] + [ELA_MODEL])
+
+
+class ElaAnatomy(object):
+    def __init__(self, anatomy_fnames):
+        import nibabel as nib
+        self.pial_trees, self.vertices_labels, self.labels_names = {}, {}, {}
+        for hemi in utils.HEMIS:
+            verts, _ = nib.freesurfer.read_geometry(anatomy_fnames['{}_pial'.format(hemi)])
+            labels_ids = np.load(anatomy_fnames['{}_labels_ids'.format(hemi)])
+            names = np.load(anatomy_fnames['{}_labels_names'.format(hemi)])
+            if len(labels_ids) != len(verts):
+                raise Exception('ElaAnatomy: The {} vertices labels index and the pial have different vertices '
+                                'numbers ({}, {})'.format(hemi, len(labels_ids), len(verts)))
+            # The vertices without a label (-1) get the last name
+            self.labels_names[hemi] = np.array([utils.to_str(name) for name in names] + ['unknown-{}'.format(hemi)])
+            self.vertices_labels[hemi] = np.where(labels_ids < 0, len(names), labels_ids)
+            self.pial_trees[hemi] = cKDTree(verts)
+        aseg = nib.load(anatomy_fnames['aseg'])
+        aseg_data = np.asarray(aseg.dataobj).astype(int)
+        lut = utils.read_freesurfer_lookup_table(return_dict=True)
+        codes = [code for code in np.unique(aseg_data) if code != 0 and lut.get(code, '') not in SUBCORTICAL_EXCLUDE]
+        voxels = np.array(np.where(np.isin(aseg_data, codes))).T
+        self.voxels_names = np.array([lut.get(code, str(code)) for code in aseg_data[tuple(voxels.T)]])
+        self.voxels_tree = cKDTree(utils.apply_trans(aseg.header.get_vox2ras_tkr(), voxels))
+
+
+def get_anatomy(anatomy_fnames):
+    # Read once per process
+    key = calc_anatomy_key(anatomy_fnames)
+    if key not in _anatomies:
+        _anatomies.clear()
+        _anatomies[key] = ElaAnatomy(anatomy_fnames)
+    return _anatomies[key]
+
+
+def calc_contacts_cigars(names, pos, bipolar):
+    # The center and the lead's direction (unit vector, from the previous to the next contact) of every contact.
+    # A contact without neighbors gets a zero direction, and its cigar is a sphere
+    groups = defaultdict(list)
+    for ind, name in enumerate(names):
+        groups[utils.elec_group(name, bipolar)].append(ind)
+    pos = np.asarray(pos, dtype=np.float64)
+    directions = np.zeros(pos.shape)
+    for group_inds in groups.values():
+        contacts_nums = [utils.elec_group_number(names[ind], bipolar)[1] for ind in group_inds]
+        group_inds = [ind for _, ind in sorted(
+            zip(contacts_nums, group_inds), key=lambda x: x[0] if isinstance(x[0], int) else 0)]
+        for k, ind in enumerate(group_inds):
+            direction = pos[group_inds[min(k + 1, len(group_inds) - 1)]] - pos[group_inds[max(k - 1, 0)]]
+            norm = np.linalg.norm(direction)
+            if norm > 0:
+                directions[ind] = direction / norm
+    return pos, directions
+
+
+def calc_contact_key(center, direction):
+    return hashlib.md5(np.concatenate((center, direction)).astype(np.float64).tobytes()).hexdigest()
+
+
+def find_points_in_cigar(tree, center, direction, radius, length):
+    # The indices of the tree's points inside the cigar, and their distances from the center
+    half_length = length / 2.0
+    inds = np.array(tree.query_ball_point(center, half_length + radius), dtype=int)
+    if len(inds) == 0:
+        return inds, np.zeros(0)
+    pts = tree.data[inds] - center
+    # The distance from the lead's axis segment
+    t = np.clip(pts.dot(direction), -half_length, half_length)
+    in_cigar = np.linalg.norm(pts - t[:, np.newaxis] * direction, axis=1) <= radius
+    return inds[in_cigar], np.linalg.norm(pts[in_cigar], axis=1)
+
+
+def label_contact(anatomy, name, center, direction, error_radius, elec_length):
+    for approx in range(MAX_APPROX + 1):
+        radius = error_radius * (approx + 1)
+        cortical, cortical_inds = Counter(), {}
+        for hemi in utils.HEMIS:
+            cortical_inds[hemi] = find_points_in_cigar(anatomy.pial_trees[hemi], center, direction, radius, elec_length)
+            cortical.update(anatomy.labels_names[hemi][anatomy.vertices_labels[hemi][cortical_inds[hemi][0]]].tolist())
+        voxels_inds, _ = find_points_in_cigar(anatomy.voxels_tree, center, direction, radius, elec_length)
+        subcortical = Counter(anatomy.voxels_names[voxels_inds].tolist())
+        if len(cortical) + len(subcortical) > 0:
+            break
+    points_num = max(sum(cortical.values()) + sum(subcortical.values()), 1)
+    cortical_probs = [(count / points_num, roi) for roi, count in cortical.most_common()]
+    subcortical_probs = [(count / points_num, roi) for roi, count in subcortical.most_common()]
+    lh_num, rh_num = len(cortical_inds['lh'][0]), len(cortical_inds['rh'][0])
+    hemi = 'rh' if rh_num > lh_num or (rh_num == lh_num and center[0] > 0) else 'lh'
+    return dict(
+        name=name, model=ELA_MODEL, hemi=hemi, approx=approx, elc_r=error_radius, elc_length=elec_length,
+        cortical_rois=[roi for _, roi in cortical_probs], cortical_probs=[p for p, _ in cortical_probs],
+        subcortical_rois=[roi for _, roi in subcortical_probs], subcortical_probs=[p for p, _ in subcortical_probs],
+        cortical_indices=cortical_inds[hemi][0], cortical_indices_dists=cortical_inds[hemi][1])
+
+
+def _label_contacts_chunk(p):
+    names, centers, directions, anatomy_fnames, error_radius, elec_length = p
+    anatomy = get_anatomy(anatomy_fnames)
+    return [label_contact(anatomy, name, center, direction, error_radius, elec_length)
+            for name, center, direction in zip(names, centers, directions)]
+
+
+def calc_electrodes_labeling(subject, atlas, names, pos, bipolar, error_radius=3, elec_length=4, output_fname='',
+                             cache_fname='', subjects_dir='', n_jobs=1):
+    try:
+        # Creates (or recalculates, if it's out of date) the vertices labels index, which the processes read
+        lu.create_vertices_labels_index(subject, atlas)
+    except:
+        print(traceback.format_exc())
+        print("calc_electrodes_labeling: Can't create the {} vertices labels index".format(atlas))
+        return None
+    anatomy_fnames = get_anatomy_fnames(subject, atlas, subjects_dir)
+    missing_files = [fname for fname in anatomy_fnames.values() if not op.isfile(fname)]
+    if len(missing_files) > 0:
+        print('calc_electrodes_labeling: Missing files: {}'.format(missing_files))
+        return None
+    anatomy_key = calc_anatomy_key(anatomy_fnames)
+    centers, directions = calc_contacts_cigars(names, pos, bipolar)
+    contacts_keys = [calc_contact_key(center, direction) for center, direction in zip(centers, directions)]
+    cache = utils.load(cache_fname) if cache_fname != '' and op.isfile(cache_fname) else {}
+    contacts = cache.get('contacts', {}) if cache.get('anatomy_key') == anatomy_key else {}
+    inds = [ind for ind, (name, key) in enumerate(zip(names, contacts_keys))
+            if name not in contacts or contacts[name][0] != key]
+    print('Labeling {} contacts ({} are cached)'.format(len(inds), len(names) - len(inds)))
+    if len(inds) > 0:
+        chunks = [chunk for chunk in np.array_split(inds, min(n_jobs, len(inds))) if len(chunk) > 0]
+        params = [([names[ind] for ind in chunk], centers[chunk], directions[chunk], anatomy_fnames, error_radius,
+                   elec_length) for chunk in chunks]
+        chunks_labeling = utils.run_parallel(_label_contacts_chunk, params, len(chunks))
+        for chunk, chunk_labeling in zip(chunks, chunks_labeling):
+            for ind, contact_labeling in zip(chunk, chunk_labeling):
+                contacts[names[ind]] = (contacts_keys[ind], contact_labeling)
+    contacts = {name: contacts[name] for name in names}
+    if cache_fname != '':
+        utils.save(dict(anatomy_key=anatomy_key, contacts=contacts), cache_fname)
+    labeling = [contacts[name][1] for name in names]
+    if output_fname != '':
+        utils.save(labeling, output_fname)
+    return labeling
+
+
+def is_in_tree_labeling(labeling):
+    # True if the labeling was calculated here (and not by the external electrodes_rois code)
+    return isinstance(labeling, (list, tuple)) and len(labeling) > 0 and \
+           all([isinstance(contact, dict) and contact.get('model') == ELA_MODEL for contact in labeling])
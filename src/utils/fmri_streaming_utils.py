@@ -0,0 +1,169 @@
+import numpy as np
+
+# Bounded-memory processing of 4D fMRI images (surface: V x 1 x 1 x T, volume: X x Y x Z x T). The image is read
+# through nibabel's array proxy (memory-mapped for uncompressed images) in time blocks, and when even one time
+# point is too big, also in vertices blocks. The labels' means and variances are accumulated with Welford's
+# streaming statistics, merged between blocks with Chan et al. parallel formula:
+#   n = na + nb, delta = mean_b - mean_a
+#   mean = mean_a + delta * nb / n, M2 = M2_a + M2_b + delta ** 2 * na * nb / n, var = M2 / n
+
+DEFAULT_MEMORY_MB = 512
+
+
+def calc_block_len(other_dim_len, memory_mb, itemsize=8):
+    return max(1, int(memory_mb * 1024 ** 2) // max(other_dim_len * itemsize, 1))
+
+
+class ImageTimeSeries(object):
+    # A (V x T) read only view of a 4D image, that reads only the requested blocks
+    def __init__(self, img, memory_mb=DEFAULT_MEMORY_MB):
+        if isinstance(img, str):
+            import nibabel as nib
+            img = nib.load(img)
+        self.dataobj = img.dataobj
+        self.T = img.shape[-1] if len(img.shape) > 3 else 1
+        self.V = int(np.prod(img.shape[:-1])) if len(img.shape) > 3 else int(np.prod(img.shape))
+        self.dtype = img.get_data_dtype()
+        self.memory_mb = memory_mb
+
+    @property
+    def shape(self):
+        return self.V, self.T
+
+    @property
+    def ndim(self):
+        return 2
+
+    def read_times(self, t_from, t_to):
+        # (V x (t_to - t_from)), in the same vertices order as get_data().reshape((-1, T))
+        if self.T == 1:
+            return np.asarray(self.dataobj).reshape((-1, 1))
+        return np.asarray(self.dataobj[..., t_from:t_to]).reshape((self.V, t_to - t_from))
+
+    def read_block(self, v_from, v_to, t_from, t_to):
+        # ((v_to - v_from) x (t_to - t_from)). Only the first axis' slices that contain the vertices are read,
+        # for surfaces (V x 1 x 1 x T) exactly the vertices
+        slice_len = int(np.prod(self.dataobj.shape[1:3])) if len(self.dataobj.shape) > 1 else 1
+        x_from, x_to = v_from // slice_len, -(-v_to // slice_len)
+        if self.T == 1:
+            block = np.asarray(self.dataobj[x_from:x_to]).reshape((-1, 1))
+        else:
+            block = np.asarray(self.dataobj[x_from:x_to, ..., t_from:t_to]).reshape((-1, t_to - t_from))
+        return block[v_from - x_from * slice_len:v_to - x_from * slice_len]
+
+    def time_blocks(self, memory_mb=None, itemsize=8):
+        memory_mb = self.memory_mb if memory_mb is None else memory_mb
+        block_len = calc_block_len(self.V, memory_mb, itemsize)
+        for t_from in range(0, self.T, block_len):
+            t_to = min(t_from + block_len, self.T)
+            yield t_from, t_to, self.read_times(t_from, t_to)
+
+    def read_rows(self, rows, t_from=0, t_to=None):
+        # The time series of rows (vertices), one pass over the image's time blocks, reading only the range of
+        # vertices between the rows
+        rows = np.asarray(rows)
+        t_to = self.T if t_to is None else t_to
+        out = np.empty((len(rows), t_to - t_from), dtype=self.dtype)
+        if len(rows) == 0:
+            return out
+        v_from, v_to = int(rows.min()), int(rows.max()) + 1
+        block_len = calc_block_len(v_to - v_from, self.memory_mb, self.dtype.itemsize)
+        for block_from in range(t_from, t_to, block_len):
+            block_to = min(block_from + block_len, t_to)
+            out[:, block_from - t_from:block_to - t_from] = \
+                self.read_block(v_from, v_to, block_from, block_to)[rows - v_from]
+        return out
+
+    def __getitem__(self, key):
+        # Supports x[rows], x[rows, t_from:t_to] and x[:, t_from:t_to]
+        rows, times = key if isinstance(key, tuple) else (key, slice(None))
+        if not isinstance(times, slice) or times.step not in (None, 1):
+            raise Exception('ImageTimeSeries: Only time slices are supported')
+        t_from, t_to, _ = times.indices(self.T)
+        if isinstance(rows, slice) and rows == slice(None):
+            return self.read_times(t_from, t_to)
+        if isinstance(rows, slice) and rows.step in (None, 1):
+            v_from, v_to, _ = rows.indices(self.V)
+            return self.read_block(v_from, max(v_from, v_to), t_from, t_to)
+        return self.read_rows(np.arange(self.V)[rows] if isinstance(rows, slice) else rows, t_from, t_to)
+
+
+def _labels_block_stats(membership, x_block):
+    # The counts, means and M2 (sum of squared differences from the mean) of a block. membership (L x Vb) CSR
+    counts = np.diff(membership.indptr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = membership.dot(x_block) / counts[:, np.newaxis]
+    M2 = np.zeros_like(means)
+    non_empty = np.where(counts > 0)[0]
+    if len(non_empty) > 0:
+        entries_labels = np.repeat(np.arange(membership.shape[0]), counts)
+        diffs = x_block[membership.indices] - means[entries_labels]
+        M2[non_empty] = np.add.reduceat(diffs ** 2, membership.indptr[non_empty], axis=0)
+    return counts, means, M2
+
+
+def merge_welford_stats(counts_a, means_a, M2_a, counts_b, means_b, M2_b):
+    # A label with no vertices in one of the blocks (zero count, nan mean) takes the other block's stats as is
+    counts = counts_a + counts_b
+    empty_a, empty_b = (counts_a == 0)[:, np.newaxis], (counts_b == 0)[:, np.newaxis]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio_b = (counts_b / counts)[:, np.newaxis]
+        delta = means_b - means_a
+        means = means_a + delta * ratio_b
+        M2 = M2_a + M2_b + delta ** 2 * (counts_a[:, np.newaxis] * ratio_b)
+    means = np.where(empty_a, means_b, np.where(empty_b, means_a, means))
+    M2 = np.where(empty_a, M2_b, np.where(empty_b, M2_a, M2))
+    return counts, means, M2
+
+
+def calc_labels_stats(x, membership, memory_mb=DEFAULT_MEMORY_MB):
+    # The labels' means and (population) variances over their vertices, for each time point.
+    # x: (V x T), ndarray, memmap or ImageTimeSeries. membership: (L x V) binary CSR matrix.
+    # Returns (means, variances), (L x T) each, nan for empty labels
+    membership = membership.tocsr()
+    membership.sort_indices()
+    V, T = x.shape
+    L = membership.shape[0]
+    means, variances = np.zeros((L, T)), np.zeros((L, T))
+    # Time blocks of all the vertices, or vertices blocks of one time point if a time point is too big
+    time_block_len = calc_block_len(V, memory_mb)
+    vertices_block_len = V if time_block_len > 1 else max(1, int(memory_mb * 1024 ** 2) // 8)
+    vertices_blocks = [(v_from, min(v_from + vertices_block_len, V)) for v_from in range(0, V, vertices_block_len)]
+    blocks_memberships = [membership[:, v_from:v_to].tocsr() for v_from, v_to in vertices_blocks]
+    for t_from in range(0, T, time_block_len):
+        t_to = min(t_from + time_block_len, T)
+        stats = None
+        for (v_from, v_to), block_membership in zip(vertices_blocks, blocks_memberships):
+            if len(vertices_blocks) == 1:
+                x_block = np.asarray(x[:, t_from:t_to], dtype=np.float64)
+            else:
+                x_block = np.asarray(x[v_from:v_to, t_from:t_to], dtype=np.float64)
+            block_stats = _labels_block_stats(block_membership, x_block)
+            stats = block_stats if stats is None else merge_welford_stats(*stats, *block_stats)
+        counts, block_means, M2 = stats
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means[:, t_from:t_to] = np.where(counts[:, np.newaxis] > 0, block_means, np.nan)
+            variances[:, t_from:t_to] = M2 / counts[:, np.newaxis]
+    return means, variances
+
+
+def labels_rows_batches(x, labels_vertices, memory_mb=DEFAULT_MEMORY_MB):
+    # Yields (labels indices, [label data]) batches. For arrays (and memmaps) all the labels in one batch, without
+    # copying, for an ImageTimeSeries batches of labels that fit in memory_mb, each read in one pass over the image
+    if not isinstance(x, ImageTimeSeries):
+        yield list(range(len(labels_vertices))), [(x, vertices) for vertices in labels_vertices]
+        return
+    V, T = x.shape
+    max_rows = calc_block_len(T, memory_mb, x.dtype.itemsize)
+    batch = []
+    for ind, vertices in enumerate(list(labels_vertices) + [None]):
+        if vertices is not None and (len(batch) == 0 or
+                sum([len(labels_vertices[i]) for i in batch]) + len(vertices) <= max_rows):
+            batch.append(ind)
+            continue
+        if len(batch) > 0:
+            rows = np.concatenate([labels_vertices[i] for i in batch])
+            batch_data = x.read_rows(rows)
+            splits = np.cumsum([len(labels_vertices[i]) for i in batch])[:-1]
+            yield batch, [(label_data, slice(None)) for label_data in np.split(batch_data, splits)]
+        batch = [ind] if vertices is not None else []
@@ -1,7 +1,13 @@
 import os.path as op
+import threading
+import traceback
 import nibabel as nib
 import numpy as np
 
+from src.mmvt_addon.dural_surface import DuralSurface
+
+_dural_surfaces, _dural_surfaces_lock = {}, threading.Lock()
+
 
 def get_dural_surface(subject_fol, do_calc_normals=False):
     verts, faces, norms = {}, {}, {}
@@ -10,7 +16,7 @@ def get_dural_surface(subject_fol, do_calc_normals=False):
         if op.isfile(surf_fname):
             verts[hemi], faces[hemi] = nib.freesurfer.read_geometry(surf_fname)
             if do_calc_normals:
-                norms[hemi] = calc_normals(verts[hemi], faces[hemi])
+                norms[hemi] = get_surface_normals(surf_fname, verts[hemi], faces[hemi])
         else:
             # try:
             #     from src.misc.dural import create_dural
@@ -30,6 +36,41 @@ def get_dural_surface(subject_fol, do_calc_normals=False):
         return verts, faces
 
 
+def get_surface_normals(surf_fname, verts, faces):
+    # The vertices normals are cached in {surf_fname}_normals.npy, and recalculated if the surface was changed
+    normals_fname = '{}_normals.npy'.format(surf_fname)
+    if op.isfile(normals_fname) and op.getmtime(normals_fname) >= op.getmtime(surf_fname):
+        return np.load(normals_fname)
+    normals = calc_normals(verts, faces)
+    try:
+        np.save(normals_fname, normals)
+    except:
+        print(traceback.format_exc())
+        print("get_surface_normals: Can't save the normals to {}".format(normals_fname))
+    return normals
+
+
+def get_dural_surfaces(subject_fol):
+    # The (cached in memory) DuralSurface of each hemi, None if the dural surface doesn't exist
+    surf_fnames = {hemi: op.join(subject_fol, 'surf', '{}.dural'.format(hemi)) for hemi in ['rh', 'lh']}
+    if not all([op.isfile(surf_fname) for surf_fname in surf_fnames.values()]):
+        return None
+    key = tuple([(surf_fname, op.getmtime(surf_fname)) for surf_fname in surf_fnames.values()])
+    with _dural_surfaces_lock:
+        if key not in _dural_surfaces:
+            verts, _, normals = get_dural_surface(subject_fol, do_calc_normals=True)
+            _dural_surfaces[key] = {hemi: DuralSurface(verts[hemi], normals[hemi]) for hemi in ['rh', 'lh']}
+        return _dural_surfaces[key]
+
+
+def points_inside_dural(subject_fol, points, sigmas=0):
+    # {hemi: DuralSurface.points_inside}, None if the dural surface doesn't exist
+    dural_surfaces = get_dural_surfaces(subject_fol)
+    if dural_surfaces is None:
+        return None
+    return {hemi: dural_surfaces[hemi].points_inside(points, sigmas) for hemi in ['rh', 'lh']}
+
+
 def calc_normals(vertices, faces):
     # https://sites.google.com/site/dlampetest/python/calculating-normals-of-a-triangle-mesh-using-numpy
     #Create a zeroed array with the same type and shape as our vertices i.e., per vertex normal
@@ -0,0 +1,177 @@
+import os.path as op
+import hashlib
+import traceback
+import numpy as np
+import scipy.sparse
+
+from src.utils import utils
+
+# Batched labels time courses extraction from source estimates, the same as mne's extract_label_time_course.
+# For a (src, labels) pair the labels' source vertices (rows in the stc data) and their sign flips are calculated
+# once, and cached to disk. Each mode is then a reduction of the stc data over the labels' rows:
+#   mean        W_mean (labels x sources, 1 / n) @ data
+#   mean_flip   W_flip (labels x sources, flip / n) @ data
+#   max         np.maximum.reduceat over the rows groups of abs(data)
+#   pca_flip    an SVD per label, using the cached rows and flips
+# A stack of stcs (epochs) is concatenated in time and reduced with one matmul.
+
+EXTRACT_MODES = ('mean', 'mean_flip', 'max', 'pca_flip')
+CACHE_VERSION = 1
+
+
+def calc_labels_hash(labels, src):
+    md5 = hashlib.md5()
+    md5.update('v{}'.format(CACHE_VERSION).encode())
+    for s in src:
+        vertno = np.asarray(s['vertno'], dtype=np.int64)
+        md5.update(vertno.tobytes())
+        md5.update(np.asarray(s['nn'][vertno], dtype=np.float64).tobytes())
+    for label in labels:
+        md5.update('{}_{}'.format(label.name, label.hemi).encode())
+        for hemi_label in _hemis_labels(label):
+            md5.update(np.asarray(hemi_label.vertices, dtype=np.int64).tobytes())
+    return md5.hexdigest()
+
+
+def _hemis_labels(label):
+    # BiHemiLabel -> (lh, rh)
+    return [label.lh, label.rh] if label.hemi == 'both' else [label]
+
+
+def calc_labels_rows(labels, src):
+    # Returns the CSR like (rows_ptr, rows, flips): the stc rows of label i are rows[rows_ptr[i]:rows_ptr[i+1]]
+    import mne
+    vertno = [np.asarray(s['vertno']) for s in src]
+    offsets = {'lh': 0, 'rh': len(vertno[0])}
+    hemi_inds = {'lh': 0, 'rh': 1}
+    rows_ptr, rows, flips = [0], [], []
+    for label in labels:
+        label_rows = []
+        for hemi_label in _hemis_labels(label):
+            hemi_vertno = vertno[hemi_inds[hemi_label.hemi]]
+            label_vertices = np.intersect1d(hemi_vertno, hemi_label.vertices)
+            label_rows.append(offsets[hemi_label.hemi] + np.searchsorted(hemi_vertno, label_vertices))
+        label_rows = np.concatenate(label_rows)
+        rows.append(label_rows)
+        flips.append(mne.label_sign_flip(label, src) if len(label_rows) > 0 else np.zeros(0))
+        rows_ptr.append(rows_ptr[-1] + len(label_rows))
+    return np.array(rows_ptr, dtype=np.int64), np.concatenate(rows).astype(np.int64), \
+           np.concatenate(flips).astype(np.float64)
+
+
+class LabelsExtractor(object):
+    def __init__(self, labels, src, cache_fol='', overwrite=False):
+        self.labels_names = [label.name for label in labels]
+        self.sources_num = sum([len(s['vertno']) for s in src])
+        self.vertno = [np.asarray(s['vertno']) for s in src]
+        cache_fname = ''
+        if cache_fol != '':
+            labels_hash = calc_labels_hash(labels, src)
+            cache_fname = op.join(utils.make_dir(cache_fol), 'labels_extraction_{}.npz'.format(labels_hash))
+        if op.isfile(cache_fname) and not overwrite:
+            d = np.load(cache_fname)
+            self.rows_ptr, self.rows, self.flips = d['rows_ptr'], d['rows'], d['flips']
+        else:
+            self.rows_ptr, self.rows, self.flips = calc_labels_rows(labels, src)
+            if cache_fname != '':
+                np.savez(cache_fname, rows_ptr=self.rows_ptr, rows=self.rows, flips=self.flips)
+        self.labels_sizes = np.diff(self.rows_ptr)
+        self._weights = {}
+
+    @property
+    def labels_num(self):
+        return len(self.labels_sizes)
+
+    def get_weights(self, mode):
+        # The sparse (labels x sources) matrix of the mean / mean_flip modes
+        if mode not in self._weights:
+            sizes = np.repeat(self.labels_sizes, self.labels_sizes).astype(np.float64)
+            values = 1.0 / sizes if mode == 'mean' else self.flips / sizes
+            self._weights[mode] = scipy.sparse.csr_matrix(
+                (values, self.rows, self.rows_ptr), shape=(self.labels_num, self.sources_num))
+        return self._weights[mode]
+
+    def stc_rows(self, vertices):
+        # The sources indices of the stc's rows, or None if the stc has all the sources in the src order
+        if all([len(v) == len(vno) and np.array_equal(v, vno) for v, vno in zip(vertices, self.vertno)]):
+            return None
+        return np.concatenate([np.searchsorted(self.vertno[0], vertices[0]),
+                               len(self.vertno[0]) + np.searchsorted(self.vertno[1], vertices[1])])
+
+    def extract(self, data, mode='mean_flip', vertices=None, labels_inds=None):
+        # data: stc or the stc's data (sources x T). The stc can have only a subset of the sources (like when
+        # applying the inverse on a label), as long as it has all the sources of the extracted labels.
+        # Returns a (labels x T) array, zeros for the empty labels
+        if mode not in EXTRACT_MODES:
+            raise Exception('LabelsExtractor: mode should be one of {}'.format(EXTRACT_MODES))
+        if hasattr(data, 'vertices'):
+            data, vertices = data.data, data.vertices
+        data = data.reshape((-1, 1)) if data.ndim == 1 else data
+        stc_rows = None if vertices is None else self.stc_rows(vertices)
+        labels_inds = np.arange(self.labels_num) if labels_inds is None else np.asarray(labels_inds)
+        if mode in ('mean', 'mean_flip'):
+            weights = self.get_weights(mode)[labels_inds]
+            if stc_rows is not None:
+                weights = weights[:, stc_rows]
+            return np.asarray(weights.dot(data))
+        groups = self._labels_groups(labels_inds, stc_rows)
+        if mode == 'max':
+            return self._extract_max(data, groups)
+        else:
+            return self._extract_pca_flip(data, groups)
+
+    def extract_stcs(self, stcs, mode='mean_flip'):
+        # Extracts the labels time courses of a list (epochs) of stcs with one reduction.
+        # Returns a (stcs x labels x T) array
+        stcs = list(stcs)
+        if len(stcs) == 0:
+            return np.zeros((0, self.labels_num, 0))
+        T = stcs[0].data.shape[1]
+        data = np.hstack([stc.data for stc in stcs])
+        labels_data = self.extract(data, mode, stcs[0].vertices)
+        return labels_data.reshape((self.labels_num, len(stcs), T)).transpose((1, 0, 2))
+
+    def _labels_groups(self, labels_inds, stc_rows=None):
+        # For each label, (data rows, flips). With stc_rows, only the label's sources that are in the stc
+        sources_to_stc = None
+        if stc_rows is not None:
+            sources_to_stc = np.full(self.sources_num, -1, dtype=np.int64)
+            sources_to_stc[stc_rows] = np.arange(len(stc_rows))
+        groups = []
+        for label_ind in labels_inds:
+            rows = self.rows[self.rows_ptr[label_ind]:self.rows_ptr[label_ind + 1]]
+            flips = self.flips[self.rows_ptr[label_ind]:self.rows_ptr[label_ind + 1]]
+            if sources_to_stc is not None:
+                rows = sources_to_stc[rows]
+                flips = flips[rows >= 0]
+                rows = rows[rows >= 0]
+            groups.append((rows, flips))
+        return groups
+
+    @staticmethod
+    def _extract_max(data, groups):
+        sizes = np.array([len(rows) for rows, _ in groups])
+        labels_data = np.zeros((len(groups), data.shape[1]))
+        non_empty = np.where(sizes > 0)[0]
+        if len(non_empty) == 0:
+            return labels_data
+        rows = np.concatenate([groups[ind][0] for ind in non_empty])
+        starts = np.concatenate(([0], np.cumsum(sizes[non_empty])[:-1]))
+        labels_data[non_empty] = np.maximum.reduceat(np.abs(data[rows]), starts, axis=0)
+        return labels_data
+
+    @staticmethod
+    def _extract_pca_flip(data, groups):
+        labels_data = np.zeros((len(groups), data.shape[1]))
+        for ind, (rows, flips) in enumerate(groups):
+            if len(rows) == 0:
+                continue
+            try:
+                U, s, V = np.linalg.svd(data[rows], full_matrices=False)
+                sign = np.sign(np.dot(U[:, 0], flips))
+                scale = np.linalg.norm(s) / np.sqrt(len(rows))
+                labels_data[ind] = sign * scale * V[0]
+            except:
+                print(traceback.format_exc())
+                print('LabelsExtractor: Error in the pca_flip of label {}'.format(ind))
+        return labels_data
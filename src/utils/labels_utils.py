@@ -6,10 +6,12 @@ import os
 import shutil
 import glob
 import traceback
+import hashlib
 from collections import defaultdict
 import functools
 
 from src.mmvt_addon import mmvt_utils as mu
+from src.utils import fmri_streaming_utils as fsu
 read_labels_from_annots = mu.read_labels_from_annots
 read_labels_from_annot = mu.read_labels_from_annot
 Label = mu.Label
@@ -271,13 +273,131 @@ def create_vertices_labels_lookup(subject, atlas, save_labels_ids=False, overwri
         raise Exception('Error in vertices_labels_lookup!\n{}'.format(err))
 
 
+class VerticesLabelsIndex(object):
+    # The labels ids of a hemi's vertices (-1 for vertices without a label) and the labels names table.
+    # If a vertex is in more than one label, the last one wins (like in the vertices labels lookup dict)
+    def __init__(self, labels_ids, labels_names):
+        self.labels_ids = labels_ids
+        self.labels_names = np.asarray(labels_names)
+        self._names_with_empty = np.concatenate((self.labels_names, [''])) if len(labels_names) > 0 else \
+            np.array([''])
+        self._order, self._offsets = None, None
+
+    def __len__(self):
+        return len(self.labels_ids)
+
+    @property
+    def labels_num(self):
+        return len(self.labels_names)
+
+    def label_id(self, label_name):
+        inds = np.where(self.labels_names == label_name)[0]
+        return inds[0] if len(inds) > 0 else -1
+
+    def vertices_labels_ids(self, vertices):
+        # -1 for vertices without a label, or out of range
+        vertices = np.asarray(vertices, dtype=np.int64)
+        ids = np.full(vertices.shape, -1, dtype=np.int64)
+        in_range = (vertices >= 0) & (vertices < len(self.labels_ids))
+        ids[in_range] = self.labels_ids[vertices[in_range]]
+        return ids
+
+    def vertices_labels(self, vertices):
+        # The labels names of the vertices, '' for vertices without a label
+        return self._names_with_empty[self.vertices_labels_ids(vertices)]
+
+    def label_vertices(self, label):
+        # label: name or id
+        label_id = self.label_id(label) if isinstance(label, str) else label
+        if label_id < 0:
+            return np.zeros(0, dtype=np.int64)
+        self._calc_order()
+        return self._order[self._offsets[label_id + 1]:self._offsets[label_id + 2]]
+
+    def labels_vertices(self):
+        # {label name: vertices}, only the labels with vertices
+        self._calc_order()
+        return {name: self.label_vertices(label_id) for label_id, name in enumerate(self.labels_names)
+                if self._offsets[label_id + 2] > self._offsets[label_id + 1]}
+
+    def _calc_order(self):
+        # The vertices sorted by their labels ids. The vertices of label i are order[offsets[i+1]:offsets[i+2]]
+        if self._order is None:
+            ids = np.asarray(self.labels_ids, dtype=np.int64)
+            self._order = np.argsort(ids, kind='mergesort')
+            self._offsets = np.concatenate(([0], np.cumsum(np.bincount(ids + 1, minlength=self.labels_num + 1))))
+
+
+def calc_vertices_labels_ids(labels, vertices_num):
+    dtype = np.int16 if len(labels) < np.iinfo(np.int16).max else np.int32
+    labels_ids = np.full(vertices_num, -1, dtype=dtype)
+    for label_id, label in enumerate(labels):
+        vertices = np.asarray(label.vertices, dtype=np.int64)
+        labels_ids[vertices[vertices < vertices_num]] = label_id
+    return labels_ids
+
+
+def get_vertices_labels_index_fnames(subject, atlas):
+    return op.join(MMVT_DIR, subject, '{}_vertices_labels_ids_{}.npy'.format(atlas, '{hemi}')), \
+           op.join(MMVT_DIR, subject, '{}_vertices_labels_names_{}.npy'.format(atlas, '{hemi}'))
+
+
+def get_vertices_labels_index_sources(subject, atlas, hemi, read_labels_from_fol=''):
+    # The files the hemi's index is calculated from: the annotation, the labels folder (and its files) and the pial
+    labels_fol = read_labels_from_fol if read_labels_from_fol != '' else \
+        op.join(SUBJECTS_DIR, subject, 'label', atlas)
+    fnames = [op.join(SUBJECTS_DIR, subject, 'label', '{}.{}.annot'.format(hemi, atlas)), labels_fol,
+              op.join(MMVT_DIR, subject, 'surf', '{}.pial.ply'.format(hemi))] + \
+             glob.glob(op.join(labels_fol, '*.label'))
+    return [fname for fname in fnames if op.exists(fname)]
+
+
+def is_vertices_labels_index_ok(labels_ids, index_fnames, sources_fnames, vertices_num):
+    # Like check_loopup_is_ok: all the vertices are in the index, and not all of them are unknown. The index
+    # should also be newer than the files it was calculated from
+    index_mtime = min([op.getmtime(fname) for fname in index_fnames])
+    return len(labels_ids) == vertices_num and np.any(labels_ids >= 0) and \
+           all([op.getmtime(fname) <= index_mtime for fname in sources_fnames])
+
+
+def create_vertices_labels_index(subject, atlas, overwrite=False, read_labels_from_fol='', mmap_mode='r'):
+    # Returns {hemi: VerticesLabelsIndex}. The labels ids are saved (memory-mappable) per atlas in the subject's
+    # folder, in the order of read_labels. A saved index is recalculated if it doesn't match the pial, or if it's
+    # older than the pial, the annotation or the labels files
+    ids_fname, names_fname = get_vertices_labels_index_fnames(subject, atlas)
+    index = {}
+    for hemi in utils.HEMIS:
+        verts, _ = utils.read_pial(subject, MMVT_DIR, hemi)
+        index_fnames = [ids_fname.format(hemi=hemi), names_fname.format(hemi=hemi)]
+        if all([op.isfile(fname) for fname in index_fnames]) and not overwrite:
+            labels_ids = np.load(index_fnames[0], mmap_mode=mmap_mode)
+            sources_fnames = get_vertices_labels_index_sources(subject, atlas, hemi, read_labels_from_fol)
+            if is_vertices_labels_index_ok(labels_ids, index_fnames, sources_fnames, len(verts)):
+                index[hemi] = VerticesLabelsIndex(labels_ids, np.load(index_fnames[1]))
+                continue
+            print('The {} {} vertices labels index is out of date, recalculating'.format(atlas, hemi))
+            del labels_ids
+        if read_labels_from_fol != '':
+            labels = read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi, try_first_from_annotation=False,
+                                 labels_fol=read_labels_from_fol)
+        else:
+            labels = read_labels(subject, SUBJECTS_DIR, atlas, hemi=hemi)
+        if len(labels) == 0:
+            raise Exception("Can't read labels from {} {}".format(subject, atlas))
+        labels_ids = calc_vertices_labels_ids(labels, len(verts))
+        labels_names = np.array([l.name for l in labels])
+        np.save(index_fnames[0], labels_ids)
+        np.save(index_fnames[1], labels_names)
+        index[hemi] = VerticesLabelsIndex(labels_ids, labels_names)
+    return index
+
+
 def find_label_vertices(subject, atlas, hemi, vertices, label_template='*'):
     import re
-    vertices_labels_lookup = create_vertices_labels_lookup(subject, atlas)
+    vertices_labels = create_vertices_labels_index(subject, atlas)[hemi].vertices_labels(vertices)
     label_re_template = re.compile(label_template) if label_template != '*' else None
     label_vertices, label_vertices_indices = [], []
-    for vert_ind, vert in enumerate(vertices):
-        vert_label = vertices_labels_lookup[hemi].get(vert, '')
+    for vert_ind, (vert, vert_label) in enumerate(zip(vertices, vertices_labels)):
         if vert_label == '':
             print('find_pick_activity: No label for vert {}'.format(vert))
             continue
@@ -289,18 +409,16 @@ def find_label_vertices(subject, atlas, hemi, vertices, label_template='*'):
 
 def save_labels_from_vertices_lookup(subject, atlas, subjects_dir, mmvt_dir, surf_type='pial', read_labels_from_fol='',
                                      overwrite_vertices_labels_lookup=False, n_jobs=6):
-    lookup = create_vertices_labels_lookup(
+    index = create_vertices_labels_index(
         subject, atlas, read_labels_from_fol=read_labels_from_fol, overwrite=overwrite_vertices_labels_lookup)
     labels_fol = op.join(subjects_dir, subject, 'label', atlas)
     surf = utils.load_surf(subject, mmvt_dir, subjects_dir)
     utils.delete_folder_files(labels_fol)
     ok = True
     for hemi in utils.HEMIS:
-        labels_vertices = defaultdict(list)
         # surf_fname = op.join(subjects_dir, subject, 'surf', '{}.{}'.format(hemi, surf_type))
         # surf, _ = mne.surface.read_surface(surf_fname)
-        for vertice, label in lookup[hemi].items():
-            labels_vertices[label].append(vertice)
+        labels_vertices = index[hemi].labels_vertices()
         chunks_indices = np.array_split(np.arange(len(labels_vertices)), n_jobs)
         labels_vertices_items = list(labels_vertices.items())
         chunks = [([labels_vertices_items[ind] for ind in chunk_indices], subject, labels_vertices, surf, hemi,
@@ -691,57 +809,127 @@ def remove_exclude_labels_and_data(labels_names, labels_data, excludes=()):
     return labels_names, labels_data
 
 
-def calc_time_series_per_label(x, labels, measure, excludes=(),
-                               figures_dir='', do_plot=False, do_plot_all_vertices=False):
-    import sklearn.decomposition as deco
+def calc_labels_membership(labels, vertices_num):
+    # The (labels x vertices) binary CSR matrix, row i is the vertices of labels[i]
+    import scipy.sparse
+    labels_vertices = [np.asarray(label.vertices, dtype=np.int64) for label in labels]
+    indptr = np.cumsum([0] + [len(vertices) for vertices in labels_vertices])
+    indices = np.concatenate(labels_vertices) if len(labels_vertices) > 0 else np.zeros(0, dtype=np.int64)
+    return scipy.sparse.csr_matrix(
+        (np.ones(len(indices)), indices, indptr), shape=(len(labels_vertices), vertices_num))
+
+
+def calc_labels_vertices_hash(labels):
+    # The md5 of the labels' vertices, in their order
+    md5 = hashlib.md5()
+    for label in labels:
+        md5.update(np.asarray(label.vertices, dtype=np.int64).tobytes())
+        md5.update(b'|')
+    return md5.hexdigest()
+
+
+def get_labels_membership(subject, atlas, hemi, labels, vertices_num, overwrite=False):
+    # The labels membership matrix, cached in the subject's folder. The cache is recalculated if the labels
+    # (names or vertices) or the number of vertices were changed
+    import scipy.sparse
+    output_fname = op.join(MMVT_DIR, subject, '{}_labels_membership_{}.npz'.format(atlas, hemi))
+    labels_names = [label.name for label in labels]
+    vertices_hash = calc_labels_vertices_hash(labels)
+    if op.isfile(output_fname) and not overwrite:
+        d = np.load(output_fname)
+        if 'vertices_hash' in d and str(d['vertices_hash']) == vertices_hash and \
+                int(d['vertices_num']) == vertices_num and list(d['names']) == labels_names:
+            return scipy.sparse.csr_matrix(
+                (np.ones(len(d['indices'])), d['indices'], d['indptr']), shape=(len(labels), vertices_num))
+    membership = calc_labels_membership(labels, vertices_num)
+    utils.make_dir(op.join(MMVT_DIR, subject))
+    np.savez(output_fname, indptr=membership.indptr, indices=membership.indices, names=labels_names,
+             vertices_num=vertices_num, vertices_hash=vertices_hash)
+    return membership
+
+
+def calc_time_series_per_labels(x, labels, measures, excludes=(), figures_dir='', do_plot=False,
+                                do_plot_all_vertices=False, membership=None, n_jobs=1, chunk_mb=256):
+    # Calculates the labels time series of all the measures in one pass over x (vertices x 1 x 1 x T, or
+    # vertices x T), which can be a memmap or an ImageTimeSeries (fmri_streaming_utils.py). 'mean' and 'cv' are
+    # calculated with streaming statistics over blocks of x (up to chunk_mb), the pca measures in a threads
+    # pool over the labels.
+    # Returns {measure: (labels_data, labels_names)}
+    from multiprocessing.pool import ThreadPool
     import matplotlib.pyplot as plt
 
-    labels, _ = remove_exclude_labels(labels, excludes)
-    if measure.startswith('pca'):
-        comps_num = 1 if '_' not in measure else int(measure.split('_')[1])
-        labels_data = np.zeros((len(labels), x.shape[-1], comps_num))
+    if len(excludes) > 0:
+        labels, labels_indices = remove_exclude_labels(labels, excludes)
+    else:
+        labels_indices = list(range(len(labels)))
+    x = x[:, 0, 0, :] if x.ndim == 4 else x
+    V, T = x.shape
+    if membership is None:
+        membership = calc_labels_membership(labels, V)
     else:
-        labels_data = np.zeros((len(labels), x.shape[-1]))
-    labels_names = []
+        membership = membership[labels_indices]
+    labels_names = [label.name for label in labels]
+    labels_data = {}
+
+    if 'mean' in measures or 'cv' in measures:
+        labels_mean, labels_var = fsu.calc_labels_stats(x, membership, chunk_mb)
+        if 'mean' in measures:
+            labels_data['mean'] = labels_mean
+        if 'cv' in measures:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                labels_data['cv'] = np.sqrt(labels_var) / labels_mean
+
+    for measure in [m for m in measures if m.startswith('pca')]:
+        comps_num = 1 if '_' not in measure else int(measure.split('_')[1])
+        labels_data[measure] = np.zeros((len(labels), T, comps_num))
+        # For images that are read in blocks, the labels' data is read in batches that fit in chunk_mb
+        for labels_inds, labels_x in fsu.labels_rows_batches(x, [label.vertices for label in labels], chunk_mb):
+            params = [(label_x, vertices, comps_num) for label_x, vertices in labels_x]
+            pool = ThreadPool(max(n_jobs, 1))
+            results = pool.map(_calc_label_pca, params)
+            pool.close()
+            for ind, label_pca in zip(labels_inds, results):
+                labels_data[measure][ind] = label_pca
+
     if do_plot_all_vertices:
         all_vertices_plots_dir = op.join(figures_dir, 'all_vertices')
         utils.make_dir(all_vertices_plots_dir)
-    if do_plot:
-        measure_plots_dir = op.join(figures_dir, measure)
-        utils.make_dir(measure_plots_dir)
-    for ind, label in enumerate(labels):
-        if measure == 'mean':
-            labels_data[ind, :] = np.mean(x[label.vertices, 0, 0, :], 0)
-        elif measure.startswith('pca'):
-            print(label)
-            _x = x[label.vertices, 0, 0, :].T
-            remove_cols = np.where(np.all(_x == np.mean(_x, 0), 0))[0]
-            _x = np.delete(_x, remove_cols, 1)
-            _x = (_x - np.mean(_x, 0)) / np.std(_x, 0)
-            comps = 1 if '_' not in measure else int(measure.split('_')[1])
-            pca = deco.PCA(comps)
-            x_r = pca.fit(_x).transform(_x)
-            # if x_r.shape[1] == 1:
-            labels_data[ind, :] = x_r
-            # else:
-            #     labels_data[ind, :] = x_r
-        elif measure == 'cv': #''coef_of_variation':
-            label_mean = np.mean(x[label.vertices, 0, 0, :], 0)
-            label_std = np.std(x[label.vertices, 0, 0, :], 0)
-            labels_data[ind, :] = label_std / label_mean
-        labels_names.append(label.name)
-        if do_plot_all_vertices:
+        for label in labels:
             plt.figure()
-            plt.plot(x[label.vertices, 0, 0, :].T)
+            plt.plot(x[label.vertices, :].T)
             plt.savefig(op.join(all_vertices_plots_dir, '{}.jpg'.format(label.name)))
             plt.close()
-        if do_plot:
-            plt.figure()
-            plt.plot(labels_data[ind, :])
-            plt.savefig(op.join(measure_plots_dir, '{}_{}.jpg'.format(measure, label.name)))
-            plt.close()
+    if do_plot:
+        for measure in measures:
+            measure_plots_dir = op.join(figures_dir, measure)
+            utils.make_dir(measure_plots_dir)
+            for ind, label in enumerate(labels):
+                plt.figure()
+                plt.plot(labels_data[measure][ind, :])
+                plt.savefig(op.join(measure_plots_dir, '{}_{}.jpg'.format(measure, label.name)))
+                plt.close()
+
+    return {measure: (labels_data[measure], labels_names) for measure in measures if measure in labels_data}
 
-    return labels_data, labels_names
+
+def _calc_label_pca(p):
+    import sklearn.decomposition as deco
+    x, vertices, comps_num = p
+    _x = np.asarray(x[vertices, :]).T
+    remove_cols = np.where(np.all(_x == np.mean(_x, 0), 0))[0]
+    _x = np.delete(_x, remove_cols, 1)
+    _x = (_x - np.mean(_x, 0)) / np.std(_x, 0)
+    pca = deco.PCA(comps_num)
+    return pca.fit(_x).transform(_x)
+
+
+def calc_time_series_per_label(x, labels, measure, excludes=(),
+                               figures_dir='', do_plot=False, do_plot_all_vertices=False):
+    labels_data = calc_time_series_per_labels(
+        x, labels, [measure], excludes, figures_dir, do_plot, do_plot_all_vertices)
+    if measure not in labels_data:
+        raise Exception('calc_time_series_per_label: Unknown measure {}'.format(measure))
+    return labels_data[measure]
 
 
 def morph_labels(morph_from_subject, morph_to_subject, atlas, hemi, n_jobs=1):
@@ -0,0 +1,151 @@
+import os.path as op
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse
+
+from src.utils import utils
+
+# Morphing (and smoothing) of source estimates between subjects, with cached morph operators.
+# The operator (a sparse (vertices_to x vertices_from) matrix) depends only on the subjects, the grade, the
+# smoothing and the source vertices, so it's calculated once and cached:
+#   {cache_fol}/morph_{from}_to_{to}_{grade}_{smooth}_{vertices_hash}.npz    the operator and the vertices_to
+#   an in-process LRU of the last MORPH_CACHE_SIZE operators
+# Morphing an stc is then one sparse matmul, like mne.morph_data_precomputed, and a batch of stcs with the same
+# source vertices is morphed with one sparse matmul of their stacked data.
+
+MORPH_CACHE_SIZE = 8
+MORPH_BATCH_MB = 512
+
+_morph_operators, _morph_operators_lock = OrderedDict(), threading.Lock()
+
+
+def calc_vertices_hash(vertices):
+    md5 = hashlib.md5()
+    for hemi_vertices in vertices:
+        hemi_vertices = np.ascontiguousarray(hemi_vertices, dtype=np.int64)
+        md5.update(hemi_vertices.tobytes() + str(hemi_vertices.shape).encode())
+    return md5.hexdigest()
+
+
+def get_grade_name(grade):
+    # grade: int, None (all the vertices) or the vertices_to list
+    if grade is None or isinstance(grade, int):
+        return str(grade)
+    return calc_vertices_hash(grade)[:8]
+
+
+def get_morph_operator_fname(cache_fol, from_subject, to_subject, vertices_from, grade=5, smooth=None):
+    return op.join(cache_fol, 'morph_{}_to_{}_{}_{}_{}.npz'.format(
+        from_subject, to_subject, get_grade_name(grade), smooth, calc_vertices_hash(vertices_from)))
+
+
+def compute_morph_operator(from_subject, to_subject, vertices_from, grade=5, smooth=None, subjects_dir=None,
+                           n_jobs=1):
+    # The same operator as mne.morph_data's (mne < 0.17) or mne.compute_source_morph's
+    import mne
+    if hasattr(mne, 'compute_morph_matrix'):
+        if grade is None or isinstance(grade, int):
+            vertices_to = mne.grade_to_vertices(to_subject, grade, subjects_dir=subjects_dir, n_jobs=n_jobs)
+        else:
+            vertices_to = grade
+        morph_mat = mne.compute_morph_matrix(
+            from_subject, to_subject, vertices_from, vertices_to, smooth, subjects_dir)
+    else:
+        stc_from = mne.SourceEstimate(
+            np.zeros((sum(len(v) for v in vertices_from), 1)), vertices_from, 0, 1, subject=from_subject)
+        morph = mne.compute_source_morph(
+            stc_from, from_subject, to_subject, spacing=grade, smooth=smooth, subjects_dir=subjects_dir)
+        morph_mat, vertices_to = morph.morph_mat, morph.vertices_to
+    return scipy.sparse.csr_matrix(morph_mat), [np.asarray(v) for v in vertices_to]
+
+
+def save_morph_operator(fname, morph_mat, vertices_to):
+    morph_mat = morph_mat.tocsr()
+    np.savez(fname, data=morph_mat.data, indices=morph_mat.indices, indptr=morph_mat.indptr,
+             shape=morph_mat.shape, lh_vertices_to=vertices_to[0], rh_vertices_to=vertices_to[1])
+
+
+def load_morph_operator(fname):
+    d = np.load(fname)
+    morph_mat = scipy.sparse.csr_matrix((d['data'], d['indices'], d['indptr']), shape=tuple(d['shape']))
+    return morph_mat, [d['lh_vertices_to'], d['rh_vertices_to']]
+
+
+def get_morph_operator(from_subject, to_subject, vertices_from, grade=5, smooth=None, subjects_dir=None,
+                       cache_fol='', n_jobs=1):
+    # Returns (morph_mat, vertices_to), from the in-process LRU, the cache folder, or calculates (and caches) it
+    key = (from_subject, to_subject, get_grade_name(grade), smooth, calc_vertices_hash(vertices_from),
+           subjects_dir)
+    with _morph_operators_lock:
+        if key in _morph_operators:
+            _morph_operators.move_to_end(key)
+            return _morph_operators[key]
+    fname = get_morph_operator_fname(cache_fol, from_subject, to_subject, vertices_from, grade, smooth) \
+        if cache_fol != '' else ''
+    operator = None
+    if fname != '' and op.isfile(fname):
+        try:
+            operator = load_morph_operator(fname)
+        except:
+            print(traceback.format_exc())
+            print('get_morph_operator: Error in reading {}, recalculating'.format(fname))
+    if operator is None:
+        operator = compute_morph_operator(
+            from_subject, to_subject, vertices_from, grade, smooth, subjects_dir, n_jobs)
+        if fname != '':
+            utils.make_dir(cache_fol)
+            save_morph_operator(fname, *operator)
+    with _morph_operators_lock:
+        _morph_operators[key] = operator
+        while len(_morph_operators) > MORPH_CACHE_SIZE:
+            _morph_operators.popitem(last=False)
+    return operator
+
+
+def clear_morph_operators():
+    with _morph_operators_lock:
+        _morph_operators.clear()
+
+
+def morph_stcs(stcs, from_subject, to_subject, grade=5, smooth=None, subjects_dir=None, cache_fol='', n_jobs=1):
+    # Morphs a list of stcs with one sparse matmul per group of stcs with the same source vertices
+    import mne
+    stcs_morphed = [None] * len(stcs)
+    groups = OrderedDict()
+    for ind, stc in enumerate(stcs):
+        groups.setdefault(calc_vertices_hash(stc.vertices), []).append(ind)
+    for inds in groups.values():
+        morph_mat, vertices_to = get_morph_operator(
+            from_subject, to_subject, stcs[inds[0]].vertices, grade, smooth, subjects_dir, cache_fol, n_jobs)
+        data = morph_mat.dot(np.hstack([stcs[ind].data for ind in inds]))
+        splits = np.cumsum([stcs[ind].data.shape[1] for ind in inds])[:-1]
+        for ind, stc_data in zip(inds, np.split(data, splits, axis=1)):
+            stcs_morphed[ind] = mne.SourceEstimate(
+                stc_data, vertices_to, stcs[ind].tmin, stcs[ind].tstep, subject=to_subject)
+    return stcs_morphed
+
+
+def morph_stc(stc, from_subject, to_subject, grade=5, smooth=None, subjects_dir=None, cache_fol='', n_jobs=1):
+    return morph_stcs([stc], from_subject, to_subject, grade, smooth, subjects_dir, cache_fol, n_jobs)[0]
+
+
+def morph_stcs_files(stcs_fnames, output_fnames, from_subject, to_subject, grade=5, smooth=None,
+                     subjects_dir=None, cache_fol='', ftype='stc', batch_mb=MORPH_BATCH_MB, n_jobs=1):
+    # Reads, morphs (in batches of up to batch_mb of data) and saves the stcs files
+    import mne
+    batch_stcs, batch_fnames, batch_size = [], [], 0
+    for ind, (stc_fname, output_fname) in enumerate(zip(stcs_fnames, output_fnames)):
+        stc = mne.read_source_estimate(stc_fname)
+        batch_stcs.append(stc)
+        batch_fnames.append(output_fname)
+        batch_size += stc.data.nbytes
+        if batch_size >= batch_mb * 1024 ** 2 or ind == len(stcs_fnames) - 1:
+            stcs_morphed = morph_stcs(
+                batch_stcs, from_subject, to_subject, grade, smooth, subjects_dir, cache_fol, n_jobs)
+            for stc_morphed, fname in zip(stcs_morphed, batch_fnames):
+                stc_morphed.save(fname, ftype=ftype)
+            print('{} stcs were morphed from {} to {}'.format(len(batch_stcs), from_subject, to_subject))
+            batch_stcs, batch_fnames, batch_size = [], [], 0
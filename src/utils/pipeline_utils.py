@@ -0,0 +1,162 @@
+import os
+import os.path as op
+import time
+import json
+import hashlib
+import threading
+import traceback
+import numpy as np
+
+# A dependency-aware pipeline of steps, where each step declares its inputs (files), params and outputs (files).
+# A step runs only if its key, the hash of its name, params and the content of its inputs, is different from the
+# key it was last run with (saved in {cache_fol}/{step}.json), or if one of its outputs is missing. The steps that
+# don't depend on each other (ready at the same time) run in parallel, in a threads pool.
+# The files content hashes are cached in {cache_fol}/files_hashes.json by their (size, mtime), such that big
+# files are read only after they change. Every run writes {cache_fol}/pipeline_report.csv (step, status, time).
+
+STEP_RUN, STEP_CACHED, STEP_FAILED, STEP_BLOCKED = 'run', 'cached', 'failed', 'blocked'
+HASH_CHUNK_MB = 16
+
+
+class FilesHashes(object):
+    def __init__(self, fname=''):
+        self.fname = fname
+        self.hashes = {}
+        self.lock = threading.Lock()
+        if fname != '' and op.isfile(fname):
+            try:
+                with open(fname, 'r') as f:
+                    self.hashes = json.load(f)
+            except:
+                print(traceback.format_exc())
+                print('FilesHashes: Error in reading {}'.format(fname))
+
+    def get(self, fname):
+        if not op.isfile(fname):
+            return 'missing'
+        stat = os.stat(fname)
+        file_id = [stat.st_size, stat.st_mtime_ns]
+        with self.lock:
+            if fname in self.hashes and self.hashes[fname][:2] == file_id:
+                return self.hashes[fname][2]
+        md5 = hashlib.md5()
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_MB * 1024 ** 2), b''):
+                md5.update(chunk)
+        with self.lock:
+            self.hashes[fname] = file_id + [md5.hexdigest()]
+        return md5.hexdigest()
+
+    def save(self):
+        if self.fname != '':
+            with self.lock:
+                with open(self.fname, 'w') as f:
+                    json.dump(self.hashes, f)
+
+
+def calc_params_hash(params):
+    # The params are hashed by their sorted repr, numpy arrays by their content
+    def to_str(x):
+        if isinstance(x, dict):
+            return '{' + ','.join('{}:{}'.format(k, to_str(x[k])) for k in sorted(x.keys(), key=str)) + '}'
+        if isinstance(x, (list, tuple)):
+            return '[' + ','.join(to_str(v) for v in x) + ']'
+        if isinstance(x, np.ndarray):
+            return hashlib.md5(np.ascontiguousarray(x).tobytes()).hexdigest()
+        return repr(x)
+    return hashlib.md5(to_str(params).encode()).hexdigest()
+
+
+class PipelineStep(object):
+    def __init__(self, name, func, inputs=(), outputs=(), params=None, deps=()):
+        # func() -> bool, called only when the step has to run, so it should overwrite its outputs
+        self.name, self.func = name, func
+        self.inputs, self.outputs = list(inputs), list(outputs)
+        self.params = {} if params is None else params
+        self.deps = list(deps)
+
+
+class Pipeline(object):
+    def __init__(self, cache_fol, n_jobs=1):
+        self.cache_fol = cache_fol
+        if not op.isdir(cache_fol):
+            os.makedirs(cache_fol)
+        self.n_jobs = n_jobs
+        self.steps = []
+        self.files_hashes = FilesHashes(op.join(cache_fol, 'files_hashes.json'))
+        self.report = []
+
+    def add_step(self, name, func, inputs=(), outputs=(), params=None, deps=()):
+        self.steps.append(PipelineStep(name, func, inputs, outputs, params, deps))
+        return name
+
+    def calc_step_key(self, step):
+        inputs_hashes = [(fname, self.files_hashes.get(fname)) for fname in step.inputs]
+        return calc_params_hash(dict(name=step.name, params=step.params, inputs=inputs_hashes))
+
+    def get_manifest_fname(self, step):
+        return op.join(self.cache_fol, '{}.json'.format(step.name))
+
+    def is_cached(self, step, key):
+        manifest_fname = self.get_manifest_fname(step)
+        if not op.isfile(manifest_fname) or not all(op.isfile(fname) for fname in step.outputs):
+            return False
+        try:
+            with open(manifest_fname, 'r') as f:
+                return json.load(f)['key'] == key
+        except:
+            return False
+
+    def run_step(self, step, force=False):
+        now = time.time()
+        try:
+            key = self.calc_step_key(step)
+            if not force and self.is_cached(step, key):
+                print('Pipeline: {} is up to date'.format(step.name))
+                return STEP_CACHED, time.time() - now
+            print('Pipeline: running {}'.format(step.name))
+            ret = step.func()
+            if ret and all(op.isfile(fname) for fname in step.outputs):
+                with open(self.get_manifest_fname(step), 'w') as f:
+                    json.dump(dict(key=self.calc_step_key(step), time=time.time(), outputs=step.outputs), f)
+                return STEP_RUN, time.time() - now
+            print('Pipeline: {} failed, or not all its outputs were created'.format(step.name))
+        except:
+            print(traceback.format_exc())
+            print('Pipeline: Error in {}'.format(step.name))
+        return STEP_FAILED, time.time() - now
+
+    def run(self, force=False):
+        # Returns {step name: True if it ran or was cached}
+        from multiprocessing.pool import ThreadPool
+        statuses, self.report = {}, []
+        pending = list(self.steps)
+        while len(pending) > 0:
+            blocked = [s for s in pending if any(statuses.get(d) in (STEP_FAILED, STEP_BLOCKED) for d in s.deps)]
+            for step in blocked:
+                statuses[step.name] = STEP_BLOCKED
+                self.report.append((step.name, STEP_BLOCKED, 0))
+            ready = [s for s in pending if s not in blocked and all(d in statuses for d in s.deps)]
+            if len(ready) == 0 and len(blocked) == 0:
+                raise Exception('Pipeline: Unknown or circular dependencies in {}'.format([s.name for s in pending]))
+            pool = ThreadPool(max(min(self.n_jobs, len(ready)), 1))
+            results = pool.map(lambda s: self.run_step(s, force), ready)
+            pool.close()
+            for step, (status, run_time) in zip(ready, results):
+                statuses[step.name] = status
+                self.report.append((step.name, status, run_time))
+            pending = [s for s in pending if s.name not in statuses]
+        self.files_hashes.save()
+        self.save_report()
+        return {name: status in (STEP_RUN, STEP_CACHED) for name, status in statuses.items()}
+
+    def save_report(self):
+        report_fname = op.join(self.cache_fol, 'pipeline_report.csv')
+        with open(report_fname, 'w') as f:
+            f.write('step,status,time\n')
+            for name, status, run_time in self.report:
+                f.write('{},{},{:.2f}\n'.format(name, status, run_time))
+        print('{:<45} {:>8} {:>10}'.format('step', 'status', 'time (s)'))
+        for name, status, run_time in self.report:
+            print('{:<45} {:>8} {:>10.2f}'.format(name, status, run_time))
+        print('The pipeline report was saved to {}'.format(report_fname))
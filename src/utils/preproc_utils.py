@@ -1,12 +1,13 @@
 import os
 import os.path as op
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import glob
 import traceback
 import shutil
 import collections
 import logging
 import re
+import time
 
 from src.utils import utils
 from src.utils import args_utils as au
@@ -48,14 +49,72 @@ def init_args(args):
     return args
 
 
-def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
-    if subjects_itr is None:
-        subjects_itr = args.subject
-    subjects_flags, subjects_errors = {}, {}
-    args = init_args(args)
-    subject = ''
-    for tup in subjects_itr:
-        subject = get_subject(tup, subject_func)
+class TimedFlags(dict):
+    # Records the time of every step (the time since the previous flag was set), for the subjects' summary table
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.steps_times = OrderedDict()
+        self.last_time = time.time()
+
+    def __setitem__(self, key, val):
+        now = time.time()
+        self.steps_times[key] = self.steps_times.get(key, 0) + now - self.last_time
+        self.last_time = now
+        dict.__setitem__(self, key, val)
+
+
+def get_memory_gb():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024.0 ** 3
+    except:
+        return 0
+
+
+def calc_subjects_budget(args, subjects_num):
+    # Splits the CPU budget (n_jobs) between the concurrent subjects and their inner n_jobs. The number of
+    # concurrent subjects is also limited by the memory budget (memory_budget_gb, default 80% of the RAM) divided
+    # by the memory of a single subject (subject_memory_gb, 0 for no limit)
+    subjects_n_jobs = max(min(args.get('subjects_n_jobs', 1), subjects_num, args.n_jobs), 1)
+    subject_memory_gb = args.get('subject_memory_gb', 0)
+    if subject_memory_gb > 0:
+        memory_budget_gb = args.get('memory_budget_gb', 0)
+        if memory_budget_gb <= 0:
+            memory_budget_gb = get_memory_gb() * 0.8
+        if memory_budget_gb > 0:
+            subjects_n_jobs = max(min(subjects_n_jobs, int(memory_budget_gb // subject_memory_gb)), 1)
+    inner_n_jobs = max(args.n_jobs // subjects_n_jobs, 1)
+    return subjects_n_jobs, inner_n_jobs
+
+
+def get_tup_key(tup):
+    # The key of a subject's tup (like (subject, inverse_method)), for its flags, errors, times and log
+    return '{}'.format(tup)
+
+
+def get_subject_log_fname(subject, main_func, key=''):
+    logs_fol = utils.make_dir(op.join(MMVT_DIR, subject, 'logs'))
+    log_name = utils.namebase(main_func.__code__.co_filename)
+    if key != '' and key != subject:
+        log_name = '{}_{}'.format(log_name, re.sub(r'[^\w\-]+', '_', key).strip('_'))
+    return op.join(logs_fol, '{}.log'.format(log_name))
+
+
+def get_subjects_status_fname(main_func):
+    return op.join(utils.get_logs_fol(), 'subjects_status_{}.pkl'.format(
+        utils.namebase(main_func.__code__.co_filename)))
+
+
+def run_subject(tup, subject, args, main_func, interactive=True, log_fname=''):
+    # Returns flags, steps_times, error, wall time. If log_fname isn't empty, the subject's output is written there
+    import sys
+    now = time.time()
+    timed_flags, error = TimedFlags(), ''
+    flags = timed_flags
+    stdout, stderr, log_file = sys.stdout, sys.stderr, None
+    if log_fname != '':
+        log_file = open(log_fname, 'a', buffering=1)
+        sys.stdout = sys.stderr = log_file
+    try:
         utils.make_dir(op.join(MMVT_DIR, subject, 'mmvt'))
         remote_subject_dir = utils.build_remote_subject_dir(args.remote_subject_dir, subject)
         if remote_subject_dir == '':
@@ -66,29 +125,136 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
         print('remote dir: {}'.format(remote_subject_dir))
         print('****************************************************************')
         os.environ['SUBJECT'] = subject
-        flags = dict()
+        # if utils.should_run(args, 'prepare_subject_folder'):
+        # I think we always want to run this
+        # *) Prepare the local subject's folder
+        flags['prepare_subject_folder'] = prepare_subject_folder(
+            subject, remote_subject_dir, args)
+        if not flags['prepare_subject_folder'] and not args.ignore_missing:
+            ans = input('Do you wish to continue (y/n)? ') if interactive else 'n'
+            if not au.is_true(ans):
+                return None, timed_flags.steps_times, '', time.time() - now
+        flags['prepare_subject_folder'] = True
+        ret_flags = main_func(tup, remote_subject_dir, args, flags)
+        flags = dict(ret_flags) if ret_flags is not None else dict(flags)
+    except:
+        error = traceback.format_exc()
+        print('Error in subject {}'.format(subject))
+        print(error)
+    finally:
+        if log_file is not None:
+            sys.stdout, sys.stderr = stdout, stderr
+            log_file.close()
+    return dict(flags), timed_flags.steps_times, error, time.time() - now
+
+
+def _run_subject_process(results_queue, tup, subject, args, main_func, log_fname):
+    results_queue.put((get_tup_key(tup), run_subject(tup, subject, utils.Bag(args), main_func, False, log_fname)))
+
+
+def run_subjects_parallel(subjects_tups, args, main_func, subjects_n_jobs):
+    # Every tup runs in a new process, with fresh modules' globals. The processes aren't daemonic (unlike a
+    # multiprocessing.Pool's workers), so the subjects can run their own pools with the inner n_jobs.
+    # At most subjects_n_jobs tups run at once, and the tups of the same subject run one after the other, as they
+    # write to the same files. Returns [(key, run_subject's results)], in the order of subjects_tups
+    import multiprocessing
+    import queue
+    results_queue = multiprocessing.Queue()
+    pending, running, results = list(subjects_tups), {}, {}
+
+    def read_results(timeout=None):
         try:
-            # if utils.should_run(args, 'prepare_subject_folder'):
-            # I think we always want to run this
-            # *) Prepare the local subject's folder
-            flags['prepare_subject_folder'] = prepare_subject_folder(
-                subject, remote_subject_dir, args)
-            if not flags['prepare_subject_folder'] and not args.ignore_missing:
-                ans = input('Do you wish to continue (y/n)? ')
-                if not au.is_true(ans):
-                    continue
-            flags['prepare_subject_folder'] = True
-
-            flags = main_func(tup, remote_subject_dir, args, flags)
-            subjects_flags[subject] = flags
-        except:
-            subjects_errors[subject] = traceback.format_exc()
-            print('Error in subject {}'.format(subject))
-            print(traceback.format_exc())
+            while True:
+                key, result = results_queue.get(timeout=timeout) if timeout else results_queue.get_nowait()
+                results[key] = result
+                running.pop(key)[1].join()
+                timeout = None
+        except queue.Empty:
+            pass
+
+    while len(pending) > 0 or len(running) > 0:
+        running_subjects = set(sub for sub, _ in running.values())
+        for sub, tup in list(pending):
+            if len(running) >= subjects_n_jobs:
+                break
+            if sub in running_subjects:
+                continue
+            key = get_tup_key(tup)
+            process = multiprocessing.Process(target=_run_subject_process, args=(
+                results_queue, tup, sub, dict(args), main_func, get_subject_log_fname(sub, main_func, key)))
+            process.start()
+            running[key] = (sub, process)
+            running_subjects.add(sub)
+            pending.remove((sub, tup))
+        read_results(timeout=1)
+        # A process that was terminated without putting its results (the results are flushed before exiting)
+        dead_keys = [key for key, (_, process) in running.items() if not process.is_alive()]
+        if len(dead_keys) > 0:
+            read_results()
+            for key in [key for key in dead_keys if key in running]:
+                sub, process = running.pop(key)
+                process.join()
+                results[key] = (None, {}, 'The process of {} exited with code {}'.format(key, process.exitcode), 0)
+    return [(get_tup_key(tup), results[get_tup_key(tup)]) for _, tup in subjects_tups]
+
+
+def is_subject_good(flags, error):
+    return error == '' and flags is not None and all(flags.values())
+
 
-    if subject == '':
+def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
+    if subjects_itr is None:
+        subjects_itr = args.subject
+    subjects_flags, subjects_errors = {}, {}
+    args = init_args(args)
+    subjects_tups = [(get_subject(tup, subject_func), tup) for tup in subjects_itr]
+    if len(subjects_tups) == 0:
         print('No subjects were found!')
         return False
+    subject = subjects_tups[-1][0]
+    subjects_keys = [get_tup_key(tup) for _, tup in subjects_tups]
+    status_fname = get_subjects_status_fname(main_func)
+    if args.get('resume', False) and op.isfile(status_fname):
+        # Skips the subjects that were already finished without errors
+        prev_subjects_flags, prev_subjects_errors = utils.load(status_fname)
+        done = [key for key in subjects_keys if key in prev_subjects_flags and
+                is_subject_good(prev_subjects_flags[key], prev_subjects_errors.get(key, ''))]
+        print('Resume: skipping {} finished subjects'.format(len(done)))
+        subjects_tups = [(sub, tup) for (sub, tup), key in zip(subjects_tups, subjects_keys) if key not in done]
+    run_subjects_tups = subjects_tups
+    # The tups of the same subject don't run at once
+    subjects_n_jobs, inner_n_jobs = calc_subjects_budget(args, len(set(sub for sub, _ in subjects_tups)))
+    if subjects_n_jobs > 1:
+        print('Running {} subjects in parallel, with n_jobs={} each'.format(subjects_n_jobs, inner_n_jobs))
+        args.n_jobs = inner_n_jobs
+    # Everything is kept per tup, as there can be a few tups per subject (like meg's inverse methods)
+    keys_subjects = {get_tup_key(tup): sub for sub, tup in subjects_tups}
+    subjects_times, subjects_steps_times = {}, {}
+    for run_ind in range(args.get('subjects_retries', 0) + 1):
+        if run_ind > 0:
+            subjects_tups = [(sub, tup) for sub, tup in subjects_tups if not is_subject_good(
+                subjects_flags.get(get_tup_key(tup), {}), subjects_errors.get(get_tup_key(tup), ''))]
+            if len(subjects_tups) == 0:
+                break
+            print('Retrying {} subjects: {}'.format(
+                len(subjects_tups), [get_tup_key(tup) for _, tup in subjects_tups]))
+        if subjects_n_jobs == 1:
+            results = [(get_tup_key(tup), run_subject(tup, sub, args, main_func)) for sub, tup in subjects_tups]
+        else:
+            results = run_subjects_parallel(subjects_tups, args, main_func, subjects_n_jobs)
+        for key, (flags, steps_times, error, wall_time) in results:
+            subjects_times[key], subjects_steps_times[key] = wall_time, steps_times
+            subjects_errors.pop(key, None)
+            if flags is not None:
+                subjects_flags[key] = flags
+            if error != '':
+                subjects_errors[key] = error
+                if subjects_n_jobs > 1:
+                    print('Error in subject {} (see {})'.format(
+                        key, get_subject_log_fname(keys_subjects[key], main_func, key)))
+    save_subjects_status(status_fname, run_subjects_tups, subjects_flags, subjects_errors)
+    print_subjects_times(subjects_times, subjects_steps_times)
+
     errors = defaultdict(list)
     ret = True
     good_subjects, bad_subjects = [], []
@@ -102,6 +268,8 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
             logging.info('{}: {}'.format(flag_type, val))
             if not val:
                 errors[subject].append(flag_type)
+    for subject in subjects_errors.keys():
+        errors[subject].append('exception')
     if len(errors) > 0:
         ret = False
         print('Errors:')
@@ -123,6 +291,33 @@ def run_on_subjects(args, main_func, subjects_itr=None, subject_func=None):
     return ret
 
 
+def save_subjects_status(status_fname, subjects_tups, subjects_flags, subjects_errors):
+    # The flags and errors per subject's tup (the status of the previous runs is kept), for --resume
+    prev_subjects_flags, prev_subjects_errors = utils.load(status_fname) if op.isfile(status_fname) else ({}, {})
+    for key in [get_tup_key(tup) for _, tup in subjects_tups]:
+        prev_subjects_errors.pop(key, None)
+        if key in subjects_flags:
+            prev_subjects_flags[key] = subjects_flags[key]
+        if key in subjects_errors:
+            prev_subjects_errors[key] = subjects_errors[key]
+    utils.save((prev_subjects_flags, prev_subjects_errors), status_fname)
+
+
+def print_subjects_times(subjects_times, subjects_steps_times):
+    steps = list(OrderedDict.fromkeys(
+        step for steps_times in subjects_steps_times.values() for step in steps_times.keys()))
+    lines = [['subject', 'total'] + steps]
+    for subject, wall_time in subjects_times.items():
+        lines.append([subject, '{:.1f}'.format(wall_time)] + [
+            '{:.1f}'.format(subjects_steps_times[subject][step]) if step in subjects_steps_times[subject] else '-'
+            for step in steps])
+    widths = [max(len(line[ind]) for line in lines) for ind in range(len(lines[0]))]
+    print('Wall time (s) per subject and step:')
+    for line in lines:
+        print('  '.join(val.rjust(width) for val, width in zip(line, widths)))
+    utils.write_list_to_file([','.join(line) for line in lines], op.join(utils.get_logs_fol(), 'subjects_times.csv'))
+
+
 def set_default_args(args, ini_name='default_args.ini'):
     settings = utils.read_config_ini(MMVT_DIR, ini_name)
     if settings is not None:
@@ -173,6 +368,13 @@ def add_common_args(parser):
     parser.add_argument('-f', '--function', help='function name', required=False, default='all', type=au.str_arr_type)
     parser.add_argument('--exclude', help='functions not to run', required=False, default='', type=au.str_arr_type)
     parser.add_argument('--n_jobs', help='cpu num', required=False, default=-1)
+    parser.add_argument('--subjects_n_jobs', help='subjects to run in parallel (out of n_jobs)', required=False,
+                        default=1, type=int)
+    parser.add_argument('--memory_budget_gb', help='0 for 80%% of the RAM', required=False, default=0, type=float)
+    parser.add_argument('--subject_memory_gb', help='0 for no limit', required=False, default=0, type=float)
+    parser.add_argument('--subjects_retries', help='', required=False, default=0, type=int)
+    parser.add_argument('--resume', help='skip the subjects that were finished', required=False, default=0,
+                        type=au.is_true)
 
     # Prepare subject dir
     parser.add_argument('--necessary_files', help='necessary_files', required=False, default='')
@@ -0,0 +1,130 @@
+import os.path as op
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse
+from scipy.spatial import cKDTree
+
+from src.utils import utils
+
+# Projection of volume values (pts, vals) onto surface vertices, by the k nearest points of each vertex.
+# The geometry doesn't change between contrasts, so for each (points set, vertices set) the nearest points are
+# calculated once, in bounded-memory chunks in a threads pool, and cached:
+#   {cache_fol}/points_tree_{pts_hash}.pkl                    the points' KD-tree
+#   {cache_fol}/projection_{pts_hash}_{verts_hash}_{k}.npz    the nearest points of each vertex (inds, dists)
+# The 'dist' projection is linear, and cached as a sparse (vertices x points) matrix, so projecting a contrast
+# is one sparse matmul. The 'max' projection takes the nearest point's value with the maximal abs value.
+# In memory, the last PROJECTIONS_CACHE_SIZE projections are kept (LRU).
+
+PROJECTION_METHODS = ('max', 'dist')
+QUERY_CHUNK_MB = 64
+PROJECTIONS_CACHE_SIZE = 4
+
+_projections, _projections_lock = OrderedDict(), threading.Lock()
+
+
+def calc_points_hash(pts):
+    pts = np.ascontiguousarray(pts, dtype=np.float64)
+    return hashlib.md5(pts.tobytes() + str(pts.shape).encode()).hexdigest()
+
+
+def get_points_tree(pts, cache_fol=''):
+    tree_fname = op.join(cache_fol, 'points_tree_{}.pkl'.format(calc_points_hash(pts))) if cache_fol != '' else ''
+    if tree_fname != '' and op.isfile(tree_fname):
+        return utils.load(tree_fname)
+    tree = cKDTree(np.asarray(pts, dtype=np.float64))
+    if tree_fname != '':
+        utils.save(tree, tree_fname)
+    return tree
+
+
+def query_nearest_points(tree, verts, k_points=100, n_jobs=1, chunk_mb=QUERY_CHUNK_MB):
+    # The k nearest points of each vertex, (V x k) dists (float32) and inds (int32), in vertices chunks
+    from multiprocessing.pool import ThreadPool
+    verts = np.asarray(verts, dtype=np.float64)
+    V, k_points = len(verts), min(k_points, tree.n)
+    dists, inds = np.empty((V, k_points), dtype=np.float32), np.empty((V, k_points), dtype=np.int32)
+    chunk_len = max(1, int(chunk_mb * 1024 ** 2) // (k_points * 16))
+    chunks = [(v_from, min(v_from + chunk_len, V)) for v_from in range(0, V, chunk_len)]
+
+    def query_chunk(chunk):
+        v_from, v_to = chunk
+        chunk_dists, chunk_inds = tree.query(verts[v_from:v_to], k=k_points)
+        dists[v_from:v_to] = chunk_dists.reshape((v_to - v_from, k_points))
+        inds[v_from:v_to] = chunk_inds.reshape((v_to - v_from, k_points))
+
+    pool = ThreadPool(max(n_jobs, 1))
+    pool.map(query_chunk, chunks)
+    pool.close()
+    return dists, inds
+
+
+class SurfaceProjection(object):
+    def __init__(self, verts, pts, k_points=100, cache_fol='', n_jobs=1, chunk_mb=QUERY_CHUNK_MB):
+        self.points_num, self.vertices_num = len(pts), len(verts)
+        self.chunk_mb = chunk_mb
+        if cache_fol != '':
+            utils.make_dir(cache_fol)
+        cache_fname = op.join(cache_fol, 'projection_{}_{}_{}.npz'.format(
+            calc_points_hash(pts), calc_points_hash(verts), k_points)) if cache_fol != '' else ''
+        if cache_fname != '' and op.isfile(cache_fname):
+            d = np.load(cache_fname)
+            self.dists, self.inds = d['dists'], d['inds']
+        else:
+            tree = get_points_tree(pts, cache_fol)
+            self.dists, self.inds = query_nearest_points(tree, verts, k_points, n_jobs, chunk_mb)
+            if cache_fname != '':
+                np.savez(cache_fname, dists=self.dists, inds=self.inds)
+        self._dist_matrix = None
+
+    @property
+    def coverage(self):
+        # The ratio of the points that are near (in the k nearest points of) at least one vertex
+        return len(np.unique(self.inds)) / float(self.points_num)
+
+    @property
+    def dist_matrix(self):
+        # The (vertices x points) 'dist' projection: 1 / dist ** 2 weights, normalized per vertex
+        if self._dist_matrix is None:
+            weights = 1 / (self.dists.astype(np.float64) ** 2)
+            weights /= np.sum(weights, 1, keepdims=True)
+            k_points = self.inds.shape[1]
+            self._dist_matrix = scipy.sparse.csr_matrix(
+                (weights.ravel(), self.inds.ravel(), np.arange(0, self.vertices_num * k_points + 1, k_points)),
+                shape=(self.vertices_num, self.points_num))
+        return self._dist_matrix
+
+    def project(self, vals, method='max'):
+        # vals: The points' values (points, ) or (points x T). Returns (vertices, ) or (vertices x T)
+        if method not in PROJECTION_METHODS:
+            raise Exception('SurfaceProjection: method should be one of {}'.format(PROJECTION_METHODS))
+        vals = np.asarray(vals)
+        if method == 'dist':
+            return self.dist_matrix.dot(vals)
+        verts_vals = np.empty((self.vertices_num, ) + vals.shape[1:], dtype=vals.dtype)
+        chunk_len = max(1, int(self.chunk_mb * 1024 ** 2) // (self.inds.shape[1] * vals[:1].nbytes))
+        for v_from in range(0, self.vertices_num, chunk_len):
+            v_to = min(v_from + chunk_len, self.vertices_num)
+            near_vals = vals[self.inds[v_from:v_to]]
+            max_inds = np.expand_dims(np.argmax(np.abs(near_vals), 1), 1)
+            verts_vals[v_from:v_to] = np.take_along_axis(near_vals, max_inds, 1)[:, 0]
+        return verts_vals
+
+
+def get_surface_projection(verts, pts, k_points=100, cache_fol='', n_jobs=1):
+    # The (cached in memory) projection of the points onto the vertices
+    key = (calc_points_hash(pts), calc_points_hash(verts), k_points, cache_fol)
+    with _projections_lock:
+        if key in _projections:
+            _projections.move_to_end(key)
+        else:
+            _projections[key] = SurfaceProjection(verts, pts, k_points, cache_fol, n_jobs)
+            while len(_projections) > PROJECTIONS_CACHE_SIZE:
+                _projections.popitem(last=False)
+        return _projections[key]
+
+
+def clear_projections():
+    with _projections_lock:
+        _projections.clear()
@@ -38,6 +38,7 @@ except:
     pass
 
 from src.mmvt_addon import mmvt_utils as mu
+from src.mmvt_addon import colors_utils as cu
 # links to mmvt_utils
 Bag = mu.Bag
 make_dir = mu.make_dir
@@ -78,6 +79,11 @@ change_fname_extension = mu.change_fname_extension
 copy_file = mu.copy_file
 namebase = mu.namebase
 check_if_atlas_exist = mu.check_if_atlas_exist
+faces_verts_csr_fname = mu.faces_verts_csr_fname
+faces_verts_exist = mu.faces_verts_exist
+load_faces_verts_lookup = mu.load_faces_verts_lookup
+read_ply_header = mu.read_ply_header
+migrate_ascii_ply_files = mu.migrate_ascii_ply_files
 
 from src.mmvt_addon.scripts import scripts_utils as su
 get_link_dir = su.get_link_dir
@@ -133,7 +139,8 @@ def get_scalar_map(x_min, x_max, color_map='jet'):
 def arr_to_colors(x, x_min=None, x_max=None, colors_map='jet', scalar_map=None, norm_percs=(1, 99)):
     if scalar_map is None:
         x_min, x_max = calc_min_max(x, x_min, x_max, norm_percs)
-        scalar_map = get_scalar_map(x_min, x_max, colors_map)
+        # Cached colormap LUT, same bins as matplotlib's ScalarMappable.to_rgba
+        return cu.calc_colors_from_lut(x, colors_map, x_min, x_max, rounding='floor')
     return scalar_map.to_rgba(x)
 
 
@@ -155,10 +162,13 @@ def mat_to_colors(x, x_min=None, x_max=None, colorsMap='jet', scalar_map=None, f
 def arr_to_colors_two_colors_maps(x, x_min=None, x_max=None, cm_big='YlOrRd', cm_small='PuBu', threshold=0, default_val=0,
                                   scalar_map_big=None, scalar_map_small=None, flip_cm_big=False, flip_cm_small=False,
                                   norm_percs=(3, 97), norm_by_percentile=True):
-    colors = np.ones((len(x), 3)) * default_val
     norm_percs = norm_percs if norm_by_percentile else None
     x_min, x_max = calc_min_max(x, x_min, x_max, norm_percs)
+    if scalar_map_big is None and scalar_map_small is None:
+        return cu.calc_two_colormaps_colors(
+            x, x_min, x_max, cm_big, cm_small, threshold, default_val, flip_cm_big, flip_cm_small)
 
+    colors = np.ones((len(x), 3)) * default_val
     if np.sum(x >= threshold) > 0:
         if not flip_cm_big:
             big_colors = arr_to_colors(x[x >= threshold], threshold, x_max, cm_big, scalar_map_big)[:, :3]
@@ -219,20 +229,13 @@ def read_srf_file(srf_file):
     return verts, faces, verts_num, faces_num
 
 
-def read_ply_file(ply_file, npz_fname=''):
+def read_ply_file(ply_file, npz_fname='', migrate=False):
     if file_type(ply_file) == '':
         ply_file = '{}.ply'.format(ply_file)
     npz_file = change_fname_extension(ply_file, 'npz')
     if file_type(ply_file) == 'ply' and not op.isfile(npz_file):
         # print('Reading {}'.format(ply_file))
-        with open(ply_file, 'r') as f:
-            lines = f.readlines()
-            verts_num = int(lines[2].split(' ')[-1])
-            faces_num = int(lines[6].split(' ')[-1])
-            verts_lines = lines[9:9 + verts_num]
-            faces_lines = lines[9 + verts_num:]
-            verts = np.array([list(map(float, l.strip().split(' '))) for l in verts_lines])
-            faces = np.array([list(map(int, l.strip().split(' '))) for l in faces_lines])[:,1:]
+        verts, faces = mu.read_ply_file(ply_file, migrate)
     elif file_type(ply_file) == 'npz' or op.isfile(npz_file):
         # print('Reading {}'.format(npz_file))
         d = np.load(npz_file)
@@ -276,17 +279,9 @@ def read_pial(subject, mmvt_dir, hemi, surface_type='pial'):
     return verts, faces
 
 
-def write_ply_file(verts, faces, ply_file_name, write_also_npz=False):
+def write_ply_file(verts, faces, ply_file_name, write_also_npz=False, binary=True):
     try:
-        verts_num = verts.shape[0]
-        faces_num = faces.shape[0]
-        faces = faces.astype(np.int)
-        faces_for_ply = np.hstack((np.ones((faces_num, 1)) * faces.shape[1], faces))
-        with open(ply_file_name, 'w') as f:
-            f.write(PLY_HEADER.format(verts_num, faces_num))
-        with open(ply_file_name, 'ab') as f:
-            np.savetxt(f, verts, fmt='%.5f', delimiter=' ')
-            np.savetxt(f, faces_for_ply, fmt='%d', delimiter=' ')
+        mu.write_ply_file(verts, faces, ply_file_name, binary)
         if write_also_npz:
             np.savez('{}.npz'.format(op.splitext(ply_file_name)[0]), verts=verts, faces=faces)
         return True
@@ -338,31 +333,33 @@ def get_ply_vertices_num(ply_file_template):
 
 
 def calc_ply_faces_verts(verts, faces, out_file, overwrite=False, ply_name='', errors={}, verbose=False):
-    if not overwrite and op.isfile(out_file):
+    # Writes the vertices->loops lookup in a CSR format (see mu.VertsLoopsLookup) next to out_file:
+    # One int32 array: [verts_num, indptr (verts_num + 1), indices]
+    csr_out_file = faces_verts_csr_fname(out_file)
+    if not overwrite and op.isfile(csr_out_file):
         if verbose:
-            print('{} already exist.'.format(out_file))
+            print('{} already exist.'.format(csr_out_file))
     else:
-        _faces = faces.ravel()
+        _faces = faces.ravel().astype(np.int64)
+        verts_num = verts.shape[0]
         if verbose:
             print('{}: verts: {}, faces: {}, faces ravel: {}'.format(
-                ply_name, verts.shape[0], faces.shape[0], len(_faces)))
-        faces_arg_sort = np.argsort(_faces)
-        faces_sort = np.sort(_faces)
-        faces_count = Counter(faces_sort)
-        max_len = max([v for v in faces_count.values()])
-        print(ply_name, verts.shape[0], max_len)
-        lookup = np.ones((verts.shape[0], max_len)) * -1
-        diff = np.diff(faces_sort)
-        n = 0
-        for ind, (k, v) in enumerate(zip(faces_sort, faces_arg_sort)):
-            lookup[k, n] = v
-            n = 0 if ind < len(diff) and diff[ind] > 0 else n+1
-        np.save(out_file, lookup.astype(np.int))
+                ply_name, verts_num, faces.shape[0], len(_faces)))
+        if len(_faces) > 0 and (_faces.min() < 0 or _faces.max() >= verts_num):
+            errors[ply_name] = 'Wrong values in faces! ' + \
+                'verts num: {}, faces values range: {}-{}'.format(verts_num, _faces.min(), _faces.max())
+            return errors
+        # The loops indices are the faces ravel indices, sorted by their vertices
+        indices = np.argsort(_faces, kind='mergesort')
+        indptr = np.zeros(verts_num + 1, dtype=np.int64)
+        np.cumsum(np.bincount(_faces, minlength=verts_num), out=indptr[1:])
+        if indptr[-1] > np.iinfo(np.int32).max:
+            errors[ply_name] = 'Too many loops for an int32 lookup ({})!'.format(indptr[-1])
+            return errors
+        csr = np.concatenate(([verts_num], indptr, indices)).astype(np.int32)
+        np.save(csr_out_file, csr)
         if verbose:
-            print('{} max lookup val: {}'.format(ply_name, int(np.max(lookup))))
-        if len(_faces) != int(np.max(lookup)) + 1:
-            errors[ply_name] = 'Wrong values in lookup table! ' + \
-                'faces ravel: {}, max looup val: {}'.format(len(_faces), int(np.max(lookup)))
+            print('{} max valence: {}'.format(ply_name, np.max(np.diff(indptr)) if verts_num > 0 else 0))
     return errors
 
 